@@ -0,0 +1,262 @@
+"""
+Производительность этапов ETL из src/make_metrics на синтетической выгрузке Метрики:
+время, строк в секунду и пиковая память (RSS) каждого этапа. Каждый этап запускается
+в отдельном процессе, поэтому пиковая память не смешивается между этапами.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_etl --visits 1000000 --save-baseline benchmarks/baselines/etl_1m.json
+    python -m benchmarks.bench_etl --visits 1000000 --baseline benchmarks/baselines/etl_1m.json
+
+С --baseline этапы, ставшие медленнее или тяжелее больше чем на --tolerance, помечаются
+как REGRESSION, и процесс завершается с кодом 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import UTC, datetime
+from pathlib import Path
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from benchmarks.generate_metrika_data import VERSION_YEARS, generate_dataset
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ETL_DIR = Path(__file__).resolve().parent.parent / "src" / "make_metrics"
+
+VERSIONS = list(VERSION_YEARS)
+
+
+def _peak_rss_mb() -> float | None:
+    """
+    Пиковый RSS текущего процесса. В Linux берем VmHWM из /proc: ru_maxrss переживает exec
+    и у дочернего процесса показывал бы пик родителя (генератора данных)
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss в macOS — в байтах, в остальных системах — в КБ
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _stage_advanced_metrics():
+    import etl_with_url
+    for version in VERSIONS:
+        etl_with_url.compute_advanced_metrics(version)
+
+
+def _stage_url_metrics():
+    import etl_with_url
+    for version in VERSIONS:
+        etl_with_url.compute_url_metrics(version, top_n=200).write_parquet(
+            etl_with_url.OUTPUT_DIR / f"url_metrics_{version}.parquet"
+        )
+
+
+def _stage_url_daily():
+    import etl_with_url
+    for version in VERSIONS:
+        etl_with_url.compute_url_daily_series(version).write_parquet(
+            etl_with_url.OUTPUT_DIR / f"url_daily_{version}.parquet"
+        )
+
+
+def _stage_url_alignment():
+    import url_alignment
+    daily = [pl.read_parquet(url_alignment.OUTPUT_DIR / f"url_daily_{version}.parquet") for version in VERSIONS]
+    url_alignment.align_daily_series(*daily).write_parquet(url_alignment.OUTPUT_DIR / url_alignment.ALIGNMENT_FILE)
+
+
+def _stage_anomalies():
+    import anomaly_detection
+    daily = [pl.read_parquet(anomaly_detection.OUTPUT_DIR / f"url_daily_{version}.parquet") for version in VERSIONS]
+    alignment = pl.read_parquet(anomaly_detection.OUTPUT_DIR / anomaly_detection.ALIGNMENT_FILE)
+    anomaly_detection.find_anomalies(*daily, alignment=alignment)
+
+
+def _stage_goal_metrics():
+    import etl_with_goals
+    for version in VERSIONS:
+        etl_with_goals.compute_advanced_metrics(version)
+
+
+def _stage_client_index():
+    import client_index
+    client_index.build_client_index(VERSIONS).save()
+
+
+def _stage_dedup():
+    import sources
+    for version in VERSIONS:
+        for kind in sources.DEDUP_KEYS:
+            sources.duplicate_rows(kind, version)
+
+
+def _stage_metrics_cube():
+    import metrics_cube
+    metrics_cube.write_metrics_cube(metrics_cube.build_metrics_cube(VERSIONS))
+
+
+# порядок важен: url_alignment и anomalies читают ряды, записанные url_daily
+STAGE_DEPENDENCIES = {"url_alignment": ["url_daily"], "anomalies": ["url_daily", "url_alignment"]}
+
+STAGES = {
+    "advanced_metrics": _stage_advanced_metrics,
+    "url_metrics": _stage_url_metrics,
+    "url_daily": _stage_url_daily,
+    "url_alignment": _stage_url_alignment,
+    "anomalies": _stage_anomalies,
+    "goal_metrics": _stage_goal_metrics,
+    "metrics_cube": _stage_metrics_cube,
+    "client_index": _stage_client_index,
+    "dedup": _stage_dedup,
+}
+
+
+def _run_stage(name: str, workdir: str) -> dict:
+    """Выполняется в отдельном процессе: ETL работает с относительными data/raw и data/metrics"""
+    os.chdir(workdir)
+    sys.path.insert(0, str(ETL_DIR))
+
+    rss_before = _peak_rss_mb()
+    t0 = time.perf_counter()
+    # печать прогресса ETL не нужна в отчете бенчмарка
+    with contextlib.redirect_stdout(io.StringIO()):
+        STAGES[name]()
+    wall = time.perf_counter() - t0
+
+    return {"wall_s": wall, "peak_rss_mb": _peak_rss_mb(), "start_rss_mb": rss_before}
+
+
+def count_input_rows(raw_dir: Path) -> int:
+    """Визиты + хиты обеих версий — по метаданным parquet, без чтения данных"""
+    return sum(pq.ParquetFile(path).metadata.num_rows for path in raw_dir.glob("*_yandex_metrika_*.parquet"))
+
+
+def run_benchmark(workdir: Path, stages: list[str], repeat: int = 1) -> dict:
+    """
+    Все этапы по порядку, каждый repeat раз в свежем процессе (spawn).
+    Время — минимум по повторам, память — максимум
+    """
+    rows = count_input_rows(workdir / "data" / "raw")
+    (workdir / "data" / "metrics").mkdir(parents=True, exist_ok=True)
+    ctx = multiprocessing.get_context("spawn")
+
+    results = {}
+    for name in stages:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                runs.append(pool.submit(_run_stage, name, str(workdir)).result())
+        wall = min(r["wall_s"] for r in runs)
+        peaks = [r["peak_rss_mb"] for r in runs if r["peak_rss_mb"] is not None]
+        results[name] = {
+            "wall_s": round(wall, 3),
+            "rows_per_s": round(rows / wall) if wall else None,
+            "peak_rss_mb": round(max(peaks), 1) if peaks else None,
+            "start_rss_mb": round(runs[0]["start_rss_mb"], 1) if runs[0]["start_rss_mb"] is not None else None,
+        }
+        print(_format_row(name, results[name]))
+
+    return {
+        "created_at": datetime.now(UTC).isoformat(),
+        "input_rows": rows,
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "stages": results,
+    }
+
+
+def _format_row(name: str, stage: dict) -> str:
+    rss = f"{stage['peak_rss_mb']:.0f}" if stage["peak_rss_mb"] is not None else "n/a"
+    return f"{name:>18} {stage['wall_s']:>9.2f} {stage['rows_per_s'] or 0:>12,} {rss:>12}"
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Этапы, у которых время или пиковая память выросли больше чем на tolerance относительно baseline.
+    Сравнение осмысленно только на том же размере данных и той же машине — об этом предупреждаем
+    """
+    if baseline.get("input_rows") != report["input_rows"]:
+        print(f"Warning: baseline was recorded on {baseline.get('input_rows'):,} rows, current run has {report['input_rows']:,}")
+
+    regressions = []
+    for name, stage in report["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            continue
+        for field in ("wall_s", "peak_rss_mb"):
+            if stage.get(field) is None or not base.get(field):
+                continue
+            change = stage[field] / base[field] - 1
+            if change > tolerance:
+                regressions.append(f"{name}.{field}: {base[field]} -> {stage[field]} (+{change:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--visits", type=int, default=100_000, help="визитов на версию для синтетических данных")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="готовая папка с data/raw; по умолчанию данные генерируются во временную папку")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--save-baseline", type=Path, default=None)
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.data_dir or Path(tmp)
+        if args.data_dir is None:
+            print(f"Generating {args.visits:,} visits per version (seed={args.seed})...")
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_dataset(workdir / "data" / "raw", args.visits, args.seed)
+
+        selected = set(args.stages)
+        for name in args.stages:
+            selected.update(STAGE_DEPENDENCIES.get(name, []))
+        stages = [name for name in STAGES if name in selected]
+
+        print(f"{'stage':>18} {'wall_s':>9} {'rows/s':>12} {'peak_rss_mb':>12}")
+        report = run_benchmark(workdir.resolve(), stages, args.repeat)
+
+    if args.save_baseline:
+        args.save_baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.save_baseline.write_text(json.dumps(report, indent=2), encoding="utf8")
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf8"))
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Пропускная способность асинхронных MCP-инструментов в зависимости от числа воркеров.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_mcp_tools --calls 16 --rows 200000 --workers 1 2 4 8
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import mcp_ux_server as server
+
+
+def make_url_metrics_files(directory: Path, n_files: int, rows: int, seed: int = 0) -> list[str]:
+    """N разных файлов в формате url_metrics_v*.parquet — чтобы вызовы не склеивались coalescing-ом"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n_files):
+        df = pd.DataFrame({
+            "url": [f"https://priem.mai.ru/page/{i}/{j}" for j in range(rows)],
+            "page_hits": rng.integers(1, 100_000, rows),
+            "page_visits": rng.integers(1, 50_000, rows),
+            "page_bounces": rng.integers(0, 5_000, rows),
+            "bounce_rate": rng.uniform(0, 100, rows),
+            "avg_pages_per_visit": rng.uniform(1, 10, rows),
+            "version": "v1",
+        })
+        path = directory / f"url_metrics_{i}.parquet"
+        df.to_parquet(path, index=False)
+        paths.append(str(path))
+    return paths
+
+
+async def _loop_lag_monitor(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Максимальная задержка тиков event loop — показывает, блокируют ли инструменты сервер"""
+    max_lag = 0.0
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - t0 - interval)
+    return max_lag
+
+
+async def run_round(paths: list[str]) -> tuple[float, float]:
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(_loop_lag_monitor(stop))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(
+        server._run_offloaded(server._load_parquet_summary_direct, path) for path in paths
+    ))
+    wall = time.perf_counter() - t0
+
+    stop.set()
+    return wall, await monitor
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--kind", choices=["thread", "process"], default="thread")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Generating {args.calls} files x {args.rows:,} rows...")
+        paths = make_url_metrics_files(Path(tmp), args.calls, args.rows)
+
+        base = None
+        print(f"{'workers':>7} {'wall_s':>8} {'calls/s':>8} {'speedup':>8} {'loop_lag_ms':>12}")
+        for workers in args.workers:
+            server.configure_worker_pool(workers, args.kind)
+            wall, lag = asyncio.run(run_round(paths))
+            throughput = args.calls / wall
+            base = base or throughput
+            print(f"{workers:>7} {wall:>8.2f} {throughput:>8.2f} {throughput / base:>8.2f} {lag * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Синтетическая выгрузка Яндекс.Метрики в формате, который читают ETL из src/make_metrics:
+визиты (ym:s:*) и хиты (ym:pv:*) с согласованными watchID, JSON-списками watchIDs/goalsID
+и Zipf-распределением популярности страниц. Генерация детерминирована seed-ом и идет кусками
+по chunk_visits визитов, поэтому память не зависит от итогового размера (от 10k до 100M строк).
+
+Запуск из корня репозитория:
+    python -m benchmarks.generate_metrika_data --visits 1000000 --out /tmp/metrika
+"""
+import argparse
+import calendar
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+SITE = "https://priem.mai.ru"
+OTHER_SITES = ["https://mai.ru", "https://lk.mai.ru"]
+
+# год выгрузки -> имена файлов, как в HITS_FILES / VISITS_FILES у ETL
+VERSION_YEARS = {"v1": 2022, "v2": 2024}
+
+GOAL_IDS = [225392702, 225392711, 225392735, 225392750, 225392768, 225392790]
+
+TRAFFIC_SOURCES = ["organic", "direct", "ad", "referral", "social", "internal"]
+TRAFFIC_SOURCE_P = [0.45, 0.25, 0.12, 0.08, 0.06, 0.04]
+DEVICES = ["desktop", "mobile", "tablet"]
+DEVICE_P = [0.52, 0.44, 0.04]
+
+SECTIONS = ["bachelor", "master", "postgraduate", "olymp", "dormitory", "news", "contacts", "programs"]
+
+UTC_OFFSET_SEC = 3 * 3600
+
+
+class VersionProfile:
+    """Параметры поведения, которыми отличаются версии сайта (v2 — чуть больше отказов и короче визиты)"""
+
+    def __init__(self, bounce_p: float, mean_step_sec: float, goal_p: float):
+        self.bounce_p = bounce_p
+        self.mean_step_sec = mean_step_sec
+        self.goal_p = goal_p
+
+
+PROFILES = {
+    "v1": VersionProfile(bounce_p=0.30, mean_step_sec=55.0, goal_p=0.12),
+    "v2": VersionProfile(bounce_p=0.36, mean_step_sec=48.0, goal_p=0.10),
+}
+
+
+def make_url_catalog(n_urls: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Каталог страниц, индекс — ранг популярности (0 — главная). Небольшая доля — чужие домены
+    и варианты с utm-метками, чтобы фильтр is_priem_url и нормализация URL было на чем проверять
+    """
+    urls = [f"{SITE}/"]
+    for rank in range(1, n_urls):
+        section = SECTIONS[rank % len(SECTIONS)]
+        roll = rng.random()
+        if roll < 0.03:
+            urls.append(f"{OTHER_SITES[rank % len(OTHER_SITES)]}/{section}/{rank}/")
+        elif roll < 0.08:
+            urls.append(f"{SITE}/{section}/{rank}/?utm_source=vk&utm_medium=social")
+        else:
+            urls.append(f"{SITE}/{section}/{rank}/")
+    return np.array(urls, dtype=object)
+
+
+def zipf_ranks(rng: np.random.Generator, size: int, n_urls: int, a: float = 1.2) -> np.ndarray:
+    """Ранги страниц по закону Ципфа, обрезанные до размера каталога"""
+    return np.minimum(rng.zipf(a, size) - 1, n_urls - 1)
+
+
+def _json_id_lists(owner: np.ndarray, ids: np.ndarray, n_owners: int) -> pl.Series:
+    """
+    JSON-списки строковых id по владельцам (как ym:s:watchIDs: ["1","2"]), пустой список — "[]".
+    owner отсортирован по возрастанию
+    """
+    lists = (
+        pl.DataFrame({"owner": owner, "id": ids.astype(str)})
+        .group_by("owner", maintain_order=True)
+        .agg(pl.col("id"))
+    )
+    joined = (
+        pl.DataFrame({"owner": np.arange(n_owners)})
+        .join(lists, on="owner", how="left")
+        .sort("owner")
+        .select(
+            pl.when(pl.col("id").list.len() > 0)
+            .then(pl.lit('["') + pl.col("id").list.join('","') + pl.lit('"]'))
+            .otherwise(pl.lit("[]"))
+        )
+    )
+    return joined.to_series()
+
+
+def generate_chunk(
+    rng: np.random.Generator,
+    urls: np.ndarray,
+    n_visits: int,
+    first_visit_id: int,
+    first_watch_id: int,
+    n_clients: int,
+    period_start: int,
+    period_days: int,
+    profile: VersionProfile,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Один кусок визитов и их хитов. watchID хитов и списки watchIDs визитов совпадают по построению"""
+    n_urls = len(urls)
+
+    # глубина: с вероятностью bounce_p один хит, иначе 2 + геометрическое
+    bounce = rng.random(n_visits) < profile.bounce_p
+    depth = np.where(bounce, 1, 1 + np.minimum(rng.geometric(0.35, n_visits), 60))
+    n_hits = int(depth.sum())
+
+    # по выходным трафик ниже (часть выходных визитов переносится на случайный день), днем выше, чем ночью
+    day = rng.integers(0, period_days, n_visits)
+    weekend = ((period_start // 86_400 + day + 3) % 7) >= 5
+    day = np.where(weekend & (rng.random(n_visits) < 0.35), rng.integers(0, period_days, n_visits), day)
+    second_of_day = np.clip(rng.normal(14.5 * 3600, 4 * 3600, n_visits), 0, 86_399).astype(np.int64)
+    visit_start = period_start + day * 86_400 + second_of_day
+
+    client_id = rng.integers(1, n_clients + 1, n_visits, dtype=np.int64) * 1_000_003 + 17
+    visit_id = np.arange(first_visit_id, first_visit_id + n_visits, dtype=np.int64)
+
+    # хиты: визиты разворачиваются по глубине, шаг внутри визита — экспоненциальное время на странице
+    hit_owner = np.repeat(np.arange(n_visits), depth)
+    first_hit = np.zeros(n_hits, dtype=bool)
+    first_hit[np.concatenate(([0], np.cumsum(depth)[:-1]))] = True
+    step_sec = rng.exponential(profile.mean_step_sec, n_hits).astype(np.int64)
+    step_sec[first_hit] = 0
+    offset = np.cumsum(step_sec)
+    offset -= np.repeat(offset[first_hit], depth)
+    hit_time = visit_start[hit_owner] + offset
+
+    hit_rank = zipf_ranks(rng, n_hits, n_urls)
+    hit_url = urls[hit_rank]
+    watch_id = np.arange(first_watch_id, first_watch_id + n_hits, dtype=np.int64)
+
+    last_hit = np.cumsum(depth) - 1
+    visit_duration = offset[last_hit] + np.where(depth == 1, rng.exponential(20, n_visits), rng.exponential(40, n_visits)).astype(np.int64)
+
+    goal_count = np.where(rng.random(n_visits) < profile.goal_p, rng.integers(1, 3, n_visits), 0)
+    goal_owner = np.repeat(np.arange(n_visits), goal_count)
+    goal_id = np.array(GOAL_IDS, dtype=np.int64)[zipf_ranks(rng, len(goal_owner), len(GOAL_IDS), a=1.6)]
+
+    start_dt = pl.from_epoch(pl.Series(visit_start), time_unit="s")
+    visits = pl.DataFrame({
+        "ym:s:visitID": visit_id,
+        "ym:s:counterID": np.full(n_visits, 24_938_209, dtype=np.int64),
+        "ym:s:clientID": client_id,
+        "ym:s:watchIDs": _json_id_lists(hit_owner, watch_id, n_visits),
+        "ym:s:goalsID": _json_id_lists(goal_owner, goal_id, n_visits),
+        "ym:s:isNewUser": (rng.random(n_visits) < 0.45).astype(np.int64),
+        "ym:s:date": start_dt.dt.strftime("%Y-%m-%d"),
+        "ym:s:dateTime": start_dt.dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "ym:s:dateTimeUTC": (start_dt - timedelta(seconds=UTC_OFFSET_SEC)).dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "ym:s:visitDuration": visit_duration,
+        "ym:s:startURL": hit_url[first_hit],
+        "ym:s:endURL": hit_url[last_hit],
+        "ym:s:lastTrafficSource": rng.choice(TRAFFIC_SOURCES, n_visits, p=TRAFFIC_SOURCE_P),
+        "ym:s:deviceCategory": rng.choice(DEVICES, n_visits, p=DEVICE_P),
+    })
+
+    hits = pl.DataFrame({
+        "ym:pv:watchID": watch_id,
+        "ym:pv:pageViewID": watch_id,
+        "ym:pv:URL": hit_url,
+        "ym:pv:dateTime": pl.from_epoch(pl.Series(hit_time), time_unit="s").dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "ym:pv:clientID": client_id[hit_owner],
+    })
+    return visits, hits
+
+
+def generate_version(
+    out_dir: Path,
+    version: str,
+    n_visits: int,
+    seed: int = 0,
+    n_urls: int = 5_000,
+    period_days: int = 60,
+    chunk_visits: int = 500_000,
+) -> dict:
+    """
+    Пишет <год>_yandex_metrika_visits.parquet и <год>_yandex_metrika_hits.parquet одной версии.
+    Куски дописываются в parquet по мере генерации (по row group на кусок)
+    """
+    year = VERSION_YEARS[version]
+    rng = np.random.default_rng([seed, year])
+    urls = make_url_catalog(n_urls, np.random.default_rng([seed, 0]))
+    period_start = calendar.timegm(datetime(year, 3, 1).timetuple())
+    n_clients = max(1, int(n_visits * 0.6))
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    visits_path = out_dir / f"{year}_yandex_metrika_visits.parquet"
+    hits_path = out_dir / f"{year}_yandex_metrika_hits.parquet"
+
+    visits_writer = hits_writer = None
+    written_visits = written_hits = 0
+    t0 = time.perf_counter()
+    try:
+        while written_visits < n_visits:
+            size = min(chunk_visits, n_visits - written_visits)
+            visits, hits = generate_chunk(
+                rng, urls, size, written_visits, written_hits,
+                n_clients, period_start, period_days, PROFILES[version],
+            )
+            visits_table, hits_table = visits.to_arrow(), hits.to_arrow()
+            if visits_writer is None:
+                visits_writer = pq.ParquetWriter(visits_path, visits_table.schema, compression="zstd")
+                hits_writer = pq.ParquetWriter(hits_path, hits_table.schema, compression="zstd")
+            visits_writer.write_table(visits_table)
+            hits_writer.write_table(hits_table)
+            written_visits += size
+            written_hits += hits.height
+            print(f"  {version}: {written_visits:,} визитов, {written_hits:,} хитов")
+    finally:
+        if visits_writer is not None:
+            visits_writer.close()
+            hits_writer.close()
+
+    return {
+        "version": version,
+        "visits": written_visits,
+        "hits": written_hits,
+        "seconds": round(time.perf_counter() - t0, 2),
+        "visits_file": str(visits_path),
+        "hits_file": str(hits_path),
+    }
+
+
+def generate_dataset(out_dir: Path, n_visits: int, seed: int = 0, n_urls: int = 5_000, **kwargs) -> list[dict]:
+    """Обе версии (2022 и 2024) одного размера в out_dir — это data/raw для ETL"""
+    return [generate_version(out_dir, version, n_visits, seed, n_urls, **kwargs) for version in VERSION_YEARS]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--visits", type=int, default=100_000, help="визитов на версию; хитов примерно в 3 раза больше")
+    parser.add_argument("--out", type=Path, default=Path("data/raw"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--urls", type=int, default=5_000)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--chunk", type=int, default=500_000)
+    args = parser.parse_args()
+
+    for info in generate_dataset(args.out, args.visits, args.seed, args.urls, period_days=args.days, chunk_visits=args.chunk):
+        print(f"{info['version']}: {info['visits']:,} визитов, {info['hits']:,} хитов за {info['seconds']} с")
+
+
+if __name__ == "__main__":
+    main()
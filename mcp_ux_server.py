@@ -1,16 +1,63 @@
+import asyncio
+import base64
+import itertools
 import json
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from util.embeddings import INDEX_DIR, VectorIndex
+from util.run_history import HISTORY_DB, RunHistory
 
 DATA_DIR = Path("./data")
 
+MCP_WORKERS = int(os.environ.get("MCP_WORKERS", "4"))
+MCP_POOL_KIND = os.environ.get("MCP_POOL_KIND", "thread")
 
-def _read_parquet_df(path: str) -> pd.DataFrame:
+ANOMALIES_FILE = "data/metrics/anomalies_v1_v2.parquet"
+GOAL_ANOMALIES_FILE = "data/metrics/goal_anomalies_v1_v2.parquet"
+URL_ALIGNMENT_FILE = "data/metrics/url_alignment_v1_v2.parquet"
+METRICS_CUBE_FILE = "data/metrics/metrics_cube.parquet"
+
+# ряд всего сайта в anomalies_v1_v2.parquet (anomaly_detection.SITE_URL) — не страница
+SITE_URL = "__site__"
+
+# метрика full_metrics -> дневной ряд сайта, по сдвигу которого она считается значимой.
+# Ряды сайта — суммы по страницам сайта из url_daily_*; у остальных метрик рядов нет
+SITE_SERIES_METRICS = {
+    "total_hits": "page_hits",
+    "total_visits": "page_visits",
+    "bounce_rate": "bounce_rate",
+    "user_engagement": "bounce_rate",
+    "deep_visits_rate": "bounce_rate",
+    "pages_per_visit": "avg_visit_depth",
+    "avg_pages": "avg_visit_depth",
+    "session_duration_sec": "avg_duration_sec",
+}
+
+# аддитивные меры куба из src/make_metrics/metrics_cube.py
+CUBE_MEASURES = ["visits", "bounces", "new_visits", "hits", "sum_visit_duration"]
+
+QUERY_DEFAULT_LIMIT = 100
+QUERY_MAX_LIMIT = 1000
+# offset + limit строк держится в памяти (top-k, head), поэтому offset тоже ограничен
+QUERY_MAX_OFFSET = 100_000
+
+EXCEL_GOAL_ID_COLUMN = "Номер цели"
+EXCEL_GOAL_NAME_COLUMN = "Название цели"
+EXCEL_GOAL_DESCRIPTION_COLUMN = "Описание"
+
+
+def _resolve_data_path(path: str) -> Path:
     """
-    Загружает DataFrame из parquet файла.
-    Ищет ТОЛЬКО в папке ./data
+    Путь к файлу данных: пути вида data/... берутся как есть, остальные — относительно ./data
     """
     if path.startswith("data/"):
         p = Path(path)
@@ -19,6 +66,15 @@ def _read_parquet_df(path: str) -> pd.DataFrame:
 
     if not p.exists():
         raise FileNotFoundError(f"File not found: {p}")
+    return p
+
+
+def _read_parquet_df(path: str) -> pd.DataFrame:
+    """
+    Загружает DataFrame из parquet файла.
+    Ищет ТОЛЬКО в папке ./data
+    """
+    p = _resolve_data_path(path)
     return pd.read_parquet(p)
 
 
@@ -26,19 +82,11 @@ def _read_excel_file(path: str) -> str:
     """
     Загружает Excel файл и преобразует в JSON строку
     """
-    if path.startswith("data/"):
-        p = Path(path)
-    else:
-        p = DATA_DIR / path
-
-    if not p.exists():
-        raise FileNotFoundError(f"File not found: {p}")
+    p = _resolve_data_path(path)
 
     excel_data = {}
-    xl = pd.ExcelFile(p)
-    
-    for sheet_name in xl.sheet_names:
-        df = pd.read_excel(p, sheet_name=sheet_name)
+    # sheet_name=None — все листы за одно открытие книги
+    for sheet_name, df in pd.read_excel(p, sheet_name=None).items():
         excel_data[sheet_name] = {
             "columns": df.columns.tolist(),
             "data": df.to_dict('records')
@@ -47,10 +95,99 @@ def _read_excel_file(path: str) -> str:
     return json.dumps(excel_data, ensure_ascii=False, indent=2)
 
 
-def _analyze_full_metrics_data(df: pd.DataFrame) -> dict:
+_goal_catalog_cache: dict[tuple[str, int], pd.DataFrame] = {}
+
+
+def _parse_goal_catalog(p: Path) -> pd.DataFrame:
+    """
+    Разбирает книгу с описаниями целей в таблицу goal_id, goal_name, goal_description.
+    Строки без номера цели (пустые, заголовки разделов) отбрасываются
+    """
+    frames = []
+    for df in pd.read_excel(p, sheet_name=None).values():
+        if EXCEL_GOAL_ID_COLUMN not in df.columns:
+            continue
+        frames.append(pd.DataFrame({
+            "goal_id": pd.to_numeric(df[EXCEL_GOAL_ID_COLUMN], errors="coerce"),
+            "goal_name": df.get(EXCEL_GOAL_NAME_COLUMN),
+            "goal_description": df.get(EXCEL_GOAL_DESCRIPTION_COLUMN),
+        }))
+
+    if not frames:
+        return pd.DataFrame(
+            {"goal_name": pd.Series(dtype="string"), "goal_description": pd.Series(dtype="string")},
+            index=pd.Index([], dtype="int64", name="goal_id"),
+        )
+
+    catalog = pd.concat(frames, ignore_index=True).dropna(subset=["goal_id"])
+    return (
+        catalog
+        .astype({"goal_id": "int64", "goal_name": "string", "goal_description": "string"})
+        .drop_duplicates(subset="goal_id", keep="first")
+        .set_index("goal_id")
+        .sort_index()
+    )
+
+
+def _load_goal_catalog(path: str) -> pd.DataFrame:
+    """
+    Каталог целей из Excel, проиндексированный по goal_id.
+    Книга разбирается один раз: результат сохраняется в parquet рядом с ней
+    (<имя>.goals.parquet) и в память процесса. Кэш сбрасывается, когда xlsx новее parquet
+    """
+    p = _resolve_data_path(path)
+
+    source_mtime = p.stat().st_mtime_ns
+    key = (str(p.resolve()), source_mtime)
+    if key in _goal_catalog_cache:
+        return _goal_catalog_cache[key]
+
+    cache_path = p.with_suffix(".goals.parquet")
+    if cache_path.exists() and cache_path.stat().st_mtime_ns >= source_mtime:
+        catalog = pd.read_parquet(cache_path)
+    else:
+        catalog = _parse_goal_catalog(p)
+        try:
+            catalog.to_parquet(cache_path)
+        except OSError as e:
+            print(f"Warning: Could not write goal catalog cache {cache_path}: {e}")
+
+    _goal_catalog_cache[key] = catalog
+    return catalog
+
+
+def _load_goal_descriptions(path: str) -> dict:
+    """
+    Описания целей для промпта: {"<goal_id>": {"name": ..., "description": ...}}
+    """
+    catalog = _load_goal_catalog(path)
+    return {
+        str(goal_id): {"name": row.goal_name, "description": row.goal_description}
+        for goal_id, row in zip(catalog.index, catalog.itertuples(index=False))
+    }
+
+
+def _version_shifts(anomalies: pd.DataFrame | None, key: str) -> dict:
+    """Сдвиги между версиями из результата детектора аномалий: {(ключ ряда, метрика): строка}"""
+    if anomalies is None:
+        return {}
+    shifts = anomalies[anomalies["kind"] == "version_shift"]
+    return {(str(getattr(row, key)), row.metric): row for row in shifts.itertuples(index=False)}
+
+
+def _with_anomaly_score(metric_data: dict, row) -> dict:
+    return {**metric_data, "robust_z": float(row.robust_z), "anomaly_score": float(row.score)}
+
+
+def _analyze_full_metrics_data(df: pd.DataFrame, anomalies: pd.DataFrame | None = None) -> dict:
     """
     Анализ данных из full_metrics.parquet
     Предполагается структура: 2 строки (версии), много столбцов с метриками
+
+    Если переданы anomalies (anomalies_v1_v2.parquet), метрики из SITE_SERIES_METRICS значимы,
+    когда детектор нашел сдвиг между версиями в дневном ряду сайта (url = __site__). У прочих
+    метрик (пользователи, доли ботов, удержание) дневных рядов нет — для них остается порог 20%,
+    и у таких метрик significance = change_20pct
     """
     analysis = {}
 
@@ -86,21 +223,38 @@ def _analyze_full_metrics_data(df: pd.DataFrame) -> dict:
         analysis["metrics_comparison"] = metrics_comparison
         analysis["total_metrics"] = len(metrics_comparison)
 
-        significant_changes = {
-            col: data for col, data in metrics_comparison.items() 
-            if abs(data["change_percent"]) > 20
-        }
+        if anomalies is not None:
+            shifts = _version_shifts(anomalies, "url")
+            significant_changes = {}
+            for col, data in metrics_comparison.items():
+                series = SITE_SERIES_METRICS.get(col)
+                if series is None:
+                    if abs(data["change_percent"]) > 20:
+                        significant_changes[col] = {**data, "significance": "change_20pct"}
+                elif (SITE_URL, series) in shifts:
+                    significant_changes[col] = _with_anomaly_score(data, shifts[SITE_URL, series])
+            analysis["significance"] = "anomaly_detection"
+        else:
+            significant_changes = {
+                col: data for col, data in metrics_comparison.items()
+                if abs(data["change_percent"]) > 20
+            }
+            analysis["significance"] = "change_20pct"
+        # имя ключа прежнее: его читают prompt_builder и ux_llm_agent
         analysis["significant_changes_20pct"] = significant_changes
         analysis["significant_changes_count"] = len(significant_changes)
     
     return analysis
 
 
-def _analyze_goals_data(df: pd.DataFrame) -> dict:
+def _analyze_goals_data(df: pd.DataFrame, anomalies: pd.DataFrame | None = None) -> dict:
     """
     Анализ данных по целям из goal_stats_common_v1_v2.parquet
     Структура: goal_id, avg_steps, avg_duration_sec, version
     8 строк: 4 цели для v1, 4 цели для v2
+
+    Если переданы anomalies (goal_anomalies_v1_v2.parquet), значимыми считаются не изменения >20%,
+    а сдвиги между версиями в дневных рядах целей, найденные детектором аномалий
     """
     analysis = {}
     
@@ -162,29 +316,174 @@ def _analyze_goals_data(df: pd.DataFrame) -> dict:
     analysis["goals_comparison"] = goals_comparison
     analysis["total_goals"] = len(goals_comparison)
 
+    shifts = _version_shifts(anomalies, "goal_id")
     significant_goals = {}
     for goal_id, metrics in goals_comparison.items():
         significant_metrics = {}
         for metric_name, metric_data in metrics.items():
-            if abs(metric_data["change_percent"]) > 20:
+            if anomalies is not None:
+                if (goal_id, metric_name) in shifts:
+                    significant_metrics[metric_name] = _with_anomaly_score(metric_data, shifts[goal_id, metric_name])
+            elif abs(metric_data["change_percent"]) > 20:
                 significant_metrics[metric_name] = metric_data
         
         if significant_metrics:
             significant_goals[goal_id] = significant_metrics
     
+    analysis["significance"] = "anomaly_detection" if anomalies is not None else "change_20pct"
     analysis["significant_goals"] = significant_goals
     analysis["significant_goals_count"] = len(significant_goals)
     
     return analysis
 
 
+URL_METRICS = ["page_hits", "page_visits", "bounce_rate", "avg_pages_per_visit", "median_time_on_page_sec"]
+
+
+def _analyze_url_metrics_data(
+    df_v1: pd.DataFrame,
+    df_v2: pd.DataFrame,
+    min_page_hits: int = 50,
+    anomalies: pd.DataFrame | None = None,
+    alignment: pd.DataFrame | None = None,
+) -> dict:
+    """
+    Сравнение метрик по URL из url_metrics_v1.parquet и url_metrics_v2.parquet
+    Структура: url, page_hits, page_visits, page_bounces, bounce_rate, avg_pages_per_visit, version
+    (+ median_time_on_page_sec и другие колонки времени на странице, если ETL их посчитал)
+    Сравниваются только URL, которые есть в обеих версиях и набрали хотя бы min_page_hits хитов
+
+    Если передано alignment (url_alignment_v1_v2.parquet), URL версий сопоставляются через него:
+    страница, сменившая адрес, сравнивается со своим новым адресом, а не выпадает. Такие пары
+    перечислены в url_aliases
+
+    Если переданы anomalies (anomalies_v1_v2.parquet), значимыми считаются не изменения >20%,
+    а сдвиги между версиями, найденные детектором аномалий по дневным рядам (kind = version_shift)
+    """
+    analysis = {}
+
+    metrics = [m for m in URL_METRICS if m in df_v1.columns and m in df_v2.columns]
+    left = _with_url_key(df_v1, alignment, "v1")[["url", "url_key", *metrics]]
+    right = _with_url_key(df_v2, alignment, "v2")[["url_key", *metrics]]
+    merged = (
+        left.rename(columns={"url": "url_v1"})
+        .merge(right, on="url_key", how="inner", suffixes=("_v1", "_v2"))
+        .rename(columns={"url_key": "url"})
+    )
+
+    analysis["data_structure"] = {
+        "v1_urls_count": len(df_v1),
+        "v2_urls_count": len(df_v2),
+        "common_urls_count": len(merged),
+    }
+
+    if alignment is not None:
+        aliases = merged[merged["url_v1"] != merged["url"]]
+        info = alignment[alignment["version"] == "v1"].set_index("url")
+        analysis["url_aliases"] = {
+            str(row.url): {
+                "url_v1": str(row.url_v1),
+                "match_type": str(info.at[row.url_v1, "match_type"]) if row.url_v1 in info.index else "exact",
+                "similarity": float(info.at[row.url_v1, "similarity"]) if row.url_v1 in info.index else 1.0,
+            }
+            for row in aliases[["url", "url_v1"]].itertuples(index=False)
+        }
+
+    if "page_hits" in metrics:
+        merged = merged[
+            np.maximum(merged["page_hits_v1"], merged["page_hits_v2"]) >= min_page_hits
+        ]
+
+    urls = merged["url"].astype(str).to_numpy()
+    changes = {}
+    for metric in metrics:
+        v1 = merged[f"{metric}_v1"].astype(float).to_numpy()
+        v2 = merged[f"{metric}_v2"].astype(float).to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = np.where(v1 != 0, (v2 - v1) / np.abs(v1) * 100, np.where(v2 != 0, 100.0, 0.0))
+        changes[metric] = (v1, v2, change)
+
+    urls_comparison = {}
+    significant_urls = {}
+    for i, url in enumerate(urls):
+        url_comparison = {}
+        significant_metrics = {}
+        for metric, (v1, v2, change) in changes.items():
+            metric_data = {
+                "v1_value": float(v1[i]),
+                "v2_value": float(v2[i]),
+                "change_percent": float(change[i])
+            }
+            url_comparison[metric] = metric_data
+            if abs(metric_data["change_percent"]) > 20:
+                significant_metrics[metric] = metric_data
+
+        urls_comparison[url] = url_comparison
+        if significant_metrics:
+            significant_urls[url] = significant_metrics
+
+    if anomalies is not None:
+        significant_urls = _significant_from_anomalies(urls_comparison, anomalies)
+        analysis["significance"] = "anomaly_detection"
+    else:
+        analysis["significance"] = "change_20pct"
+
+    analysis["urls_comparison"] = urls_comparison
+    analysis["total_urls"] = len(urls_comparison)
+    analysis["significant_urls"] = significant_urls
+    analysis["significant_urls_count"] = len(significant_urls)
+
+    return analysis
+
+
+def _with_url_key(df: pd.DataFrame, alignment: pd.DataFrame | None, version: str) -> pd.DataFrame:
+    """
+    url_key — общий для версий ключ URL из соответствия; без соответствия ключ — сам url.
+    Если несколько URL версии сошлись в один ключ (например, варианты с utm-метками),
+    остается самый посещаемый — метрики вроде медианы времени на странице не складываются
+    """
+    df = df.copy()
+    if alignment is None:
+        df["url_key"] = df["url"]
+        return df
+
+    keys = alignment.loc[alignment["version"] == version, ["url", "url_key"]]
+    df = df.merge(keys, on="url", how="left")
+    df["url_key"] = df["url_key"].fillna(df["url"])
+    if "page_hits" in df.columns:
+        df = df.sort_values("page_hits", ascending=False, kind="stable")
+    return df.drop_duplicates("url_key", keep="first")
+
+
+def _significant_from_anomalies(urls_comparison: dict, anomalies: pd.DataFrame) -> dict:
+    """
+    Значимые метрики URL по результатам детектора аномалий.
+    Для метрик, которых нет в url_metrics (например, avg_duration_sec), берутся медианы дневных рядов.
+    Ряд всего сайта (__site__) — не URL: он идет в анализ full_metrics
+    """
+    shifts = anomalies[(anomalies["kind"] == "version_shift") & (anomalies["url"] != SITE_URL)]
+
+    significant_urls = {}
+    for row in shifts.itertuples(index=False):
+        metric_data = urls_comparison.get(row.url, {}).get(row.metric)
+        if metric_data is None:
+            v1, v2 = float(row.baseline), float(row.value)
+            metric_data = {
+                "v1_value": v1,
+                "v2_value": v2,
+                "change_percent": (v2 - v1) / abs(v1) * 100 if v1 != 0 else (100.0 if v2 != 0 else 0.0),
+            }
+        significant_urls.setdefault(row.url, {})[row.metric] = _with_anomaly_score(metric_data, row)
+    return significant_urls
+
+
 def _load_full_metrics_analysis(metrics_file: str) -> str:
     """
     Загрузка и анализ данных из full_metrics.parquet
     """
     df = _read_parquet_df(metrics_file)
     
-    analysis = _analyze_full_metrics_data(df)
+    analysis = _analyze_full_metrics_data(df, anomalies=_load_anomalies())
 
     analysis["data_info"] = {
         "source_file": metrics_file,
@@ -201,7 +500,7 @@ def _load_goals_analysis(goals_file: str) -> str:
     """
     df = _read_parquet_df(goals_file)
     
-    analysis = _analyze_goals_data(df)
+    analysis = _analyze_goals_data(df, anomalies=_load_anomalies(GOAL_ANOMALIES_FILE))
 
     analysis["data_info"] = {
         "source_file": goals_file,
@@ -212,6 +511,51 @@ def _load_goals_analysis(goals_file: str) -> str:
     return json.dumps(analysis, ensure_ascii=False, indent=2)
 
 
+def _load_anomalies(anomalies_file: str = ANOMALIES_FILE) -> pd.DataFrame | None:
+    """
+    Ранжированные аномалии из anomaly_detection.py, если ETL их уже посчитал
+    """
+    try:
+        return _read_parquet_df(anomalies_file)
+    except FileNotFoundError:
+        return None
+
+
+def _load_url_alignment(alignment_file: str = URL_ALIGNMENT_FILE) -> pd.DataFrame | None:
+    """
+    Соответствие URL версий из src/make_metrics/url_alignment.py, если ETL его уже посчитал
+    """
+    try:
+        return _read_parquet_df(alignment_file)
+    except FileNotFoundError:
+        return None
+
+
+def _load_url_metrics_analysis(url_metrics_v1_file: str, url_metrics_v2_file: str) -> str:
+    """
+    Загрузка и сравнение метрик по URL двух версий
+    """
+    analysis = _analyze_url_metrics_data(
+        _read_parquet_df(url_metrics_v1_file),
+        _read_parquet_df(url_metrics_v2_file),
+        anomalies=_load_anomalies(),
+        alignment=_load_url_alignment(),
+    )
+
+    analysis["data_info"] = {
+        "source_files": [url_metrics_v1_file, url_metrics_v2_file],
+    }
+
+    return json.dumps(analysis, ensure_ascii=False, indent=2)
+
+
+def _load_goal_catalog_json(excel_file: str) -> str:
+    """
+    Каталог целей в компактном JSON: {"<goal_id>": {"name": ..., "description": ...}}
+    """
+    return json.dumps(_load_goal_descriptions(excel_file), ensure_ascii=False)
+
+
 def _load_parquet_summary_direct(filename: str) -> str:
     """
     Прямая функция для преобразования parquet в JSON-сводку
@@ -220,26 +564,445 @@ def _load_parquet_summary_direct(filename: str) -> str:
     return df.to_json(orient="records", force_ascii=False)
 
 
+_FILTER_OPS = {
+    "==": lambda f, v: f == v,
+    "!=": lambda f, v: f != v,
+    "<": lambda f, v: f < v,
+    "<=": lambda f, v: f <= v,
+    ">": lambda f, v: f > v,
+    ">=": lambda f, v: f >= v,
+    "in": lambda f, v: f.isin(v),
+    "not in": lambda f, v: ~f.isin(v),
+    "contains": lambda f, v: pc.match_substring(f, pattern=v),
+    "is_null": lambda f, v: f.is_null(),
+    "not_null": lambda f, v: f.is_valid(),
+}
+
+_AGGREGATES = {"sum", "mean", "min", "max", "count", "count_distinct"}
+
+
+def _build_filter(filters: list | None):
+    """
+    Фильтры вида [["bounce_rate", ">", 20], ["url", "contains", "bachelor"]] -> выражение pyarrow,
+    условия объединяются через AND. Выражение передается в сканер parquet (predicate pushdown)
+    """
+    expr = None
+    for column, op, *value in filters or []:
+        if op not in _FILTER_OPS:
+            raise ValueError(f"Unsupported filter operator: {op}. Supported: {sorted(_FILTER_OPS)}")
+        cond = _FILTER_OPS[op](ds.field(column), value[0] if value else None)
+        expr = cond if expr is None else expr & cond
+    return expr
+
+
+def _sort_keys(sort: list | None) -> list[tuple[str, str]]:
+    """[["page_hits", "desc"], ["url"]] -> [("page_hits", "descending"), ("url", "ascending")]"""
+    keys = []
+    for column, *order in sort or []:
+        direction = order[0] if order else "asc"
+        keys.append((column, "descending" if direction in ("desc", "descending") else "ascending"))
+    return keys
+
+
+def _top_k(batches, keys: list[tuple[str, str]], k: int) -> pa.Table | None:
+    """
+    Первые k строк по сортировке без чтения всего файла в память:
+    на каждом батче оставляем только текущий top-k
+    """
+    top = None
+    for batch in batches:
+        table = pa.Table.from_batches([batch])
+        if top is not None:
+            table = pa.concat_tables([top, table])
+        top = pc.take(table, pc.select_k_unstable(table, k=min(k, table.num_rows), sort_keys=keys))
+    return top.sort_by(keys) if top is not None else None
+
+
+def _aggregate_batches(batches, schema: pa.Schema, group_by: list[str], aggregates: list) -> pa.Table:
+    """
+    Агрегаты по group_by без чтения всех строк в память: каждый батч сканера сводится к частичным
+    агрегатам по группам и складывается с накопленными, так что в памяти — число групп, а не строк.
+    mean собирается из sum и count, count_distinct — из множества различных пар (группа, значение)
+    """
+    # частичный агрегат -> (колонка, агрегат по батчу, как сложить накопленное); count_all — число
+    # строк группы, держит группы даже без других агрегатов
+    partials = {"__rows": ([], "count_all", "sum")}
+    for column, func in aggregates:
+        if func == "count_distinct":
+            continue
+        for part in (("sum", "count") if func == "mean" else (func,)):
+            partials[f"{column}_{part}"] = (column, part, "sum" if part == "count" else part)
+    distinct_columns = list(dict.fromkeys(column for column, func in aggregates if func == "count_distinct"))
+
+    totals = None
+    distinct = dict.fromkeys(distinct_columns)
+    scanned = False
+    # фильтр мог не пропустить ни строки: тогда агрегаты по пустой таблице, как при чтении целиком
+    for batch in itertools.chain(batches, [None]):
+        if batch is None:
+            if scanned:
+                break
+            batch = pa.RecordBatch.from_pylist([], schema=schema)
+        scanned = True
+        table = pa.Table.from_batches([batch])
+        part = (
+            table.group_by(group_by)
+            .aggregate([(column, func) for column, func, _ in partials.values()])
+            .rename_columns([*group_by, *partials])
+        )
+        if totals is not None:
+            part = (
+                pa.concat_tables([totals, part])
+                .group_by(group_by)
+                .aggregate([(name, combine) for name, (_, _, combine) in partials.items()])
+                .rename_columns([*group_by, *partials])
+            )
+        totals = part
+        for column in distinct_columns:
+            pairs = table.group_by([*group_by, column]).aggregate([])
+            if distinct[column] is not None:
+                pairs = pa.concat_tables([distinct[column], pairs]).group_by([*group_by, column]).aggregate([])
+            distinct[column] = pairs
+
+    # у каждой группы есть хотя бы одна пара (группа, значение), поэтому после сортировки по
+    # ключам группы итога и счетчиков различных значений идут в одном порядке
+    order = [(key, "ascending") for key in group_by]
+    if order:
+        totals = totals.sort_by(order)
+    result = {key: totals[key] for key in group_by}
+    for column, func in aggregates:
+        name = f"{column}_{func}"
+        if func == "mean":
+            result[name] = pc.divide(pc.cast(totals[f"{column}_sum"], pa.float64()), totals[f"{column}_count"])
+        elif func == "count_distinct":
+            counts = distinct[column].group_by(group_by).aggregate([(column, "count")])
+            result[name] = (counts.sort_by(order) if order else counts)[f"{column}_count"]
+        else:
+            result[name] = totals[name]
+    return pa.table(result)
+
+
+def _query_parquet(
+    filename: str,
+    columns: list[str] | None = None,
+    filters: list | None = None,
+    sort: list | None = None,
+    limit: int = QUERY_DEFAULT_LIMIT,
+    offset: int = 0,
+    group_by: list[str] | None = None,
+    aggregates: list | None = None,
+    format: str = "json",
+) -> str:
+    """
+    Запрос к parquet файлу с проекцией колонок, фильтрами, сортировкой, limit/offset и агрегатами.
+    Проекция и фильтры выполняются сканером parquet, поэтому размер ответа
+    ограничен запросом (limit <= QUERY_MAX_LIMIT, offset <= QUERY_MAX_OFFSET), а не размером файла;
+    агрегаты считаются по батчам, в памяти — только группы.
+
+    aggregates: [["page_hits", "sum"], ["url", "count"]] — агрегаты по group_by (или по всему файлу)
+    format: "json" — колоночный JSON {"columns": [...], "data": {колонка: [значения]}},
+            "arrow" — Arrow IPC stream в base64
+    """
+    dataset = ds.dataset(_resolve_data_path(filename), format="parquet")
+    expr = _build_filter(filters)
+    keys = _sort_keys(sort)
+    limit = max(0, min(int(limit), QUERY_MAX_LIMIT))
+    if int(offset) < 0:
+        raise ValueError(f"offset must be non-negative, got {offset}")
+    offset = min(int(offset), QUERY_MAX_OFFSET)
+
+    if aggregates:
+        for _, func in aggregates:
+            if func not in _AGGREGATES:
+                raise ValueError(f"Unsupported aggregate: {func}. Supported: {sorted(_AGGREGATES)}")
+        group_by = group_by or []
+        needed = list(dict.fromkeys([*group_by, *(column for column, _ in aggregates)]))
+        schema = pa.schema([dataset.schema.field(column) for column in needed])
+        result = _aggregate_batches(dataset.to_batches(columns=needed, filter=expr), schema, group_by, aggregates)
+        matched_rows = result.num_rows
+        if keys:
+            result = result.sort_by(keys)
+        result = result.slice(offset, limit)
+    elif keys:
+        projection = columns or dataset.schema.names
+        needed = list(dict.fromkeys([*projection, *(column for column, _ in keys)]))
+        top = _top_k(dataset.to_batches(columns=needed, filter=expr), keys, offset + limit)
+        result = (top if top is not None else dataset.schema.empty_table().select(needed)).slice(offset, limit)
+        result = result.select(projection)
+        matched_rows = dataset.count_rows(filter=expr)
+    else:
+        # без сортировки сканер останавливается, как только набрал offset + limit строк
+        result = dataset.head(offset + limit, columns=columns, filter=expr).slice(offset, limit)
+        matched_rows = dataset.count_rows(filter=expr)
+
+    if format == "arrow":
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, result.schema) as writer:
+            writer.write_table(result)
+        return json.dumps({
+            "format": "arrow_ipc_base64",
+            "rows": result.num_rows,
+            "matched_rows": matched_rows,
+            "data": base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii"),
+        })
+
+    return json.dumps({
+        "columns": result.column_names,
+        "rows": result.num_rows,
+        "offset": offset,
+        "matched_rows": matched_rows,
+        "data": result.to_pydict(),
+    }, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+_metrics_cube_cache: dict[tuple[str, int], tuple[pa.Table, dict[str, int]]] = {}
+
+
+def _load_metrics_cube(cube_file: str) -> tuple[pa.Table, dict[str, int]]:
+    """
+    Куб метрик целиком в памяти процесса (он компактный) и размеры его кубоидов.
+    Перечитывается, только когда ETL перезаписал файл
+    """
+    p = _resolve_data_path(cube_file)
+    key = (str(p.resolve()), p.stat().st_mtime_ns)
+    if key not in _metrics_cube_cache:
+        table = pq.read_table(p)
+        counts = table.group_by("cuboid").aggregate([("cuboid", "count")])
+        sizes = dict(zip(counts["cuboid"].to_pylist(), counts["cuboid_count"].to_pylist()))
+        _metrics_cube_cache.clear()
+        _metrics_cube_cache[key] = (table, sizes)
+    return _metrics_cube_cache[key]
+
+
+def _slice_metrics_cube(
+    cube_file: str = METRICS_CUBE_FILE,
+    by: list[str] | None = None,
+    filters: dict | None = None,
+    limit: int = QUERY_DEFAULT_LIMIT,
+) -> str:
+    """
+    Срез куба метрик: суммы мер по версиям и измерениям by при условиях filters
+    ({"device": "mobile", "is_new_user": [0, 1]}), плюс доли, посчитанные из сумм.
+    Берется кубоид ровно по нужным измерениям, а если он не материализован —
+    самый маленький кубоид, который их содержит. Сырые визиты не читаются
+    """
+    table, sizes = _load_metrics_cube(cube_file)
+    by = list(by or [])
+    filters = filters or {}
+    needed = set(by) | set(filters)
+
+    candidates = [name for name in sizes if needed <= set(filter(None, name.split("|")))]
+    if not candidates:
+        raise ValueError(f"No cuboid contains dimensions {sorted(needed)}. Available: {sorted(sizes)}")
+    cuboid = min(candidates, key=lambda name: sizes[name])
+
+    mask = pc.equal(table["cuboid"], cuboid)
+    for dim, values in filters.items():
+        values = values if isinstance(values, list) else [values]
+        value_set = pa.array(values).cast(table.schema.field(dim).type)
+        mask = pc.and_(mask, pc.is_in(table[dim], value_set=value_set))
+
+    df = (
+        table.filter(mask)
+        .group_by(["version", *by])
+        .aggregate([(m, "sum") for m in CUBE_MEASURES])
+        .to_pandas()
+        .rename(columns={f"{m}_sum": m for m in CUBE_MEASURES})
+    )
+
+    visits = df["visits"].where(df["visits"] > 0)
+    df["bounce_rate"] = (df["bounces"] / visits * 100).round(2)
+    df["new_user_rate"] = (df["new_visits"] / visits * 100).round(2)
+    df["pages_per_visit"] = (df["hits"] / visits).round(2)
+    df["avg_duration_sec"] = (df["sum_visit_duration"] / visits).round(1)
+
+    matched_rows = len(df)
+    df = df.sort_values(["visits", "version"], ascending=[False, True]).head(max(0, min(int(limit), QUERY_MAX_LIMIT)))
+
+    return json.dumps({
+        "cuboid": cuboid,
+        "by": by,
+        "filters": filters,
+        "rows": len(df),
+        "matched_rows": matched_rows,
+        "data": df.to_dict("records"),
+    }, ensure_ascii=False, default=str)
+
+
+_ux_index_cache: dict[tuple[str, int], VectorIndex] = {}
+
+
+def _search_ux_index(query: str, kind: str | None = None, k: int = 10, index_dir: str = str(INDEX_DIR)) -> str:
+    """
+    Ближайшие к query URL, цели и выводы прошлых запусков из индекса ux_llm_agent.update_ux_index.
+    Индекс читается через mmap и держится в памяти процесса, пока его не пересоберут
+    """
+    p = Path(index_dir)
+    key = (str(p.resolve()), (p / "index.json").stat().st_mtime_ns)
+    if key not in _ux_index_cache:
+        _ux_index_cache.clear()
+        _ux_index_cache[key] = VectorIndex.load(p)
+    index = _ux_index_cache[key]
+
+    hits = index.search(query, k=min(k, QUERY_MAX_LIMIT), kind=kind)
+    return json.dumps({
+        "query": query,
+        "kind": kind,
+        "results": [{"score": round(score, 4), **meta} for score, meta in hits],
+    }, ensure_ascii=False)
+
+
+_executor: Executor | None = None
+_in_flight: dict[tuple, asyncio.Future] = {}
+
+
+def _load_run_history(
+    metric: str | None = None,
+    goal_id: str | None = None,
+    url: str | None = None,
+    last_runs: int = 10,
+    db_path: str = str(HISTORY_DB),
+) -> str:
+    """
+    Тренд метрики по прошлым запускам ETL и выводы прошлых анализов по метрике, цели или URL
+    из истории util.run_history
+    """
+    if not Path(db_path).exists():
+        raise FileNotFoundError(f"Run history not found: {db_path}")
+    last_runs = min(last_runs, QUERY_MAX_LIMIT)
+    with RunHistory(db_path) as history:
+        trend = history.metric_trend(metric, last_runs=last_runs) if metric and not (goal_id or url) else []
+        insights = history.insight_history(metric=metric, goal_id=goal_id, url=url, last_runs=last_runs)
+    return json.dumps({
+        "metric": metric,
+        "goal_id": goal_id,
+        "url": url,
+        "last_runs": last_runs,
+        "trend": trend,
+        "insights": insights,
+    }, ensure_ascii=False)
+
+
+def configure_worker_pool(workers: int = MCP_WORKERS, kind: str = MCP_POOL_KIND) -> Executor:
+    """
+    Пересоздает пул, в котором выполняются тяжелые функции инструментов.
+    kind="thread" подходит для чтения parquet/Excel (pyarrow отпускает GIL),
+    kind="process" — если упираемся в json.dumps и прочий чистый Python
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    if kind == "process":
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mcp-worker")
+    return _executor
+
+
+async def _run_offloaded(func, *args):
+    """
+    Выполняет func(*args) в пуле воркеров, не блокируя event loop сервера.
+    Одинаковые запросы, пришедшие, пока первый еще выполняется, ждут его результат
+    вместо того чтобы повторно читать и анализировать тот же файл
+    """
+    if _executor is None:
+        configure_worker_pool()
+
+    # repr, а не сами аргументы: у query-инструмента аргументы — списки, они не хешируются
+    key = (func.__name__, repr(args))
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+
+    # shield: отмена одного клиента не должна отменять результат для остальных ожидающих
+    return await asyncio.shield(future)
+
+
 try:
     from fastmcp import FastMCP
 
     mcp = FastMCP("UX MCP Tools")
 
     @mcp.tool()
-    def load_parquet_as_summary(filename: str) -> str:
-        return _load_parquet_summary_direct(filename)
+    async def load_parquet_as_summary(filename: str) -> str:
+        return await _run_offloaded(_load_parquet_summary_direct, filename)
+
+    @mcp.tool()
+    async def query_parquet(
+        filename: str,
+        columns: list[str] | None = None,
+        filters: list[list] | None = None,
+        sort: list[list] | None = None,
+        limit: int = QUERY_DEFAULT_LIMIT,
+        offset: int = 0,
+        group_by: list[str] | None = None,
+        aggregates: list[list] | None = None,
+        format: str = "json",
+    ) -> str:
+        """
+        Запрос к parquet файлу: columns — проекция, filters — [[колонка, оператор, значение]]
+        (==, !=, <, <=, >, >=, in, not in, contains, is_null, not_null), sort — [[колонка, "asc"|"desc"]],
+        limit (до 1000) / offset (от 0 до 100000), group_by + aggregates — [[колонка, sum|mean|min|max|count|count_distinct]].
+        format: "json" (колоночный) или "arrow" (Arrow IPC в base64)
+        """
+        return await _run_offloaded(
+            _query_parquet, filename, columns, filters, sort, limit, offset, group_by, aggregates, format
+        )
+
+    @mcp.tool()
+    async def slice_metrics_cube(
+        by: list[str] | None = None,
+        filters: dict | None = None,
+        limit: int = QUERY_DEFAULT_LIMIT,
+        cube_file: str = METRICS_CUBE_FILE,
+    ) -> str:
+        """
+        Срез предагрегированного куба метрик по версиям: by — измерения группировки
+        (date, is_new_user, landing_url, traffic_source, device — те, что есть в выгрузке),
+        filters — {измерение: значение или список значений}. Возвращает visits, bounces, hits,
+        bounce_rate, new_user_rate, pages_per_visit, avg_duration_sec
+        """
+        return await _run_offloaded(_slice_metrics_cube, cube_file, by, filters, limit)
+
+    @mcp.tool()
+    async def search_ux_index(query: str, kind: str | None = None, k: int = 10) -> str:
+        """
+        Поиск по смыслу среди URL (kind="url"), целей ("goal") и выводов прошлых анализов ("insight"):
+        возвращает k ближайших с косинусной близостью score
+        """
+        return await _run_offloaded(_search_ux_index, query, kind, k)
+
+    @mcp.tool()
+    async def load_run_history(
+        metric: str | None = None, goal_id: str | None = None, url: str | None = None, last_runs: int = 10
+    ) -> str:
+        """
+        История прошлых запусков: значения метрики по снимкам ETL (trend) и выводы прошлых
+        анализов по метрике, цели или URL (insights)
+        """
+        return await _run_offloaded(_load_run_history, metric, goal_id, url, last_runs)
+
+    @mcp.tool()
+    async def load_full_metrics_analysis(metrics_file: str) -> str:
+        return await _run_offloaded(_load_full_metrics_analysis, metrics_file)
+
+    @mcp.tool()
+    async def load_goals_analysis(goals_file: str) -> str:
+        return await _run_offloaded(_load_goals_analysis, goals_file)
 
     @mcp.tool()
-    def load_full_metrics_analysis(metrics_file: str) -> str:
-        return _load_full_metrics_analysis(metrics_file)
+    async def load_url_metrics_analysis(url_metrics_v1_file: str, url_metrics_v2_file: str) -> str:
+        return await _run_offloaded(_load_url_metrics_analysis, url_metrics_v1_file, url_metrics_v2_file)
 
     @mcp.tool()
-    def load_goals_analysis(goals_file: str) -> str:
-        return _load_goals_analysis(goals_file)
+    async def load_excel_file(excel_file: str) -> str:
+        return await _run_offloaded(_read_excel_file, excel_file)
 
     @mcp.tool()
-    def load_excel_file(excel_file: str) -> str:
-        return _read_excel_file(excel_file)
+    async def load_goal_catalog(excel_file: str) -> str:
+        return await _run_offloaded(_load_goal_catalog_json, excel_file)
 
 except ImportError:
     pass
\ No newline at end of file
@@ -1,5 +1,6 @@
 class Agent:
-    def __init__(self, name: str, instructions: str, model: str):
+    def __init__(self, name: str, instructions: str, model: str, tools: list | None = None):
         self.name = name
         self.instructions = instructions
-        self.model = model
\ No newline at end of file
+        self.model = model
+        self.tools = list(tools or [])
\ No newline at end of file
@@ -1,3 +1,4 @@
 class RunConfig:
-    def __init__(self, model_provider):
+    def __init__(self, model_provider, tracer=None):
         self.model_provider = model_provider
+        self.tracer = tracer
@@ -1,13 +1,204 @@
+import asyncio
+import inspect
+import json
+import time
+
+from minimal_agents.tracing import CallSpan
+from util.json_stream import AnalysisStreamParser
+
+
+def _prompt_bytes(agent, input: str) -> int:
+    return len(agent.instructions.encode("utf8")) + len(input.encode("utf8"))
+
+
+# вывод одного инструмента, который попадет обратно в контекст модели
+MAX_TOOL_OUTPUT_CHARS = 30_000
+
+
 class RunnerResult:
-    def __init__(self, final_output: str):
+    def __init__(self, final_output: str, items: list | None = None, span: CallSpan | None = None,
+                 tool_calls: list | None = None, turns: int = 1):
         self.final_output = final_output
+        self.items = items
+        self.span = span
+        self.tool_calls = tool_calls
+        self.turns = turns
+
+
+def _output_item(item) -> dict:
+    """Элемент resp.output как dict для следующего запроса (SDK отдает pydantic-модели)"""
+    if isinstance(item, dict):
+        return item
+    if hasattr(item, "model_dump"):
+        return item.model_dump(exclude_none=True)
+    return dict(item.__dict__)
+
+
+def _field(item, key: str):
+    return item.get(key) if isinstance(item, dict) else getattr(item, key, None)
+
+
+class _ToolCallCache:
+    """
+    Вызовы инструментов одного запуска: одинаковые (имя + аргументы) выполняются один раз,
+    в том числе если модель запросила их одновременно — второй ждет первый
+    """
+
+    def __init__(self, tools: list):
+        self.tools = {tool.name: tool for tool in tools}
+        self.tasks: dict[tuple[str, str], asyncio.Task] = {}
+        self.log: list[dict] = []
+
+    async def call(self, name: str, raw_arguments: str, turn: int, max_chars: int) -> str:
+        entry = {"turn": turn, "name": name, "arguments": raw_arguments, "cached": False, "status": "ok"}
+        self.log.append(entry)
+        t0 = time.perf_counter()
+
+        tool = self.tools.get(name)
+        try:
+            arguments = json.loads(raw_arguments or "{}")
+        except json.JSONDecodeError as e:
+            arguments, error = None, f"Error: arguments are not valid JSON: {e}"
+        else:
+            error = None if tool is not None else f"Error: unknown tool {name}. Available: {sorted(self.tools)}"
+        if error is not None:
+            entry["status"] = "error"
+            return error
+
+        key = (name, json.dumps(arguments, sort_keys=True, ensure_ascii=False))
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(tool.call(arguments))
+        else:
+            entry["cached"] = True
+
+        try:
+            output = await task
+        except Exception as e:  # noqa: BLE001 - ошибка любого инструмента возвращается модели текстом
+            entry["status"] = "error"
+            output = f"Error: {type(e).__name__}: {e}"
+        finally:
+            entry["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+        if len(output) > max_chars:
+            output = output[:max_chars] + f"\n... truncated {len(output) - max_chars} chars"
+        return output
+
 
 class Runner:
     @staticmethod
     async def run(agent, input: str, run_config):
         provider = run_config.model_provider
-        response = await provider.complete(
-            instructions=agent.instructions,
-            input_text=input
-        )
-        return RunnerResult(response)
+        span = CallSpan(agent.name, _prompt_bytes(agent, input))
+        try:
+            response = await provider.complete(
+                instructions=agent.instructions,
+                input_text=input,
+                span=span
+            )
+        except Exception as e:
+            span.finish(e)
+            Runner._record(run_config, span)
+            raise
+        span.finish()
+        Runner._record(run_config, span)
+        return RunnerResult(response, span=span)
+
+    @staticmethod
+    async def run_streamed(agent, input: str, run_config, on_item=None):
+        """
+        Потоковый запуск: элементы массива analysis разбираются по мере генерации
+        и сразу передаются в on_item (sync или async callback)
+        """
+        provider = run_config.model_provider
+        span = CallSpan(agent.name, _prompt_bytes(agent, input), mode="stream")
+        parser = AnalysisStreamParser()
+        chunks = []
+        try:
+            async for chunk in provider.stream(
+                instructions=agent.instructions,
+                input_text=input,
+                span=span
+            ):
+                if span.ttft_ms is None:
+                    span.ttft_ms = span.elapsed_ms()
+                chunks.append(chunk)
+                t0 = time.perf_counter()
+                items = parser.feed(chunk)
+                span.parse_ms += (time.perf_counter() - t0) * 1000
+                for item in items:
+                    if on_item is not None:
+                        res = on_item(item)
+                        if inspect.isawaitable(res):
+                            await res
+        except Exception as e:
+            span.finish(e)
+            Runner._record(run_config, span)
+            raise
+        span.finish()
+        Runner._record(run_config, span)
+        return RunnerResult("".join(chunks), parser.items, span=span)
+
+    @staticmethod
+    async def run_with_tools(
+        agent,
+        input: str,
+        run_config,
+        max_turns: int = 8,
+        max_tokens: int | None = None,
+        max_tool_output_chars: int = MAX_TOOL_OUTPUT_CHARS,
+    ):
+        """
+        Цикл function calling: модель сама запрашивает нужные срезы данных через agent.tools.
+        Все вызовы одного хода выполняются параллельно, повторные вызовы с теми же аргументами
+        берутся из кэша запуска. Последний ход (max_turns) или ход после превышения max_tokens
+        (input + output за весь запуск) идет без инструментов — модель обязана ответить текстом
+        """
+        if max_turns < 1:
+            raise ValueError(f"max_turns must be at least 1, got {max_turns}")
+        provider = run_config.model_provider
+        tools = _ToolCallCache(agent.tools)
+        schemas = [tool.schema() for tool in agent.tools]
+        history = [{"role": "user", "content": input}]
+        used_tokens = 0
+
+        for turn in range(1, max_turns + 1):
+            out_of_budget = max_tokens is not None and used_tokens >= max_tokens
+            final_turn = turn == max_turns or out_of_budget or not schemas
+            span = CallSpan(agent.name, _prompt_bytes(agent, json.dumps(history, ensure_ascii=False)), mode="tools")
+            try:
+                resp = await provider.respond(
+                    instructions=agent.instructions,
+                    input_items=history,
+                    tools=schemas,
+                    tool_choice="none" if final_turn else "auto",
+                    span=span,
+                )
+            except Exception as e:
+                span.finish(e)
+                Runner._record(run_config, span)
+                raise
+            span.finish()
+            Runner._record(run_config, span)
+            used_tokens += (span.input_tokens or 0) + (span.output_tokens or 0)
+
+            output = list(getattr(resp, "output", None) or [])
+            calls = [item for item in output if _field(item, "type") == "function_call"]
+            if not calls or final_turn:
+                return RunnerResult(resp.output_text, span=span, tool_calls=tools.log, turns=turn)
+
+            history.extend(_output_item(item) for item in output)
+            results = await asyncio.gather(*(
+                tools.call(_field(call, "name"), _field(call, "arguments"), turn, max_tool_output_chars)
+                for call in calls
+            ))
+            history.extend(
+                {"type": "function_call_output", "call_id": _field(call, "call_id"), "output": result}
+                for call, result in zip(calls, results)
+            )
+
+    @staticmethod
+    def _record(run_config, span: CallSpan):
+        tracer = getattr(run_config, "tracer", None)
+        if tracer is not None:
+            tracer.record(span)
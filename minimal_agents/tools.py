@@ -0,0 +1,69 @@
+import asyncio
+import inspect
+import json
+import types
+import typing
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", dict: "object", list: "array"}
+
+
+def _json_schema(annotation) -> dict:
+    """JSON Schema для аннотации параметра: str, int, float, bool, list[...], dict, X | None"""
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin in (typing.Union, types.UnionType):
+        non_null = [a for a in args if a is not type(None)]
+        if len(non_null) == 1:
+            return _json_schema(non_null[0])
+        return {"anyOf": [_json_schema(a) for a in non_null]}
+    if origin is list:
+        return {"type": "array", "items": _json_schema(args[0]) if args else {}}
+    if origin is dict:
+        return {"type": "object"}
+    if annotation in _JSON_TYPES:
+        return {"type": _JSON_TYPES[annotation]}
+    return {}
+
+
+class FunctionTool:
+    """
+    Python-функция как инструмент модели (function calling Responses API).
+    Схема параметров строится по сигнатуре и аннотациям, описание — docstring.
+    Синхронная функция выполняется в потоке, чтобы чтение файлов не блокировало event loop
+    и несколько вызовов за один ход шли параллельно. Результат — строка (не строку сериализуем в JSON)
+    """
+
+    def __init__(self, func, name: str | None = None, description: str | None = None, parameters: dict | None = None):
+        self.func = func
+        self.name = name or func.__name__.lstrip("_")
+        self.description = description or " ".join((inspect.getdoc(func) or "").split())
+        self.parameters = parameters or self._parameters_from_signature(func)
+
+    @staticmethod
+    def _parameters_from_signature(func) -> dict:
+        hints = typing.get_type_hints(func)
+        properties, required = {}, []
+        for name, param in inspect.signature(func).parameters.items():
+            if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                continue
+            properties[name] = _json_schema(hints.get(name, str))
+            if param.default is inspect.Parameter.empty:
+                required.append(name)
+        return {"type": "object", "properties": properties, "required": required}
+
+    def schema(self) -> dict:
+        return {"type": "function", "name": self.name, "description": self.description, "parameters": self.parameters}
+
+    async def call(self, arguments: dict) -> str:
+        if inspect.iscoroutinefunction(self.func):
+            result = await self.func(**arguments)
+        else:
+            result = await asyncio.to_thread(self.func, **arguments)
+        return result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+
+
+def function_tool(func=None, *, name: str | None = None, description: str | None = None):
+    """Декоратор или функция: function_tool(f) или @function_tool(name="...")"""
+    if func is None:
+        return lambda f: FunctionTool(f, name=name, description=description)
+    return FunctionTool(func, name=name, description=description)
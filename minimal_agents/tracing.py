@@ -0,0 +1,114 @@
+import json
+import math
+import time
+from datetime import UTC, datetime
+
+SUMMARY_FIELDS = [
+    "total_ms", "queue_ms", "network_ms", "parse_ms", "ttft_ms",
+    "prompt_bytes", "input_tokens", "output_tokens",
+]
+
+
+class CallSpan:
+    """Замеры одного вызова модели: время по фазам, токены, размер промпта, ретраи"""
+
+    def __init__(self, agent_name: str, prompt_bytes: int, mode: str = "complete"):
+        self.agent_name = agent_name
+        self.mode = mode
+        self.started_at = datetime.now(UTC).isoformat()
+        self.prompt_bytes = prompt_bytes
+        self.total_ms = 0.0
+        self.queue_ms = 0.0
+        self.network_ms = 0.0
+        self.parse_ms = 0.0
+        self.ttft_ms = None
+        self.input_tokens = None
+        self.output_tokens = None
+        self.cached_tokens = None
+        self.cache_hit = False
+        self.retries = 0
+        self.status = "ok"
+        self.error = None
+        self._t0 = time.perf_counter()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._t0) * 1000
+
+    def set_usage(self, usage):
+        """Токены из usage ответа Responses API (объект или dict)"""
+        if usage is None:
+            return
+        get = usage.get if isinstance(usage, dict) else lambda key: getattr(usage, key, None)
+        self.input_tokens = get("input_tokens")
+        self.output_tokens = get("output_tokens")
+        details = get("input_tokens_details")
+        if details is not None:
+            cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+            self.cached_tokens = cached
+            self.cache_hit = self.cache_hit or bool(cached)
+
+    def finish(self, error: Exception | None = None):
+        """Закрывает span: сетевое время = полное время минус ожидание в rate limiter и парсинг"""
+        self.total_ms = self.elapsed_ms()
+        self.network_ms = max(0.0, self.total_ms - self.queue_ms - self.parse_ms)
+        if error is not None:
+            self.status = "error"
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Перцентиль по nearest-rank"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return float(ordered[rank - 1])
+
+
+def summarize_spans(spans: list[dict]) -> dict:
+    """p50/p95/max по фазам и токенам, число ошибок и ретраев, доля попаданий в кэш"""
+    summary = {
+        "calls": len(spans),
+        "errors": sum(1 for s in spans if s.get("status") != "ok"),
+        "retries": sum(s.get("retries") or 0 for s in spans),
+        "cache_hit_rate": (sum(1 for s in spans if s.get("cache_hit")) / len(spans)) if spans else 0.0,
+    }
+    for field in SUMMARY_FIELDS:
+        values = [s[field] for s in spans if s.get(field) is not None]
+        if not values:
+            continue
+        summary[field] = {
+            "p50": _percentile(values, 50),
+            "p95": _percentile(values, 95),
+            "max": float(max(values)),
+            "sum": float(sum(values)),
+        }
+    return summary
+
+
+def load_spans(path: str) -> list[dict]:
+    """Читает spans из JSON lines файла, записанного RunTracer"""
+    with open(path, encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RunTracer:
+    """
+    Собирает CallSpan всех вызовов Runner. Если задан path — каждый span сразу
+    дописывается в него строкой JSON, чтобы считать SLO по истории запусков
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.spans = []
+
+    def record(self, span: CallSpan):
+        data = span.to_dict()
+        self.spans.append(data)
+        if self.path:
+            with open(self.path, "a", encoding="utf8") as f:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+    def summary(self) -> dict:
+        return summarize_spans(self.spans)
@@ -1,9 +1,41 @@
 import streamlit as st
 import pandas as pd
 import json
+import os
+import sys
+from pathlib import Path
+
+# streamlit кладет в sys.path только src/, а история запусков лежит в util/ корня репозитория
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+try:
+    from util.run_history import HISTORY_DB, RunHistory
+except ImportError:
+    RunHistory = None
+
+REPORT_FILE = "ux_metrics_analysis.json"
+PARTIAL_REPORT_FILE = "ux_metrics_analysis.partial.jsonl"
+HISTORY_LAST_RUNS = 30
+
+def load_partial_report(path):
+    """Элементы анализа, которые агент уже успел сгенерировать (по одному JSON в строке)"""
+    items = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError:
+                # последняя строка может быть дописана не до конца
+                break
+    return {"analysis": items, "partial": True}
 
 def load_json_data(*args):
-    with open("ux_metrics_analysis.json", 'r', encoding='utf-8') as file:
+    if os.path.exists(PARTIAL_REPORT_FILE) and (
+        not os.path.exists(REPORT_FILE)
+        or os.path.getmtime(PARTIAL_REPORT_FILE) > os.path.getmtime(REPORT_FILE)
+    ):
+        return load_partial_report(PARTIAL_REPORT_FILE)
+
+    with open(REPORT_FILE, 'r', encoding='utf-8') as file:
         data = json.load(file)
         return data
 
@@ -44,6 +76,10 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 st.title('Анализ UX метрик')
+if json_data.get('partial'):
+    st.info(f"Анализ еще выполняется: получено {len(json_data['analysis'])} метрик. Обновите страницу, чтобы увидеть новые.")
+elif json_data.get('truncated'):
+    st.warning("Ответ модели был обрезан: показаны только успевшие сгенерироваться метрики.")
 st.markdown('---')
 
 def calculate_overall_metrics(data):
@@ -206,6 +242,35 @@ st.table(table_data)
 
 st.markdown('---')
 
+if RunHistory is not None and HISTORY_DB.exists():
+    st.subheader('История метрик по запускам')
+
+    with RunHistory(HISTORY_DB) as history:
+        metric_options = [m['metric'] for m in json_data['analysis']]
+        selected_metric = st.selectbox("Метрика", metric_options) if metric_options else None
+        trend = history.metric_trend(selected_metric, last_runs=HISTORY_LAST_RUNS) if selected_metric else []
+        insights = history.insight_history(metric=selected_metric, report="metrics", last_runs=HISTORY_LAST_RUNS) if selected_metric else []
+
+    if trend:
+        trend_df = pd.DataFrame(trend).pivot_table(index='run_at', columns='version', values='value')
+        st.line_chart(trend_df)
+    else:
+        st.write("Снимков этой метрики в истории еще нет")
+
+    if insights:
+        st.write("**Выводы прошлых запусков**")
+        st.table([
+            {
+                "Запуск": row['run_at'],
+                "Версия A": row['version_a'],
+                "Версия B": row['version_b'],
+                "Вывод": row['insight'],
+            }
+            for row in reversed(insights)
+        ])
+
+    st.markdown('---')
+
 with st.expander("Просмотр исходных данных"):
     st.json(json_data)
 
@@ -0,0 +1,304 @@
+from pathlib import Path
+
+import polars as pl
+
+from url_alignment import ALIGNMENT_FILE, apply_alignment
+
+OUTPUT_DIR = Path("data/metrics")
+
+SITE_URL = "__site__"
+
+# метрики, которые считаются из дневных сумм compute_url_daily_series
+DAILY_METRICS = {
+    "page_hits": pl.col("page_hits").cast(pl.Float64),
+    "page_visits": pl.col("page_visits").cast(pl.Float64),
+    "bounce_rate": pl.col("page_bounces") / pl.col("page_visits") * 100,
+    "avg_pages_per_visit": pl.col("page_hits") / pl.col("page_visits"),
+    "avg_visit_depth": pl.col("sum_visit_hits") / pl.col("page_visits"),
+    "avg_duration_sec": pl.col("sum_visit_duration") / pl.col("page_visits"),
+}
+
+SUM_COLUMNS = ["page_hits", "page_visits", "page_bounces", "sum_visit_duration", "sum_visit_hits"]
+
+# метрики целей из дневных сумм etl_with_goals.goal_daily_series
+GOAL_DAILY_METRICS = {
+    "avg_steps": pl.col("sum_steps") / pl.col("goal_visits"),
+    "avg_duration_sec": pl.col("sum_duration") / pl.col("goal_visits"),
+}
+
+# IQR / 1.349 = стандартное отклонение для нормального распределения
+IQR_TO_SIGMA = 1.349
+
+
+def add_site_totals(daily: pl.DataFrame) -> pl.DataFrame:
+    """Добавляет к дневным рядам по URL ряд всего сайта (url = __site__)."""
+    site = (
+        daily
+        .group_by(["date", "version"])
+        .agg([pl.col(c).sum() for c in SUM_COLUMNS])
+        .with_columns(pl.lit(SITE_URL).alias("url"))
+    )
+    return pl.concat([daily.select(site.columns), site], how="vertical_relaxed")
+
+
+def to_long(daily: pl.DataFrame) -> pl.DataFrame:
+    """
+    Дневные суммы -> длинная таблица url, date, version, metric, value, volume.
+    volume (хиты + визиты за день) нужен для ранжирования: аномалия на странице
+    с десятью визитами важна меньше, чем на главной.
+    """
+    wide = daily.with_columns([
+        expr.alias(f"m__{name}") for name, expr in DAILY_METRICS.items()
+    ]).with_columns([
+        (pl.col("page_hits") + pl.col("page_visits")).cast(pl.Float64).alias("volume"),
+        pl.col("page_visits").cast(pl.Float64).alias("n_visits"),
+    ])
+    return (
+        wide
+        .unpivot(
+            index=["url", "date", "version", "volume", "n_visits"],
+            on=[f"m__{name}" for name in DAILY_METRICS],
+            variable_name="metric",
+            value_name="value",
+        )
+        .with_columns(pl.col("metric").str.strip_prefix("m__"))
+        .filter(pl.col("value").is_finite())
+    )
+
+
+def goal_to_long(daily: pl.DataFrame) -> pl.DataFrame:
+    """
+    Дневные суммы по целям -> та же длинная таблица, что у to_long: ряд цели идет в колонке url
+    (номер цели строкой), вес дня — число визитов с целью.
+    """
+    return (
+        daily
+        .with_columns([
+            pl.col("goal_id").cast(pl.Utf8).alias("url"),
+            pl.col("goal_visits").cast(pl.Float64).alias("volume"),
+            pl.col("goal_visits").cast(pl.Float64).alias("n_visits"),
+            *[expr.alias(f"m__{name}") for name, expr in GOAL_DAILY_METRICS.items()],
+        ])
+        .unpivot(
+            index=["url", "date", "version", "volume", "n_visits"],
+            on=[f"m__{name}" for name in GOAL_DAILY_METRICS],
+            variable_name="metric",
+            value_name="value",
+        )
+        .with_columns(pl.col("metric").str.strip_prefix("m__"))
+        .filter(pl.col("value").is_finite())
+    )
+
+
+def _sampling_noise(center: pl.Expr, n: pl.Expr) -> pl.Expr:
+    """
+    Ожидаемый разброс от одной только выборки: биномиальный для доли отказов
+    и пуассоновский для счетчиков. Без него доля отказов по странице с сотней визитов
+    в день давала бы «аномалии» на обычном шуме.
+    """
+    # сглаживание Лапласа: при нулевой базовой линии шум все равно не нулевой
+    p = ((center / 100).clip(0, 1) * n + 1) / (n + 2)
+    return (
+        pl.when(pl.col("metric") == "bounce_rate")
+        .then((p * (1 - p) / pl.max_horizontal(n, pl.lit(1.0))).sqrt() * 100)
+        .when(pl.col("metric").is_in(["page_hits", "page_visits"]))
+        .then((center.abs() + 1).sqrt())
+        .otherwise(0.0)
+    )
+
+
+def _robust_scale(q75: pl.Expr, q25: pl.Expr, center: pl.Expr, n: pl.Expr, rel_floor: float) -> pl.Expr:
+    """
+    Робастная оценка разброса по IQR. Снизу ограничена выборочным шумом и долей rel_floor
+    от уровня ряда, чтобы почти постоянные ряды не давали огромных z-score на любом шуме.
+    """
+    return pl.max_horizontal(
+        (q75 - q25) / IQR_TO_SIGMA,
+        _sampling_noise(center, n),
+        center.abs() * rel_floor,
+        pl.lit(1e-9),
+    )
+
+
+def detect_daily_anomalies(
+    long: pl.DataFrame,
+    window: int = 8,
+    min_history: int = 4,
+    z_threshold: float = 4.0,
+    rel_floor: float = 0.1,
+) -> pl.DataFrame:
+    """
+    Аномальные дни внутри одной версии с учетом недельной сезонности.
+    Базовая линия для дня — медиана значений за предыдущие window таких же дней недели
+    (понедельник сравнивается с прошлыми понедельниками), разброс — их IQR.
+    Все URL и метрики считаются одним векторным выражением через over(), без цикла по рядам.
+    """
+    group = ["url", "version", "metric", "weekday"]
+    history = pl.col("value").shift(1)
+
+    return (
+        long
+        .with_columns(pl.col("date").dt.weekday().alias("weekday"))
+        .sort(["url", "version", "metric", "date"])
+        .with_columns([
+            history.rolling_median(window, min_periods=min_history).over(group).alias("baseline"),
+            history.rolling_quantile(0.75, window_size=window, min_periods=min_history).over(group).alias("q75"),
+            history.rolling_quantile(0.25, window_size=window, min_periods=min_history).over(group).alias("q25"),
+        ])
+        .filter(pl.col("baseline").is_not_null())
+        .with_columns(
+            _robust_scale(pl.col("q75"), pl.col("q25"), pl.col("baseline"), pl.col("n_visits"), rel_floor)
+            .alias("scale")
+        )
+        .with_columns(((pl.col("value") - pl.col("baseline")) / pl.col("scale")).alias("robust_z"))
+        .filter(pl.col("robust_z").abs() >= z_threshold)
+        .select([
+            pl.lit("daily").alias("kind"),
+            "url", "version", "metric", "date", "value", "baseline", "robust_z", "volume",
+        ])
+    )
+
+
+def score_version_shift(
+    long: pl.DataFrame,
+    base_version: str = "v1",
+    new_version: str = "v2",
+    min_days: int = 3,
+    z_threshold: float = 3.0,
+    rel_floor: float = 0.05,
+) -> pl.DataFrame:
+    """
+    Сдвиг уровня между версиями: насколько медиана дневных значений new_version
+    отклоняется от распределения дневных значений base_version (робастный z-score).
+    Заменяет фиксированный порог |change| > 20%: у шумной метрики 20% — норма,
+    у стабильной и 5% — событие.
+    """
+    stats = (
+        long
+        .group_by(["url", "metric", "version"])
+        .agg([
+            pl.col("value").median().alias("median"),
+            pl.col("value").quantile(0.75).alias("q75"),
+            pl.col("value").quantile(0.25).alias("q25"),
+            pl.len().alias("days"),
+            pl.col("volume").sum().alias("volume"),
+            pl.col("n_visits").median().alias("n_visits"),
+        ])
+    )
+    base = stats.filter(pl.col("version") == base_version).drop("version")
+    new = stats.filter(pl.col("version") == new_version).drop("version")
+
+    return (
+        base
+        .join(new, on=["url", "metric"], how="inner", suffix="_new")
+        .filter((pl.col("days") >= min_days) & (pl.col("days_new") >= min_days))
+        .with_columns(
+            _robust_scale(pl.col("q75"), pl.col("q25"), pl.col("median"), pl.col("n_visits"), rel_floor)
+            .alias("scale")
+        )
+        .with_columns(((pl.col("median_new") - pl.col("median")) / pl.col("scale")).alias("robust_z"))
+        .filter(pl.col("robust_z").abs() >= z_threshold)
+        .select([
+            pl.lit("version_shift").alias("kind"),
+            "url",
+            pl.lit(new_version).alias("version"),
+            "metric",
+            pl.lit(None, dtype=pl.Date).alias("date"),
+            pl.col("median_new").alias("value"),
+            pl.col("median").alias("baseline"),
+            "robust_z",
+            pl.col("volume_new").alias("volume"),
+        ])
+    )
+
+
+def align_daily(daily: pl.DataFrame, alignment: pl.DataFrame, version: str) -> pl.DataFrame:
+    """
+    Дневные ряды версии под общими для обеих версий ключами URL (url_alignment.py):
+    страницы, переехавшие или склеенные нормализацией, суммируются под url_key.
+    """
+    return (
+        apply_alignment(daily, alignment, version)
+        .group_by(["url_key", "date", "version"])
+        .agg([pl.col(c).sum() for c in SUM_COLUMNS])
+        .rename({"url_key": "url"})
+    )
+
+
+def find_anomalies(
+    daily_v1: pl.DataFrame,
+    daily_v2: pl.DataFrame,
+    top_n: int | None = 500,
+    min_daily_volume: int = 20,
+    alignment: pl.DataFrame | None = None,
+) -> pl.DataFrame:
+    """
+    Кандидаты в проблемы для LLM: аномальные дни внутри версий и сдвиги уровня между версиями,
+    по всем URL и по сайту целиком. score = |z| * log(1 + volume), итог отсортирован по score.
+    Дни, где у страницы меньше min_daily_volume хитов и визитов, не участвуют: на них
+    любые доли — шум.
+
+    alignment — соответствие URL версий из url_alignment.py: с ним сдвиг между версиями
+    считается и для страниц, сменивших адрес (url в результате — адрес в new-версии).
+    Без него версии сравниваются по точному совпадению URL.
+    """
+    daily = pl.concat([daily_v1, daily_v2], how="vertical_relaxed")
+    long = to_long(add_site_totals(daily)).filter(pl.col("volume") >= min_daily_volume)
+
+    if alignment is not None:
+        aligned = pl.concat([
+            align_daily(daily_v1, alignment, "v1"),
+            align_daily(daily_v2, alignment, "v2"),
+        ], how="vertical_relaxed")
+        shift_long = to_long(add_site_totals(aligned)).filter(pl.col("volume") >= min_daily_volume)
+    else:
+        shift_long = long
+
+    return _rank(pl.concat([
+        detect_daily_anomalies(long),
+        score_version_shift(shift_long),
+    ], how="vertical_relaxed"), top_n)
+
+
+def find_goal_anomalies(
+    daily_v1: pl.DataFrame,
+    daily_v2: pl.DataFrame,
+    top_n: int | None = None,
+    min_daily_volume: int = 5,
+) -> pl.DataFrame:
+    """
+    То же для целей: аномальные дни и сдвиги между версиями средних шагов и длительности
+    визита с целью (goal_id вместо url). Визитов с целью в день намного меньше, чем хитов
+    страницы, поэтому порог объема дня ниже.
+    """
+    long = goal_to_long(pl.concat([daily_v1, daily_v2], how="vertical_relaxed")).filter(
+        pl.col("volume") >= min_daily_volume
+    )
+    return _rank(pl.concat([
+        detect_daily_anomalies(long),
+        score_version_shift(long),
+    ], how="vertical_relaxed"), top_n).rename({"url": "goal_id"})
+
+
+def _rank(candidates: pl.DataFrame, top_n: int | None) -> pl.DataFrame:
+    """score = |z| * log(1 + volume), по убыванию score"""
+    ranked = (
+        candidates
+        .with_columns((pl.col("robust_z").abs() * pl.col("volume").log1p()).alias("score"))
+        .sort(["score", "url", "metric"], descending=[True, False, False])
+    )
+    return ranked.head(top_n) if top_n else ranked
+
+
+if __name__ == "__main__":
+    url_daily_v1 = pl.read_parquet(OUTPUT_DIR / "url_daily_v1.parquet")
+    url_daily_v2 = pl.read_parquet(OUTPUT_DIR / "url_daily_v2.parquet")
+
+    alignment_file = OUTPUT_DIR / ALIGNMENT_FILE
+    alignment = pl.read_parquet(alignment_file) if alignment_file.exists() else None
+
+    anomalies = find_anomalies(url_daily_v1, url_daily_v2, alignment=alignment)
+    anomalies.write_parquet(OUTPUT_DIR / "anomalies_v1_v2.parquet")
+
+    print(f"anomalies_v1_v2.parquet сохранен: {anomalies.height} аномалий")
+    print(anomalies.head(20))
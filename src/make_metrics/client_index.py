@@ -0,0 +1,375 @@
+import json
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from profiling import progress, stage
+from sources import iter_source_batches, source_files
+
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+OUTPUT_DIR = Path("data/metrics")
+INDEX_DIR = OUTPUT_DIR / "client_index"
+
+BATCH_ROWS = 500_000
+
+# измерения множеств клиентов: все за версию, по дням, новые по дню первого визита, вернувшиеся, по URL, по целям
+DIMENSIONS = ("all", "day", "new_day", "returning", "url", "goal")
+
+RETENTION_DAYS = (1, 7, 30)
+
+# без pyroaring несжатые номера копятся в буфере и сливаются в отсортированный массив при переполнении
+_PENDING_LIMIT = 1 << 20
+
+
+class ClientSet:
+    """
+    Множество клиентов — плотных номеров uint32 из словаря ClientIndex.
+    С pyroaring это сжатый roaring bitmap: десятки миллионов клиентов занимают единицы мегабайт,
+    пересечение и объединение идут по контейнерам без распаковки. Без pyroaring — отсортированный
+    массив uint32 и np.intersect1d / np.union1d: те же ответы, но памяти 4 байта на клиента
+    """
+
+    __slots__ = ("_array", "_bitmap", "_pending", "_pending_size")
+
+    def __init__(self, ids=None):
+        self._bitmap = BitMap() if BitMap is not None else None
+        self._array = np.zeros(0, dtype=np.uint32)
+        self._pending: list[np.ndarray] = []
+        self._pending_size = 0
+        if ids is not None:
+            self.add_many(ids)
+
+    @classmethod
+    def _wrap(cls, bitmap=None, array: np.ndarray | None = None) -> "ClientSet":
+        result = cls()
+        if bitmap is not None:
+            result._bitmap = bitmap
+        else:
+            result._array = array
+        return result
+
+    def add_many(self, ids):
+        ids = np.asarray(ids, dtype=np.uint32)
+        if self._bitmap is not None:
+            self._bitmap.update(ids)
+            return
+        self._pending.append(ids)
+        self._pending_size += len(ids)
+        if self._pending_size >= _PENDING_LIMIT:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._array = np.unique(np.concatenate([self._array, *self._pending]))
+            self._pending = []
+            self._pending_size = 0
+
+    def _sorted(self) -> np.ndarray:
+        self._flush()
+        return self._array
+
+    def __len__(self) -> int:
+        return len(self._bitmap) if self._bitmap is not None else len(self._sorted())
+
+    def __and__(self, other: "ClientSet") -> "ClientSet":
+        if self._bitmap is not None:
+            return ClientSet._wrap(bitmap=self._bitmap & other._bitmap)
+        return ClientSet._wrap(array=np.intersect1d(self._sorted(), other._sorted(), assume_unique=True))
+
+    def __or__(self, other: "ClientSet") -> "ClientSet":
+        if self._bitmap is not None:
+            return ClientSet._wrap(bitmap=self._bitmap | other._bitmap)
+        return ClientSet._wrap(array=np.union1d(self._sorted(), other._sorted()))
+
+    def __sub__(self, other: "ClientSet") -> "ClientSet":
+        if self._bitmap is not None:
+            return ClientSet._wrap(bitmap=self._bitmap - other._bitmap)
+        return ClientSet._wrap(array=np.setdiff1d(self._sorted(), other._sorted(), assume_unique=True))
+
+    def intersection_len(self, other: "ClientSet") -> int:
+        """|self ∧ other| без построения пересечения (у roaring — подсчет по контейнерам)"""
+        if self._bitmap is not None:
+            return self._bitmap.intersection_cardinality(other._bitmap)
+        return len(np.intersect1d(self._sorted(), other._sorted(), assume_unique=True))
+
+    def to_numpy(self) -> np.ndarray:
+        if self._bitmap is not None:
+            return np.fromiter(self._bitmap, dtype=np.uint32, count=len(self._bitmap))
+        return self._sorted()
+
+    def serialize(self) -> bytes:
+        """
+        b"R" + переносимый формат roaring или b"A" + zlib от разностей соседних номеров
+        (у плотных множеств разности малы и хорошо сжимаются)
+        """
+        if self._bitmap is not None:
+            return b"R" + self._bitmap.serialize()
+        array = self._sorted()
+        return b"A" + zlib.compress(np.diff(array, prepend=np.uint32(0)).astype(np.uint32).tobytes())
+
+    @classmethod
+    def deserialize(cls, payload: bytes) -> "ClientSet":
+        kind, body = payload[:1], payload[1:]
+        if kind == b"R":
+            if BitMap is None:
+                raise ImportError("Client index was written with pyroaring; install pyroaring to read it")
+            return cls._wrap(bitmap=BitMap.deserialize(body))
+        array = np.cumsum(np.frombuffer(zlib.decompress(body), dtype=np.uint32), dtype=np.uint32)
+        if BitMap is not None:
+            return cls._wrap(bitmap=BitMap(array))
+        return cls._wrap(array=array)
+
+
+def intersect_all(sets: list[ClientSet]) -> ClientSet:
+    """Пересечение нескольких множеств, начиная с самого маленького"""
+    ordered = sorted(sets, key=len)
+    result = ordered[0]
+    for other in ordered[1:]:
+        result = result & other
+    return result
+
+
+class ClientIndex:
+    """
+    Индекс клиентов: словарь ym:s:clientID -> плотный номер (позиция в отсортированном массиве id,
+    общий для обеих версий — поэтому множества версий можно пересекать) и множества ClientSet
+    по ключам (версия, измерение, значение): активные за день, новые по дню первого визита,
+    посетившие URL, достигшие цели. Удержание, пересечение версий и воронки считаются
+    операциями над множествами, без self-join сырых визитов.
+
+    На диске — каталог с clients.npy (словарь) и sets.parquet (version, dim, key, clients, payload)
+    """
+
+    def __init__(self, client_ids: np.ndarray, sets: dict[tuple[str, str, str], ClientSet] | None = None):
+        self.client_ids = client_ids
+        self.sets = sets if sets is not None else {}
+
+    def lookup(self, client_ids) -> tuple[np.ndarray, np.ndarray]:
+        """(номер, есть ли id в словаре) для каждого client_id; в пустом словаре нет ни одного"""
+        client_ids = np.asarray(client_ids, dtype=np.uint64)
+        if len(self.client_ids) == 0:
+            return np.zeros(len(client_ids), dtype=np.uint32), np.zeros(len(client_ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.client_ids, client_ids), len(self.client_ids) - 1)
+        return pos.astype(np.uint32), self.client_ids[pos] == client_ids
+
+    def encode(self, client_ids) -> np.ndarray:
+        """Номера для client_id из словаря; неизвестные id отбрасываются"""
+        pos, found = self.lookup(client_ids)
+        return pos[found]
+
+    def decode(self, ids: np.ndarray) -> np.ndarray:
+        return self.client_ids[np.asarray(ids, dtype=np.int64)]
+
+    def get(self, version: str, dim: str, key: str = "") -> ClientSet:
+        """Множество по ключу; отсутствующий ключ — пустое множество"""
+        return self.sets.get((version, dim, str(key))) or ClientSet()
+
+    def keys(self, version: str, dim: str) -> list[str]:
+        return sorted(k for v, d, k in self.sets if v == version and d == dim)
+
+    def _add_groups(self, version: str, dim: str, groups: pl.DataFrame):
+        """groups — колонки key (Utf8) и ids (list[u32]) после group_by"""
+        for key, ids in groups.iter_rows():
+            if key is None:
+                continue
+            self.sets.setdefault((version, dim, key), ClientSet()).add_many(ids)
+
+    def save(self, index_dir: Path = INDEX_DIR) -> Path:
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / "clients.npy", self.client_ids)
+        keys = sorted(self.sets)
+        pl.DataFrame({
+            "version": [k[0] for k in keys],
+            "dim": [k[1] for k in keys],
+            "key": [k[2] for k in keys],
+            "clients": pl.Series([len(self.sets[k]) for k in keys], dtype=pl.UInt64),
+            "payload": pl.Series([self.sets[k].serialize() for k in keys], dtype=pl.Binary),
+        }).write_parquet(index_dir / "sets.parquet", compression="zstd")
+        return index_dir
+
+    @classmethod
+    def load(cls, index_dir: Path = INDEX_DIR, dims: list[str] | None = None) -> "ClientIndex":
+        """dims — загрузить только эти измерения (множества по URL обычно самые многочисленные)"""
+        index_dir = Path(index_dir)
+        sets_lf = pl.scan_parquet(index_dir / "sets.parquet")
+        if dims is not None:
+            sets_lf = sets_lf.filter(pl.col("dim").is_in(dims))
+        sets = {
+            (version, dim, key): ClientSet.deserialize(payload)
+            for version, dim, key, payload in sets_lf.select(["version", "dim", "key", "payload"]).collect().iter_rows()
+        }
+        return cls(np.load(index_dir / "clients.npy"), sets)
+
+
+def build_client_dictionary(versions: list[str], batch_rows: int = BATCH_ROWS) -> np.ndarray:
+    """Отсортированные уникальные ym:s:clientID всех версий: позиция в массиве — номер клиента"""
+    uniques = []
+    with stage("client_dictionary") as st:
+        for version in versions:
+            for visits in iter_source_batches("visits", version, ["ym:s:clientID"], batch_rows):
+                uniques.append(visits["ym:s:clientID"].drop_nulls().unique().to_numpy().astype(np.uint64))
+                st.add_rows_in(visits.height)
+        client_ids = np.unique(np.concatenate(uniques)) if uniques else np.zeros(0, dtype=np.uint64)
+        st.add_rows_out(len(client_ids))
+    return client_ids
+
+
+def _encoded(index: ClientIndex, df: pl.DataFrame, column: str) -> pl.DataFrame:
+    """df с колонкой cid — номером клиента; строки с неизвестным или пустым clientID отбрасываются"""
+    df = df.filter(pl.col(column).is_not_null())
+    if len(index.client_ids) == 0:
+        return df.clear().with_columns(pl.Series("cid", [], dtype=pl.UInt32))
+    pos, found = index.lookup(df[column].to_numpy())
+    return df.with_columns(pl.Series("cid", pos)).filter(pl.Series(found))
+
+
+def _grouped(df: pl.DataFrame, key: pl.Expr) -> pl.DataFrame:
+    return df.group_by(key.alias("key")).agg(pl.col("cid").unique().alias("ids"))
+
+
+def index_visits(index: ClientIndex, version: str, batch_rows: int = BATCH_ROWS):
+    """Множества all, day, new_day, returning и goal по визитам версии"""
+    visits_files = source_files("visits", version)
+    columns = ["ym:s:clientID", "ym:s:date", "ym:s:isNewUser", "ym:s:goalsID"]
+    total = 0
+    with stage(f"client_sets_visits_{version}", files=visits_files) as st:
+        for visits in iter_source_batches("visits", version, columns, batch_rows):
+            visits = _encoded(index, visits, "ym:s:clientID").with_columns(
+                pl.col("ym:s:date").cast(pl.Utf8).str.slice(0, 10).alias("day"),
+                pl.col("ym:s:isNewUser").cast(pl.Int64, strict=False).fill_null(0).alias("is_new"),
+            )
+            index.sets.setdefault((version, "all", ""), ClientSet()).add_many(visits["cid"].unique().to_numpy())
+            index._add_groups(version, "day", _grouped(visits, pl.col("day")))
+            index._add_groups(version, "new_day", _grouped(visits.filter(pl.col("is_new") == 1), pl.col("day")))
+            index.sets.setdefault((version, "returning", ""), ClientSet()).add_many(
+                visits.filter(pl.col("is_new") == 0)["cid"].unique().to_numpy()
+            )
+
+            goals = (
+                visits
+                .select([
+                    "cid",
+                    pl.col("ym:s:goalsID").str.json_decode(dtype=pl.List(pl.Utf8)).alias("goal"),
+                ])
+                .explode("goal")
+                .drop_nulls("goal")
+            )
+            index._add_groups(version, "goal", _grouped(goals, pl.col("goal")))
+
+            total += visits.height
+            progress(total, label=f"Client sets {version} visits")
+        st.add_rows_in(total)
+
+
+def index_hits(index: ClientIndex, version: str, batch_rows: int = BATCH_ROWS):
+    """Множества url по хитам версии: клиенты, открывавшие страницу"""
+    hits_files = source_files("hits", version)
+    total = 0
+    with stage(f"client_sets_hits_{version}", files=hits_files) as st:
+        for hits in iter_source_batches("hits", version, ["ym:pv:clientID", "ym:pv:URL"], batch_rows):
+            hits = _encoded(index, hits, "ym:pv:clientID")
+            index._add_groups(version, "url", _grouped(hits, pl.col("ym:pv:URL")))
+            total += hits.height
+            progress(total, label=f"Client sets {version} hits")
+        st.add_rows_in(total)
+
+
+def build_client_index(versions: list[str] = ("v1", "v2"), batch_rows: int = BATCH_ROWS) -> ClientIndex:
+    """Словарь клиентов и множества по визитам и хитам всех версий"""
+    versions = list(versions)
+    index = ClientIndex(build_client_dictionary(versions, batch_rows))
+    for version in versions:
+        index_visits(index, version, batch_rows)
+        index_hits(index, version, batch_rows)
+    return index
+
+
+def retention(index: ClientIndex, version: str, days: tuple[int, ...] = RETENTION_DAYS) -> dict[str, float | None]:
+    """
+    Удержание дня N: доля новых клиентов дня d, активных в день d + N, по всем когортам,
+    для которых день d + N попадает в данные версии (иначе None)
+    """
+    cohort_days = index.keys(version, "new_day")
+    active_days = set(index.keys(version, "day"))
+    last_day = max(active_days) if active_days else None
+    result = {}
+    for n in days:
+        retained = cohort = 0
+        for day in cohort_days:
+            target = (np.datetime64(day) + np.timedelta64(n, "D")).astype(str)
+            if last_day is None or target > last_day:
+                continue
+            new = index.get(version, "new_day", day)
+            cohort += len(new)
+            if target in active_days:
+                retained += new.intersection_len(index.get(version, "day", target))
+        result[f"retention_d{n}"] = float(retained / cohort * 100) if cohort else None
+    return result
+
+
+def client_metrics(index: ClientIndex, version: str) -> dict:
+    """Метрики клиентов версии для full_metrics: точное число клиентов, вернувшиеся, удержание"""
+    clients = index.get(version, "all")
+    returning = index.get(version, "returning")
+    active_days = [len(index.get(version, "day", day)) for day in index.keys(version, "day")]
+    metrics = {
+        "unique_clients": len(clients),
+        "returning_clients": len(returning),
+        "returning_client_rate": float(len(returning) / len(clients) * 100) if len(clients) else 0.0,
+        "avg_daily_clients": float(np.mean(active_days)) if active_days else 0.0,
+    }
+    metrics.update(retention(index, version))
+    return metrics
+
+
+def version_overlap(index: ClientIndex, a: str = "v1", b: str = "v2") -> dict:
+    """Сколько клиентов были и в версии a, и в версии b"""
+    clients_a, clients_b = index.get(a, "all"), index.get(b, "all")
+    both = clients_a.intersection_len(clients_b)
+    return {
+        f"clients_{a}": len(clients_a),
+        f"clients_{b}": len(clients_b),
+        "clients_both": both,
+        f"share_of_{a}_seen_in_{b}": float(both / len(clients_a) * 100) if len(clients_a) else 0.0,
+    }
+
+
+def funnel(index: ClientIndex, version: str, steps: list[tuple[str, str]]) -> list[dict]:
+    """
+    Воронка по шагам (измерение, ключ), например [("url", "https://priem.mai.ru/"), ("goal", "123")]:
+    клиенты, прошедшие все шаги до текущего включительно (без учета порядка во времени)
+    """
+    result = []
+    current = None
+    for dim, key in steps:
+        step = index.get(version, dim, key)
+        current = step if current is None else current & step
+        first = result[0]["clients"] if result else len(current)
+        result.append({
+            "dim": dim,
+            "key": key,
+            "step_clients": len(step),
+            "clients": len(current),
+            "conversion_from_first": float(len(current) / first * 100) if first else 0.0,
+        })
+    return result
+
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    index = build_client_index()
+    index_dir = index.save()
+    backend = "pyroaring" if BitMap is not None else "numpy"
+    print(f"Client index: {len(index.client_ids):,} clients, {len(index.sets):,} sets ({backend}) "
+          f"-> {index_dir} in {time.perf_counter() - started:.1f}s")
+    report = {version: client_metrics(index, version) for version in ("v1", "v2")}
+    report["overlap"] = version_overlap(index)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
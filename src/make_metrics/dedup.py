@@ -0,0 +1,250 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# потолок памяти множества увиденных id, включая дельты и фильтры Блума; сверх него партиции уходят на диск
+DEDUP_MEMORY_MB = int(os.environ.get("ETL_DEDUP_MEMORY_MB", "256"))
+
+# число партиций (степень двойки): id распределяются по ним хешем
+DEDUP_PARTITIONS = 64
+
+# бит фильтра Блума на id вынесенной на диск партиции и число хеш-функций: ~3% ложных срабатываний
+BLOOM_BITS_PER_ID = 8
+BLOOM_HASHES = 3
+
+# доля потолка памяти под фильтры Блума всех партиций: при тесном потолке фильтры становятся реже
+BLOOM_MEMORY_SHARE = 0.25
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX = np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+def _hash(ids: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        return ids.view(np.uint64) * _GOLDEN
+
+
+class _Bloom:
+    """Фильтр Блума партиции на диске: новый id почти всегда отсекается без чтения файла"""
+
+    __slots__ = ("bits", "shift")
+
+    def __init__(self, size_bits: int):
+        """size_bits — степень двойки"""
+        self.bits = np.zeros(size_bits // 8, dtype=np.uint8)
+        self.shift = np.uint64(64 - size_bits.bit_length() + 1)
+
+    def _positions(self, hashes: np.ndarray):
+        # старшие биты хеша задают партицию и внутри нее одинаковы: позиции берутся из перемешанных значений
+        with np.errstate(over="ignore"):
+            h1 = hashes * _MIX
+            h2 = ((hashes ^ (hashes >> np.uint64(29))) * _GOLDEN) | np.uint64(1)
+            for i in range(BLOOM_HASHES):
+                yield (h1 + np.uint64(i) * h2) >> self.shift
+
+    def add(self, hashes: np.ndarray):
+        for pos in self._positions(hashes):
+            np.bitwise_or.at(self.bits, pos >> np.uint64(3), (1 << (pos & np.uint64(7))).astype(np.uint8))
+
+    def might_contain(self, hashes: np.ndarray) -> np.ndarray:
+        result = np.ones(len(hashes), dtype=bool)
+        for pos in self._positions(hashes):
+            result &= ((self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1).astype(bool)
+        return result
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+
+def _contains_sorted(array: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """values (отсортированы) есть в отсортированном array"""
+    if len(array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    idx = np.searchsorted(array, values)
+    return array[np.minimum(idx, len(array) - 1)] == values
+
+
+def _merge_sorted(array: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Слияние отсортированных массивов без общих элементов за один проход"""
+    if len(array) == 0:
+        return np.array(values, dtype=np.uint64)
+    return np.insert(array, np.searchsorted(array, values), values)
+
+
+class IdDeduper:
+    """
+    Потоковая дедупликация uint64-идентификаторов (visitID, watchID) в ограниченной памяти.
+
+    Увиденные id разложены хешем по DEDUP_PARTITIONS партициям; в каждой — отсортированный
+    основной массив и небольшая дельта новых id, которая вливается в основной массив, когда
+    дорастает до его восьмой части. Потолок memory_mb проверяется после каждого добавления и
+    включает дельты и фильтры Блума: сверх него крупнейшие партиции сбрасываются в .npy и дальше
+    читаются через mmap, а когда в памяти остаются только дельты вынесенных партиций — крупнейшие
+    из них вливаются в свои файлы. Перед обращением к файлу id проверяется фильтром Блума
+    (фильтры делят BLOOM_MEMORY_SHARE потолка), так что на диск идут почти только настоящие дубли.
+    Ответ всегда точный
+    """
+
+    def __init__(self, memory_mb: int = DEDUP_MEMORY_MB, spill_dir: Path | None = None, partitions: int = DEDUP_PARTITIONS):
+        self.partitions = partitions
+        self._shift = np.uint64(64 - int(np.log2(partitions)))
+        self._memory_limit = memory_mb << 20
+        # освобождаем с запасом до 7/8 потолка, чтобы не сбрасывать по партиции на каждый кусок
+        self._memory_target = self._memory_limit - self._memory_limit // 8
+        self._bloom_bits_cap = int(self._memory_limit * BLOOM_MEMORY_SHARE) // partitions * 8
+        self._spill_root = spill_dir
+        self._spill_dir: Path | None = None
+        self._main = [np.zeros(0, dtype=np.uint64) for _ in range(partitions)]
+        self._delta = [np.zeros(0, dtype=np.uint64) for _ in range(partitions)]
+        self._spilled: list[Path | None] = [None] * partitions
+        self._spilled_size = [0] * partitions
+        self._blooms: list[_Bloom | None] = [None] * partitions
+        self.seen = 0
+        self.duplicates = 0
+        self.spills = 0
+        self.peak_memory_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _main_array(self, p: int) -> np.ndarray:
+        if self._spilled[p] is not None:
+            return np.load(self._spilled[p], mmap_mode="r")
+        return self._main[p]
+
+    def _main_size(self, p: int) -> int:
+        return self._spilled_size[p] if self._spilled[p] is not None else len(self._main[p])
+
+    def _contains(self, p: int, values: np.ndarray) -> np.ndarray:
+        found = _contains_sorted(self._delta[p], values)
+        if self._spilled[p] is None:
+            return found | _contains_sorted(self._main[p], values)
+        candidates = ~found
+        if self._blooms[p] is not None:
+            candidates &= self._blooms[p].might_contain(values)
+        if candidates.any():
+            found[candidates] = _contains_sorted(self._main_array(p), values[candidates])
+        return found
+
+    def _add(self, p: int, values: np.ndarray):
+        if len(values) == 0:
+            return
+        self._delta[p] = _merge_sorted(self._delta[p], values)
+        if len(self._delta[p]) > self._main_size(p) // 8 + 65_536:
+            self._merge(p)
+        self._enforce_budget()
+
+    def _merge(self, p: int):
+        merged = _merge_sorted(np.asarray(self._main_array(p)), self._delta[p])
+        self._delta[p] = np.zeros(0, dtype=np.uint64)
+        if self._spilled[p] is not None:
+            self._write_spill(p, merged)
+        else:
+            self._main[p] = merged
+
+    def _bloom_bits(self, count: int) -> int:
+        """
+        Размер фильтра партиции: BLOOM_BITS_PER_ID на id, округление до степени двойки, но не больше
+        доли партиции в бюджете фильтров. Меньше бита на id фильтр почти всегда отвечает «возможно»
+        и только тратит время — тогда его нет (0), и кандидаты сразу ищутся в файле
+        """
+        bits = 1 << max(6, (count * BLOOM_BITS_PER_ID - 1).bit_length())
+        while bits > self._bloom_bits_cap:
+            bits >>= 1
+        return bits if bits >= count else 0
+
+    def _write_spill(self, p: int, array: np.ndarray):
+        if self._spill_dir is None:
+            self._spill_dir = Path(tempfile.mkdtemp(prefix="etl_dedup_", dir=self._spill_root))
+        path = self._spill_dir / f"part-{p:03d}.npy"
+        np.save(path, array)
+        self._blooms[p] = None
+        size_bits = self._bloom_bits(len(array))
+        if size_bits:
+            bloom = _Bloom(size_bits)
+            bloom.add(array)
+            self._blooms[p] = bloom
+        self._spilled[p] = path
+        self._spilled_size[p] = len(array)
+
+    @property
+    def memory_bytes(self) -> int:
+        return (
+            sum(a.nbytes for a in self._main)
+            + sum(a.nbytes for a in self._delta)
+            + sum(b.nbytes for b in self._blooms if b is not None)
+        )
+
+    def _enforce_budget(self):
+        """
+        Если память выше потолка — освобождает ее до 7/8 потолка: сначала крупнейшие партиции
+        в памяти (основной массив с дельтой) уходят на диск, потом крупнейшие дельты вынесенных
+        партиций вливаются в свои файлы. Фильтры Блума ограничены своей долей и не вытесняются
+        """
+        memory = self.memory_bytes
+        if memory <= self._memory_limit:
+            self.peak_memory_bytes = max(self.peak_memory_bytes, memory)
+            return
+        while memory > self._memory_target:
+            in_memory = [p for p in range(self.partitions) if self._spilled[p] is None and self._main_size(p) + len(self._delta[p])]
+            if in_memory:
+                p = max(in_memory, key=lambda i: self._main[i].nbytes + self._delta[i].nbytes)
+                array = _merge_sorted(self._main[p], self._delta[p])
+                self._main[p] = np.zeros(0, dtype=np.uint64)
+                self._delta[p] = np.zeros(0, dtype=np.uint64)
+                self._write_spill(p, array)
+                self.spills += 1
+            else:
+                deltas = [p for p in range(self.partitions) if len(self._delta[p])]
+                if not deltas:
+                    break
+                self._merge(max(deltas, key=lambda i: len(self._delta[i])))
+            memory = self.memory_bytes
+        self.peak_memory_bytes = max(self.peak_memory_bytes, memory)
+
+    def duplicate_mask(self, ids) -> np.ndarray:
+        """
+        True для id, которые уже встречались — раньше в потоке или выше в этом же куске;
+        первое вхождение остается (False) и запоминается
+        """
+        ids = np.ascontiguousarray(ids, dtype=np.uint64)
+        mask = np.zeros(len(ids), dtype=bool)
+        if len(ids) == 0:
+            return mask
+        # хеш — биекция uint64, поэтому хранятся и сравниваются хеши: сортировка по ним сразу
+        # группирует партиции, и на кусок нужна одна сортировка
+        hashes = _hash(ids)
+        order = np.argsort(hashes, kind="stable")
+        sorted_hashes = hashes[order]
+        repeat = np.zeros(len(ids), dtype=bool)
+        repeat[1:] = sorted_hashes[1:] == sorted_hashes[:-1]
+        unique = sorted_hashes[~repeat]
+
+        bounds = np.searchsorted(unique, np.arange(self.partitions + 1, dtype=np.uint64) << self._shift)
+        bounds[-1] = len(unique)
+        seen = np.zeros(len(unique), dtype=bool)
+        for p in range(self.partitions):
+            lo, hi = bounds[p], bounds[p + 1]
+            if lo == hi:
+                continue
+            values = unique[lo:hi]
+            found = self._contains(p, values)
+            seen[lo:hi] = found
+            self._add(p, values[~found])
+
+        mask[order] = repeat | seen[np.cumsum(~repeat) - 1]
+        self.seen += len(ids)
+        self.duplicates += int(mask.sum())
+        return mask
@@ -0,0 +1,136 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import polars as pl
+
+from profiling import stage
+from visit_hit_join import OUTPUT_DIR, visit_hits_dir
+
+# время на странице дольше получаса — брошенная вкладка, а не чтение
+MAX_DWELL_SEC = 1800
+
+# лог-шкала корзин гистограммы: границы (1.1^b - 1) сек, относительная ошибка квантиля ~5%
+BIN_GROWTH = 1.1
+
+QUANTILES = {"median_time_on_page_sec": 0.5, "p75_time_on_page_sec": 0.75, "p90_time_on_page_sec": 0.9}
+
+ENGAGEMENT_COLUMNS = ["dwell_hits", "avg_time_on_page_sec", *QUANTILES]
+
+
+def dwell_bin(seconds: pl.Expr) -> pl.Expr:
+    """Номер корзины гистограммы для времени на странице."""
+    return (seconds.log1p() / math.log(BIN_GROWTH)).floor().cast(pl.UInt16)
+
+
+def partition_dwell_sketch(path: Path) -> pl.DataFrame:
+    """
+    Скетч одной партиции visit_hits: для каждого url число хитов по корзинам времени на странице
+    и сумма секунд. Последний хит визита (time_on_page_sec = null) не учитывается: после него
+    следующего хита нет, и время на нем неизвестно.
+    """
+    return (
+        pl.scan_parquet(path)
+        .select(["url", "time_on_page_sec"])
+        .filter(pl.col("time_on_page_sec").is_not_null() & pl.col("url").is_not_null())
+        .with_columns(pl.col("time_on_page_sec").clip(0, MAX_DWELL_SEC).cast(pl.Float64))
+        .group_by(["url", dwell_bin(pl.col("time_on_page_sec")).alias("bin")])
+        .agg([
+            pl.len().cast(pl.UInt64).alias("hits"),
+            pl.col("time_on_page_sec").sum().alias("sum_sec"),
+        ])
+        .collect()
+    )
+
+
+def merge_sketches(sketches: list[pl.DataFrame]) -> pl.DataFrame:
+    """Скетчи складываются покорзинно — результат не зависит от того, как данные делились на партиции."""
+    return (
+        pl.concat(sketches)
+        .group_by(["url", "bin"])
+        .agg([pl.col("hits").sum(), pl.col("sum_sec").sum()])
+        .sort(["url", "bin"])
+    )
+
+
+def sketch_quantiles(sketch: pl.DataFrame) -> pl.DataFrame:
+    """
+    Квантили по гистограмме: корзина, в которой накопленная доля хитов достигает q,
+    и линейная интерполяция внутри нее. Все url считаются одним выражением через over().
+    """
+    lower = pl.lit(BIN_GROWTH).pow(pl.col("bin").cast(pl.Float64)) - 1
+    upper = pl.lit(BIN_GROWTH).pow(pl.col("bin").cast(pl.Float64) + 1) - 1
+
+    ranked = (
+        sketch
+        .sort(["url", "bin"])
+        .with_columns([
+            pl.col("hits").cum_sum().over("url").alias("cum_hits"),
+            pl.col("hits").sum().over("url").alias("total_hits"),
+        ])
+        .with_columns((pl.col("cum_hits") - pl.col("hits")).alias("before"))
+    )
+
+    quantile_exprs = []
+    for name, q in QUANTILES.items():
+        target = pl.col("total_hits") * q
+        inside = (target - pl.col("before")) / pl.col("hits")
+        estimate = (lower + (upper - lower) * inside).clip(0, MAX_DWELL_SEC)
+        quantile_exprs.append(
+            estimate.filter((pl.col("cum_hits") >= target) & (pl.col("before") < target)).first().alias(name)
+        )
+
+    return (
+        ranked
+        .group_by("url")
+        .agg([
+            pl.col("hits").sum().alias("dwell_hits"),
+            (pl.col("sum_sec").sum() / pl.col("hits").sum()).alias("avg_time_on_page_sec"),
+            *quantile_exprs,
+        ])
+        .with_columns([pl.col(name).round(1) for name in ["avg_time_on_page_sec", *QUANTILES]])
+        .sort("dwell_hits", descending=True)
+    )
+
+
+def compute_url_engagement(version: str, workers: int | None = None) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Время на странице по URL из таблицы визит -> хиты (visit_hit_join.build_visit_hit_map).
+    Партиции обрабатываются параллельно в пуле потоков (polars отпускает GIL), их скетчи
+    сливаются. Возвращает (метрики по url, объединенный скетч) — скетч сохраняется отдельно,
+    чтобы позже слить его с данными за другие периоды без пересчета.
+    """
+    parts = sorted(visit_hits_dir(version).glob("part-*.parquet"))
+    if not parts:
+        raise FileNotFoundError(f"No visit->hit partitions for {version}: run visit_hit_join.py first")
+
+    with stage("dwell_sketch") as st:
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 4)) as pool:
+            sketches = list(pool.map(partition_dwell_sketch, parts))
+        sketch = merge_sketches(sketches)
+        st.add_rows_out(sketch.height)
+
+    with stage("dwell_quantiles") as st:
+        engagement = sketch_quantiles(sketch)
+        st.add_rows_out(engagement.height)
+
+    return engagement, sketch
+
+
+def add_engagement(url_metrics: pl.DataFrame, engagement: pl.DataFrame) -> pl.DataFrame:
+    """Добавляет к url_metrics колонки времени на странице; у url без данных dwell_hits = 0."""
+    return (
+        url_metrics
+        .join(engagement.select(["url", *ENGAGEMENT_COLUMNS]), on="url", how="left")
+        .with_columns([pl.col(c).fill_null(0) for c in ENGAGEMENT_COLUMNS])
+    )
+
+
+if __name__ == "__main__":
+    for version in ("v1", "v2"):
+        engagement, sketch = compute_url_engagement(version)
+        engagement.write_parquet(OUTPUT_DIR / f"url_engagement_{version}.parquet")
+        sketch.write_parquet(OUTPUT_DIR / f"url_dwell_sketch_{version}.parquet")
+        print(f"url_engagement_{version}.parquet сохранен: {engagement.height:,} URL")
+        print(engagement.head(10))
@@ -1,20 +1,15 @@
+from collections import defaultdict
 from pathlib import Path
+
 import polars as pl
-from collections import defaultdict
 
-DATA_DIR = Path("data/raw")
+from anomaly_detection import find_goal_anomalies
+from sites import visit_columns, visit_site, write_site_partitions
+from sources import scan_source
+
 OUTPUT_DIR = Path("data/metrics")
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-HITS_FILES = {
-    "v1": "2022_yandex_metrika_hits.parquet",
-    "v2": "2024_yandex_metrika_hits.parquet",
-}
-VISITS_FILES = {
-    "v1": "2022_yandex_metrika_visits.parquet",
-    "v2": "2024_yandex_metrika_visits.parquet",
-}
-
 CHUNK_SIZE = 100_000
 
 def visits_with_n_hits(df: pl.DataFrame) -> pl.DataFrame:
@@ -52,14 +47,32 @@ def add_goals(df: pl.DataFrame) -> pl.DataFrame:
 
 
 
+def goal_daily_series(goals_expanded: pl.DataFrame, version: str) -> pl.DataFrame:
+    """
+    Дневные ряды по целям: goal_id, date, version, goal_visits, sum_steps, sum_duration.
+    Суммы, а не средние — anomaly_detection.find_goal_anomalies считает по ним средние за день
+    """
+    return (
+        goals_expanded
+        .group_by([
+            "goal_id",
+            pl.col("ym:s:dateTime").cast(pl.Utf8).str.slice(0, 10).str.to_date("%Y-%m-%d", strict=False).alias("date"),
+        ])
+        .agg([
+            pl.len().alias("goal_visits"),
+            pl.col("hits_count").sum().cast(pl.Float64).alias("sum_steps"),
+            pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).sum().alias("sum_duration"),
+        ])
+        .filter(pl.col("date").is_not_null())
+        .with_columns(pl.lit(version).alias("version"))
+        .sort(["goal_id", "date"])
+    )
 
 
 def compute_advanced_metrics(version: str) -> dict:
     """Полный набор метрик для одной версии"""
     print(f"\n=== ГЛУБОКИЙ АНАЛИЗ {version} ===")
     
-    visits_file = DATA_DIR / VISITS_FILES[version]
-    hits_file = DATA_DIR / HITS_FILES[version]
     
     metrics = defaultdict(float)
     
@@ -68,8 +81,7 @@ def compute_advanced_metrics(version: str) -> dict:
 
     print("Базовые метрики...")
     visits_lf = (
-        pl.scan_parquet(visits_file)
-        .select([
+        scan_source("visits", version, [
             "ym:s:visitID", "ym:s:counterID", "ym:s:watchIDs", "ym:s:isNewUser", 
             "ym:s:date", "ym:s:dateTime", "ym:s:dateTimeUTC", "ym:s:visitDuration", "ym:s:startURL",
             "ym:s:endURL", "ym:s:goalsID"
@@ -115,15 +127,15 @@ def compute_advanced_metrics(version: str) -> dict:
     
     # HITS
     hits_lf = (
-        pl.scan_parquet(hits_file)
-        .select([
+        scan_source("hits", version, [
             "ym:pv:watchID", "ym:pv:pageViewID", "ym:pv:URL", 
             "ym:pv:dateTime", "ym:pv:clientID"
         ])
     )
     
     total_hits = 0
-    unique_users = 0
+    # n_unique по кускам складывать нельзя: клиент из нескольких кусков посчитался бы несколько раз
+    chunk_clients = []
     landing_pages = defaultdict(int)
     exit_pages = defaultdict(int)
     depth_1 = depth_2plus = 0
@@ -134,7 +146,7 @@ def compute_advanced_metrics(version: str) -> dict:
         chunk_hits = hits.height
         total_hits += chunk_hits
 
-        unique_users += hits["ym:pv:clientID"].n_unique()
+        chunk_clients.append(hits["ym:pv:clientID"].unique())
 
         top_pages = (
             hits.group_by("ym:pv:URL")
@@ -147,6 +159,8 @@ def compute_advanced_metrics(version: str) -> dict:
         
         print(f"  Hits: {total_hits:,}")
 
+    unique_users = pl.concat(chunk_clients).n_unique() if chunk_clients else 0
+
     # БОЛЕЕ ГЛУБОКИЕ МЕТРИКИ
     
     # Конверсия по глубине просмотра
@@ -180,17 +194,18 @@ def compute_advanced_metrics(version: str) -> dict:
 
 
 
+    goals_columns = [
+        "ym:s:visitID",
+        "ym:s:dateTime",
+        "ym:s:startURL",
+        "ym:s:endURL",
+        "ym:s:visitDuration",
+        "ym:s:watchIDs",
+        "ym:s:goalsID",
+    ]
     visits_goals_df = (
-        pl.scan_parquet(visits_file)
-        .select([
-            "ym:s:visitID",
-            "ym:s:dateTime",
-            "ym:s:startURL",
-            "ym:s:endURL",
-            "ym:s:visitDuration",
-            "ym:s:watchIDs",
-            "ym:s:goalsID",
-        ])
+        scan_source("visits", version, goals_columns + [c for c in visit_columns() if c not in goals_columns])
+        .with_columns(visit_site())
         .collect(streaming=True)
     )
 
@@ -228,6 +243,18 @@ def compute_advanced_metrics(version: str) -> dict:
     })
 
     goal_stats.write_parquet(OUTPUT_DIR / f"goal_stats_{version}.parquet")
+    goal_daily_series(goals_expanded, version).write_parquet(OUTPUT_DIR / f"goal_daily_{version}.parquet")
+
+    # те же цели по сайтам: та же таблица, сгруппированная еще и по site
+    site_goal_stats = (
+        goals_expanded
+        .group_by(["site", "goal_id"])
+        .agg([
+            pl.col("hits_count").mean().alias("avg_steps"),
+            pl.col("ym:s:visitDuration").mean().alias("avg_duration_sec"),
+        ])
+    )
+    write_site_partitions(site_goal_stats, f"goal_stats_{version}.parquet")
 
 
 
@@ -266,47 +293,62 @@ def compute_advanced_metrics(version: str) -> dict:
     return dict(metrics)
 
 
+if __name__ == "__main__":
+    metrics_v1 = compute_advanced_metrics("v1")
+    metrics_v2 = compute_advanced_metrics("v2")
 
+    goal_stats_v1 = pl.read_parquet(OUTPUT_DIR / "goal_stats_v1.parquet")
+    goal_stats_v2 = pl.read_parquet(OUTPUT_DIR / "goal_stats_v2.parquet")
 
-
-
-
-metrics_v1 = compute_advanced_metrics("v1")
-metrics_v2 = compute_advanced_metrics("v2")
-
-goal_stats_v1 = pl.read_parquet(OUTPUT_DIR / "goal_stats_v1.parquet")
-goal_stats_v2 = pl.read_parquet(OUTPUT_DIR / "goal_stats_v2.parquet")
-
-common_goals = (
-        goal_stats_v1.select("goal_id")
-        .join(goal_stats_v2.select("goal_id"), on="goal_id", how="inner")
-        .unique()
+    # цели, которые есть только в одной версии, в сравнение не попадают — но и не теряются молча
+    goal_presence = (
+        goal_stats_v1.select("goal_id").unique().with_columns(pl.lit(True).alias("in_v1"))
+        .join(
+            goal_stats_v2.select("goal_id").unique().with_columns(pl.lit(True).alias("in_v2")),
+            on="goal_id", how="full", coalesce=True,
+        )
+        .with_columns([pl.col("in_v1").fill_null(False), pl.col("in_v2").fill_null(False)])
+        .sort("goal_id")
     )
+    goal_presence.write_parquet(OUTPUT_DIR / "goal_presence_v1_v2.parquet")
 
-goal_stats_v1_common = goal_stats_v1.join(common_goals, on="goal_id", how="inner")
-goal_stats_v2_common = goal_stats_v2.join(common_goals, on="goal_id", how="inner")
+    common_goals = goal_presence.filter(pl.col("in_v1") & pl.col("in_v2")).select("goal_id")
+    only_v1 = goal_presence.filter(~pl.col("in_v2")).height
+    only_v2 = goal_presence.filter(~pl.col("in_v1")).height
+    print(f"Цели: общих {common_goals.height}, только в v1 {only_v1}, только в v2 {only_v2} "
+          f"(goal_presence_v1_v2.parquet)")
 
-goal_stats_v1_common = goal_stats_v1_common.with_columns(pl.lit("v1").alias("version"))
-goal_stats_v2_common = goal_stats_v2_common.with_columns(pl.lit("v2").alias("version"))
+    goal_stats_v1_common = goal_stats_v1.join(common_goals, on="goal_id", how="inner")
+    goal_stats_v2_common = goal_stats_v2.join(common_goals, on="goal_id", how="inner")
 
-goal_stats_both = pl.concat([goal_stats_v1_common, goal_stats_v2_common])
+    goal_stats_v1_common = goal_stats_v1_common.with_columns(pl.lit("v1").alias("version"))
+    goal_stats_v2_common = goal_stats_v2_common.with_columns(pl.lit("v2").alias("version"))
 
-goal_stats_both.write_parquet(OUTPUT_DIR / "goal_stats_common_v1_v2.parquet")
+    goal_stats_both = pl.concat([goal_stats_v1_common, goal_stats_v2_common])
 
+    goal_stats_both.write_parquet(OUTPUT_DIR / "goal_stats_common_v1_v2.parquet")
+
+    # вместо порога |change| > 20% цели сравниваются детектором аномалий по дневным рядам
+    goal_anomalies = find_goal_anomalies(
+        pl.read_parquet(OUTPUT_DIR / "goal_daily_v1.parquet"),
+        pl.read_parquet(OUTPUT_DIR / "goal_daily_v2.parquet"),
+    )
+    goal_anomalies.write_parquet(OUTPUT_DIR / "goal_anomalies_v1_v2.parquet")
+    print(f"goal_anomalies_v1_v2.parquet сохранен: {goal_anomalies.height} аномалий")
 
 
-key_metrics = [
-    "total_visits", "total_hits", "unique_users", "new_users",
-    "new_user_rate", "bounce_rate", "pages_per_visit", 
-    "deep_visits_rate", "hits_per_user", "visits_per_user"
-]
 
-comparison = pl.DataFrame({
-    "metric": key_metrics,
-    "v1": pl.Series("v1", [metrics_v1.get(m, 0) for m in key_metrics], dtype=pl.Float64),
-    "v2": pl.Series("v2", [metrics_v2.get(m, 0) for m in key_metrics], dtype=pl.Float64)
-})
+    key_metrics = [
+        "total_visits", "total_hits", "unique_users", "new_users",
+        "new_user_rate", "bounce_rate", "pages_per_visit", 
+        "deep_visits_rate", "hits_per_user", "visits_per_user"
+    ]
 
-comparison.write_parquet(OUTPUT_DIR / "advanced_metrics.parquet")
-pl.DataFrame([{"version": "v1", **metrics_v1}, {"version": "v2", **metrics_v2}]).write_parquet(OUTPUT_DIR / "full_metrics.parquet")
+    comparison = pl.DataFrame({
+        "metric": key_metrics,
+        "v1": pl.Series("v1", [metrics_v1.get(m, 0) for m in key_metrics], dtype=pl.Float64),
+        "v2": pl.Series("v2", [metrics_v2.get(m, 0) for m in key_metrics], dtype=pl.Float64)
+    })
 
+    comparison.write_parquet(OUTPUT_DIR / "advanced_metrics.parquet")
+    pl.DataFrame([{"version": "v1", **metrics_v1}, {"version": "v2", **metrics_v2}]).write_parquet(OUTPUT_DIR / "full_metrics.parquet")
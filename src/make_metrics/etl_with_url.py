@@ -1,20 +1,31 @@
+from collections import defaultdict
 from pathlib import Path
+
 import polars as pl
-from collections import defaultdict
 
-DATA_DIR = Path("data/raw")
+from anomaly_detection import find_anomalies
+from client_index import build_client_index, client_metrics, version_overlap
+from engagement import add_engagement, compute_url_engagement
+from logs_api_convert import EXPORTS_DIR, convert_pending_exports
+from profiling import activate, profiler_from_env, progress, stage
+from sites import (
+    SiteMetrics,
+    host_site_counts,
+    host_site_map,
+    visit_columns,
+    visit_site,
+    with_hit_site,
+    write_site_full_metrics,
+    write_site_partitions,
+)
+from sources import duplicate_count, scan_source, source_files
+from traffic_filter import TrafficFilter, robot_columns
+from url_alignment import ALIGNMENT_FILE, align_daily_series, alignment_summary
+from visit_hit_join import build_visit_hit_map
+
 OUTPUT_DIR = Path("data/metrics")
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-HITS_FILES = {
-    "v1": "2022_yandex_metrika_hits.parquet",
-    "v2": "2024_yandex_metrika_hits.parquet",
-}
-VISITS_FILES = {
-    "v1": "2022_yandex_metrika_visits.parquet",
-    "v2": "2024_yandex_metrika_visits.parquet",
-}
-
 CHUNK_SIZE = 100_000
 
 def add_hits_count(df: pl.DataFrame) -> pl.DataFrame:
@@ -33,22 +44,27 @@ def add_hits_count(df: pl.DataFrame) -> pl.DataFrame:
         )
     )
 
-def compute_advanced_metrics(version: str) -> dict:
-    """Полный набор метрик для одной версии"""
+def compute_advanced_metrics(version: str, sites: SiteMetrics | None = None) -> dict:
+    """
+    Полный набор метрик для одной версии. sites — накопитель метрик по сайтам (counterID):
+    куски того же прохода сводятся еще и по сайту
+    """
     print(f"\n=== ГЛУБОКИЙ АНАЛИЗ {version} ===")
     
-    visits_file = DATA_DIR / VISITS_FILES[version]
-    hits_file = DATA_DIR / HITS_FILES[version]
+    visits_files = source_files("visits", version)
+    hits_files = source_files("hits", version)
 
     metrics = defaultdict(float)
     
     # БАЗОВЫЕ МЕТРИКИ (VISITS)
     print("Базовые метрики...")
+    visits_columns = [
+        "ym:s:visitID", "ym:s:counterID", "ym:s:clientID", "ym:s:watchIDs", "ym:s:isNewUser", 
+        "ym:s:date", "ym:s:dateTime", "ym:s:dateTimeUTC", "ym:s:visitDuration", "ym:s:startURL", "ym:s:endURL"
+    ]
     visits_lf = (
-        pl.scan_parquet(visits_file)
-        .select([
-            "ym:s:visitID", "ym:s:counterID", "ym:s:watchIDs", "ym:s:isNewUser", 
-            "ym:s:date", "ym:s:dateTime", "ym:s:dateTimeUTC", "ym:s:visitDuration", "ym:s:startURL", "ym:s:endURL"
+        scan_source("visits", version, visits_columns + [
+            c for c in visit_columns() + robot_columns("visits", version) if c not in visits_columns
         ])
     )
     
@@ -58,64 +74,114 @@ def compute_advanced_metrics(version: str) -> dict:
     bounce_visits = 0
     avg_duration = 0.0
     visit_durations = []
+    human_visits = human_new_users = human_bounce_visits = 0
+    human_visit_duration = 0.0
+
+    with stage("visits_scan", files=visits_files) as st:
+        visits_all = visits_lf.collect(streaming=True)
+        st.add_rows_out(visits_all.height)
+
+    hits_lf = (
+        scan_source("hits", version, [
+            "ym:pv:watchID", "ym:pv:pageViewID", "ym:pv:URL", 
+            "ym:pv:dateTime", "ym:pv:clientID", *robot_columns("hits", version)
+        ])
+    )
+    with stage("hits_scan", files=hits_files) as st:
+        hits_all = hits_lf.collect(streaming=True)
+        st.add_rows_out(hits_all.height)
+
+    # клиенты-роботы размечаются до агрегации: полные и очищенные (human_*) метрики — из одного прохода,
+    # а таблица клиентов считается по уже прочитанным визитам и хитам, без повторного чтения файлов
+    traffic = TrafficFilter.from_frames(visits_all, hits_all)
 
-    batches = visits_lf.collect(streaming=True).iter_slices(CHUNK_SIZE)
+    batches = visits_all.iter_slices(CHUNK_SIZE)
     for batch in batches:
         visits = batch
         chunk_size = visits.height
         total_visits += chunk_size
 
-        new_users += visits.select(pl.col("ym:s:isNewUser").sum()).item()
+        with stage("json_decode") as st:
+            visits_hc = add_hits_count(visits)
+            st.add_rows_in(chunk_size)
 
-        visits_hc = add_hits_count(visits)
-        chunk_bounce = visits_hc.select(pl.col("hits_count").eq(1).sum()).item()
-        bounce_visits += chunk_bounce
+        with stage("traffic_mark") as st:
+            visits_hc = traffic.mark(visits_hc, "ym:s:clientID", "visits")
+            st.add_rows_in(chunk_size)
 
-        sum_visit_duration += (
-            visits
-            .select(pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).sum())
-            .item()
-        )
-        
-        print(f"  Visits: {total_visits:,}")
+        if sites is not None:
+            with stage("sites_group_by") as st:
+                sites.add_visits(visits_hc)
+                st.add_rows_in(chunk_size)
+
+        with stage("visits_aggregate") as st:
+            new_users += visits.select(pl.col("ym:s:isNewUser").sum()).item()
+
+            chunk_bounce = visits_hc.select(pl.col("hits_count").eq(1).sum()).item()
+            bounce_visits += chunk_bounce
+
+            sum_visit_duration += (
+                visits
+                .select(pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).sum())
+                .item()
+            )
+
+            human = visits_hc.filter(pl.col("bot_rule").is_null())
+            if human.height:
+                human_visits += human.height
+                human_new_users += human.select(pl.col("ym:s:isNewUser").sum()).item()
+                human_bounce_visits += human.select(pl.col("hits_count").eq(1).sum()).item()
+                human_visit_duration += (
+                    human.select(pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).sum()).item()
+                )
+            st.add_rows_in(chunk_size)
+
+        progress(total_visits, label="Visits")
 
     avg_session_duration = (
         float(sum_visit_duration / total_visits) if total_visits else 0.0
     )
 
     # HITS
-    hits_lf = (
-        pl.scan_parquet(hits_file)
-        .select([
-            "ym:pv:watchID", "ym:pv:pageViewID", "ym:pv:URL", 
-            "ym:pv:dateTime", "ym:pv:clientID"
-        ])
-    )
-    
     total_hits = 0
-    unique_users = 0
+    # n_unique по кускам складывать нельзя: клиент из нескольких кусков посчитался бы несколько раз
+    chunk_clients = []
+    human_hits = 0
+    human_chunk_clients = []
     landing_pages = defaultdict(int)
     exit_pages = defaultdict(int)
     depth_1 = depth_2plus = 0
     
-    batches = hits_lf.collect(streaming=True).iter_slices(CHUNK_SIZE * 5)
+    batches = hits_all.iter_slices(CHUNK_SIZE * 5)
     for i, batch in enumerate(batches):
         hits = batch
         chunk_hits = hits.height
         total_hits += chunk_hits
 
-        unique_users += hits["ym:pv:clientID"].n_unique()
+        with stage("hits_group_by") as st:
+            chunk_clients.append(hits["ym:pv:clientID"].unique())
 
-        top_pages = (
-            hits.group_by("ym:pv:URL")
-            .agg(total=pl.col("ym:pv:pageViewID").count())
-            .sort("total", descending=True)
-            .head(10)
-        )
-        for row in top_pages.iter_rows(named=True):
-            landing_pages[row["ym:pv:URL"]] += row["total"]
-        
-        print(f"  Hits: {total_hits:,}")
+            marked = traffic.mark(hits.select("ym:pv:clientID", "ym:pv:URL"), "ym:pv:clientID", "hits")
+            if sites is not None:
+                sites.add_hits(marked)
+            human = marked.filter(pl.col("bot_rule").is_null())
+            human_hits += human.height
+            human_chunk_clients.append(human["ym:pv:clientID"].unique())
+
+            top_pages = (
+                hits.group_by("ym:pv:URL")
+                .agg(total=pl.col("ym:pv:pageViewID").count())
+                .sort("total", descending=True)
+                .head(10)
+            )
+            for row in top_pages.iter_rows(named=True):
+                landing_pages[row["ym:pv:URL"]] += row["total"]
+            st.add_rows_in(chunk_hits)
+
+        progress(total_hits, label="Hits")
+
+    unique_users = pl.concat(chunk_clients).n_unique() if chunk_clients else 0
+    human_users = pl.concat(human_chunk_clients).n_unique() if human_chunk_clients else 0
 
     # БОЛЕЕ ГЛУБОКИЕ МЕТРИКИ
     
@@ -171,10 +237,29 @@ def compute_advanced_metrics(version: str) -> dict:
         "top_landing_page": str(top_landing_url),
         "top_exit_page": str(top_exit_url),
         "top_pages_count": int(top_pages_count),
+
+        # строки с повторным visitID / watchID из пересекающихся выгрузок, выброшенные при чтении
+        "duplicate_visits": duplicate_count("visits", version),
+        "duplicate_hits": duplicate_count("hits", version),
+
+        # те же метрики без клиентов-роботов (traffic_filter) и счетчики по правилам отсева
+        "human_total_visits": int(human_visits),
+        "human_total_hits": int(human_hits),
+        "human_unique_users": int(human_users),
+        "human_new_user_rate": float(human_new_users / human_visits * 100) if human_visits else 0.0,
+        "human_bounce_rate": float(human_bounce_visits / human_visits * 100) if human_visits else 0.0,
+        "human_pages_per_visit": float(human_hits / human_visits) if human_visits else 0.0,
+        "human_deep_visits_rate": (
+            float((human_visits - human_bounce_visits) / human_visits * 100) if human_visits else 0.0
+        ),
+        "human_session_duration_sec": float(human_visit_duration / human_visits) if human_visits else 0.0,
+        **traffic.summary(total_visits, total_hits),
     })
     
     print(f"{version}: {total_visits:,} визитов | {total_hits:,} хитов | "
           f"отказы {metrics['bounce_rate']:.1f}% | глубина {metrics['avg_pages']:.1f}")
+    print(f"{version} без роботов: {human_visits:,} визитов | отказы {metrics['human_bounce_rate']:.1f}% | "
+          f"отсеяно {metrics['bot_visit_share']:.1f}% визитов ({metrics['bot_clients']:,} клиентов)")
     
     return dict(metrics)
 
@@ -184,55 +269,10 @@ def is_priem_url(col: pl.Expr) -> pl.Expr:
     return col.str.contains(r"^https?://priem\.mai\.ru").fill_null(False)
 
 
-def compute_url_metrics(version: str, top_n: int = 200) -> pl.DataFrame:
-    """
-    Метрики по отдельным URL для выбранной версии:
-    url, version, page_hits, page_visits, page_bounces, bounce_rate, avg_pages_per_visit.
-    """
-    visits_file = DATA_DIR / VISITS_FILES[version]
-    hits_file = DATA_DIR / HITS_FILES[version]
-
-    # VISITS:
-    visits_lf = (
-        pl.scan_parquet(visits_file)
-        .select([
-            "ym:s:visitID",
-            "ym:s:watchIDs",
-            "ym:s:startURL",
-        ])
-    )
-    visits_df = visits_lf.collect(streaming=True)
-    visits_hc = add_hits_count(visits_df)
-
-    visits_hc = visits_hc.filter(is_priem_url(pl.col("ym:s:startURL")))
-
-    visits_by_url = (
-        visits_hc
-        .group_by(pl.col("ym:s:startURL").fill_null("unknown").alias("url"))
-        .agg([
-            pl.count().alias("page_visits"),
-            pl.col("hits_count").eq(1).sum().alias("page_bounces"),
-        ])
-    )
-
-    hits_lf = (
-        pl.scan_parquet(hits_file)
-        .select(["ym:pv:URL", "ym:pv:pageViewID"])
-    )
-    hits_df = hits_lf.collect(streaming=True)
-
-    hits_df = hits_df.filter(is_priem_url(pl.col("ym:pv:URL")))
-
-
-    hits_by_url = (
-        hits_df
-        .group_by(pl.col("ym:pv:URL").fill_null("unknown").alias("url"))
-        .agg(pl.count().alias("page_hits"))
-    )
-
-    url_metrics = (
+def _url_metrics_table(hits_by_url: pl.DataFrame, visits_by_url: pl.DataFrame, keys: list[str], version: str) -> pl.DataFrame:
+    return (
         hits_by_url
-        .join(visits_by_url, on="url", how="outer")
+        .join(visits_by_url, on=keys, how="full", coalesce=True)
         .with_columns([
             pl.col("page_hits").fill_null(0),
             pl.col("page_visits").fill_null(0),
@@ -247,42 +287,269 @@ def compute_url_metrics(version: str, top_n: int = 200) -> pl.DataFrame:
                 .alias("avg_pages_per_visit"),
             pl.lit(version).alias("version"),
         ])
-        .sort("page_hits", descending=True)
-        .head(top_n)
     )
 
-    return url_metrics
-
 
+def compute_url_metrics(version: str, top_n: int = 200, by_site: bool = False):
+    """
+    Метрики по отдельным URL для выбранной версии:
+    url, version, page_hits, page_visits, page_bounces, bounce_rate, avg_pages_per_visit.
+    by_site=True в том же проходе группирует еще и по сайту (sites.SITE_KEY) без фильтра домена и
+    возвращает (общие метрики priem.mai.ru, метрики с колонкой site — top_n URL каждого сайта)
+    """
+    visits_files = source_files("visits", version)
+    hits_files = source_files("hits", version)
 
+    # VISITS:
+    visits_columns = ["ym:s:visitID", "ym:s:watchIDs", "ym:s:startURL"]
+    if by_site:
+        visits_columns += [c for c in visit_columns() if c not in visits_columns]
+    visits_lf = scan_source("visits", version, visits_columns)
+    with stage("visits_scan", files=visits_files) as st:
+        visits_df = visits_lf.collect(streaming=True)
+        st.add_rows_out(visits_df.height)
+
+    with stage("json_decode") as st:
+        visits_hc = add_hits_count(visits_df)
+        st.add_rows_in(visits_df.height)
+
+    # по сайтам группируются все URL, общий результат потом отбирается по домену из тех же групп
+    keys = ["site", "url"] if by_site else ["url"]
+    with stage("visits_group_by") as st:
+        if by_site:
+            visits_hc = visits_hc.with_columns(visit_site())
+            hosts = host_site_map(host_site_counts(visits_hc))
+        else:
+            visits_hc = visits_hc.filter(is_priem_url(pl.col("ym:s:startURL")))
+
+        visits_by_url = (
+            visits_hc
+            .with_columns(pl.col("ym:s:startURL").fill_null("unknown").alias("url"))
+            .group_by(keys)
+            .agg([
+                pl.count().alias("page_visits"),
+                pl.col("hits_count").eq(1).sum().alias("page_bounces"),
+            ])
+        )
+        st.add_rows_in(visits_df.height)
+        st.add_rows_out(visits_by_url.height)
 
+    hits_lf = (
+        scan_source("hits", version, ["ym:pv:URL", "ym:pv:pageViewID"])
+    )
+    with stage("hits_scan", files=hits_files) as st:
+        hits_df = hits_lf.collect(streaming=True)
+        st.add_rows_out(hits_df.height)
+
+    with stage("hits_group_by") as st:
+        st.add_rows_in(hits_df.height)
+        if by_site:
+            hits_df = with_hit_site(hits_df, "ym:pv:URL", hosts)
+        else:
+            hits_df = hits_df.filter(is_priem_url(pl.col("ym:pv:URL")))
+
+        hits_by_url = (
+            hits_df
+            .with_columns(pl.col("ym:pv:URL").fill_null("unknown").alias("url"))
+            .group_by(keys)
+            .agg(pl.count().alias("page_hits"))
+        )
+        st.add_rows_out(hits_by_url.height)
 
+    if not by_site:
+        return (
+            _url_metrics_table(hits_by_url, visits_by_url, keys, version)
+            .sort("page_hits", descending=True)
+            .head(top_n)
+        )
 
+    site_url_metrics = (
+        _url_metrics_table(hits_by_url, visits_by_url, keys, version)
+        .sort(["site", "page_hits"], descending=[False, True])
+        .group_by("site", maintain_order=True)
+        .head(top_n)
+    )
+    priem_only = [
+        df.filter(is_priem_url(pl.col("url"))).group_by("url").agg(pl.exclude("site", "url").sum())
+        for df in (hits_by_url, visits_by_url)
+    ]
+    url_metrics = (
+        _url_metrics_table(*priem_only, ["url"], version)
+        .sort("page_hits", descending=True)
+        .head(top_n)
+    )
+    return url_metrics, site_url_metrics
 
+def as_date(col: pl.Expr) -> pl.Expr:
+    """Дата из строки, Date или Datetime: берем первые 10 символов YYYY-MM-DD."""
+    return col.cast(pl.Utf8).str.slice(0, 10).str.to_date("%Y-%m-%d", strict=False)
 
 
-metrics_v1 = compute_advanced_metrics("v1")
-metrics_v2 = compute_advanced_metrics("v2")
+def compute_url_daily_series(version: str) -> pl.DataFrame:
+    """
+    Дневные ряды по URL для выбранной версии:
+    date, url, page_hits, page_visits, page_bounces, sum_visit_duration, sum_visit_hits.
+    Суммы, а не средние — чтобы ряды можно было складывать (по сайту, по неделям).
+    Используются в anomaly_detection.py вместо сравнения двух агрегированных точек.
+    """
+    visits_files = source_files("visits", version)
+    hits_files = source_files("hits", version)
+
+    with stage("visits_scan", files=visits_files) as st:
+        visits_df = (
+            scan_source("visits", version, ["ym:s:date", "ym:s:watchIDs", "ym:s:startURL", "ym:s:visitDuration"])
+            .filter(is_priem_url(pl.col("ym:s:startURL")))
+            .collect(streaming=True)
+        )
+        st.add_rows_out(visits_df.height)
+
+    with stage("json_decode") as st:
+        visits_hc = add_hits_count(visits_df)
+        st.add_rows_in(visits_df.height)
+
+    with stage("visits_group_by") as st:
+        visits_daily = (
+            visits_hc
+            .group_by([
+                as_date(pl.col("ym:s:date")).alias("date"),
+                pl.col("ym:s:startURL").alias("url"),
+            ])
+            .agg([
+                pl.len().alias("page_visits"),
+                pl.col("hits_count").eq(1).sum().alias("page_bounces"),
+                pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).sum().alias("sum_visit_duration"),
+                pl.col("hits_count").sum().alias("sum_visit_hits"),
+            ])
+        )
+        st.add_rows_in(visits_hc.height)
+        st.add_rows_out(visits_daily.height)
+
+    # скан хитов и группировка — один ленивый запрос, поэтому и один этап
+    with stage("hits_scan_group_by", files=hits_files) as st:
+        hits_daily = (
+            scan_source("hits", version, ["ym:pv:URL", "ym:pv:dateTime"])
+            .filter(is_priem_url(pl.col("ym:pv:URL")))
+            .group_by([
+                as_date(pl.col("ym:pv:dateTime")).alias("date"),
+                pl.col("ym:pv:URL").alias("url"),
+            ])
+            .agg(pl.len().alias("page_hits"))
+            .collect(streaming=True)
+        )
+        st.add_rows_out(hits_daily.height)
 
-url_metrics_v1 = compute_url_metrics("v1", top_n=200)
-url_metrics_v2 = compute_url_metrics("v2", top_n=200)
+    return (
+        hits_daily
+        .join(visits_daily, on=["date", "url"], how="full", coalesce=True)
+        .with_columns([
+            pl.col("page_hits").fill_null(0),
+            pl.col("page_visits").fill_null(0),
+            pl.col("page_bounces").fill_null(0),
+            pl.col("sum_visit_duration").fill_null(0.0),
+            pl.col("sum_visit_hits").fill_null(0),
+            pl.lit(version).alias("version"),
+        ])
+        .filter(pl.col("date").is_not_null())
+        .sort(["url", "date"])
+    )
 
-url_metrics_v1.write_parquet(OUTPUT_DIR / "url_metrics_v1.parquet")
-url_metrics_v2.write_parquet(OUTPUT_DIR / "url_metrics_v2.parquet")
 
-print("url_metrics_v1.parquet и url_metrics_v2.parquet сохранены")
+if __name__ == "__main__":
+    profiler = activate(profiler_from_env("etl_with_url"))
+
+    # свежие выгрузки Logs API (TSV/CSV) сначала переводятся в parquet; уже сконвертированные пропускаются
+    if EXPORTS_DIR.exists():
+        convert_pending_exports()
+
+    # метрики по сайтам копятся в том же проходе, что и общие
+    sites_v1, sites_v2 = SiteMetrics("v1"), SiteMetrics("v2")
+    with stage("advanced_metrics_v1"):
+        metrics_v1 = compute_advanced_metrics("v1", sites=sites_v1)
+    with stage("advanced_metrics_v2"):
+        metrics_v2 = compute_advanced_metrics("v2", sites=sites_v2)
+
+    # множества клиентов по дням, URL и целям: точное число клиентов, удержание, пересечение версий
+    with stage("client_index") as st:
+        client_index = build_client_index(["v1", "v2"])
+        st.add_rows_out(len(client_index.sets))
+    client_index.save()
+    metrics_v1.update(client_metrics(client_index, "v1"))
+    metrics_v2.update(client_metrics(client_index, "v2"))
+    overlap = version_overlap(client_index)
+    print(f"Клиентов в обеих версиях: {overlap['clients_both']:,} "
+          f"({overlap['share_of_v1_seen_in_v2']:.1f}% клиентов v1)")
+
+    with stage("url_metrics_v1") as st:
+        url_metrics_v1, site_url_metrics_v1 = compute_url_metrics("v1", top_n=200, by_site=True)
+        st.add_rows_out(url_metrics_v1.height + site_url_metrics_v1.height)
+    with stage("url_metrics_v2") as st:
+        url_metrics_v2, site_url_metrics_v2 = compute_url_metrics("v2", top_n=200, by_site=True)
+        st.add_rows_out(url_metrics_v2.height + site_url_metrics_v2.height)
+
+    # время на странице: соединение визитов с хитами и квантили по партициям
+    with stage("visit_hits_v1"):
+        build_visit_hit_map("v1")
+    with stage("visit_hits_v2"):
+        build_visit_hit_map("v2")
+    with stage("engagement_v1"):
+        engagement_v1, _ = compute_url_engagement("v1")
+    with stage("engagement_v2"):
+        engagement_v2, _ = compute_url_engagement("v2")
+
+    url_metrics_v1 = add_engagement(url_metrics_v1, engagement_v1)
+    url_metrics_v2 = add_engagement(url_metrics_v2, engagement_v2)
+
+    url_metrics_v1.write_parquet(OUTPUT_DIR / "url_metrics_v1.parquet")
+    url_metrics_v2.write_parquet(OUTPUT_DIR / "url_metrics_v2.parquet")
+    write_site_partitions(add_engagement(site_url_metrics_v1, engagement_v1), "url_metrics_v1.parquet")
+    write_site_partitions(add_engagement(site_url_metrics_v2, engagement_v2), "url_metrics_v2.parquet")
+
+    print("url_metrics_v1.parquet и url_metrics_v2.parquet сохранены (общие и по сайтам)")
+
+    with stage("url_daily_v1") as st:
+        url_daily_v1 = compute_url_daily_series("v1")
+        st.add_rows_out(url_daily_v1.height)
+    with stage("url_daily_v2") as st:
+        url_daily_v2 = compute_url_daily_series("v2")
+        st.add_rows_out(url_daily_v2.height)
+
+    url_daily_v1.write_parquet(OUTPUT_DIR / "url_daily_v1.parquet")
+    url_daily_v2.write_parquet(OUTPUT_DIR / "url_daily_v2.parquet")
+
+    # соответствие URL версий: страницы, сменившие адрес, сравниваются между собой
+    with stage("url_alignment") as st:
+        alignment = align_daily_series(url_daily_v1, url_daily_v2)
+        st.add_rows_out(alignment.height)
+    alignment.write_parquet(OUTPUT_DIR / ALIGNMENT_FILE)
+    print(f"{ALIGNMENT_FILE} сохранен: {alignment_summary(alignment)}")
+
+    with stage("anomalies") as st:
+        st.add_rows_in(url_daily_v1.height + url_daily_v2.height)
+        anomalies = find_anomalies(url_daily_v1, url_daily_v2, alignment=alignment)
+        st.add_rows_out(anomalies.height)
+    anomalies.write_parquet(OUTPUT_DIR / "anomalies_v1_v2.parquet")
+
+    print(f"url_daily_v*.parquet и anomalies_v1_v2.parquet сохранены ({anomalies.height} аномалий)")
+
+    key_metrics = [
+        "total_visits", "total_hits", "unique_users", "new_users",
+        "new_user_rate", "bounce_rate", "pages_per_visit", 
+        "deep_visits_rate", "hits_per_user", "visits_per_user",
+        "unique_clients", "returning_client_rate", "retention_d1", "retention_d7",
+        "human_bounce_rate", "human_pages_per_visit", "bot_visit_share",
+    ]
+
+    comparison = pl.DataFrame({
+        "metric": key_metrics,
+        "v1": pl.Series("v1", [metrics_v1.get(m, 0) for m in key_metrics], dtype=pl.Float64),
+        "v2": pl.Series("v2", [metrics_v2.get(m, 0) for m in key_metrics], dtype=pl.Float64)
+    })
 
-key_metrics = [
-    "total_visits", "total_hits", "unique_users", "new_users",
-    "new_user_rate", "bounce_rate", "pages_per_visit", 
-    "deep_visits_rate", "hits_per_user", "visits_per_user"
-]
+    comparison.write_parquet(OUTPUT_DIR / "advanced_metrics.parquet")
+    pl.DataFrame([{"version": "v1", **metrics_v1}, {"version": "v2", **metrics_v2}]).write_parquet(OUTPUT_DIR / "full_metrics.parquet")
 
-comparison = pl.DataFrame({
-    "metric": key_metrics,
-    "v1": pl.Series("v1", [metrics_v1.get(m, 0) for m in key_metrics], dtype=pl.Float64),
-    "v2": pl.Series("v2", [metrics_v2.get(m, 0) for m in key_metrics], dtype=pl.Float64)
-})
+    site_files = write_site_full_metrics(sites_v1.metrics(), sites_v2.metrics())
+    print(f"full_metrics.parquet по сайтам ({len(site_files)}): data/metrics/sites/<сайт>/, сводка site_metrics.parquet")
 
-comparison.write_parquet(OUTPUT_DIR / "advanced_metrics.parquet")
-pl.DataFrame([{"version": "v1", **metrics_v1}, {"version": "v2", **metrics_v2}]).write_parquet(OUTPUT_DIR / "full_metrics.parquet")
+    report_path = profiler.write_report()
+    print(f"Отчет о запуске: {report_path}")
@@ -2,19 +2,11 @@ from pathlib import Path
 import polars as pl
 from collections import defaultdict
 
-DATA_DIR = Path("data/raw")
+from sources import scan_source
+
 OUTPUT_DIR = Path("data/metrics")
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-HITS_FILES = {
-    "v1": "2022_yandex_metrika_hits.parquet",
-    "v2": "2024_yandex_metrika_hits.parquet",
-}
-VISITS_FILES = {
-    "v1": "2022_yandex_metrika_visits.parquet",
-    "v2": "2024_yandex_metrika_visits.parquet",
-}
-
 CHUNK_SIZE = 100_000
 
 def visits_with_n_hits(df: pl.DataFrame) -> pl.DataFrame:
@@ -37,8 +29,6 @@ def compute_advanced_metrics(version: str) -> dict:
     """Полный набор метрик для одной версии"""
     print(f"\n=== ГЛУБОКИЙ АНАЛИЗ {version} ===")
     
-    visits_file = DATA_DIR / VISITS_FILES[version]
-    hits_file = DATA_DIR / HITS_FILES[version]
 
     metrics = defaultdict(float)
     
@@ -46,8 +36,7 @@ def compute_advanced_metrics(version: str) -> dict:
 
     print("Базовые метрики...")
     visits_lf = (
-        pl.scan_parquet(visits_file)
-        .select([
+        scan_source("visits", version, [
             "ym:s:visitID", "ym:s:counterID", "ym:s:watchIDs", "ym:s:isNewUser", 
             "ym:s:date", "ym:s:dateTime", "ym:s:dateTimeUTC", "ym:s:visitDuration", "ym:s:startURL", "ym:s:endURL"
         ])
@@ -91,15 +80,15 @@ def compute_advanced_metrics(version: str) -> dict:
     # HITS & ПУТИ ПО СЕЙТУ
     print(" Hits и пути...")
     hits_lf = (
-        pl.scan_parquet(hits_file)
-        .select([
+        scan_source("hits", version, [
             "ym:pv:watchID", "ym:pv:pageViewID", "ym:pv:URL", 
             "ym:pv:dateTime", "ym:pv:clientID"
         ])
     )
     
     total_hits = 0
-    unique_users = 0
+    # n_unique по кускам складывать нельзя: клиент из нескольких кусков посчитался бы несколько раз
+    chunk_clients = []
     landing_pages = defaultdict(int)
     exit_pages = defaultdict(int)
     depth_1 = depth_2plus = 0
@@ -110,7 +99,7 @@ def compute_advanced_metrics(version: str) -> dict:
         chunk_hits = hits.height
         total_hits += chunk_hits
 
-        unique_users += hits["ym:pv:clientID"].n_unique()
+        chunk_clients.append(hits["ym:pv:clientID"].unique())
 
         top_pages = (
             hits.group_by("ym:pv:URL")
@@ -123,6 +112,8 @@ def compute_advanced_metrics(version: str) -> dict:
         
         print(f"  Hits: {total_hits:,}")
 
+    unique_users = pl.concat(chunk_clients).n_unique() if chunk_clients else 0
+
     # ГЛУБОКИЕ МЕТРИКИ
     print("Глубокий анализ...")
 
@@ -186,22 +177,21 @@ def compute_advanced_metrics(version: str) -> dict:
     return dict(metrics)
 
 
+if __name__ == "__main__":
+    metrics_v1 = compute_advanced_metrics("v1")
+    metrics_v2 = compute_advanced_metrics("v2")
 
+    key_metrics = [
+        "total_visits", "total_hits", "unique_users", "new_users",
+        "new_user_rate", "bounce_rate", "pages_per_visit", 
+        "deep_visits_rate", "hits_per_user", "visits_per_user"
+    ]
 
-metrics_v1 = compute_advanced_metrics("v1")
-metrics_v2 = compute_advanced_metrics("v2")
-
-key_metrics = [
-    "total_visits", "total_hits", "unique_users", "new_users",
-    "new_user_rate", "bounce_rate", "pages_per_visit", 
-    "deep_visits_rate", "hits_per_user", "visits_per_user"
-]
-
-comparison = pl.DataFrame({
-    "metric": key_metrics,
-    "v1": pl.Series("v1", [metrics_v1.get(m, 0) for m in key_metrics], dtype=pl.Float64),
-    "v2": pl.Series("v2", [metrics_v2.get(m, 0) for m in key_metrics], dtype=pl.Float64)
-})
+    comparison = pl.DataFrame({
+        "metric": key_metrics,
+        "v1": pl.Series("v1", [metrics_v1.get(m, 0) for m in key_metrics], dtype=pl.Float64),
+        "v2": pl.Series("v2", [metrics_v2.get(m, 0) for m in key_metrics], dtype=pl.Float64)
+    })
 
-comparison.write_parquet(OUTPUT_DIR / "advanced_metrics.parquet")
-pl.DataFrame([{"version": "v1", **metrics_v1}, {"version": "v2", **metrics_v2}]).write_parquet(OUTPUT_DIR / "full_metrics.parquet")
+    comparison.write_parquet(OUTPUT_DIR / "advanced_metrics.parquet")
+    pl.DataFrame([{"version": "v1", **metrics_v1}, {"version": "v2", **metrics_v2}]).write_parquet(OUTPUT_DIR / "full_metrics.parquet")
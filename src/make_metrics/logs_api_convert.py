@@ -0,0 +1,257 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from profiling import activate, profiler_from_env, progress, stage
+from sources import DATA_DIR, DATE_COLUMNS, ID_COLUMNS, SCHEMA, id_expr
+
+# выгрузки Logs API: data/exports/<version>/<visits|hits>*.tsv[.gz] или .csv[.gz]
+EXPORTS_DIR = Path("data/exports")
+MANIFEST_DIR = DATA_DIR / "_converted"
+
+# строк в файле-части: одна группа строк parquet на часть
+ROW_GROUP_ROWS = 500_000
+
+# размер блока чтения CSV: кусок сжатого потока, который парсится за раз
+READ_BLOCK_BYTES = 16 << 20
+
+CONVERT_WORKERS = int(os.environ.get("ETL_CONVERT_WORKERS", "4"))
+
+# списки идентификаторов сразу разбираются в list[u64]; sources возвращает их ETL в прежнем виде
+LIST_COLUMNS = {"ym:s:watchIDs", "ym:s:goalsID"}
+
+EXPORT_SUFFIXES = (".tsv", ".tsv.gz", ".csv", ".csv.gz")
+
+
+def export_kind(path: Path) -> str:
+    """visits или hits по имени файла выгрузки"""
+    name = path.name.lower()
+    for kind in ("visits", "hits"):
+        if kind in name:
+            return kind
+    raise ValueError(f"Cannot tell visits from hits by file name: {path}")
+
+
+def _open_stream(source, compression: str | None):
+    """Бинарный поток выгрузки; gzip распаковывается на лету (по расширению .gz или compression="gzip")"""
+    if isinstance(source, (str, Path)):
+        if compression == "gzip" or (compression is None and str(source).lower().endswith(".gz")):
+            return gzip.open(source, "rb")
+        return open(source, "rb")
+    return gzip.GzipFile(fileobj=source) if compression == "gzip" else source
+
+
+def _open_reader(stream, delimiter: str, block_size: int):
+    """
+    Потоковый CSV-ридер pyarrow. Заголовок читается отдельно, чтобы все колонки, в том числе
+    незнакомые, читались строками: иначе тип, выведенный по первому блоку, ломался бы на следующих
+    """
+    header = stream.readline().decode("utf-8-sig").rstrip("\r\n")
+    names = header.split(delimiter)
+    return pacsv.open_csv(
+        stream,
+        read_options=pacsv.ReadOptions(column_names=names, block_size=block_size),
+        # у TSV Logs API нет кавычек: кавычка внутри URL — обычный символ
+        parse_options=pacsv.ParseOptions(delimiter=delimiter, quote_char=False if delimiter == "\t" else '"'),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in names},
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def parse_id_list(col: pl.Expr) -> pl.Expr:
+    """[1,2,3] из Logs API (или ["1","2"] из прежних выгрузок) -> list[u64]; пустой список остается пустым"""
+    return (
+        col.str.replace_all(r'[\[\]"\s]', "")
+        .str.split(",")
+        .list.eval(pl.element().filter(pl.element() != ""))
+        # отдельный eval: в одном polars приводит и пустые строки до фильтра, и строгое приведение падает
+        .list.eval(pl.element().cast(pl.UInt64, strict=True))
+    )
+
+
+def _typed(table: pa.Table) -> pl.DataFrame:
+    """
+    Строки выгрузки -> типы SCHEMA; списки id разобраны; незнакомые колонки остаются строками.
+    Идентификаторы приводятся строго: битое значение останавливает конвертацию, а не теряется как null
+    """
+    df = pl.from_arrow(table)
+    exprs = []
+    for name, dtype in df.schema.items():
+        if name in LIST_COLUMNS:
+            exprs.append(parse_id_list(pl.col(name)).alias(name))
+        elif name in ID_COLUMNS and dtype != pl.UInt64:
+            exprs.append(id_expr(name, dtype))
+        elif name in SCHEMA and SCHEMA[name] != dtype:
+            exprs.append(pl.col(name).cast(SCHEMA[name], strict=False))
+        else:
+            exprs.append(pl.col(name))
+    return df.select(exprs)
+
+
+def _write_part(df: pl.DataFrame, kind: str, out_dir: Path, stem: str, part: int, row_group_rows: int) -> dict[str, int]:
+    """Часть раскладывается по дням: <out_dir>/date=YYYY-MM-DD/<stem>-<part>.parquet"""
+    written = {}
+    date_column = DATE_COLUMNS[kind]
+    if date_column in df.columns:
+        df = df.with_columns(pl.col(date_column).cast(pl.Utf8).str.slice(0, 10).fill_null("unknown").alias("_date"))
+        groups = df.partition_by("_date", as_dict=True)
+    else:
+        groups = {("unknown",): df.with_columns(pl.lit("unknown").alias("_date"))}
+
+    for (day,), piece in groups.items():
+        day_dir = out_dir / f"date={day}"
+        day_dir.mkdir(parents=True, exist_ok=True)
+        piece.drop("_date").write_parquet(
+            day_dir / f"{stem}-{part:05d}.parquet", compression="zstd", row_group_size=row_group_rows
+        )
+        written[day] = piece.height
+    return written
+
+
+def _own_parts(out_dir: Path, stem: str) -> list[Path]:
+    """
+    Части, записанные для выгрузки stem: ровно <stem>-<номер>.parquet. Части других выгрузок,
+    чье имя лишь начинается с того же stem (hits и hits-2024), сюда не попадают
+    """
+    own = re.compile(re.escape(stem) + r"-\d{5,}\.parquet")
+    return [p for p in out_dir.glob(f"date=*/{glob.escape(stem)}-*.parquet") if own.fullmatch(p.name)]
+
+
+def _convert_part(table: pa.Table, kind: str, out_dir: Path, stem: str, part: int, row_group_rows: int) -> dict[str, int]:
+    return _write_part(_typed(table), kind, out_dir, stem, part, row_group_rows)
+
+
+def convert_export(
+    source,
+    kind: str,
+    version: str,
+    out_root: Path = DATA_DIR,
+    stem: str | None = None,
+    delimiter: str | None = None,
+    compression: str | None = None,
+    row_group_rows: int = ROW_GROUP_ROWS,
+    workers: int = CONVERT_WORKERS,
+) -> dict:
+    """
+    Потоковая конвертация выгрузки Logs API (TSV/CSV, можно gzip) в parquet в hive-раскладке,
+    которую читает sources: <out_root>/<kind>/version=<version>/date=<день>/<stem>-<часть>.parquet.
+
+    source — путь или бинарный поток (например, ответ загрузки; тогда нужен stem, а для gzip — compression="gzip").
+    Файл читается блоками, набирается часть в row_group_rows строк, части типизируются и пишутся
+    в workers потоках; в памяти одновременно не больше workers + 1 частей
+    """
+    if isinstance(source, (str, Path)):
+        path = Path(source)
+        stem = stem or path.name.split(".")[0]
+        suffixes = "".join(path.suffixes).lower()
+        delimiter = delimiter or ("," if ".csv" in suffixes else "\t")
+    elif stem is None:
+        raise ValueError("stem is required when converting a stream")
+    delimiter = delimiter or "\t"
+
+    out_dir = Path(out_root) / kind / f"version={version}"
+    # повторная конвертация той же выгрузки заменяет ее прошлые части, а не дописывает к ним
+    for old_part in _own_parts(out_dir, stem):
+        old_part.unlink()
+    stats = {"rows": 0, "parts": 0, "days": {}}
+
+    def submit_part(pool, futures, table: pa.Table):
+        futures.append(pool.submit(_convert_part, table, kind, out_dir, stem, stats["parts"], row_group_rows))
+        stats["parts"] += 1
+
+    def collect(futures, keep: int):
+        while len(futures) > keep:
+            for day, rows in futures.pop(0).result().items():
+                stats["days"][day] = stats["days"].get(day, 0) + rows
+
+    started = time.perf_counter()
+    stream = _open_stream(source, compression)
+    with stream, ThreadPoolExecutor(max_workers=workers) as pool:
+        reader = _open_reader(stream, delimiter, READ_BLOCK_BYTES)
+        futures, pending, pending_rows = [], [], 0
+        for batch in reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            stats["rows"] += batch.num_rows
+            while pending_rows >= row_group_rows:
+                table = pa.Table.from_batches(pending)
+                submit_part(pool, futures, table.slice(0, row_group_rows))
+                rest = table.slice(row_group_rows)
+                pending, pending_rows = rest.to_batches(), rest.num_rows
+                collect(futures, workers)
+            progress(stats["rows"], label=f"{stem} converted")
+        if pending_rows:
+            submit_part(pool, futures, pa.Table.from_batches(pending))
+        collect(futures, 0)
+
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    stats["days"] = dict(sorted(stats["days"].items()))
+    return stats
+
+
+def _manifest_path(path: Path, version: str) -> Path:
+    return MANIFEST_DIR / version / f"{path.name}.json"
+
+
+def convert_pending_exports(exports_dir: Path = EXPORTS_DIR, out_root: Path = DATA_DIR) -> list[dict]:
+    """
+    Конвертирует новые и изменившиеся выгрузки из exports_dir/<version>/. Сделанное отмечается
+    в data/raw/_converted/<version>/<файл>.json (размер и mtime выгрузки), повторно не читается
+    """
+    results = []
+    for path in sorted(p for p in Path(exports_dir).glob("*/*") if p.name.lower().endswith(EXPORT_SUFFIXES)):
+        version = path.parent.name
+        source_stat = {"size": path.stat().st_size, "mtime_ns": path.stat().st_mtime_ns}
+        manifest = _manifest_path(path, version)
+        if manifest.exists() and json.loads(manifest.read_text(encoding="utf8")).get("source") == source_stat:
+            continue
+
+        kind = export_kind(path)
+        with stage(f"convert_{kind}_{version}", files=[path]) as st:
+            stats = convert_export(path, kind, version, out_root=out_root)
+            st.add_rows_out(stats["rows"])
+        print(f"{path} -> {kind}/version={version}: {stats['rows']:,} строк, {stats['parts']} частей, "
+              f"{len(stats['days'])} дней за {stats['seconds']} с")
+
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        manifest.write_text(json.dumps({"source": source_stat, **stats}, ensure_ascii=False, indent=2), encoding="utf8")
+        results.append({"file": str(path), "kind": kind, "version": version, **stats})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузки Logs API (TSV/CSV, gzip) -> parquet в data/raw")
+    parser.add_argument("files", nargs="*", type=Path, help="файлы выгрузки; без них — все новые из data/exports/<version>/")
+    parser.add_argument("--version", help="версия для files (v1, v2)")
+    parser.add_argument("--kind", choices=["visits", "hits"], help="по умолчанию — по имени файла")
+    parser.add_argument("--out", type=Path, default=DATA_DIR)
+    parser.add_argument("--row-group-rows", type=int, default=ROW_GROUP_ROWS)
+    parser.add_argument("--workers", type=int, default=CONVERT_WORKERS)
+    args = parser.parse_args()
+
+    profiler = activate(profiler_from_env("logs_api_convert"))
+    if not args.files:
+        convert_pending_exports(out_root=args.out)
+    else:
+        if not args.version:
+            parser.error("--version is required with explicit files")
+        for path in args.files:
+            kind = args.kind or export_kind(path)
+            with stage(f"convert_{kind}_{args.version}", files=[path]) as st:
+                stats = convert_export(path, kind, args.version, out_root=args.out,
+                                       row_group_rows=args.row_group_rows, workers=args.workers)
+                st.add_rows_out(stats["rows"])
+            print(f"{path} -> {kind}/version={args.version}: {stats['rows']:,} строк, "
+                  f"{stats['parts']} частей, {len(stats['days'])} дней за {stats['seconds']} с")
@@ -0,0 +1,166 @@
+from itertools import combinations
+from pathlib import Path
+
+import polars as pl
+
+from sources import VISITS_FILES, scan_source, source_columns
+
+OUTPUT_DIR = Path("data/metrics")
+
+CUBE_FILE = "metrics_cube.parquet"
+
+# измерение куба -> колонка визитов Метрики; колонок, которых нет в выгрузке, куб просто не содержит
+DIMENSION_COLUMNS = {
+    "date": "ym:s:date",
+    "is_new_user": "ym:s:isNewUser",
+    "landing_url": "ym:s:startURL",
+    "traffic_source": "ym:s:lastTrafficSource",
+    "device": "ym:s:deviceCategory",
+}
+
+# аддитивные меры: их можно складывать при свертке, доли считаются уже из сумм
+MEASURES = ["visits", "bounces", "new_visits", "hits", "sum_visit_duration"]
+
+CUBOID_SEPARATOR = "|"
+
+
+def available_dimensions(version: str, dimensions: list[str] | None = None) -> list[str]:
+    """Измерения из dimensions (по умолчанию все известные), для которых в файлах визитов версии есть колонка."""
+    names = source_columns("visits", version)
+    return [d for d in (dimensions or DIMENSION_COLUMNS) if DIMENSION_COLUMNS[d] in names]
+
+
+def cuboid_name(dims) -> str:
+    """Имя кубоида — отсортированные измерения через |; пустая строка — итог по всей версии."""
+    return CUBOID_SEPARATOR.join(sorted(dims))
+
+
+def base_cuboid(version: str, dimensions: list[str]) -> pl.DataFrame:
+    """
+    Самый детальный кубоид: визиты одной версии, сгруппированные по всем dimensions.
+    Один проход по сырым визитам; все остальные срезы строятся уже из него.
+    """
+    columns = [DIMENSION_COLUMNS[dim] for dim in dimensions]
+    columns += [c for c in ("ym:s:watchIDs", "ym:s:isNewUser", "ym:s:visitDuration") if c not in columns]
+
+    dim_exprs = []
+    for dim in dimensions:
+        col = pl.col(DIMENSION_COLUMNS[dim])
+        if dim == "date":
+            col = col.cast(pl.Utf8).str.slice(0, 10).str.to_date("%Y-%m-%d", strict=False)
+        elif dim == "is_new_user":
+            col = col.cast(pl.Int8, strict=False)
+        else:
+            col = col.cast(pl.Utf8).fill_null("unknown")
+        dim_exprs.append(col.alias(dim))
+
+    hits_count = (
+        pl.col("ym:s:watchIDs")
+        .str.json_decode(dtype=pl.List(pl.Utf8))
+        .list.len()
+        .fill_null(0)
+    )
+
+    return (
+        scan_source("visits", version, columns)
+        .select([
+            *dim_exprs,
+            hits_count.alias("hits_count"),
+            pl.col("ym:s:isNewUser").cast(pl.Int64, strict=False).fill_null(0).alias("is_new"),
+            pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).fill_null(0.0).alias("duration"),
+        ])
+        .group_by(dimensions)
+        .agg([
+            pl.len().alias("visits"),
+            pl.col("hits_count").eq(1).sum().alias("bounces"),
+            pl.col("is_new").sum().alias("new_visits"),
+            pl.col("hits_count").sum().alias("hits"),
+            pl.col("duration").sum().alias("sum_visit_duration"),
+        ])
+        .collect(streaming=True)
+    )
+
+
+def rollup_lattice(base: pl.DataFrame, dimensions: list[str], max_dims: int | None = None) -> dict[str, pl.DataFrame]:
+    """
+    Все свертки базового кубоида: для каждого подмножества dimensions (не больше max_dims измерений)
+    суммы мер. Каждый кубоид считается из самого маленького уже посчитанного родителя
+    (подмножество + одно измерение), а не из базы — сверху вниз по решетке.
+    """
+    max_dims = len(dimensions) if max_dims is None else max_dims
+    cuboids = {cuboid_name(dimensions): base}
+
+    for size in range(len(dimensions) - 1, -1, -1):
+        for dims in combinations(dimensions, size):
+            parents = [
+                cuboids[name] for name in (cuboid_name(set(dims) | {extra}) for extra in dimensions if extra not in dims)
+                if name in cuboids
+            ]
+            parent = min(parents, key=lambda df: df.height)
+            cuboids[cuboid_name(dims)] = (
+                parent.group_by(list(dims)).agg([pl.col(m).sum() for m in MEASURES])
+                if dims else parent.select([pl.col(m).sum() for m in MEASURES])
+            )
+
+    return {name: df for name, df in cuboids.items() if name.count(CUBOID_SEPARATOR) < max_dims or not name}
+
+
+def build_metrics_cube(
+    versions: list[str] | None = None,
+    dimensions: list[str] | None = None,
+    max_dims: int | None = None,
+) -> pl.DataFrame:
+    """
+    Материализованный куб метрик в одной таблице (аналог GROUPING SETS):
+    колонка cuboid — какие измерения сгруппированы, остальные измерения в строке равны null.
+    Любой срез для дашборда или агента — это фильтр по cuboid и сумма по нескольким строкам,
+    без повторного чтения сырых визитов.
+    """
+    versions = versions or list(VISITS_FILES)
+    # измерение попадает в куб, только если колонка есть у всех версий: иначе base_cuboid упадет на версии без нее
+    dimensions = list(dimensions or DIMENSION_COLUMNS)
+    for version in versions:
+        present = set(available_dimensions(version, dimensions)) if dimensions else set()
+        missing = [d for d in dimensions if d not in present]
+        if missing:
+            print(f"Куб метрик {version}: нет колонок измерений {', '.join(missing)}, они пропущены")
+        dimensions = [d for d in dimensions if d in present]
+
+    frames = []
+    for version in versions:
+        print(f"Куб метрик {version}: измерения {', '.join(dimensions)}")
+        base = base_cuboid(version, dimensions)
+        for name, cuboid in rollup_lattice(base, dimensions, max_dims).items():
+            frames.append(cuboid.with_columns([
+                pl.lit(version).alias("version"),
+                pl.lit(name).alias("cuboid"),
+            ]))
+        print(f"  базовый кубоид: {base.height:,} строк")
+
+    # сортировка по cuboid: в каждой row group parquet один-два кубоида, чтение среза пропускает остальные
+    return (
+        pl.concat(frames, how="diagonal_relaxed")
+        .select(["cuboid", "version", *dimensions, *MEASURES])
+        .sort(["cuboid", "version", *dimensions], nulls_last=True)
+    )
+
+
+def write_metrics_cube(cube: pl.DataFrame, path: Path = OUTPUT_DIR / CUBE_FILE):
+    """Parquet с zstd (строки parquet кодирует словарем сам); небольшие row group — чтобы срез читал мало данных."""
+    cube.write_parquet(
+        path,
+        compression="zstd",
+        statistics=True,
+        row_group_size=50_000,
+    )
+
+
+if __name__ == "__main__":
+    OUTPUT_DIR.mkdir(exist_ok=True)
+
+    cube = build_metrics_cube()
+    write_metrics_cube(cube)
+
+    sizes = cube.group_by("cuboid").len().sort("len", descending=True)
+    print(f"{CUBE_FILE} сохранен: {cube.height:,} строк, {sizes.height} кубоидов")
+    print(sizes)
@@ -0,0 +1,334 @@
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import re
+import sys
+import time
+from datetime import UTC, datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
+
+OUTPUT_DIR = Path("data/metrics")
+REPORT_FILE = "etl_run_report.json"
+
+PROFILE_TOP_FUNCTIONS = 15
+
+
+def _read_proc(path: str, key: str) -> int | None:
+    """Значение поля key из /proc/self/status или /proc/self/io; None вне Linux."""
+    try:
+        with open(path, encoding="ascii") as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _peak_rss_mb() -> float | None:
+    """
+    Пик RSS с момента последнего _reset_peak_rss (VmHWM). Вне Linux — пик за весь процесс.
+    """
+    hwm = _read_proc("/proc/self/status", "VmHWM:")
+    if hwm is not None:
+        return hwm / 1024
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _reset_peak_rss() -> bool:
+    """Сбрасывает VmHWM до текущего RSS, чтобы пик считался для одного этапа. False — не поддерживается."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _bytes_read() -> int | None:
+    """Байты, прочитанные процессом через read() (rchar); mmap сюда не попадает."""
+    return _read_proc("/proc/self/io", "rchar:")
+
+
+def print_progress(event: dict):
+    """Колбэк по умолчанию: печатает прогресс в привычном для ETL виде и итоги этапов верхнего уровня."""
+    if event["event"] == "progress":
+        label = event.get("label") or event["stage"]
+        print(f"  {label}: {event['rows']:,}")
+    elif event["event"] == "end" and "/" not in event["stage"]:
+        peak = f", пик {event['peak_rss_mb']:.0f} МБ" if event.get("peak_rss_mb") is not None else ""
+        rows = f", {event['rows_out']:,} строк" if event.get("rows_out") is not None else ""
+        print(f"  [{event['stage']}] {event['wall_s']:.2f} с (CPU {event['cpu_s']:.2f} с){rows}{peak}")
+
+
+class StageRecord:
+    """
+    Замеры одного этапа. Повторные входы в этап с тем же именем (например, разбор JSON
+    в каждом чанке) суммируются в одну запись, calls — число входов.
+    rows_in / rows_out этап выставляет сам.
+    """
+
+    def __init__(self, name: str, parent: "StageRecord | None"):
+        self.name = name
+        self.parent = parent
+        self.calls = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.rows_in = None
+        self.rows_out = None
+        self.input_bytes = None
+        self.bytes_read = None
+        self.peak_rss_mb = None
+        self.profile_file = None
+        self.profile_top = None
+
+    def add_rows_in(self, rows: int):
+        self.rows_in = (self.rows_in or 0) + rows
+
+    def add_rows_out(self, rows: int):
+        self.rows_out = (self.rows_out or 0) + rows
+
+    def _add_peak(self, peak: float | None):
+        if peak is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb or 0.0, peak)
+
+    def to_dict(self) -> dict:
+        data = {k: v for k, v in self.__dict__.items() if k != "parent" and v is not None}
+        data["wall_s"] = round(self.wall_s, 4)
+        data["cpu_s"] = round(self.cpu_s, 4)
+        if self.wall_s:
+            # > 1 — этап реально параллелится потоками polars
+            data["cpu_utilization"] = round(self.cpu_s / self.wall_s, 2)
+        if self.rows_in and self.wall_s:
+            data["rows_per_s"] = round(self.rows_in / self.wall_s)
+        if self.peak_rss_mb is not None:
+            data["peak_rss_mb"] = round(self.peak_rss_mb, 1)
+        return data
+
+
+class _StageContext:
+    def __init__(self, profiler: "StageProfiler", name: str, files):
+        self.profiler = profiler
+        self.name = name
+        self.files = files
+        self.record = None
+
+    def __enter__(self) -> StageRecord:
+        self.record = self.profiler._enter(self.name, self.files)
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._exit(self.record, exc)
+        return False
+
+
+class StageProfiler:
+    """
+    Инструментация ETL: время (wall и CPU), строки на входе и выходе, прочитанные байты
+    и пик памяти по вложенным этапам. Имена вложенных этапов составные: "v1/visits/json_decode".
+
+    profile: None, "cprofile" или "sampling" (pyinstrument, если установлен) — профилирование
+    этапов верхнего уровня или только перечисленных в profile_stages; результат сохраняется
+    в <report_dir>/profiles/.
+    on_progress получает события-словари {"stage", "event": "start" | "progress" | "end", ...}.
+    Выключенный профайлер (enabled=False) ничего не замеряет, но события progress передает.
+    """
+
+    def __init__(
+        self,
+        run_name: str = "etl",
+        enabled: bool = True,
+        on_progress=print_progress,
+        profile: str | None = None,
+        profile_stages: list[str] | None = None,
+        report_dir: Path = OUTPUT_DIR,
+    ):
+        if profile == "sampling" and SamplingProfiler is None:
+            print("Warning: pyinstrument is not installed, falling back to cProfile")
+            profile = "cprofile"
+        self.run_name = run_name
+        self.enabled = enabled
+        self.on_progress = on_progress
+        self.profile = profile
+        self.profile_stages = set(profile_stages or [])
+        self.report_dir = Path(report_dir)
+        self.records: dict[str, StageRecord] = {}
+        self.started_at = datetime.now(UTC).isoformat()
+        self.peak_rss_scope = ("stage" if _reset_peak_rss() else "process") if enabled else None
+        self._stack: list[tuple] = []
+        self._t0 = time.perf_counter()
+
+    def stage(self, name: str, files=None) -> _StageContext:
+        """Контекстный менеджер этапа; files — входные файлы, их размер попадет в input_bytes."""
+        return _StageContext(self, name, files)
+
+    def progress(self, rows: int, label: str | None = None, **fields):
+        """Промежуточный прогресс текущего этапа (например, после каждого чанка)."""
+        if self.on_progress is None:
+            return
+        stage = self._stack[-1][0].name if self._stack else self.run_name
+        self.on_progress({
+            "stage": stage,
+            "event": "progress",
+            "rows": rows,
+            "label": label,
+            "elapsed_s": round(time.perf_counter() - self._t0, 3),
+            **fields,
+        })
+
+    def _enter(self, name: str, files) -> StageRecord:
+        parent = self._stack[-1][0] if self._stack else None
+        full_name = f"{parent.name}/{name}" if parent else name
+        if not self.enabled:
+            record = StageRecord(full_name, parent)
+            self._stack.append((record, None))
+            return record
+
+        record = self.records.get(full_name)
+        if record is None:
+            record = self.records[full_name] = StageRecord(full_name, parent)
+        if files:
+            sizes = [Path(f).stat().st_size for f in files if Path(f).exists()]
+            record.input_bytes = (record.input_bytes or 0) + sum(sizes)
+
+        if self.on_progress is not None:
+            self.on_progress({"stage": full_name, "event": "start", "elapsed_s": round(time.perf_counter() - self._t0, 3)})
+
+        profiler = self._start_profiler(name, parent)
+        if self.peak_rss_scope == "stage":
+            _reset_peak_rss()
+        state = (time.perf_counter(), time.process_time(), _bytes_read(), profiler)
+        self._stack.append((record, state))
+        return record
+
+    def _exit(self, record: StageRecord, exc):
+        _, state = self._stack.pop()
+        if state is None:
+            return
+        t0, cpu0, read0, profiler = state
+
+        record.calls += 1
+        record.wall_s += time.perf_counter() - t0
+        record.cpu_s += time.process_time() - cpu0
+        read1 = _bytes_read()
+        if read0 is not None and read1 is not None:
+            record.bytes_read = (record.bytes_read or 0) + read1 - read0
+        record._add_peak(_peak_rss_mb())
+        if record.parent is not None:
+            # сброс VmHWM во вложенном этапе стер бы пик родителя — передаем его вверх
+            record.parent._add_peak(record.peak_rss_mb)
+        if profiler is not None:
+            self._stop_profiler(record, profiler)
+
+        if self.on_progress is not None:
+            self.on_progress({
+                "stage": record.name,
+                "event": "end",
+                "status": "error" if exc is not None else "ok",
+                "elapsed_s": round(time.perf_counter() - self._t0, 3),
+                **record.to_dict(),
+            })
+
+    def _start_profiler(self, name: str, parent: StageRecord | None):
+        if self.profile is None:
+            return None
+        if self.profile_stages and name not in self.profile_stages:
+            return None
+        if not self.profile_stages and parent is not None:
+            return None
+        # профайлер уже запущен во внешнем этапе — второй одновременно нельзя
+        if any(state and state[3] is not None for _, state in self._stack):
+            return None
+        profiler = SamplingProfiler() if self.profile == "sampling" else cProfile.Profile()
+        profiler.start() if self.profile == "sampling" else profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, record: StageRecord, profiler):
+        profiles_dir = self.report_dir / "profiles"
+        profiles_dir.mkdir(parents=True, exist_ok=True)
+        safe_name = re.sub(r"[^\w.-]+", "_", record.name)
+
+        if self.profile == "sampling":
+            profiler.stop()
+            path = profiles_dir / f"{safe_name}.html"
+            path.write_text(profiler.output_html(), encoding="utf8")
+            record.profile_top = profiler.output_text(unicode=True, color=False).splitlines()[:PROFILE_TOP_FUNCTIONS * 2]
+        else:
+            profiler.disable()
+            path = profiles_dir / f"{safe_name}.prof"
+            profiler.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            record.profile_top = [line for line in out.getvalue().splitlines() if line.strip()][-PROFILE_TOP_FUNCTIONS:]
+        record.profile_file = str(path)
+
+    def report(self) -> dict:
+        """Машиночитаемый отчет о запуске: окружение, итоги и все этапы в порядке первого входа."""
+        stages = [r.to_dict() for r in self.records.values()]
+        top_level = [r for r in self.records.values() if r.parent is None]
+        return {
+            "run_name": self.run_name,
+            "started_at": self.started_at,
+            "finished_at": datetime.now(UTC).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "peak_rss_scope": self.peak_rss_scope,
+            "total_wall_s": round(time.perf_counter() - self._t0, 3),
+            "total_cpu_s": round(sum(r.cpu_s for r in top_level), 3),
+            "stages": stages,
+        }
+
+    def write_report(self, path: Path | None = None) -> Path:
+        path = Path(path or self.report_dir / REPORT_FILE)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.report(), ensure_ascii=False, indent=2), encoding="utf8")
+        return path
+
+
+# ETL вызывает stage()/progress() модуля; по умолчанию профайлер выключен и только печатает прогресс
+_active = StageProfiler(enabled=False)
+
+
+def activate(profiler: StageProfiler) -> StageProfiler:
+    """Делает profiler текущим для stage() и progress() во всех модулях ETL."""
+    global _active
+    _active = profiler
+    return profiler
+
+
+def stage(name: str, files=None) -> _StageContext:
+    return _active.stage(name, files)
+
+
+def progress(rows: int, label: str | None = None, **fields):
+    _active.progress(rows, label, **fields)
+
+
+def profiler_from_env(run_name: str) -> StageProfiler:
+    """
+    Профайлер для запуска скрипта: ETL_PROFILE=cprofile|sampling включает профилирование,
+    ETL_PROFILE_STAGES=visits_scan,json_decode — только этих этапов.
+    """
+    stages = os.environ.get("ETL_PROFILE_STAGES")
+    return StageProfiler(
+        run_name=run_name,
+        profile=os.environ.get("ETL_PROFILE") or None,
+        profile_stages=stages.split(",") if stages else None,
+    )
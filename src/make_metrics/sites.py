@@ -0,0 +1,246 @@
+import os
+import re
+from pathlib import Path
+
+import polars as pl
+
+OUTPUT_DIR = Path("data/metrics")
+SITES_DIR = OUTPUT_DIR / "sites"
+
+# ключ сайта: колонка визитов (по умолчанию счетчик Метрики) или "domain" — хост стартовой страницы.
+# У хитов счетчика нет: их сайт — сайт, на который чаще всего приходят визиты с этого хоста
+SITE_KEY = os.environ.get("ETL_SITE_KEY", "ym:s:counterID")
+
+UNKNOWN_SITE = "unknown"
+
+_UNSAFE = re.compile(r"[^\w.\-]+")
+
+
+def url_host(col: pl.Expr) -> pl.Expr:
+    """Хост URL в нижнем регистре, без порта; null для пустых и неразборных URL"""
+    return col.str.extract(r"^[A-Za-z][A-Za-z0-9+.\-]*://([^/?#:]+)", 1).str.to_lowercase()
+
+
+def visit_columns() -> list[str]:
+    """Колонки визитов, нужные для ключа сайта и соответствия хостов"""
+    return ["ym:s:startURL"] if SITE_KEY == "domain" else [SITE_KEY, "ym:s:startURL"]
+
+
+def visit_site() -> pl.Expr:
+    """Сайт визита строкой"""
+    if SITE_KEY == "domain":
+        site = url_host(pl.col("ym:s:startURL"))
+    else:
+        site = pl.col(SITE_KEY).cast(pl.Utf8)
+    return site.fill_null(UNKNOWN_SITE).alias("site")
+
+
+def host_site_counts(visits: pl.DataFrame) -> pl.DataFrame:
+    """(host, site, visits) по куску визитов: из сумм по кускам строится host_site_map"""
+    # сначала свертка по URL: хост разбирается регуляркой на уникальных URL, а не на каждом визите
+    return (
+        visits
+        .group_by(["ym:s:startURL", visit_site()])
+        .agg(pl.len().alias("visits"))
+        .with_columns(url_host(pl.col("ym:s:startURL")).alias("host"))
+        .drop_nulls("host")
+        .group_by(["host", "site"])
+        .agg(pl.col("visits").sum())
+    )
+
+
+def host_site_map(counts: pl.DataFrame | None) -> pl.DataFrame:
+    """host -> site: для каждого хоста сайт с наибольшим числом визитов"""
+    if counts is None:
+        return pl.DataFrame(schema={"host": pl.Utf8, "site": pl.Utf8})
+    return (
+        counts
+        .group_by(["host", "site"])
+        .agg(pl.col("visits").sum())
+        .sort(["visits", "site"], descending=[True, False])
+        .unique("host", keep="first", maintain_order=True)
+        .select(["host", "site"])
+    )
+
+
+def with_hit_site(hits: pl.DataFrame, url_column: str, hosts: pl.DataFrame) -> pl.DataFrame:
+    """Добавляет хитам колонку site по хосту URL; хост разбирается один раз на уникальный URL"""
+    urls = hits.select(pl.col(url_column).unique()).with_columns(url_host(pl.col(url_column)).alias("host"))
+    if SITE_KEY == "domain":
+        urls = urls.rename({"host": "site"})
+    else:
+        urls = urls.join(hosts, on="host", how="left").drop("host")
+    return (
+        hits
+        .join(urls, on=url_column, how="left", maintain_order="left")
+        .with_columns(pl.col("site").fill_null(UNKNOWN_SITE))
+    )
+
+
+def site_dir(site: str) -> Path:
+    return SITES_DIR / (_UNSAFE.sub("_", str(site)) or UNKNOWN_SITE)
+
+
+def write_site_partitions(df: pl.DataFrame, name: str) -> list[Path]:
+    """Раскладывает таблицу с колонкой site по data/metrics/sites/<сайт>/<name>"""
+    written = []
+    for (site,), piece in df.partition_by("site", as_dict=True).items():
+        directory = site_dir(site)
+        directory.mkdir(parents=True, exist_ok=True)
+        piece.drop("site").write_parquet(directory / name)
+        written.append(directory / name)
+    return written
+
+
+class SiteMetrics:
+    """
+    Метрики full_metrics по сайтам, собираемые в том же проходе, что и общие: каждый кусок визитов
+    и хитов сводится group_by по сайту к суммам, которые складываются с накопленными. Память —
+    по числу сайтов (и пар сайт-клиент для уникальных пользователей), а не по числу проходов
+    """
+
+    _VISIT_SUMS = ("total_visits", "new_users", "bounce_visits", "sum_visit_duration",
+                   "human_visits", "human_new_users", "human_bounce_visits", "human_visit_duration")
+
+    def __init__(self, version: str):
+        self.version = version
+        self._visits: pl.DataFrame | None = None
+        self._hits: pl.DataFrame | None = None
+        self._host_counts: pl.DataFrame | None = None
+        self._landings: pl.DataFrame | None = None
+        self._exits: pl.DataFrame | None = None
+        self._clients: pl.DataFrame | None = None
+        self._hosts: pl.DataFrame | None = None
+
+    @staticmethod
+    def _accumulate(total: pl.DataFrame | None, part: pl.DataFrame, key: list[str]) -> pl.DataFrame:
+        if total is None:
+            return part
+        return pl.concat([total, part], how="vertical_relaxed").group_by(key).agg(pl.all().sum())
+
+    def add_visits(self, visits: pl.DataFrame):
+        """Кусок визитов с колонками hits_count и bot_rule (null — не робот)"""
+        human = pl.col("bot_rule").is_null()
+        bounce = pl.col("hits_count").eq(1)
+        duration = pl.col("ym:s:visitDuration").cast(pl.Float64, strict=False).fill_null(0)
+        visits = visits.with_columns(visit_site())
+        part = visits.group_by("site").agg(
+            total_visits=pl.len(),
+            new_users=pl.col("ym:s:isNewUser").sum(),
+            bounce_visits=bounce.sum(),
+            sum_visit_duration=duration.sum(),
+            human_visits=human.sum(),
+            human_new_users=pl.col("ym:s:isNewUser").filter(human).sum(),
+            human_bounce_visits=(bounce & human).sum(),
+            human_visit_duration=duration.filter(human).sum(),
+        )
+        self._visits = self._accumulate(self._visits, part, ["site"])
+        self._host_counts = self._accumulate(self._host_counts, host_site_counts(visits), ["host", "site"])
+        self._landings = self._accumulate(self._landings, (
+            visits.group_by(["site", pl.col("ym:s:startURL").fill_null("unknown").alias("url")]).agg(count=pl.len())
+        ), ["site", "url"])
+        self._exits = self._accumulate(self._exits, (
+            visits.group_by(["site", pl.col("ym:s:endURL").fill_null("unknown").alias("url")]).agg(count=pl.len())
+        ), ["site", "url"])
+
+    def hosts(self) -> pl.DataFrame:
+        """Соответствие хостов сайтам по всем уже добавленным визитам"""
+        if self._hosts is None:
+            self._hosts = host_site_map(self._host_counts)
+            self._host_counts = None
+        return self._hosts
+
+    def add_hits(self, hits: pl.DataFrame):
+        """Кусок хитов (ym:pv:URL, ym:pv:clientID, bot_rule); визиты версии уже добавлены"""
+        hits = with_hit_site(hits, "ym:pv:URL", self.hosts())
+        human = pl.col("bot_rule").is_null()
+        part = hits.group_by("site").agg(total_hits=pl.len(), human_hits=human.sum())
+        self._hits = self._accumulate(self._hits, part, ["site"])
+        # пары сайт-клиент сводятся после каждого куска: память — по числу пар, а не хитов
+        part = hits.select("site", "ym:pv:clientID", human.alias("human")).unique()
+        self._clients = part if self._clients is None else pl.concat([self._clients, part]).unique()
+
+    @staticmethod
+    def _top_url(counts: pl.DataFrame, name: str) -> pl.DataFrame:
+        # при равном числе визитов — первый по алфавиту URL, иначе выбор зависит от порядка потоков
+        return counts.group_by("site").agg(
+            pl.col("url").sort_by(["count", "url"], descending=[True, False]).first().alias(name)
+        )
+
+    def metrics(self) -> pl.DataFrame:
+        """Строка метрик на сайт: те же имена, что у общих метрик в full_metrics"""
+        visits = self._visits if self._visits is not None else pl.DataFrame(
+            schema={"site": pl.Utf8, **{name: pl.Float64 for name in self._VISIT_SUMS}}
+        )
+        hits = self._hits if self._hits is not None else pl.DataFrame(
+            schema={"site": pl.Utf8, "total_hits": pl.UInt32, "human_hits": pl.UInt32}
+        )
+        if self._clients is not None:
+            users = self._clients.group_by("site").agg(
+                unique_users=pl.col("ym:pv:clientID").n_unique(),
+                human_unique_users=pl.col("ym:pv:clientID").filter(pl.col("human")).n_unique(),
+            )
+        else:
+            users = pl.DataFrame(schema={"site": pl.Utf8, "unique_users": pl.UInt32, "human_unique_users": pl.UInt32})
+
+        top_pages = pl.DataFrame(schema={"site": pl.Utf8, "top_landing_page": pl.Utf8, "top_exit_page": pl.Utf8})
+        if self._landings is not None:
+            top_pages = (
+                self._top_url(self._landings, "top_landing_page")
+                .join(self._top_url(self._exits, "top_exit_page"), on="site", how="full", coalesce=True)
+            )
+
+        def ratio(num: str, den: str, scale: float = 1.0) -> pl.Expr:
+            return pl.when(pl.col(den) > 0).then(pl.col(num) / pl.col(den) * scale).otherwise(0.0)
+
+        return (
+            visits
+            .join(hits, on="site", how="full", coalesce=True)
+            .join(users, on="site", how="left")
+            .join(top_pages, on="site", how="left")
+            .with_columns(pl.exclude("site", "top_landing_page", "top_exit_page").fill_null(0))
+            .with_columns(
+                deep_visits=pl.col("total_visits") - pl.col("bounce_visits"),
+                bot_visits=pl.col("total_visits") - pl.col("human_visits"),
+            )
+            .select(
+                "site",
+                pl.lit(self.version).alias("version"),
+                pl.col("total_visits").cast(pl.Int64),
+                pl.col("total_hits").cast(pl.Int64),
+                pl.col("unique_users").cast(pl.Int64),
+                pl.col("new_users").cast(pl.Int64),
+                ratio("new_users", "total_visits", 100).alias("new_user_rate"),
+                ratio("bounce_visits", "total_visits", 100).alias("bounce_rate"),
+                ratio("total_hits", "total_visits").alias("pages_per_visit"),
+                ratio("deep_visits", "total_visits", 100).alias("user_engagement"),
+                pl.col("bounce_visits").cast(pl.Int64).alias("visits_depth_1"),
+                pl.col("deep_visits").cast(pl.Int64).alias("visits_depth_2plus"),
+                ratio("deep_visits", "total_visits", 100).alias("deep_visits_rate"),
+                ratio("total_hits", "unique_users").alias("hits_per_user"),
+                ratio("total_visits", "unique_users").alias("visits_per_user"),
+                ratio("total_hits", "total_visits").alias("avg_pages"),
+                ratio("sum_visit_duration", "total_visits").alias("session_duration_sec"),
+                "top_landing_page",
+                "top_exit_page",
+                pl.col("human_visits").cast(pl.Int64).alias("human_total_visits"),
+                pl.col("human_hits").cast(pl.Int64).alias("human_total_hits"),
+                pl.col("human_unique_users").cast(pl.Int64),
+                ratio("human_new_users", "human_visits", 100).alias("human_new_user_rate"),
+                ratio("human_bounce_visits", "human_visits", 100).alias("human_bounce_rate"),
+                ratio("human_hits", "human_visits").alias("human_pages_per_visit"),
+                ratio("human_visit_duration", "human_visits").alias("human_session_duration_sec"),
+                ratio("bot_visits", "total_visits", 100).alias("bot_visit_share"),
+            )
+            .sort("total_visits", descending=True)
+        )
+
+
+def write_site_full_metrics(*site_metrics: pl.DataFrame) -> list[Path]:
+    """
+    full_metrics.parquet каждого сайта (строка на версию, как общий файл) и сводная
+    data/metrics/site_metrics.parquet со всеми сайтами и версиями
+    """
+    combined = pl.concat(site_metrics, how="diagonal_relaxed")
+    combined.write_parquet(OUTPUT_DIR / "site_metrics.parquet")
+    return write_site_partitions(combined, "full_metrics.parquet")
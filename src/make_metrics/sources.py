@@ -0,0 +1,412 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from dedup import IdDeduper
+
+DATA_DIR = Path("data/raw")
+
+# одиночные выгрузки версий — частный случай: шаблоны ниже находят и их, и суточные/часовые файлы
+HITS_FILES = {
+    "v1": "2022_yandex_metrika_hits.parquet",
+    "v2": "2024_yandex_metrika_hits.parquet",
+}
+VISITS_FILES = {
+    "v1": "2022_yandex_metrika_visits.parquet",
+    "v2": "2024_yandex_metrika_visits.parquet",
+}
+
+# шаблоны glob относительно DATA_DIR, {version} подставляется. Переопределяются переменными
+# ETL_VISITS_GLOB / ETL_HITS_GLOB (несколько шаблонов через ;), например "exports/{version}/visits_*.parquet"
+SOURCE_GLOBS = {
+    "visits": [
+        "{legacy_stem}.parquet",
+        "{legacy_stem}_*.parquet",
+        "visits/version={version}/**/*.parquet",
+    ],
+    "hits": [
+        "{legacy_stem}.parquet",
+        "{legacy_stem}_*.parquet",
+        "hits/version={version}/**/*.parquet",
+    ],
+}
+
+LEGACY_FILES = {"visits": VISITS_FILES, "hits": HITS_FILES}
+
+# колонка с датой события: по ней отсекаются партиции, группы строк и сами строки
+DATE_COLUMNS = {"visits": "ym:s:date", "hits": "ym:pv:dateTime"}
+
+# типы известных колонок выгрузки: файлы разных партий приводятся к ним (дрейф схемы).
+# Идентификаторы Метрики — UInt64: значения от 2^63 в Int64 не помещаются
+SCHEMA = {
+    "ym:s:visitID": pl.UInt64,
+    "ym:s:counterID": pl.Int64,
+    "ym:s:clientID": pl.UInt64,
+    "ym:s:watchIDs": pl.Utf8,
+    "ym:s:goalsID": pl.Utf8,
+    "ym:s:isNewUser": pl.Int64,
+    "ym:s:date": pl.Utf8,
+    "ym:s:dateTime": pl.Utf8,
+    "ym:s:dateTimeUTC": pl.Utf8,
+    "ym:s:visitDuration": pl.Int64,
+    "ym:s:startURL": pl.Utf8,
+    "ym:s:endURL": pl.Utf8,
+    "ym:s:lastTrafficSource": pl.Utf8,
+    "ym:s:deviceCategory": pl.Utf8,
+    "ym:pv:watchID": pl.UInt64,
+    "ym:pv:pageViewID": pl.UInt64,
+    "ym:pv:URL": pl.Utf8,
+    "ym:pv:dateTime": pl.Utf8,
+    "ym:pv:clientID": pl.UInt64,
+}
+
+ID_COLUMNS = {name for name, dtype in SCHEMA.items() if dtype == pl.UInt64}
+
+# ключи дедупликации: пересекающиеся выгрузки приносят тот же визит или хит повторно
+DEDUP_KEYS = {"visits": "ym:s:visitID", "hits": "ym:pv:watchID"}
+
+# ETL_DEDUP=0 отключает дедупликацию (например, чтобы сравнить с прежними цифрами)
+DEDUP = os.environ.get("ETL_DEDUP", "1") != "0"
+
+# сколько групп строк читается одновременно: потолок и параллелизма ввода-вывода, и памяти
+IO_WORKERS = int(os.environ.get("ETL_IO_WORKERS", "4"))
+
+_DATE_IN_PATH = re.compile(r"(?:date=)?(\d{4})-?(\d{2})-?(\d{2})(?!\d)")
+
+# (kind, version, окно дат, файлы и их mtime) -> номера строк-дублей по файлам
+_duplicates_cache: dict[tuple, dict[Path, np.ndarray]] = {}
+DEDUP_STATS: dict[tuple[str, str], dict[str, int]] = {}
+
+_date_range: tuple[str | None, str | None] = (
+    os.environ.get("ETL_DATE_FROM") or None,
+    os.environ.get("ETL_DATE_TO") or None,
+)
+
+
+def set_date_range(date_from: str | date | None = None, date_to: str | date | None = None):
+    """
+    Окно дат (включительно, YYYY-MM-DD) для всех источников; None — без границы.
+    По умолчанию берется из ETL_DATE_FROM / ETL_DATE_TO
+    """
+    global _date_range
+    _date_range = (
+        str(date_from)[:10] if date_from is not None else None,
+        str(date_to)[:10] if date_to is not None else None,
+    )
+
+
+def date_range() -> tuple[str | None, str | None]:
+    return _date_range
+
+
+def _in_range(first: str | None, last: str | None) -> bool:
+    """Пересекается ли [first, last] с окном дат; неизвестная граница не отсекает"""
+    date_from, date_to = _date_range
+    if date_from is not None and last is not None and last < date_from:
+        return False
+    return date_to is None or first is None or first <= date_to
+
+
+def _path_date(path: Path) -> str | None:
+    """Дата партиции из пути: сегмент date=YYYY-MM-DD, а без него — дата в имени файла (YYYY-MM-DD / YYYYMMDD)"""
+    parts = path.relative_to(DATA_DIR).parts if path.is_relative_to(DATA_DIR) else (path.name,)
+    for part in parts[:-1]:
+        if part.startswith("date="):
+            match = _DATE_IN_PATH.fullmatch(part)
+            if match:
+                return "-".join(match.groups())
+    match = _DATE_IN_PATH.search(parts[-1])
+    return "-".join(match.groups()) if match else None
+
+
+def _patterns(kind: str, version: str) -> list[str]:
+    env = os.environ.get(f"ETL_{kind.upper()}_GLOB")
+    patterns = env.split(";") if env else SOURCE_GLOBS[kind]
+    legacy_stem = Path(LEGACY_FILES[kind][version]).stem
+    return [p.format(version=version, legacy_stem=legacy_stem) for p in patterns]
+
+
+def discover_files(kind: str, version: str) -> list[Path]:
+    """Все файлы версии по шаблонам, без отсечения по датам"""
+    files = set()
+    for pattern in _patterns(kind, version):
+        files.update(p for p in DATA_DIR.glob(pattern) if p.is_file())
+    return sorted(files)
+
+
+def _stats_range(path: Path, column: str) -> tuple[str | None, str | None]:
+    """min/max колонки даты по статистике parquet (только метаданные); None, если статистики нет"""
+    metadata = pq.ParquetFile(path).metadata
+    names = metadata.schema.names
+    if column not in names:
+        return None, None
+    index = names.index(column)
+    lows, highs = [], []
+    for rg in range(metadata.num_row_groups):
+        stats = metadata.row_group(rg).column(index).statistics
+        if stats is None or not stats.has_min_max:
+            return None, None
+        lows.append(str(stats.min)[:10])
+        highs.append(str(stats.max)[:10])
+    return (min(lows), max(highs)) if lows else (None, None)
+
+
+def source_files(kind: str, version: str) -> list[Path]:
+    """
+    Файлы версии, которые пересекаются с окном дат: сначала по дате в пути (hive date=... или имя файла),
+    для файлов без даты в пути — по min/max статистике колонки даты
+    """
+    files = discover_files(kind, version)
+    if not files:
+        raise FileNotFoundError(f"No {kind} files for {version} in {DATA_DIR}: {_patterns(kind, version)}")
+    if _date_range == (None, None):
+        return files
+
+    selected = []
+    for path in files:
+        day = _path_date(path)
+        if day is not None:
+            keep = _in_range(day, day)
+        else:
+            keep = _in_range(*_stats_range(path, DATE_COLUMNS[kind]))
+        if keep:
+            selected.append(path)
+    return selected
+
+
+def id_expr(name: str, actual: pl.DataType) -> pl.Expr:
+    """
+    Колонка идентификатора как UInt64. Int64 переинтерпретируется побитно: id от 2^63, записанный
+    в знаковую колонку, там отрицательный. Остальные типы приводятся строго — значение, которое
+    не является id, роняет чтение, а не превращается молча в null
+    """
+    if actual == pl.Int64:
+        return pl.col(name).reinterpret(signed=False).alias(name)
+    return pl.col(name).cast(pl.UInt64, strict=True).alias(name)
+
+
+def _conform_exprs(file_schema: dict, columns: list[str]) -> list[pl.Expr]:
+    """
+    Выражения, приводящие файл к общей схеме: недостающая колонка — null нужного типа,
+    идентификатор — UInt64 (см. id_expr), другой тип — приведение
+    (список id вместо JSON-строки снова становится строкой ["1","2"])
+    """
+    exprs = []
+    for name in columns:
+        target = SCHEMA.get(name)
+        actual = file_schema.get(name)
+        if actual is None:
+            exprs.append(pl.lit(None, dtype=target or pl.Utf8).alias(name))
+        elif target is None or actual == target:
+            exprs.append(pl.col(name))
+        elif name in ID_COLUMNS:
+            exprs.append(id_expr(name, actual))
+        elif target == pl.Utf8 and isinstance(actual, pl.List):
+            exprs.append(pl.concat_str([
+                pl.lit("["),
+                pl.col(name).list.eval(pl.lit('"') + pl.element().cast(pl.Utf8) + pl.lit('"')).list.join(","),
+                pl.lit("]"),
+            ]).alias(name))
+        else:
+            exprs.append(pl.col(name).cast(target, strict=False).alias(name))
+    return exprs
+
+
+def _date_filter(kind: str) -> pl.Expr | None:
+    date_from, date_to = _date_range
+    if date_from is None and date_to is None:
+        return None
+    day = pl.col(DATE_COLUMNS[kind]).cast(pl.Utf8).str.slice(0, 10)
+    condition = pl.lit(True)
+    if date_from is not None:
+        condition = condition & (day >= date_from)
+    if date_to is not None:
+        condition = condition & (day <= date_to)
+    return condition
+
+
+def _with_date_column(kind: str, columns: list[str]) -> list[str]:
+    """Колонки для чтения: нужные плюс колонка даты, если включено окно дат"""
+    if _date_range != (None, None) and DATE_COLUMNS[kind] not in columns:
+        return [*columns, DATE_COLUMNS[kind]]
+    return list(columns)
+
+
+def source_columns(kind: str, version: str) -> set[str]:
+    """Колонки, которые есть хотя бы в одном файле версии"""
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+        schemas = list(pool.map(pl.read_parquet_schema, discover_files(kind, version)))
+    return set().union(*schemas) if schemas else set()
+
+
+def source_rows(kind: str, version: str) -> int:
+    """Строк в выбранных файлах по метаданным (до фильтра строк по дате)"""
+    return sum(pq.ParquetFile(path).metadata.num_rows for path in source_files(kind, version))
+
+
+def scan_source(kind: str, version: str, columns: list[str], dedup: bool = DEDUP) -> pl.LazyFrame:
+    """
+    Ленивое чтение колонок columns из всех выбранных файлов версии, приведенных к SCHEMA,
+    с фильтром строк по окну дат (polars отсекает по нему и группы строк по статистике).
+    При dedup повторные visitID / watchID отбрасываются (см. duplicate_rows)
+    """
+    files = source_files(kind, version)
+    read_columns = _with_date_column(kind, columns)
+    duplicates = duplicate_rows(kind, version) if dedup else {}
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+        schemas = list(pool.map(pl.read_parquet_schema, files))
+
+    frames = []
+    for path, schema in zip(files, schemas):
+        present = [c for c in read_columns if c in schema]
+        lf = pl.scan_parquet(path).select(present)
+        if path in duplicates:
+            # номер строки добавляется после проекции: иначе старый потоковый движок теряет колонки в concat
+            skip = pl.Series(duplicates[path], dtype=pl.UInt32)
+            lf = lf.with_row_index("_row").filter(~pl.col("_row").is_in(skip)).drop("_row")
+        frames.append(lf.select(_conform_exprs(schema, read_columns)))
+    lf = pl.concat(frames, how="vertical_relaxed") if frames else pl.LazyFrame(
+        schema={c: SCHEMA.get(c, pl.Utf8) for c in read_columns}
+    )
+
+    condition = _date_filter(kind)
+    if condition is not None:
+        lf = lf.filter(condition)
+    return lf.select(columns)
+
+
+def _row_groups(kind: str, files: list[Path]) -> list[tuple[Path, int, int]]:
+    """
+    (файл, группа строк, номер ее первой строки в файле) для чтения:
+    группы, целиком вне окна дат, отбрасываются по статистике
+    """
+    units = []
+    column = DATE_COLUMNS[kind]
+    for path in files:
+        metadata = pq.ParquetFile(path).metadata
+        names = metadata.schema.names
+        index = names.index(column) if column in names else None
+        offset = 0
+        for rg in range(metadata.num_row_groups):
+            rows = metadata.row_group(rg).num_rows
+            keep = True
+            if index is not None and _date_range != (None, None):
+                stats = metadata.row_group(rg).column(index).statistics
+                if stats is not None and stats.has_min_max and not _in_range(str(stats.min)[:10], str(stats.max)[:10]):
+                    keep = False
+            if keep:
+                units.append((path, rg, offset))
+            offset += rows
+    return units
+
+
+def _read_row_group(
+    kind: str, path: Path, rg: int, offset: int, columns: list[str],
+    skip: np.ndarray | None = None, row_index: bool = False,
+) -> pl.DataFrame:
+    """
+    Группа строк, приведенная к SCHEMA и отфильтрованная по окну дат. skip — номера строк файла,
+    которые нужно выбросить (дубли); row_index добавляет колонку _row с номером строки в файле
+    """
+    parquet = pq.ParquetFile(path)
+    names = set(parquet.schema_arrow.names)
+    df = pl.from_arrow(parquet.read_row_group(rg, columns=[c for c in columns if c in names]))
+    df = df.select(_conform_exprs(df.schema, columns))
+    if row_index:
+        df = df.with_row_index("_row", offset=offset)
+    if skip is not None:
+        local = skip[(skip >= offset) & (skip < offset + df.height)] - offset
+        if len(local):
+            keep = np.ones(df.height, dtype=bool)
+            keep[local] = False
+            df = df.filter(pl.Series(keep))
+    condition = _date_filter(kind)
+    return df.filter(condition) if condition is not None else df
+
+
+def _read_units(kind: str, units: list[tuple[Path, int, int]], columns: list[str], duplicates=None, row_index=False):
+    """
+    Группы строк по порядку: читаются в IO_WORKERS потоках с опережением не больше IO_WORKERS групп,
+    так что в памяти одновременно лишь несколько групп
+    """
+    duplicates = duplicates or {}
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as pool:
+        futures = []
+        next_unit = 0
+        while next_unit < len(units) or futures:
+            while next_unit < len(units) and len(futures) < IO_WORKERS:
+                path, rg, offset = units[next_unit]
+                futures.append((units[next_unit], pool.submit(
+                    _read_row_group, kind, path, rg, offset, columns, duplicates.get(path), row_index
+                )))
+                next_unit += 1
+            unit, future = futures.pop(0)
+            yield unit, future.result()
+
+
+def duplicate_rows(kind: str, version: str) -> dict[Path, np.ndarray]:
+    """
+    Номера строк-дублей в выбранных файлах версии: строки, чей visitID / watchID уже встретился
+    раньше (в порядке файлов и строк); первое вхождение остается. Читается только колонка ключа
+    (и даты при окне дат), множество увиденных ключей — IdDeduper в ограниченной памяти.
+    Результат кешируется до смены файлов или окна дат; число дублей — в DEDUP_STATS
+    """
+    files = source_files(kind, version)
+    cache_key = (kind, version, _date_range, tuple((path, path.stat().st_mtime_ns) for path in files))
+    if cache_key in _duplicates_cache:
+        return _duplicates_cache[cache_key]
+
+    column = DEDUP_KEYS[kind]
+    keyed = [path for path in files if column in pq.ParquetFile(path).schema_arrow.names]
+    found: dict[Path, list[np.ndarray]] = {}
+    with IdDeduper() as deduper:
+        for (path, _, _), df in _read_units(kind, _row_groups(kind, keyed), _with_date_column(kind, [column]), row_index=True):
+            df = df.filter(pl.col(column).is_not_null())
+            mask = deduper.duplicate_mask(df[column].to_numpy())
+            if mask.any():
+                found.setdefault(path, []).append(df["_row"].to_numpy()[mask])
+        seen, dropped = deduper.seen, deduper.duplicates
+
+    duplicates = {path: np.concatenate(rows) for path, rows in found.items()}
+    _duplicates_cache[cache_key] = duplicates
+    DEDUP_STATS[(kind, version)] = {"rows": seen, "duplicates": dropped}
+    print(f"  Дубли {kind} {version} по {column}: отброшено {dropped:,} из {seen:,} строк")
+    return duplicates
+
+
+def duplicate_count(kind: str, version: str) -> int:
+    """Сколько строк-дублей отброшено (0, если дедупликация не запускалась)"""
+    return DEDUP_STATS.get((kind, version), {}).get("duplicates", 0)
+
+
+def iter_source_batches(kind: str, version: str, columns: list[str], batch_rows: int, dedup: bool = DEDUP):
+    """
+    Потоковое чтение версии кусками по batch_rows строк. Группы строк всех выбранных файлов
+    читаются в IO_WORKERS потоках с опережением не больше IO_WORKERS групп — порядок строк
+    сохраняется, а в памяти одновременно лишь несколько групп. При dedup дубли выброшены
+    """
+    files = source_files(kind, version)
+    units = _row_groups(kind, files)
+    read_columns = _with_date_column(kind, columns)
+    duplicates = duplicate_rows(kind, version) if dedup else {}
+
+    pending: list[pl.DataFrame] = []
+    pending_rows = 0
+    for _, df in _read_units(kind, units, read_columns, duplicates):
+        df = df.select(columns)
+        pending.append(df)
+        pending_rows += df.height
+        while pending_rows >= batch_rows:
+            merged = pl.concat(pending)
+            yield merged.slice(0, batch_rows)
+            rest = merged.slice(batch_rows)
+            pending, pending_rows = ([rest], rest.height) if rest.height else ([], 0)
+
+    if pending_rows:
+        yield pl.concat(pending)
@@ -0,0 +1,218 @@
+"""
+Отсев роботов и аномального трафика по клиенту (clientID).
+
+Область действия: разметку bot_rule получают только проходы compute_advanced_metrics —
+full_metrics (human_* рядом с полными метриками, bot_* счетчики) и метрики по сайтам.
+URL-метрики, дневные ряды по URL и цели по-прежнему считают весь трафик, как его отдает
+Метрика: их ряды сравниваются между версиями и с отчетами Метрики, а отсев там сдвинул бы
+базу детектора аномалий. Доля роботов в них видна по bot_visit_share / bot_hit_share.
+
+Правила зависят от итогов клиента за всю версию, поэтому таблица клиентов строится до
+разметки кусков. В ETL она считается по уже прочитанным в память визитам и хитам
+(from_frames) — отдельного чтения файлов нет; for_version читает источники сам и нужен
+для отладки и тестов
+"""
+
+import os
+
+import polars as pl
+
+from profiling import stage
+from sources import scan_source, source_columns, source_files
+
+# колонки-признаки робота, если они есть в выгрузке (переопределяются ETL_ROBOT_COLUMNS через запятую)
+ROBOT_FLAG_COLUMNS = {
+    "visits": ["ym:s:isRobot", "ym:s:robotness"],
+    "hits": ["ym:pv:isRobot"],
+}
+_env_robot_columns = os.environ.get("ETL_ROBOT_COLUMNS")
+if _env_robot_columns:
+    _names = [c.strip() for c in _env_robot_columns.split(",") if c.strip()]
+    ROBOT_FLAG_COLUMNS = {
+        "visits": [c for c in _names if c.startswith("ym:s:")],
+        "hits": [c for c in _names if c.startswith("ym:pv:")],
+    }
+
+# частота хитов: клиент с HIT_RATE_MIN_HITS+ хитами и больше MAX_HITS_PER_MINUTE в минуту активности
+HIT_RATE_MIN_HITS = 30
+MAX_HITS_PER_MINUTE = 20
+
+# невозможные интервалы: больше MAX_HITS_PER_SECOND просмотров одного клиента в одну секунду
+MAX_HITS_PER_SECOND = 3
+
+# клиент, у которого ZERO_BOUNCE_MIN_VISITS+ визитов и все — один хит с нулевой длительностью
+ZERO_BOUNCE_MIN_VISITS = 10
+
+# порядок важен: клиенту приписывается первое сработавшее правило
+RULES = ("robot_flag", "hit_burst", "hit_rate", "zero_duration_bounces")
+
+# ETL_TRAFFIC_FILTER=0 отключает правила: отфильтрованные метрики совпадут с полными
+TRAFFIC_FILTER = os.environ.get("ETL_TRAFFIC_FILTER", "1") != "0"
+
+
+def _truthy(col: pl.Expr) -> pl.Expr:
+    """Признак робота в любом виде: 1 / true / yes / ненулевое число; null — не робот"""
+    text = col.cast(pl.Utf8).str.to_lowercase().str.strip_chars()
+    return text.is_not_null() & ~text.is_in(["", "0", "0.0", "false", "no", "none", "null"])
+
+
+def robot_columns(kind: str, version: str) -> list[str]:
+    """Колонки-признаки робота, которые есть в выгрузке версии: их надо добавить в чтение"""
+    present = source_columns(kind, version)
+    return [c for c in ROBOT_FLAG_COLUMNS[kind] if c in present]
+
+
+def _present_robot_columns(kind: str, columns: list[str]) -> list[str]:
+    return [c for c in ROBOT_FLAG_COLUMNS[kind] if c in columns]
+
+
+def _hits_client_stats(hits: pl.LazyFrame) -> pl.DataFrame:
+    """По клиенту: хиты, максимум хитов в одну секунду, минуты активности, признак робота в хитах"""
+    robot_columns = _present_robot_columns("hits", hits.collect_schema().names())
+    # время группируется числом, а не строкой; агрегат признака робота — только если колонки есть
+    per_second_aggs = {"hits": pl.len()}
+    if robot_columns:
+        per_second_aggs["robot"] = pl.any_horizontal([_truthy(pl.col(c)) for c in robot_columns]).any()
+    per_second = (
+        hits.select("ym:pv:clientID", "ym:pv:dateTime", *robot_columns)
+        .filter(pl.col("ym:pv:clientID").is_not_null())
+        .with_columns(pl.col("ym:pv:dateTime").str.to_datetime("%Y-%m-%d %H:%M:%S", strict=False))
+        .group_by(["ym:pv:clientID", "ym:pv:dateTime"])
+        .agg(**per_second_aggs)
+    )
+    return (
+        per_second
+        .group_by("ym:pv:clientID")
+        .agg(
+            hits=pl.col("hits").sum(),
+            max_hits_per_second=pl.col("hits").max(),
+            active_minutes=(pl.col("ym:pv:dateTime").max() - pl.col("ym:pv:dateTime").min())
+            .dt.total_seconds().fill_null(0).truediv(60).clip(lower_bound=1),
+            robot_hits=pl.col("robot").any() if robot_columns else pl.lit(False),
+        )
+        .collect(streaming=True)
+        .rename({"ym:pv:clientID": "clientID"})
+    )
+
+
+def _visits_client_stats(visits: pl.LazyFrame) -> pl.DataFrame:
+    """По клиенту: визиты, визиты из одного хита с нулевой длительностью, признак робота в визитах"""
+    robot_columns = _present_robot_columns("visits", visits.collect_schema().names())
+    # один хит — в списке watchIDs нет запятой; JSON не разбираем
+    zero_bounce = (
+        pl.col("ym:s:visitDuration").cast(pl.Int64, strict=False).fill_null(0).eq(0)
+        & ~pl.col("ym:s:watchIDs").fill_null("").str.contains(",", literal=True)
+    )
+    return (
+        visits.select("ym:s:clientID", "ym:s:visitDuration", "ym:s:watchIDs", *robot_columns)
+        .filter(pl.col("ym:s:clientID").is_not_null())
+        .group_by("ym:s:clientID")
+        .agg(
+            visits=pl.len(),
+            zero_bounces=zero_bounce.sum(),
+            robot_visits=pl.any_horizontal([_truthy(pl.col(c)) for c in robot_columns]).any()
+            if robot_columns else pl.lit(False),
+        )
+        .collect(streaming=True)
+        .rename({"ym:s:clientID": "clientID"})
+    )
+
+
+class TrafficFilter:
+    """
+    Отсев роботов и аномального трафика. Правила считаются по клиенту заранее, по всем хитам
+    и визитам версии (только нужные колонки), и дают таблицу clientID -> правило.
+    Дальше mark() добавляет к куску визитов или хитов колонку bot_rule (null — обычный трафик),
+    так что полные и отфильтрованные метрики собираются в том же проходе, а счетчики по правилам
+    копятся в counters
+    """
+
+    def __init__(self, bot_clients: pl.DataFrame):
+        self.bot_clients = bot_clients
+        self.counters = {rule: {"clients": 0, "visits": 0, "hits": 0} for rule in RULES}
+        for rule, clients in bot_clients.group_by("bot_rule").len().iter_rows():
+            self.counters[rule]["clients"] = clients
+
+    @classmethod
+    def empty(cls) -> "TrafficFilter":
+        return cls(pl.DataFrame(schema={"clientID": pl.UInt64, "bot_rule": pl.Utf8}))
+
+    @classmethod
+    def for_version(cls, version: str) -> "TrafficFilter":
+        """Читает источники версии сам; в ETL дешевле from_frames по уже прочитанным данным"""
+        if not TRAFFIC_FILTER:
+            return cls.empty()
+        with stage("traffic_filter_scan", files=source_files("hits", version) + source_files("visits", version)):
+            visits = scan_source(
+                "visits", version,
+                ["ym:s:clientID", "ym:s:visitDuration", "ym:s:watchIDs", *robot_columns("visits", version)],
+            )
+            hits = scan_source("hits", version, ["ym:pv:clientID", "ym:pv:dateTime", *robot_columns("hits", version)])
+            return cls.from_frames(visits, hits)
+
+    @classmethod
+    def from_frames(cls, visits: pl.DataFrame | pl.LazyFrame, hits: pl.DataFrame | pl.LazyFrame) -> "TrafficFilter":
+        """
+        Таблица клиентов-роботов по визитам и хитам версии. Нужны ym:s:clientID, ym:s:visitDuration,
+        ym:s:watchIDs и ym:pv:clientID, ym:pv:dateTime; колонки-признаки робота — если есть
+        """
+        if not TRAFFIC_FILTER:
+            return cls.empty()
+        with stage("traffic_filter") as st:
+            hits = _hits_client_stats(hits.lazy())
+            visits = _visits_client_stats(visits.lazy())
+            clients = hits.join(visits, on="clientID", how="full", coalesce=True)
+            st.add_rows_in(hits.height + visits.height)
+
+            rule = (
+                pl.when(pl.col("robot_hits").fill_null(False) | pl.col("robot_visits").fill_null(False))
+                .then(pl.lit("robot_flag"))
+                .when(pl.col("max_hits_per_second").fill_null(0) > MAX_HITS_PER_SECOND)
+                .then(pl.lit("hit_burst"))
+                .when(
+                    (pl.col("hits").fill_null(0) >= HIT_RATE_MIN_HITS)
+                    & (pl.col("hits") / pl.col("active_minutes") > MAX_HITS_PER_MINUTE)
+                )
+                .then(pl.lit("hit_rate"))
+                .when(
+                    (pl.col("visits").fill_null(0) >= ZERO_BOUNCE_MIN_VISITS)
+                    & (pl.col("zero_bounces") == pl.col("visits"))
+                )
+                .then(pl.lit("zero_duration_bounces"))
+            )
+            bot_clients = (
+                clients
+                .select("clientID", rule.alias("bot_rule"))
+                .filter(pl.col("bot_rule").is_not_null())
+            )
+            st.add_rows_out(bot_clients.height)
+        return cls(bot_clients)
+
+    def mark(self, df: pl.DataFrame, client_column: str, kind: str) -> pl.DataFrame:
+        """Добавляет bot_rule по клиенту и учитывает строки куска в counters[правило][kind]"""
+        if self.bot_clients.is_empty():
+            return df.with_columns(pl.lit(None, dtype=pl.Utf8).alias("bot_rule"))
+        marked = df.join(
+            self.bot_clients.rename({"clientID": client_column}), on=client_column, how="left", maintain_order="left"
+        )
+        for rule, rows in marked.group_by("bot_rule").len().iter_rows():
+            if rule is not None:
+                self.counters[rule][kind] += rows
+        return marked
+
+    def summary(self, total_visits: int, total_hits: int) -> dict:
+        """Плоские счетчики для full_metrics: bot_<правило>_clients/visits и доли отсеянного"""
+        result = {}
+        for rule, counts in self.counters.items():
+            for kind, value in counts.items():
+                result[f"bot_{rule}_{kind}"] = int(value)
+        bot_visits = sum(c["visits"] for c in self.counters.values())
+        bot_hits = sum(c["hits"] for c in self.counters.values())
+        result.update({
+            "bot_clients": int(self.bot_clients.height),
+            "bot_visits": int(bot_visits),
+            "bot_hits": int(bot_hits),
+            "bot_visit_share": float(bot_visits / total_visits * 100) if total_visits else 0.0,
+            "bot_hit_share": float(bot_hits / total_hits * 100) if total_hits else 0.0,
+        })
+        return result
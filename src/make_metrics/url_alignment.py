@@ -0,0 +1,332 @@
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+DATA_DIR = Path("data/raw")
+OUTPUT_DIR = Path("data/metrics")
+
+ALIGNMENT_FILE = "url_alignment_v1_v2.parquet"
+
+# необязательная таблица редиректов старой версии сайта: колонки from_url, to_url
+REDIRECTS_FILE = DATA_DIR / "redirects.csv"
+
+# параметры, которые не меняют содержимое страницы
+TRACKING_PARAMS = r"(?:utm_[a-z_]+|yclid|gclid|fbclid|_openstat|from|ysclid)"
+
+# MinHash: NUM_PERM = LSH_BANDS * LSH_ROWS; порог срабатывания LSH ~ (1/bands)^(1/rows) = 0.5
+NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = 4
+MIN_SIMILARITY = 0.75
+# полосы, в которые попало больше URL, — общий шаблон адреса (/news/<id>/), а не похожесть;
+# без ограничения такие корзины дают n*m кандидатов
+MAX_BUCKET_SIZE = 50
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_HASH_MASK = (1 << 31) - 1
+
+
+def normalize_url(col: pl.Expr) -> pl.Expr:
+    """
+    Каноническая форма URL для группировки и сравнения:
+    https, хост в нижнем регистре без www., без #фрагмента и меток utm_*/yclid/...,
+    без завершающего / и index.html (кроме корня сайта).
+    """
+    url = col.str.strip_chars().str.replace(r"#.*$", "")
+    scheme_host = (
+        url.str.extract(r"^[a-zA-Z]+://([^/?#]+)", 1)
+        .str.to_lowercase()
+        .str.replace(r"^www\.", "")
+        .str.replace(r":(80|443)$", "")
+    )
+    path = (
+        url.str.replace(r"^[a-zA-Z]+://[^/?#]+", "")
+        .str.replace(r"\?.*$", "")
+        .str.replace_all(r"/{2,}", "/")
+        .str.replace(r"/index\.(html?|php)$", "/")
+        .str.replace(r"/+$", "")
+    )
+    query = (
+        url.str.extract(r"\?(.*)$", 1)
+        .fill_null("")
+        .str.replace_all(TRACKING_PARAMS + r"=[^&]*&?", "")
+        .str.replace(r"&+$", "")
+    )
+    return (
+        pl.when(scheme_host.is_null())
+        .then(col)
+        .otherwise(
+            pl.lit("https://") + scheme_host
+            + pl.when(path == "").then(pl.lit("/")).otherwise(path)
+            + pl.when(query == "").then(pl.lit("")).otherwise(pl.lit("?") + query)
+        )
+    )
+
+
+def _url_body(col: pl.Expr) -> pl.Expr:
+    """Часть URL без схемы и хоста — по ней считается похожесть."""
+    return col.str.replace(r"^[a-zA-Z]+://[^/?#]+", "").str.to_lowercase()
+
+
+def minhash_signatures(urls: pl.Series, num_perm: int = NUM_PERM, seed: int = 1) -> np.ndarray:
+    """
+    MinHash-сигнатуры по символьным триграммам пути: (len(urls), num_perm).
+    Триграммы и их хэши строит polars, минимум по каждой перестановке — np.minimum.reduceat,
+    цикл только по перестановкам.
+    """
+    body = pl.DataFrame({"id": np.arange(len(urls)), "body": urls}).with_columns(
+        (pl.lit("^") + _url_body(pl.col("body")) + pl.lit("$")).alias("body")
+    )
+    shingles = (
+        body
+        .with_columns(pl.int_ranges(0, (pl.col("body").str.len_chars() - 2).clip(lower_bound=1)).alias("offset"))
+        .explode("offset")
+        .select([
+            "id",
+            (pl.col("body").str.slice(pl.col("offset"), 3).hash(seed) & _HASH_MASK).alias("h"),
+        ])
+        .unique()
+        .sort("id")
+    )
+    ids = shingles["id"].to_numpy()
+    hashes = shingles["h"].to_numpy().astype(np.uint64)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _HASH_MASK, num_perm, dtype=np.uint64)
+    b = rng.integers(0, _HASH_MASK, num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(urls), num_perm), dtype=np.uint64)
+    for i in range(num_perm):
+        permuted = (a[i] * hashes + b[i]) % np.uint64(_MERSENNE_PRIME)
+        signatures[ids[starts], i] = np.minimum.reduceat(permuted, starts)
+    return signatures
+
+
+def _band_keys(signatures: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    """Ключ каждой полосы LSH — смесь rows значений сигнатуры в один uint64: (n, bands)."""
+    keys = np.zeros((signatures.shape[0], bands), dtype=np.uint64)
+    banded = signatures[:, : bands * rows].reshape(signatures.shape[0], bands, rows)
+    for r in range(rows):
+        keys = keys * np.uint64(0x100000001B3) + banded[:, :, r]
+    return keys
+
+
+def fuzzy_match(
+    urls_v1: pl.Series,
+    urls_v2: pl.Series,
+    min_similarity: float = MIN_SIMILARITY,
+) -> pl.DataFrame:
+    """
+    Пары похожих URL через MinHash LSH: кандидаты — совпадение хотя бы одной полосы
+    (корзины больше MAX_BUCKET_SIZE пропускаются), а не все n*m пар. Оценка похожести — доля совпавших значений сигнатуры (≈ Жаккар
+    по триграммам). Остаются только взаимно лучшие пары не ниже min_similarity —
+    так соответствие однозначное без жадного цикла.
+    """
+    empty = pl.DataFrame(schema={"url_v1": pl.Utf8, "url_v2": pl.Utf8, "score": pl.Float64})
+    if urls_v1.is_empty() or urls_v2.is_empty():
+        return empty
+
+    sig_v1 = minhash_signatures(urls_v1)
+    sig_v2 = minhash_signatures(urls_v2)
+
+    def band_table(signatures: np.ndarray, side: str) -> pl.DataFrame:
+        keys = _band_keys(signatures, LSH_BANDS, LSH_ROWS)
+        return (
+            pl.DataFrame({
+                f"id_{side}": np.repeat(np.arange(len(signatures)), LSH_BANDS),
+                "band": np.tile(np.arange(LSH_BANDS), len(signatures)),
+                "key": keys.ravel(),
+            })
+            .filter(pl.len().over(["band", "key"]) <= MAX_BUCKET_SIZE)
+        )
+
+    candidates = (
+        band_table(sig_v1, "v1")
+        .join(band_table(sig_v2, "v2"), on=["band", "key"], how="inner")
+        .select(["id_v1", "id_v2"])
+        .unique()
+    )
+    if candidates.is_empty():
+        return empty
+
+    id_v1 = candidates["id_v1"].to_numpy()
+    id_v2 = candidates["id_v2"].to_numpy()
+    score = (sig_v1[id_v1] == sig_v2[id_v2]).mean(axis=1)
+
+    best = (
+        pl.DataFrame({"id_v1": id_v1, "id_v2": id_v2, "score": score})
+        .filter(pl.col("score") >= min_similarity)
+        .filter(
+            (pl.col("score") == pl.col("score").max().over("id_v1"))
+            & (pl.col("score") == pl.col("score").max().over("id_v2"))
+        )
+        .sort(["score", "id_v1", "id_v2"], descending=[True, False, False])
+        .unique("id_v1", keep="first", maintain_order=True)
+        .unique("id_v2", keep="first", maintain_order=True)
+    )
+    return pl.DataFrame({
+        "url_v1": urls_v1.gather(best["id_v1"]),
+        "url_v2": urls_v2.gather(best["id_v2"]),
+        "score": best["score"],
+    })
+
+
+def load_redirects(path: Path = REDIRECTS_FILE) -> pl.DataFrame | None:
+    """Таблица редиректов (from_url, to_url) из csv или parquet; None, если ее нет."""
+    if not path.exists():
+        return None
+    redirects = pl.read_parquet(path) if path.suffix == ".parquet" else pl.read_csv(path)
+    return redirects.select([
+        normalize_url(pl.col("from_url")).alias("norm_v1"),
+        normalize_url(pl.col("to_url")).alias("norm_v2"),
+    ]).drop_nulls().unique()
+
+
+def _url_groups(urls: pl.DataFrame) -> pl.DataFrame:
+    """
+    url, hits -> url, norm, rep: rep — самый посещаемый исходный URL среди URL с той же
+    нормализованной формой. Им и подписывается группа в сравнениях.
+    """
+    return (
+        urls
+        .group_by("url")
+        .agg(pl.col("hits").sum())
+        .with_columns(normalize_url(pl.col("url")).alias("norm"))
+        .sort(["hits", "url"], descending=[True, False])
+        .with_columns(pl.col("url").first().over("norm").alias("rep"))
+    )
+
+
+def build_url_alignment(
+    urls_v1: pl.DataFrame,
+    urls_v2: pl.DataFrame,
+    redirects: pl.DataFrame | None = None,
+    min_similarity: float = MIN_SIMILARITY,
+) -> pl.DataFrame:
+    """
+    Соответствие URL двух версий сайта. На входе — url и hits каждой версии (например, суммы
+    дневных рядов), на выходе по строке на каждый URL каждой версии:
+    version, url, url_key, match_type, similarity.
+
+    url_key — общий ключ для сравнения: самый посещаемый URL версии v2 из сопоставленной
+    группы (или собственный, если пары нет). match_type по убыванию надежности:
+    exact (тот же URL есть в другой версии), normalized (совпала нормализованная форма),
+    redirect (по таблице редиректов), fuzzy (MinHash LSH по триграммам пути),
+    removed / added — пары не нашлось. Каждая ступень работает только с тем, что не
+    сопоставили предыдущие, нормализованная группа v1 сопоставляется не больше чем с одной группой v2.
+    """
+    groups_v1 = _url_groups(urls_v1)
+    groups_v2 = _url_groups(urls_v2)
+    norms_v1 = groups_v1.select("norm").unique()
+    norms_v2 = groups_v2.select("norm").unique()
+
+    pairs = [
+        norms_v1.join(norms_v2, on="norm", how="inner").select([
+            pl.col("norm").alias("norm_v1"),
+            pl.col("norm").alias("norm_v2"),
+            pl.lit("normalized").alias("match_type"),
+            pl.lit(1.0).alias("similarity"),
+        ])
+    ]
+
+    def unmatched(norms: pl.DataFrame, side: str) -> pl.DataFrame:
+        matched = pl.concat(pairs).select(pl.col(f"norm_{side}").alias("norm"))
+        return norms.join(matched, on="norm", how="anti")
+
+    if redirects is not None and not redirects.is_empty():
+        pairs.append(
+            redirects
+            .join(unmatched(norms_v1, "v1").rename({"norm": "norm_v1"}), on="norm_v1", how="semi")
+            .join(unmatched(norms_v2, "v2").rename({"norm": "norm_v2"}), on="norm_v2", how="semi")
+            .unique("norm_v1", keep="first", maintain_order=True)
+            .unique("norm_v2", keep="first", maintain_order=True)
+            .with_columns([pl.lit("redirect").alias("match_type"), pl.lit(1.0).alias("similarity")])
+        )
+
+    fuzzy = fuzzy_match(
+        unmatched(norms_v1, "v1")["norm"].sort(),
+        unmatched(norms_v2, "v2")["norm"].sort(),
+        min_similarity,
+    )
+    pairs.append(fuzzy.select([
+        pl.col("url_v1").alias("norm_v1"),
+        pl.col("url_v2").alias("norm_v2"),
+        pl.lit("fuzzy").alias("match_type"),
+        pl.col("score").alias("similarity"),
+    ]))
+    pairs = pl.concat(pairs)
+
+    reps_v2 = groups_v2.select(["norm", "rep"]).unique("norm")
+    raw_v1 = groups_v1.select("url")
+    raw_v2 = groups_v2.select("url")
+
+    v1 = (
+        groups_v1
+        .join(pairs, left_on="norm", right_on="norm_v1", how="left")
+        .join(reps_v2.rename({"norm": "norm_v2", "rep": "rep_v2"}), on="norm_v2", how="left")
+        .with_columns([
+            pl.lit("v1").alias("version"),
+            pl.coalesce(["rep_v2", "rep"]).alias("url_key"),
+            pl.when(pl.col("url").is_in(raw_v2["url"])).then(pl.lit("exact"))
+            .otherwise(pl.col("match_type").fill_null("removed")).alias("match_type"),
+        ])
+    )
+    v2 = (
+        groups_v2
+        .join(pairs, left_on="norm", right_on="norm_v2", how="left")
+        .with_columns([
+            pl.lit("v2").alias("version"),
+            pl.col("rep").alias("url_key"),
+            pl.when(pl.col("url").is_in(raw_v1["url"])).then(pl.lit("exact"))
+            .otherwise(pl.col("match_type").fill_null("added")).alias("match_type"),
+        ])
+    )
+    columns = ["version", "url", "url_key", "match_type", "similarity", "hits"]
+    return (
+        pl.concat([v1.select(columns), v2.select(columns)])
+        .with_columns(
+            pl.when(pl.col("match_type") == "exact").then(pl.lit(1.0))
+            .otherwise(pl.col("similarity")).alias("similarity")
+        )
+        .sort(["version", "hits", "url"], descending=[False, True, False])
+    )
+
+
+def align_daily_series(url_daily_v1: pl.DataFrame, url_daily_v2: pl.DataFrame) -> pl.DataFrame:
+    """Соответствие URL по дневным рядам compute_url_daily_series: вес URL — сумма хитов и визитов."""
+    def totals(daily: pl.DataFrame) -> pl.DataFrame:
+        return daily.group_by("url").agg((pl.col("page_hits") + pl.col("page_visits")).sum().alias("hits"))
+
+    return build_url_alignment(totals(url_daily_v1), totals(url_daily_v2), load_redirects())
+
+
+def apply_alignment(df: pl.DataFrame, alignment: pl.DataFrame, version: str) -> pl.DataFrame:
+    """Добавляет к таблице версии колонку url_key; URL, которых нет в соответствии, остаются собой."""
+    keys = alignment.filter(pl.col("version") == version).select(["url", "url_key"])
+    return (
+        df
+        .join(keys, on="url", how="left")
+        .with_columns(pl.coalesce(["url_key", "url"]).alias("url_key"))
+    )
+
+
+def alignment_summary(alignment: pl.DataFrame) -> dict:
+    """Число URL каждой версии по типам сопоставления."""
+    counts = alignment.group_by(["version", "match_type"]).agg(pl.len().alias("urls")).sort(["version", "match_type"])
+    summary = {}
+    for row in counts.iter_rows(named=True):
+        summary.setdefault(row["version"], {})[row["match_type"]] = row["urls"]
+    return summary
+
+
+if __name__ == "__main__":
+    url_daily_v1 = pl.read_parquet(OUTPUT_DIR / "url_daily_v1.parquet")
+    url_daily_v2 = pl.read_parquet(OUTPUT_DIR / "url_daily_v2.parquet")
+
+    alignment = align_daily_series(url_daily_v1, url_daily_v2)
+    alignment.write_parquet(OUTPUT_DIR / ALIGNMENT_FILE)
+
+    print(f"{ALIGNMENT_FILE} сохранен: {alignment_summary(alignment)}")
+    print(alignment.filter(pl.col("match_type").is_in(["redirect", "fuzzy"])).head(20))
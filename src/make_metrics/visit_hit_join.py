@@ -0,0 +1,223 @@
+import math
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import polars as pl
+
+from profiling import activate, profiler_from_env, progress, stage
+from sources import VISITS_FILES, iter_source_batches, source_files, source_rows
+
+OUTPUT_DIR = Path("data/metrics")
+
+# строк на чтение из parquet за раз и строк хитов на партицию: вместе задают потолок памяти
+BATCH_ROWS = 500_000
+PARTITION_ROWS = 4_000_000
+
+
+def visit_hits_dir(version: str) -> Path:
+    return OUTPUT_DIR / f"visit_hits_{version}"
+
+
+def _spill(df: pl.DataFrame, key: str, partitions: int, directory: Path, name: str):
+    """Раскладывает кусок по партициям key % partitions: <directory>/<номер>/<name>.parquet."""
+    df = df.with_columns((pl.col(key) % partitions).alias("_part"))
+    for (part,), piece in df.partition_by("_part", as_dict=True).items():
+        part_dir = directory / f"{part:05d}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+        piece.drop("_part").write_parquet(part_dir / f"{name}.parquet", compression="lz4")
+
+
+def explode_visit_watch_ids(visits: pl.DataFrame) -> pl.DataFrame:
+    """
+    Визиты -> пары (visit_id, watch_id, hit_index): по строке на каждый watchID из ym:s:watchIDs.
+    hit_index — позиция хита в визите, по ней восстанавливается порядок страниц.
+    """
+    return (
+        visits
+        .select([
+            pl.col("ym:s:visitID").alias("visit_id"),
+            pl.col("ym:s:watchIDs")
+            .str.json_decode(dtype=pl.List(pl.Utf8))
+            .list.eval(pl.element().cast(pl.UInt64, strict=False))
+            .alias("watch_id"),
+        ])
+        .with_columns(pl.int_ranges(0, pl.col("watch_id").list.len(), dtype=pl.UInt16).alias("hit_index"))
+        .explode(["watch_id", "hit_index"])
+        .drop_nulls("watch_id")
+    )
+
+
+def partition_sides(version: str, spill_dir: Path, partitions: int, batch_rows: int = BATCH_ROWS) -> dict:
+    """
+    Фаза 1: потоково читает визиты и хиты и раскладывает обе стороны по watch_id % partitions
+    в spill-файлы. В памяти одновременно только один кусок.
+    """
+    visits_files = source_files("visits", version)
+    hits_files = source_files("hits", version)
+    stats = {"visits": 0, "visit_watch_ids": 0, "hits": 0}
+
+    with stage("partition_visits", files=visits_files) as st:
+        for i, visits in enumerate(iter_source_batches("visits", version, ["ym:s:visitID", "ym:s:watchIDs"], batch_rows)):
+            pairs = explode_visit_watch_ids(visits)
+            _spill(pairs, "watch_id", partitions, spill_dir / "visits", f"batch_{i:06d}")
+            stats["visits"] += visits.height
+            stats["visit_watch_ids"] += pairs.height
+            progress(stats["visits"], label="Visits partitioned")
+        st.add_rows_in(stats["visits"])
+        st.add_rows_out(stats["visit_watch_ids"])
+
+    with stage("partition_hits", files=hits_files) as st:
+        for i, hits in enumerate(iter_source_batches("hits", version, ["ym:pv:watchID", "ym:pv:URL", "ym:pv:dateTime"], batch_rows)):
+            hits = hits.select([
+                pl.col("ym:pv:watchID").alias("watch_id"),
+                pl.col("ym:pv:URL").alias("url"),
+                pl.col("ym:pv:dateTime").cast(pl.Utf8).str.slice(0, 19)
+                .str.to_datetime("%Y-%m-%d %H:%M:%S", strict=False).alias("hit_time"),
+            ])
+            _spill(hits, "watch_id", partitions, spill_dir / "hits", f"batch_{i:06d}")
+            stats["hits"] += hits.height
+            progress(stats["hits"], label="Hits partitioned")
+        st.add_rows_in(stats["hits"])
+
+    return stats
+
+
+def _read_partition(directory: Path) -> pl.DataFrame | None:
+    files = sorted(directory.glob("*.parquet")) if directory.exists() else []
+    return pl.read_parquet(files) if files else None
+
+
+def merge_partitions(spill_dir: Path, partitions: int) -> dict:
+    """
+    Фаза 2: в каждой партиции сортирует обе стороны по watch_id и соединяет сортировкой-слиянием
+    (ключи помечены отсортированными). Результат заново раскладывается по visit_id % partitions,
+    чтобы все хиты одного визита оказались в одной партиции.
+    """
+    stats = {"matched": 0, "missing_hits": 0, "orphan_hits": 0}
+
+    with stage("merge_join") as st:
+        for part in range(partitions):
+            name = f"{part:05d}"
+            visits = _read_partition(spill_dir / "visits" / name)
+            hits = _read_partition(spill_dir / "hits" / name)
+            n_hits = hits.height if hits is not None else 0
+            if visits is None:
+                stats["orphan_hits"] += n_hits
+                continue
+            if hits is None:
+                hits = pl.DataFrame(schema={"watch_id": pl.UInt64, "url": pl.Utf8, "hit_time": pl.Datetime("us")})
+
+            visits = visits.sort("watch_id").set_sorted("watch_id")
+            hits = hits.unique("watch_id", keep="first").sort("watch_id").set_sorted("watch_id")
+            joined = visits.join(hits, on="watch_id", how="left")
+
+            matched = joined.select(pl.col("url").is_not_null().sum()).item()
+            stats["matched"] += matched
+            stats["missing_hits"] += joined.height - matched
+            stats["orphan_hits"] += n_hits - matched
+            st.add_rows_in(visits.height + n_hits)
+
+            _spill(joined, "visit_id", partitions, spill_dir / "joined", f"from_{name}")
+            progress(part + 1, label="Partitions joined")
+
+    return stats
+
+
+def finalize_partitions(spill_dir: Path, partitions: int, out_dir: Path) -> int:
+    """
+    Фаза 3: каждая партиция по visit_id сортируется по (visit_id, hit_index) и дополняется
+    тем, что без соединения не посчитать: время на странице (до следующего хита визита)
+    и признак настоящей страницы выхода. Пишется в out_dir/part-XXXXX.parquet.
+    """
+    rows = 0
+    with stage("finalize") as st:
+        for part in range(partitions):
+            joined = _read_partition(spill_dir / "joined" / f"{part:05d}")
+            if joined is None:
+                continue
+            result = (
+                joined
+                .sort(["visit_id", "hit_index"])
+                .with_columns([
+                    (pl.col("hit_time").shift(-1).over("visit_id") - pl.col("hit_time"))
+                    .dt.total_seconds().alias("time_on_page_sec"),
+                    (pl.col("hit_index") == pl.col("hit_index").max().over("visit_id")).alias("is_exit"),
+                ])
+                .select(["visit_id", "hit_index", "watch_id", "url", "hit_time", "time_on_page_sec", "is_exit"])
+            )
+            result.write_parquet(out_dir / f"part-{part:05d}.parquet", compression="zstd", statistics=True)
+            rows += result.height
+        st.add_rows_out(rows)
+    return rows
+
+
+def build_visit_hit_map(
+    version: str,
+    partitions: int | None = None,
+    spill_root: Path | None = None,
+    batch_rows: int = BATCH_ROWS,
+) -> dict:
+    """
+    Таблица визит -> хиты для версии: visit_id, hit_index, watch_id, url, hit_time,
+    time_on_page_sec, is_exit — набор parquet-партиций в data/metrics/visit_hits_<версия>/,
+    внутри партиции строки отсортированы по (visit_id, hit_index).
+
+    Соединение идет через spill-файлы на диске (spill_root, по умолчанию временная папка
+    рядом с OUTPUT_DIR), поэтому память ограничена размером партиции, а не выгрузки.
+    Число партиций по умолчанию — из числа хитов в метаданных parquet.
+    """
+    if partitions is None:
+        partitions = max(1, math.ceil(source_rows("hits", version) / PARTITION_ROWS))
+
+    out_dir = visit_hits_dir(version)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+
+    t0 = time.perf_counter()
+    spill_dir = Path(tempfile.mkdtemp(prefix=f"visit_hits_{version}_", dir=spill_root or OUTPUT_DIR))
+    try:
+        stats = partition_sides(version, spill_dir, partitions, batch_rows)
+        stats.update(merge_partitions(spill_dir, partitions))
+        stats["rows"] = finalize_partitions(spill_dir, partitions, out_dir)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    stats.update({"version": version, "partitions": partitions, "seconds": round(time.perf_counter() - t0, 2)})
+    return stats
+
+
+def scan_visit_hits(version: str) -> pl.LazyFrame:
+    """Ленивое чтение таблицы визит -> хиты всех партиций."""
+    return pl.scan_parquet(visit_hits_dir(version) / "part-*.parquet")
+
+
+def true_exit_pages(version: str, top_n: int = 20) -> pl.DataFrame:
+    """Страницы выхода по последнему реальному хиту визита (а не по ym:s:endURL)."""
+    return (
+        scan_visit_hits(version)
+        .filter(pl.col("is_exit") & pl.col("url").is_not_null())
+        .group_by("url")
+        .agg(pl.len().alias("exits"))
+        .sort("exits", descending=True)
+        .head(top_n)
+        .collect()
+    )
+
+
+if __name__ == "__main__":
+    profiler = activate(profiler_from_env("visit_hit_join"))
+
+    for version in VISITS_FILES:
+        with stage(f"visit_hits_{version}"):
+            stats = build_visit_hit_map(version)
+        print(
+            f"{version}: {stats['visits']:,} визитов, {stats['hits']:,} хитов -> {stats['rows']:,} строк "
+            f"в {stats['partitions']} партициях за {stats['seconds']} с "
+            f"(без хита: {stats['missing_hits']:,}, хитов без визита: {stats['orphan_hits']:,})"
+        )
+        print(true_exit_pages(version, top_n=5))
+
+    profiler.write_report(OUTPUT_DIR / "visit_hit_join_report.json")
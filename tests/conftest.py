@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# util/minimal_agents импортируются от корня репозитория, ETL-скрипты — соседними импортами из src/make_metrics
+for path in (ROOT, ROOT / "src" / "make_metrics"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+
+@pytest.fixture(scope="session")
+def metrika_dir(tmp_path_factory) -> Path:
+    """Синтетическая выгрузка обеих версий (как data/raw), общая для тестов ETL — только для чтения"""
+    from benchmarks.generate_metrika_data import generate_dataset
+
+    out_dir = tmp_path_factory.mktemp("raw")
+    # несколько кусков — несколько групп строк на файл
+    generate_dataset(out_dir, 3_000, n_urls=50, chunk_visits=1_000)
+    return out_dir
+
+
+@pytest.fixture
+def raw_data(metrika_dir, monkeypatch) -> Path:
+    """sources читает синтетическую выгрузку без окна дат"""
+    import sources
+
+    monkeypatch.setattr(sources, "DATA_DIR", metrika_dir)
+    monkeypatch.setattr(sources, "_date_range", (None, None))
+    return metrika_dir
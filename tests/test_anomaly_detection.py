@@ -0,0 +1,110 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from anomaly_detection import SITE_URL, find_anomalies, find_goal_anomalies
+from mcp_ux_server import (
+    _analyze_full_metrics_data,
+    _analyze_goals_data,
+    _analyze_url_metrics_data,
+)
+
+
+def _daily(version: str, start: date, days: int, seed: int, spike=None, bounce_shift=0.0) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for d in range(days):
+        day = start + timedelta(days=d)
+        for url, visits in (("/main", 400), ("/apply", 200), ("/tiny", 3)):
+            v = int(rng.poisson(visits))
+            hits = int(rng.poisson(visits * 2))
+            if spike == (url, day):
+                hits *= 6
+            bounce = 0.3 + (bounce_shift if url == "/apply" else 0.0)
+            rows.append({
+                "url": url, "date": day, "version": version, "page_hits": hits, "page_visits": v,
+                "page_bounces": int(rng.binomial(v, bounce)), "sum_visit_duration": v * 60.0, "sum_visit_hits": v * 2,
+            })
+    return pl.DataFrame(rows)
+
+
+def test_spike_and_version_shift_are_ranked_candidates():
+    spike_day = date(2024, 3, 11)
+    v1 = _daily("v1", date(2022, 3, 1), 42, seed=1)
+    v2 = _daily("v2", date(2024, 2, 5), 42, seed=2, spike=("/main", spike_day), bounce_shift=0.25)
+
+    anomalies = find_anomalies(v1, v2, top_n=None)
+
+    daily = anomalies.filter(pl.col("kind") == "daily")
+    spike = daily.filter((pl.col("url") == "/main") & (pl.col("metric") == "page_hits"))
+    assert spike["date"].to_list() == [spike_day]
+    assert spike["robust_z"][0] > 4
+
+    shift = anomalies.filter((pl.col("kind") == "version_shift") & (pl.col("metric") == "bounce_rate"))
+    assert "/apply" in shift["url"].to_list()
+    assert "/main" not in shift["url"].to_list()
+
+    # меньше min_daily_volume хитов и визитов в день — шум, не кандидат
+    assert "/tiny" not in anomalies["url"].to_list()
+    assert anomalies["score"].is_sorted(descending=True)
+    assert SITE_URL in daily["url"].to_list()
+
+
+def test_stable_series_has_no_candidates():
+    v1 = _daily("v1", date(2022, 3, 1), 42, seed=3)
+    v2 = _daily("v2", date(2024, 2, 5), 42, seed=4)
+    anomalies = find_anomalies(v1, v2, top_n=None)
+    assert anomalies.filter(pl.col("url") != "/tiny").is_empty()
+
+
+def _goal_daily(version: str, start: date, seed: int, steps_shift: float = 0.0) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for d in range(42):
+        for goal_id in (1, 2):
+            visits = int(rng.poisson(50))
+            steps = 4.0 + (steps_shift if goal_id == 1 else 0.0)
+            rows.append({
+                "goal_id": goal_id, "date": start + timedelta(days=d), "version": version, "goal_visits": visits,
+                "sum_steps": float(rng.normal(steps, 0.2) * visits), "sum_duration": float(rng.normal(120, 5) * visits),
+            })
+    return pl.DataFrame(rows)
+
+
+def test_site_and_goal_series_replace_the_20pct_rule():
+    v1 = _daily("v1", date(2022, 3, 1), 42, seed=1)
+    v2 = _daily("v2", date(2024, 2, 5), 42, seed=2, bounce_shift=0.25)
+    anomalies = find_anomalies(v1, v2, top_n=None).to_pandas()
+
+    full = pd.DataFrame({
+        "version": ["v1", "v2"],
+        "total_hits": [100.0, 130.0],
+        "bounce_rate": [30.0, 38.0],
+        "unique_users": [100.0, 150.0],
+        "new_users": [100.0, 105.0],
+    })
+    significant = _analyze_full_metrics_data(full, anomalies=anomalies)["significant_changes_20pct"]
+    # +30% хитов без сдвига в дневном ряду сайта — не событие; у пользователей рядов нет — остается порог
+    assert set(significant) == {"bounce_rate", "unique_users"}
+    assert significant["bounce_rate"]["robust_z"] > 3
+    assert significant["unique_users"]["significance"] == "change_20pct"
+    assert set(_analyze_full_metrics_data(full)["significant_changes_20pct"]) == {"total_hits", "bounce_rate", "unique_users"}
+
+    url_metrics = pd.DataFrame({"url": ["/main", "/apply"], "page_hits": [800, 400], "bounce_rate": [30.0, 30.0]})
+    urls = _analyze_url_metrics_data(url_metrics, url_metrics.assign(bounce_rate=[30.0, 55.0]), anomalies=anomalies)
+    # ряд всего сайта не попадает в значимые URL
+    assert set(urls["significant_urls"]) == {"/apply"}
+
+    goal_anomalies = find_goal_anomalies(
+        _goal_daily("v1", date(2022, 3, 1), seed=5), _goal_daily("v2", date(2024, 2, 5), seed=6, steps_shift=1.0)
+    )
+    goal_stats = pd.DataFrame({
+        "goal_id": [1, 2, 1, 2], "version": ["v1", "v1", "v2", "v2"],
+        "avg_steps": [4.0, 4.0, 5.0, 4.0], "avg_duration_sec": [120.0, 100.0, 121.0, 130.0],
+    })
+    goals = _analyze_goals_data(goal_stats, anomalies=goal_anomalies.to_pandas())
+    assert goals["significance"] == "anomaly_detection"
+    assert list(goals["significant_goals"]) == ["1"]
+    assert list(goals["significant_goals"]["1"]) == ["avg_steps"]
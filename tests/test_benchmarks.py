@@ -0,0 +1,40 @@
+import polars as pl
+
+from benchmarks.bench_etl import compare_with_baseline
+from benchmarks.generate_metrika_data import generate_version
+
+
+def test_generated_visits_and_hits_agree(metrika_dir):
+    for year in (2022, 2024):
+        visits = pl.read_parquet(metrika_dir / f"{year}_yandex_metrika_visits.parquet")
+        hits = pl.read_parquet(metrika_dir / f"{year}_yandex_metrika_hits.parquet")
+        assert visits.height == 3_000
+        assert visits["ym:s:visitID"].is_unique().all()
+
+        listed = visits.select(pl.col("ym:s:watchIDs").str.json_decode(pl.List(pl.Utf8)).explode().cast(pl.Int64))
+        assert listed.height == hits.height
+        assert listed.to_series().sort().to_list() == hits["ym:pv:watchID"].sort().to_list()
+        assert visits["ym:s:date"].str.starts_with(str(year)).all()
+        # первый хит визита — стартовая страница
+        assert set(visits["ym:s:startURL"]) <= set(hits["ym:pv:URL"])
+
+
+def test_generation_is_deterministic(tmp_path):
+    for name in ("a", "b"):
+        generate_version(tmp_path / name, "v1", 500, seed=7, n_urls=20, chunk_visits=200)
+    for kind in ("visits", "hits"):
+        file = f"2022_yandex_metrika_{kind}.parquet"
+        assert pl.read_parquet(tmp_path / "a" / file).equals(pl.read_parquet(tmp_path / "b" / file))
+
+
+def test_regressions_beyond_tolerance():
+    baseline = {"input_rows": 10, "stages": {"dedup": {"wall_s": 1.0, "peak_rss_mb": 100.0}, "cube": {"wall_s": 2.0}}}
+    report = {"input_rows": 10, "stages": {
+        "dedup": {"wall_s": 1.05, "peak_rss_mb": 130.0},
+        "cube": {"wall_s": 3.0, "peak_rss_mb": None},
+        "new_stage": {"wall_s": 9.0},
+    }}
+    assert compare_with_baseline(report, baseline, tolerance=0.1) == [
+        "dedup.peak_rss_mb: 100.0 -> 130.0 (+30%)",
+        "cube.wall_s: 2.0 -> 3.0 (+50%)",
+    ]
@@ -0,0 +1,87 @@
+import numpy as np
+import polars as pl
+import pytest
+
+import client_index
+from client_index import ClientIndex, ClientSet
+
+
+@pytest.fixture(params=["roaring", "numpy"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        monkeypatch.setattr(client_index, "BitMap", None)
+    elif client_index.BitMap is None:
+        pytest.skip("pyroaring is not installed")
+    return request.param
+
+
+def test_set_operations_and_serialization(backend, monkeypatch):
+    monkeypatch.setattr(client_index, "_PENDING_LIMIT", 4)
+    a = ClientSet([5, 1, 3, 1])
+    a.add_many([7, 9, 3])
+    b = ClientSet([3, 4, 5, 100_000])
+
+    assert len(a) == 5
+    assert (a & b).to_numpy().tolist() == [3, 5]
+    assert (a | b).to_numpy().tolist() == [1, 3, 4, 5, 7, 9, 100_000]
+    assert (a - b).to_numpy().tolist() == [1, 7, 9]
+    assert a.intersection_len(b) == 2
+    assert client_index.intersect_all([a, b, ClientSet([5, 9])]).to_numpy().tolist() == [5]
+    assert ClientSet.deserialize(a.serialize()).to_numpy().tolist() == [1, 3, 5, 7, 9]
+
+
+def test_lookup_encode_and_empty_dictionary():
+    index = ClientIndex(np.array([10, 2**63 + 1, 2**64 - 1], dtype=np.uint64))
+    pos, found = index.lookup([2**64 - 1, 11, 10, 2**63 + 1])
+
+    assert found.tolist() == [True, False, True, True]
+    assert pos[found].tolist() == [2, 0, 1]
+    assert index.encode([2**64 - 1, 11, 10]).tolist() == [2, 0]
+    assert index.decode([1]).tolist() == [2**63 + 1]
+    assert len(index.get("v1", "url", "/missing")) == 0
+
+    empty = ClientIndex(np.zeros(0, dtype=np.uint64))
+    assert empty.encode([1, 2]).tolist() == []
+    df = pl.DataFrame({"ym:s:clientID": pl.Series([1, None], dtype=pl.UInt64)})
+    assert client_index._encoded(empty, df, "ym:s:clientID").columns == ["ym:s:clientID", "cid"]
+
+
+def test_retention_overlap_and_funnel():
+    index = ClientIndex(np.arange(10, dtype=np.uint64), {
+        ("v1", "new_day", "2024-01-01"): ClientSet([0, 1, 2, 3]),
+        ("v1", "new_day", "2024-01-05"): ClientSet([4, 5]),
+        ("v1", "day", "2024-01-01"): ClientSet([0, 1, 2, 3]),
+        ("v1", "day", "2024-01-02"): ClientSet([0, 1, 6]),
+        ("v1", "day", "2024-01-05"): ClientSet([4, 5]),
+        ("v1", "day", "2024-01-06"): ClientSet([4]),
+        ("v1", "all", ""): ClientSet([0, 1, 2, 3, 4, 5, 6]),
+        ("v1", "url", "/a"): ClientSet([0, 1, 2, 4]),
+        ("v1", "goal", "7"): ClientSet([1, 4, 9]),
+        ("v2", "all", ""): ClientSet([5, 6, 7]),
+    })
+
+    assert client_index.retention(index, "v1", days=(1, 7)) == {"retention_d1": 50.0, "retention_d7": None}
+    assert client_index.version_overlap(index)["clients_both"] == 2
+    steps = client_index.funnel(index, "v1", [("url", "/a"), ("goal", "7")])
+    assert [(s["step_clients"], s["clients"]) for s in steps] == [(4, 4), (3, 2)]
+    assert steps[1]["conversion_from_first"] == 50.0
+
+
+def test_index_matches_raw_data_and_survives_save(raw_data, backend, tmp_path):
+    visits = pl.concat([
+        pl.read_parquet(raw_data / f"{year}_yandex_metrika_visits.parquet", columns=["ym:s:clientID"]) for year in (2022, 2024)
+    ])
+    hits = pl.read_parquet(raw_data / "2024_yandex_metrika_hits.parquet", columns=["ym:pv:clientID", "ym:pv:URL"])
+
+    index = client_index.build_client_index(batch_rows=1_000)
+    loaded = ClientIndex.load(index.save(tmp_path / "index"))
+
+    assert len(loaded.client_ids) == visits["ym:s:clientID"].n_unique()
+    assert loaded.keys("v2", "url") == sorted(hits["ym:pv:URL"].unique().to_list())
+    url = loaded.keys("v2", "url")[0]
+    expected = hits.filter(pl.col("ym:pv:URL") == url)["ym:pv:clientID"].cast(pl.UInt64).unique().sort()
+    assert loaded.decode(loaded.get("v2", "url", url).to_numpy()).tolist() == expected.to_list()
+    metrics = client_index.client_metrics(loaded, "v1")
+    assert metrics["unique_clients"] == len(index.get("v1", "all"))
+    assert set(metrics) >= {"retention_d1", "retention_d7", "retention_d30"}
+    assert list(ClientIndex.load(tmp_path / "index", dims=["goal"]).sets) == [k for k in sorted(index.sets) if k[1] == "goal"]
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from dedup import IdDeduper
+
+
+def _stream(n, duplicate_share=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(0, np.iinfo(np.uint64).max, size=n, dtype=np.uint64, endpoint=True)
+    stream = np.concatenate([ids, ids[rng.choice(n, int(n * duplicate_share), replace=False)]])
+    rng.shuffle(stream)
+    return stream
+
+
+def _expected_mask(stream):
+    _, first = np.unique(stream, return_index=True)
+    mask = np.ones(len(stream), dtype=bool)
+    mask[first] = False
+    return mask
+
+
+def _run(deduper, stream, chunk):
+    return np.concatenate([deduper.duplicate_mask(stream[i:i + chunk]) for i in range(0, len(stream), chunk)])
+
+
+def test_first_occurrence_kept_within_and_across_chunks():
+    with IdDeduper() as deduper:
+        assert deduper.duplicate_mask([5, 7, 5, 2**64 - 1]).tolist() == [False, False, True, False]
+        assert deduper.duplicate_mask([2**64 - 1, 8, 7, 8]).tolist() == [True, False, True, True]
+        assert deduper.duplicate_mask([]).tolist() == []
+        assert deduper.seen == 8
+        assert deduper.duplicates == 4
+
+
+@pytest.mark.parametrize("memory_mb", [256, 1])
+def test_exact_with_and_without_spill(tmp_path, memory_mb):
+    stream = _stream(400_000)
+    with IdDeduper(memory_mb=memory_mb, spill_dir=tmp_path) as deduper:
+        mask = _run(deduper, stream, 50_000)
+        assert (deduper.spills > 0) == (memory_mb == 1)
+    assert np.array_equal(mask, _expected_mask(stream))
+    assert not list(tmp_path.iterdir())
+
+
+def test_memory_cap_counts_deltas_and_blooms(tmp_path):
+    stream = _stream(1_500_000, duplicate_share=0.05)
+    limit = 1 << 20
+    with IdDeduper(memory_mb=1, spill_dir=tmp_path) as deduper:
+        for i in range(0, len(stream), 100_000):
+            deduper.duplicate_mask(stream[i:i + 100_000])
+            # после каждого куска: основные массивы, дельты и фильтры Блума вместе не выше потолка
+            assert deduper.memory_bytes <= limit
+        assert deduper.peak_memory_bytes <= limit
+        assert deduper.spills == deduper.partitions
+        assert deduper.duplicates == len(stream) - len(np.unique(stream))
@@ -0,0 +1,83 @@
+import numpy as np
+
+from util.embeddings import (
+    HashingEmbedder,
+    VectorIndex,
+    annotate_clusters,
+    attach_prior_insights,
+    insight_text,
+)
+
+
+def _meta(n: int) -> list[dict]:
+    words = ["кредит", "ипотека", "вклад", "карта", "бакалавриат", "магистратура", "контакты", "новости"]
+    rng = np.random.default_rng(0)
+    return [
+        {"kind": "url" if i % 3 else "goal", "text": f"/{'/'.join(rng.choice(words, 3))}/{i}", "id": i}
+        for i in range(n)
+    ]
+
+
+def test_embeddings_are_stable_and_normalized():
+    embedder = HashingEmbedder(dim=64)
+    vectors = embedder.embed(["рост отказов", "показатель отказов вырос", ""])
+
+    assert vectors.shape == (3, 64)
+    assert np.allclose(np.linalg.norm(vectors[:2], axis=1), 1)
+    assert not vectors[2].any()
+    assert np.array_equal(vectors, HashingEmbedder(dim=64).embed(["рост отказов", "показатель отказов вырос", ""]))
+    assert vectors[0] @ vectors[1] > embedder.embed(["контакты офиса"])[0] @ vectors[0]
+
+
+def test_ivf_with_all_lists_probed_matches_brute_force(tmp_path):
+    meta = _meta(600)
+    index = VectorIndex.build(meta, n_lists=12)
+    assert index.offsets[-1] == len(meta)
+
+    loaded = VectorIndex.load(index.save(tmp_path / "index"))
+    assert isinstance(loaded.vectors, np.memmap)
+    assert loaded.meta == index.meta
+
+    query = "/ипотека/карта/вклад"
+    vector = loaded.embedder.embed([query])[0]
+    exact = np.sort(loaded.embedder.embed([m["text"] for m in meta]) @ vector)[::-1][:5]
+    found = loaded.search(query, k=5, n_probe=12)
+    assert np.allclose([score for score, _ in found], exact, atol=1e-6)
+
+    goals = loaded.search(query, k=50, n_probe=12, kind="goal")
+    assert len(goals) == 50 and all(m["kind"] == "goal" for _, m in goals)
+    assert loaded.search(query, kind="insight") == []
+    assert all(score >= 0.5 for score, _ in loaded.search(query, k=50, n_probe=12, min_score=0.5))
+
+
+def test_duplicate_insights_are_clustered():
+    items = [
+        {"url": "/apply", "insight": "Отказы на форме заявки выросли на 20%"},
+        {"url": "/contacts", "insight": "Время на странице контактов сократилось"},
+        {"url": "/apply", "insight": "Отказы на форме заявки выросли на 20 %"},
+    ]
+
+    assert annotate_clusters(items) == 1
+    assert items[2]["duplicate_of"] == 0
+    assert "duplicate_of" not in items[1]
+
+
+def test_items_without_text_are_not_duplicates():
+    items = [{"insight": "x"}, {"foo": 1}, {"metric": None}]
+
+    assert annotate_clusters(items) == 0
+    assert all("duplicate_of" not in item for item in items)
+
+
+def test_prior_insights_come_from_insight_vectors_only():
+    old = {"url": "/apply", "insight": "Отказы на форме заявки выросли", "solution": "Сократить поля формы"}
+    index = VectorIndex.build([
+        {"kind": "insight", "text": insight_text(old), "insight": old["insight"], "solution": old["solution"], "run_at": "r1"},
+        {"kind": "url", "text": "/apply Отказы на форме заявки выросли"},
+    ])
+    items = [{"url": "/apply", "insight": "Отказы на форме заявки выросли"}, {"url": "/news", "insight": "Новости читают чаще"}]
+
+    assert attach_prior_insights(items, index) == 1
+    assert items[0]["prior_insight"]["run_at"] == "r1"
+    assert items[0]["prior_insight"]["solution"] == "Сократить поля формы"
+    assert "prior_insight" not in items[1]
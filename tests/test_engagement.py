@@ -0,0 +1,64 @@
+import numpy as np
+import polars as pl
+import pytest
+
+import engagement
+import visit_hit_join
+
+
+def _part(path, urls, seconds):
+    pl.DataFrame({"url": urls, "time_on_page_sec": seconds}, schema={"url": pl.Utf8, "time_on_page_sec": pl.Int64}).write_parquet(path)
+    return path
+
+
+def test_sketch_quantiles_are_close_to_exact(tmp_path):
+    rng = np.random.default_rng(7)
+    seconds = np.concatenate([rng.lognormal(3.5, 1.0, 20_000), rng.uniform(0, 600, 5_000)]).astype(np.int64)
+    sketch = engagement.partition_dwell_sketch(_part(tmp_path / "p.parquet", ["/a"] * len(seconds), seconds))
+
+    row = engagement.sketch_quantiles(sketch).row(0, named=True)
+    clipped = np.clip(seconds, 0, engagement.MAX_DWELL_SEC)
+    assert row["dwell_hits"] == len(seconds)
+    assert row["avg_time_on_page_sec"] == pytest.approx(clipped.mean(), abs=0.05)
+    for name, q in engagement.QUANTILES.items():
+        exact = np.quantile(clipped, q)
+        assert row[name] == pytest.approx(exact, rel=0.1, abs=1.0), name
+
+
+def test_merge_does_not_depend_on_partitioning(tmp_path):
+    rng = np.random.default_rng(3)
+    urls = rng.choice(["/a", "/b", "/c"], 3_000).tolist()
+    seconds = rng.integers(0, 3_000, 3_000)
+
+    whole = engagement.partition_dwell_sketch(_part(tmp_path / "all.parquet", urls, seconds))
+    parts = [
+        engagement.partition_dwell_sketch(_part(tmp_path / f"p{i}.parquet", urls[i::4], seconds[i::4]))
+        for i in range(4)
+    ]
+
+    merged = engagement.merge_sketches(parts)
+    assert merged.equals(engagement.merge_sketches([whole]))
+    assert engagement.sketch_quantiles(merged).equals(engagement.sketch_quantiles(whole))
+
+
+def test_last_hits_are_ignored_and_missing_urls_get_zero(tmp_path, monkeypatch):
+    monkeypatch.setattr(visit_hit_join, "OUTPUT_DIR", tmp_path)
+    directory = visit_hit_join.visit_hits_dir("v1")
+    directory.mkdir()
+    _part(directory / "part-00000.parquet", ["/a", "/a", "/b", None], [10, None, 5000, 7])
+    _part(directory / "part-00001.parquet", ["/a", "/c"], [30, None])
+
+    result, sketch = engagement.compute_url_engagement("v1", workers=2)
+
+    assert sketch["hits"].sum() == 3
+    assert result.sort("url").select("url", "dwell_hits", "avg_time_on_page_sec").rows() == [
+        ("/a", 2, 20.0), ("/b", 1, float(engagement.MAX_DWELL_SEC)),
+    ]
+    metrics = engagement.add_engagement(pl.DataFrame({"url": ["/a", "/c"]}), result)
+    assert metrics.filter(pl.col("url") == "/c").select(engagement.ENGAGEMENT_COLUMNS).row(0) == (0, 0, 0, 0, 0)
+
+
+def test_missing_partitions_raise(tmp_path, monkeypatch):
+    monkeypatch.setattr(visit_hit_join, "OUTPUT_DIR", tmp_path)
+    with pytest.raises(FileNotFoundError):
+        engagement.compute_url_engagement("v2")
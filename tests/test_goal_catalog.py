@@ -0,0 +1,65 @@
+import os
+
+import pandas as pd
+import pytest
+
+import mcp_ux_server
+
+
+def _write_workbook(path, sheets: dict[str, pd.DataFrame]):
+    with pd.ExcelWriter(path) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+
+
+def _goals(rows):
+    return pd.DataFrame(rows, columns=["Номер цели", "Название цели", "Описание"])
+
+
+@pytest.fixture
+def workbook(tmp_path, monkeypatch):
+    monkeypatch.setattr(mcp_ux_server, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(mcp_ux_server, "_goal_catalog_cache", {})
+    path = tmp_path / "goals.xlsx"
+    _write_workbook(path, {
+        "Основные": _goals([[2, "Заявка", "Отправка формы"], [None, "Раздел", None], [1, "Звонок", "Клик по телефону"]]),
+        "Прочие": _goals([[2, "Дубль", "Не должен победить"], [3, "Чат", None]]),
+        "Справка": pd.DataFrame({"x": [1]}),
+    })
+    return path
+
+
+def test_catalog_merges_sheets_and_drops_rows_without_id(workbook):
+    descriptions = mcp_ux_server._load_goal_descriptions("goals.xlsx")
+    assert list(descriptions) == ["1", "2", "3"]
+    assert descriptions["2"] == {"name": "Заявка", "description": "Отправка формы"}
+    assert pd.isna(descriptions["3"]["description"])
+
+
+def test_catalog_parsed_once_and_invalidated_by_newer_workbook(workbook, monkeypatch):
+    mcp_ux_server._load_goal_catalog("goals.xlsx")
+    assert workbook.with_suffix(".goals.parquet").exists()
+
+    def fail(path):
+        raise AssertionError("workbook parsed again")
+
+    # повторный вызов — из памяти, новый процесс — из parquet рядом с книгой
+    monkeypatch.setattr(mcp_ux_server, "_parse_goal_catalog", fail)
+    mcp_ux_server._load_goal_catalog("goals.xlsx")
+    monkeypatch.setattr(mcp_ux_server, "_goal_catalog_cache", {})
+    assert len(mcp_ux_server._load_goal_catalog("goals.xlsx")) == 3
+
+    monkeypatch.undo()
+    monkeypatch.setattr(mcp_ux_server, "DATA_DIR", workbook.parent)
+    monkeypatch.setattr(mcp_ux_server, "_goal_catalog_cache", {})
+    _write_workbook(workbook, {"Цели": _goals([[7, "Новая", "Обновленная книга"]])})
+    stat = workbook.with_suffix(".goals.parquet").stat()
+    os.utime(workbook, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert list(mcp_ux_server._load_goal_descriptions("goals.xlsx")) == ["7"]
+
+
+def test_workbook_without_goal_sheet_gives_empty_catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(mcp_ux_server, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(mcp_ux_server, "_goal_catalog_cache", {})
+    _write_workbook(tmp_path / "empty.xlsx", {"Лист": pd.DataFrame({"x": [1]})})
+    assert mcp_ux_server._load_goal_descriptions("empty.xlsx") == {}
@@ -0,0 +1,81 @@
+import json
+
+from util.incremental import (
+    load_previous_report,
+    plan_incremental,
+    prompt_fingerprint,
+    values_close,
+)
+
+
+def _metric(v1, v2):
+    return {"v1_value": v1, "v2_value": v2, "change": "x"}
+
+
+def _previous(snapshot: dict, analysis: list[dict], fingerprint: str) -> dict:
+    return {"analysis": analysis, "input_snapshot": snapshot, "prompt_fingerprint": fingerprint}
+
+
+def test_fingerprint_depends_on_every_part():
+    assert prompt_fingerprint("model", "prompt") == prompt_fingerprint("model", "prompt")
+    assert prompt_fingerprint("model", "prompt") != prompt_fingerprint("model", "prompt2")
+    assert prompt_fingerprint("ab", "c") != prompt_fingerprint("a", "bc")
+
+
+def test_values_close_handles_metrics_and_nested_groups():
+    assert values_close(_metric(100, 200), _metric(100.5, 201))
+    assert not values_close(_metric(100, 200), _metric(100, 210))
+    assert values_close(_metric("n/a", 1), _metric("n/a", 1))
+    assert values_close({"bounce": _metric(10, 20)}, {"bounce": _metric(10, 20)})
+    assert not values_close({"bounce": _metric(10, 20)}, {"bounce": _metric(10, 20), "hits": _metric(1, 1)})
+
+
+def test_plan_reuses_unchanged_keys_and_keeps_old_snapshot():
+    fingerprint = prompt_fingerprint("m", "p")
+    previous = _previous(
+        {"bounce": _metric(10, 20), "hits": _metric(100, 200), "gone": _metric(1, 1), "no_items": _metric(5, 5)},
+        [{"metric": "bounce", "insight": "a"}, {"metric": "bounce", "insight": "b"}, {"metric": "hits", "insight": "c"}],
+        fingerprint,
+    )
+    current = {"bounce": _metric(10, 20.1), "hits": _metric(100, 300), "new": _metric(0, 1), "no_items": _metric(5, 5)}
+
+    plan = plan_incremental(current, previous, lambda item: item.get("metric"), fingerprint)
+
+    assert not plan.full
+    assert set(plan.changed) == {"hits", "new", "no_items"}
+    assert [item["insight"] for item in plan.reused] == ["a", "b"]
+    assert plan.snapshot["bounce"] == _metric(10, 20)
+    assert plan.snapshot["hits"] == _metric(100, 300)
+    assert plan.removed == ["gone"]
+
+    report = plan.finalize({"analysis": []})
+    assert report["prompt_fingerprint"] == fingerprint
+    assert report["incremental"] == {
+        "mode": "incremental", "reanalyzed": 3, "reused_keys": 1, "reused_items": 2, "removed": 1,
+    }
+
+
+def test_full_analysis_reasons():
+    current = {"bounce": _metric(1, 2)}
+    snapshot = {"bounce": _metric(1, 2)}
+    analysis = [{"metric": "bounce"}]
+
+    def reason(previous):
+        plan = plan_incremental(current, previous, lambda item: item.get("metric"), "fp")
+        assert plan.changed == current and not plan.reused
+        return plan.summary()["reason"]
+
+    assert reason(None) == "no previous report"
+    assert reason({"analysis": analysis}) == "previous report has no input snapshot"
+    assert reason(_previous(snapshot, analysis, "other")) == "model or prompt changed"
+
+
+def test_load_previous_report(tmp_path):
+    path = tmp_path / "report.json"
+    assert load_previous_report(str(path)) is None
+    path.write_text("{broken", encoding="utf8")
+    assert load_previous_report(str(path)) is None
+    path.write_text("[1, 2]", encoding="utf8")
+    assert load_previous_report(str(path)) is None
+    path.write_text(json.dumps({"analysis": []}), encoding="utf8")
+    assert load_previous_report(str(path)) == {"analysis": []}
@@ -0,0 +1,40 @@
+from util.json_stream import AnalysisStreamParser, recover_analysis_items
+
+RESPONSE = (
+    '```json\n{"summary": {"note": "x"}, "analysis": [\n'
+    '  {"url": "/a", "text": "скобки } и \\" в строке", "nested": {"k": [1, 2]}},\n'
+    '  {"url": "/b"}\n'
+    ']}\n```'
+)
+
+
+def test_items_are_emitted_as_soon_as_they_close():
+    parser = AnalysisStreamParser()
+    emitted = []
+    for i in range(0, len(RESPONSE), 7):
+        emitted.append(parser.feed(RESPONSE[i:i + 7]))
+    items = [item for chunk in emitted for item in chunk]
+    assert items == [
+        {"url": "/a", "text": 'скобки } и " в строке', "nested": {"k": [1, 2]}},
+        {"url": "/b"},
+    ]
+    # первый элемент отдан раньше, чем пришел второй
+    first = next(i for i, chunk in enumerate(emitted) if chunk)
+    assert emitted[first] == items[:1]
+    assert parser.complete
+
+
+def test_objects_outside_the_array_are_ignored():
+    parser = AnalysisStreamParser()
+    assert parser.feed('{"meta": {"analysis": 1}, "other": [{"x": 1}], "analysis": []}') == []
+    assert parser.complete
+
+
+def test_recover_items_from_truncated_response():
+    truncated = RESPONSE[: RESPONSE.index('{"url": "/b"}') + 8]
+    assert recover_analysis_items(truncated) == [
+        {"url": "/a", "text": 'скобки } и " в строке', "nested": {"k": [1, 2]}},
+    ]
+    parser = AnalysisStreamParser()
+    parser.feed(truncated)
+    assert not parser.complete
@@ -0,0 +1,102 @@
+import gzip
+
+import polars as pl
+import pytest
+
+import logs_api_convert
+import sources
+
+HEADER = ["ym:s:visitID", "ym:s:clientID", "ym:s:date", "ym:s:watchIDs", "ym:s:startURL", "ym:s:extra"]
+ROWS = [
+    ["1", "18446744073709551615", "2024-03-01", "[11,12]", 'https://priem.mai.ru/?q="x"', "a"],
+    ["2", "42", "2024-03-01", "[13]", "https://priem.mai.ru/bachelor/", "b"],
+    ["3", "9223372036854775808", "2024-03-02", "[]", "https://priem.mai.ru/master/", ""],
+]
+
+
+def _write_tsv(path, rows=ROWS, header=HEADER):
+    text = "\n".join("\t".join(row) for row in [header, *rows]) + "\n"
+    if path.suffix == ".gz":
+        with gzip.open(path, "wt", encoding="utf8") as f:
+            f.write(text)
+    else:
+        path.write_text(text, encoding="utf8")
+
+
+def _read_parts(out_root, kind="visits", version="v1") -> pl.DataFrame:
+    parts = sorted((out_root / kind / f"version={version}").glob("date=*/*.parquet"))
+    return pl.concat([pl.read_parquet(p) for p in parts], how="diagonal_relaxed").sort("ym:s:visitID")
+
+
+@pytest.mark.parametrize("name", ["visits.tsv", "visits.tsv.gz"])
+def test_convert_tsv_to_daily_parts(tmp_path, name):
+    source = tmp_path / name
+    _write_tsv(source)
+
+    stats = logs_api_convert.convert_export(source, "visits", "v1", out_root=tmp_path / "raw", row_group_rows=2)
+
+    assert stats["rows"] == 3
+    assert stats["parts"] == 2
+    assert stats["days"] == {"2024-03-01": 2, "2024-03-02": 1}
+    df = _read_parts(tmp_path / "raw")
+    assert df.schema["ym:s:visitID"] == pl.UInt64
+    assert df.schema["ym:s:clientID"] == pl.UInt64
+    assert df["ym:s:clientID"].to_list() == [2**64 - 1, 42, 2**63]
+    assert df["ym:s:watchIDs"].to_list() == [[11, 12], [13], []]
+    # у TSV нет кавычек: кавычка в URL остается частью значения
+    assert df["ym:s:startURL"][0] == 'https://priem.mai.ru/?q="x"'
+    assert df["ym:s:extra"].to_list() == ["a", "b", None]
+
+
+def test_convert_csv(tmp_path):
+    source = tmp_path / "hits.csv"
+    source.write_text(
+        'ym:pv:watchID,ym:pv:dateTime,ym:pv:URL\n'
+        '7,2024-03-01 10:00:00,"https://priem.mai.ru/a,b"\n',
+        encoding="utf8",
+    )
+    logs_api_convert.convert_export(source, "hits", "v2", out_root=tmp_path / "raw")
+
+    (part,) = (tmp_path / "raw" / "hits" / "version=v2").glob("date=2024-03-01/hits-*.parquet")
+    df = pl.read_parquet(part)
+    assert df["ym:pv:watchID"].to_list() == [7]
+    assert df["ym:pv:URL"].to_list() == ["https://priem.mai.ru/a,b"]
+
+
+def test_bad_id_fails_loudly(tmp_path):
+    source = tmp_path / "visits.tsv"
+    _write_tsv(source, rows=[["not-an-id", "1", "2024-03-01", "[1]", "https://x/", ""]])
+    with pytest.raises(pl.exceptions.PolarsError):
+        logs_api_convert.convert_export(source, "visits", "v1", out_root=tmp_path / "raw")
+
+
+def test_reconversion_replaces_only_own_parts(tmp_path):
+    out_root = tmp_path / "raw"
+    _write_tsv(tmp_path / "visits.tsv")
+    _write_tsv(tmp_path / "visits-2024.tsv", rows=[["4", "5", "2024-03-01", "[14]", "https://x/", ""]])
+    logs_api_convert.convert_export(tmp_path / "visits.tsv", "visits", "v1", out_root=out_root, row_group_rows=1)
+    logs_api_convert.convert_export(tmp_path / "visits-2024.tsv", "visits", "v1", out_root=out_root)
+
+    # выгрузка visits стала меньше: ее лишние старые части удаляются, части visits-2024 остаются
+    _write_tsv(tmp_path / "visits.tsv", rows=ROWS[:1])
+    logs_api_convert.convert_export(tmp_path / "visits.tsv", "visits", "v1", out_root=out_root)
+
+    assert _read_parts(out_root)["ym:s:visitID"].to_list() == [1, 4]
+
+
+def test_pending_exports_are_converted_once_and_read_by_sources(tmp_path, monkeypatch):
+    exports = tmp_path / "exports" / "v1"
+    exports.mkdir(parents=True)
+    _write_tsv(exports / "visits.tsv.gz")
+    monkeypatch.setattr(logs_api_convert, "MANIFEST_DIR", tmp_path / "raw" / "_converted")
+    monkeypatch.setattr(sources, "DATA_DIR", tmp_path / "raw")
+
+    first = logs_api_convert.convert_pending_exports(tmp_path / "exports", tmp_path / "raw")
+    second = logs_api_convert.convert_pending_exports(tmp_path / "exports", tmp_path / "raw")
+
+    assert [r["rows"] for r in first] == [3]
+    assert second == []
+    visits = sources.scan_source("visits", "v1", ["ym:s:visitID", "ym:s:watchIDs"]).collect().sort("ym:s:visitID")
+    assert visits["ym:s:visitID"].to_list() == [1, 2, 3]
+    # sources отдает списки id прежней JSON-строкой
+    assert visits["ym:s:watchIDs"].to_list() == ['["11","12"]', '["13"]', "[]"]
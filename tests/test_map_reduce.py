@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from util.map_reduce import map_reduce_analysis, merge_analysis
+from util.resilience import CircuitOpenError
+
+
+def test_merge_keeps_first_duplicate_and_sorts_by_change():
+    partials = [
+        [{"url": "/a", "metric": "visits", "relative_change": 10}],
+        [{"url": "/a", "metric": "visits", "relative_change": 99}, {"url": "/b", "metric": "visits", "relative_change": -50}],
+        [{"goal_id": 1, "metrics": [{"relative_change": 5}, {"relative_change": "-70"}]}],
+    ]
+    merged = merge_analysis(partials, key_fields=("url", "metric"))
+    assert [item.get("url") for item in merged] == [None, "/b", "/a"]
+    assert merged[2]["relative_change"] == 10
+
+
+def test_failed_and_truncated_batches_do_not_drop_the_report():
+    async def run_batch(payload: str) -> str:
+        if payload == "down":
+            raise httpx.ConnectError("refused")
+        if payload == "open":
+            raise CircuitOpenError("circuit open")
+        if payload == "cut":
+            return '{"analysis": [{"url": "/cut", "metric": "visits", "relative_change": 3}, {"url": "/c'
+        if payload == "junk":
+            return "no json here"
+        return json.dumps({"analysis": [{"url": f"/{payload}", "metric": "visits", "relative_change": 1}]})
+
+    report = asyncio.run(map_reduce_analysis(
+        ["ok", "down", "cut", "junk", "open"], run_batch, key_fields=("url", "metric"), max_concurrency=2
+    ))
+    assert [item["url"] for item in report["analysis"]] == ["/cut", "/ok"]
+    assert report["batches_total"] == 5
+    assert report["failed_batches"] == [1, 3, 4]
+    assert report["truncated_batches"] == [2]
+
+
+def test_bugs_in_run_batch_propagate():
+    async def run_batch(payload: str) -> str:
+        raise KeyError(payload)
+
+    with pytest.raises(KeyError):
+        asyncio.run(map_reduce_analysis(["x"], run_batch, key_fields=("url",)))
+
+
+def test_concurrency_limit():
+    active = peak = 0
+
+    async def run_batch(payload: str) -> str:
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return '{"analysis": []}'
+
+    asyncio.run(map_reduce_analysis([str(i) for i in range(10)], run_batch, key_fields=("url",), max_concurrency=3))
+    assert peak == 3
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import mcp_ux_server
+
+calls = []
+release = threading.Event()
+
+
+def _slow_summary(name: str) -> str:
+    calls.append(name)
+    release.wait(5)
+    return f"summary:{name}"
+
+
+@pytest.fixture(autouse=True)
+def _pool():
+    calls.clear()
+    release.clear()
+    mcp_ux_server.configure_worker_pool(workers=4, kind="thread")
+    yield
+    release.set()
+
+
+def test_identical_requests_are_coalesced_and_do_not_block_the_loop():
+    async def scenario():
+        first = asyncio.create_task(mcp_ux_server._run_offloaded(_slow_summary, "a.parquet"))
+        second = asyncio.create_task(mcp_ux_server._run_offloaded(_slow_summary, "a.parquet"))
+        other = asyncio.create_task(mcp_ux_server._run_offloaded(_slow_summary, "b.parquet"))
+        # пока воркеры заняты, event loop свободен
+        t0 = time.perf_counter()
+        await asyncio.sleep(0.05)
+        assert time.perf_counter() - t0 < 1
+        release.set()
+        return await asyncio.gather(first, second, other)
+
+    assert asyncio.run(scenario()) == ["summary:a.parquet", "summary:a.parquet", "summary:b.parquet"]
+    assert sorted(calls) == ["a.parquet", "b.parquet"]
+    assert mcp_ux_server._in_flight == {}
+
+
+def test_cancelled_waiter_does_not_cancel_shared_result():
+    async def scenario():
+        first = asyncio.create_task(mcp_ux_server._run_offloaded(_slow_summary, "a.parquet"))
+        second = asyncio.create_task(mcp_ux_server._run_offloaded(_slow_summary, "a.parquet"))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "summary:a.parquet"
+    assert calls == ["a.parquet"]
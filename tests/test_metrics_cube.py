@@ -0,0 +1,80 @@
+import json
+
+import polars as pl
+import pytest
+
+import mcp_ux_server
+from metrics_cube import MEASURES, build_metrics_cube, write_metrics_cube
+
+
+@pytest.fixture
+def cube(raw_data):
+    return build_metrics_cube(["v1", "v2"], ["date", "is_new_user", "traffic_source", "device"], max_dims=3)
+
+
+def _visits(raw_data, version: str) -> pl.DataFrame:
+    year = {"v1": 2022, "v2": 2024}[version]
+    return pl.read_parquet(raw_data / f"{year}_yandex_metrika_visits.parquet")
+
+
+def test_every_cuboid_sums_to_the_version_total(raw_data, cube):
+    for version in ("v1", "v2"):
+        visits = _visits(raw_data, version)
+        hits = visits["ym:s:watchIDs"].str.json_decode(pl.List(pl.Utf8)).list.len()
+        totals = (
+            cube.filter(pl.col("version") == version)
+            .group_by("cuboid").agg([pl.col(m).sum() for m in MEASURES])
+        )
+        assert totals["visits"].to_list() == [visits.height] * totals.height
+        assert totals["hits"].to_list() == [hits.sum()] * totals.height
+        assert totals["bounces"].to_list() == [(hits == 1).sum()] * totals.height
+
+
+def test_lattice_respects_max_dims_and_matches_raw_groups(raw_data, cube):
+    names = set(cube["cuboid"].unique())
+    assert "" in names
+    assert "device|is_new_user|traffic_source" in names
+    assert "date|device|is_new_user|traffic_source" not in names
+    assert all(name.count("|") < 3 for name in names)
+
+    device = (
+        cube.filter((pl.col("cuboid") == "device") & (pl.col("version") == "v1"))
+        .select("device", "visits").sort("device")
+    )
+    expected = (
+        _visits(raw_data, "v1").group_by(pl.col("ym:s:deviceCategory").alias("device"))
+        .agg(pl.len().cast(device["visits"].dtype).alias("visits")).sort("device")
+    )
+    assert device.equals(expected)
+
+
+def test_dimension_missing_in_one_version_is_dropped(raw_data, tmp_path, monkeypatch):
+    import sources
+
+    for path in raw_data.iterdir():
+        df = pl.read_parquet(path)
+        if path.name.startswith("2024") and "visits" in path.name:
+            df = df.drop("ym:s:deviceCategory")
+        df.write_parquet(tmp_path / path.name)
+    monkeypatch.setattr(sources, "DATA_DIR", tmp_path)
+
+    cube = build_metrics_cube(["v1", "v2"], ["device", "traffic_source"])
+    assert "device" not in cube.columns
+    assert set(cube["cuboid"].unique()) == {"", "traffic_source"}
+
+
+def test_slice_tool_reads_the_smallest_covering_cuboid(cube, tmp_path, monkeypatch):
+    monkeypatch.setattr(mcp_ux_server, "DATA_DIR", tmp_path)
+    write_metrics_cube(cube, tmp_path / "cube.parquet")
+
+    out = json.loads(mcp_ux_server._slice_metrics_cube("cube.parquet", by=["device"], filters={"is_new_user": 1}))
+    assert out["cuboid"] == "device|is_new_user"
+    expected = (
+        cube.filter((pl.col("cuboid") == "device|is_new_user") & (pl.col("is_new_user") == 1))
+        .group_by("version", "device").agg(pl.col("visits").sum())
+    )
+    got = {(row["version"], row["device"]): row["visits"] for row in out["data"]}
+    assert got == {(v, d): n for v, d, n in expected.iter_rows()}
+
+    with pytest.raises(ValueError, match="No cuboid"):
+        mcp_ux_server._slice_metrics_cube("cube.parquet", by=["landing_url"])
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+from openai import APITimeoutError, AsyncOpenAI, BadRequestError
+
+from util.adk_custom_model_provider import CustomModelProvider, make_client
+from util.resilience import CircuitBreaker, CircuitOpenError, TokenBucket
+
+
+def _response_body(text: str) -> dict:
+    return {
+        "id": "resp_1",
+        "object": "response",
+        "created_at": 0,
+        "model": "stub",
+        "status": "completed",
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+        "output": [{
+            "type": "message",
+            "id": "msg_1",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "usage": {
+            "input_tokens": 3,
+            "output_tokens": 2,
+            "total_tokens": 5,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+
+def _sse(*events: dict) -> bytes:
+    return "".join(f"event: {e['type']}\ndata: {json.dumps(e)}\n\n" for e in events).encode()
+
+
+class StubServer:
+    """Заглушка /responses: отдает заранее заданные ответы по очереди и считает запросы"""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.requests = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        reply = self.replies.pop(0)
+        if isinstance(reply, int):
+            return httpx.Response(reply, json={"error": {"message": "stub", "type": "stub"}})
+        if isinstance(reply, bytes):
+            return httpx.Response(200, content=reply, headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json=_response_body(reply))
+
+
+def _provider(server: StubServer, **kwargs) -> CustomModelProvider:
+    client = AsyncOpenAI(
+        base_url="http://stub.local/v1",
+        api_key="test",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(server)),
+    )
+    kwargs.setdefault("backoff_base", 0.0)
+    return CustomModelProvider("stub", client, **kwargs)
+
+
+class CountingBucket(TokenBucket):
+    def __init__(self):
+        super().__init__(rate=1000, capacity=1000)
+        self.acquired = 0
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        self.acquired += 1
+        return await super().acquire(tokens)
+
+
+def test_complete_retries_server_errors_through_rate_limiter():
+    server = StubServer(503, 500, "ok")
+    bucket = CountingBucket()
+    provider = _provider(server, rate_limiter=bucket)
+
+    assert asyncio.run(provider.complete("instr", "input")) == "ok"
+    assert server.requests == 3
+    # каждая попытка, включая повторы, проходит через token bucket
+    assert bucket.acquired == 3
+    assert provider.circuit_breaker.state == "closed"
+
+
+def test_client_errors_are_not_retried_and_do_not_open_breaker():
+    server = StubServer(400, 400, 400)
+    provider = _provider(server, circuit_breaker=CircuitBreaker(failure_threshold=2))
+
+    for _ in range(3):
+        with pytest.raises(BadRequestError):
+            asyncio.run(provider.complete("instr", "input"))
+    assert server.requests == 3
+    assert provider.circuit_breaker.state == "closed"
+
+
+def test_breaker_opens_on_repeated_server_errors():
+    server = StubServer(500, 500, 500, 500)
+    provider = _provider(server, max_retries=5, circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(provider.complete("instr", "input"))
+    # после второй ошибки размыкатель открыт: третий запрос не отправляется
+    assert server.requests == 2
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(provider.complete("instr", "input"))
+    assert server.requests == 2
+
+
+def test_stream_retries_before_first_delta():
+    events = _sse(
+        {"type": "response.output_text.delta", "delta": "he", "item_id": "msg_1",
+         "output_index": 0, "content_index": 0, "sequence_number": 1, "logprobs": []},
+        {"type": "response.output_text.delta", "delta": "llo", "item_id": "msg_1",
+         "output_index": 0, "content_index": 0, "sequence_number": 2, "logprobs": []},
+        {"type": "response.completed", "response": _response_body("hello"), "sequence_number": 3},
+    )
+    server = StubServer(502, events)
+    provider = _provider(server)
+
+    async def collect():
+        return [chunk async for chunk in provider.stream("instr", "input")]
+
+    assert asyncio.run(collect()) == ["he", "llo"]
+    assert server.requests == 2
+
+
+class HttpStub(ThreadingHTTPServer):
+    """
+    Настоящий HTTP-сервер на 127.0.0.1 для клиента из make_client: отвечает по очереди
+    (код ошибки, ("slow", текст) — ответ после паузы, иначе текст) и запоминает порт клиента,
+    с которого пришел каждый запрос, — по нему видно, переиспользуется ли соединение
+    """
+
+    daemon_threads = True
+
+    def __init__(self, *replies, delay: float = 1.0):
+        super().__init__(("127.0.0.1", 0), _StubHandler)
+        self.replies = list(replies)
+        self.delay = delay
+        self.client_ports = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        with self.server.lock:
+            self.server.client_ports.append(self.client_address[1])
+            reply = self.server.replies.pop(0)
+        if isinstance(reply, tuple):
+            time.sleep(self.server.delay)
+            reply = reply[1]
+        if isinstance(reply, int):
+            status, body = reply, {"error": {"message": "stub", "type": "stub"}}
+        else:
+            status, body = 200, _response_body(reply)
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(payload)))
+            if status == 429:
+                self.send_header("retry-after", "0")
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # клиент уже ушел по таймауту
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_stub():
+    servers = []
+
+    def start(*replies, **kwargs) -> HttpStub:
+        server = HttpStub(*replies, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_make_client_reuses_pooled_connections(http_stub):
+    server = http_stub(*["ok"] * 5, *[("slow", "ok")] * 6, delay=0.1)
+    provider = CustomModelProvider("stub", make_client(server.base_url, "test", max_connections=2), backoff_base=0.0)
+
+    async def run():
+        sequential = [await provider.complete("instr", "input") for _ in range(5)]
+        parallel = await asyncio.gather(*(provider.complete("instr", "input") for _ in range(6)))
+        return sequential + list(parallel)
+
+    assert asyncio.run(run()) == ["ok"] * 11
+    # последовательные запросы идут по одному keep-alive соединению
+    assert len(set(server.client_ports[:5])) == 1
+    # параллельные упираются в max_connections пула
+    assert len(set(server.client_ports[5:])) <= 2
+
+
+def test_make_client_timeout_is_retried(http_stub):
+    server = http_stub(("slow", "late"), "ok", ("slow", "late"), delay=1.0)
+    provider = CustomModelProvider("stub", make_client(server.base_url, "test", timeout=0.2), backoff_base=0.0)
+
+    async def run():
+        first = await provider.complete("instr", "input")
+        assert len(server.client_ports) == 2
+        # без повторов таймаут доходит до вызывающего
+        provider.max_retries = 0
+        with pytest.raises(APITimeoutError):
+            await provider.complete("instr", "input")
+        return first
+
+    # пул клиента привязан к event loop, поэтому оба вызова — в одном asyncio.run
+    assert asyncio.run(run()) == "ok"
+    assert len(server.client_ports) == 3
+
+
+def test_make_client_retries_rate_limit_and_server_errors(http_stub):
+    server = http_stub(429, 500, 503, "ok")
+    provider = CustomModelProvider("stub", make_client(server.base_url, "test"), backoff_base=0.0)
+
+    assert asyncio.run(provider.complete("instr", "input")) == "ok"
+    assert len(server.client_ports) == 4
+    # ответы с ошибкой не рвут соединение: все попытки — по одному
+    assert len(set(server.client_ports)) == 1
+    assert provider.circuit_breaker.state == "closed"
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+import profiling
+from profiling import StageProfiler
+
+
+def test_nested_stages_accumulate_and_report(tmp_path):
+    events = []
+    profiler = StageProfiler("test", on_progress=events.append, report_dir=tmp_path)
+    source = tmp_path / "input.bin"
+    source.write_bytes(b"x" * 1000)
+
+    with profiler.stage("v1", files=[source]) as outer:
+        outer.add_rows_in(10)
+        for _ in range(3):
+            with profiler.stage("json_decode") as inner:
+                inner.add_rows_out(5)
+                profiler.progress(5, label="chunk")
+    with pytest.raises(RuntimeError), profiler.stage("broken"):
+        raise RuntimeError("boom")
+
+    report = json.loads(profiler.write_report().read_text(encoding="utf8"))
+    stages = {s["name"]: s for s in report["stages"]}
+    assert list(stages) == ["v1", "v1/json_decode", "broken"]
+    assert stages["v1"]["input_bytes"] == 1000
+    assert stages["v1"]["rows_in"] == 10
+    assert stages["v1/json_decode"]["calls"] == 3
+    assert stages["v1/json_decode"]["rows_out"] == 15
+    assert stages["v1"]["wall_s"] >= stages["v1/json_decode"]["wall_s"]
+
+    progress = [e for e in events if e["event"] == "progress"]
+    assert [(e["stage"], e["label"], e["rows"]) for e in progress] == [("v1/json_decode", "chunk", 5)] * 3
+    ends = [e for e in events if e["event"] == "end"]
+    assert ends[-1]["stage"] == "broken"
+    assert ends[-1]["status"] == "error"
+
+
+def test_disabled_profiler_only_forwards_progress():
+    events = []
+    profiler = StageProfiler(enabled=False, on_progress=events.append)
+    with profiler.stage("scan") as record:
+        record.add_rows_in(3)
+        profiler.progress(3)
+    assert profiler.records == {}
+    assert [e["event"] for e in events] == ["progress"]
+
+
+def test_cprofile_top_level_stage(tmp_path):
+    profiler = StageProfiler("test", on_progress=None, profile="cprofile", report_dir=tmp_path)
+    with profiler.stage("work"), profiler.stage("inner"):
+        sum(range(10_000))
+    record = profiler.records["work"]
+    assert record.profile_file.endswith("work.prof")
+    assert (tmp_path / "profiles" / "work.prof").exists()
+    assert profiler.records["work/inner"].profile_file is None
+
+
+def test_module_level_stage_uses_active_profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "_active", profiling._active)
+    profiler = profiling.activate(StageProfiler("etl", on_progress=None, report_dir=tmp_path))
+    with profiling.stage("visits") as record:
+        record.add_rows_in(1)
+    assert profiler.records["visits"].rows_in == 1
@@ -0,0 +1,70 @@
+from util.prompt_builder import (
+    _normalize_goal_id,
+    build_goals_payload,
+    build_metrics_payload,
+    build_url_payloads,
+    count_tokens,
+)
+
+
+def _change(v1, v2):
+    return {"v1_value": v1, "v2_value": v2, "change_percent": (v2 - v1) / v1 * 100}
+
+
+def test_metrics_payload_sorted_by_change_and_trimmed_to_budget():
+    analysis = {"significant_changes_20pct": {
+        "bounce_rate": _change(40.0, 50.0),
+        "total_visits": _change(1000, 3000),
+        "avg_pages": _change(2.5, 2.0),
+    }}
+    payload = build_metrics_payload(analysis)
+    assert payload.splitlines() == [
+        "metric|v1|v2|change_pct",
+        "total_visits|1000|3000|+200.0",
+        "bounce_rate|40|50|+25.0",
+        "avg_pages|2.5|2|-20.0",
+    ]
+
+    many = {"significant_changes_20pct": {f"metric_{i}": _change(100, 100 + i + 30) for i in range(200)}}
+    trimmed = build_metrics_payload(many, max_tokens=150)
+    assert count_tokens(trimmed) <= 150
+    assert trimmed.splitlines()[1].startswith("metric_199|")
+    assert trimmed.splitlines()[-1].startswith("... метрик опущено: ")
+
+
+def test_goal_payload_describes_each_goal_once():
+    goals = {
+        "goals_comparison": {"7": {"conversions": _change(10, 20), "conversion_rate": _change(1.0, 1.5)}},
+        "significant_goals": {"7": {"conversions": _change(10, 20)}},
+    }
+    descriptions = {"7": {"name": "Заявка | форма", "description": "Отправка\nформы"}}
+    rows = build_goals_payload(goals, descriptions).splitlines()
+    assert rows[1] == "7|Заявка / форма|Отправка формы|conversion_rate|1|1.5|+50.0"
+    assert rows[2] == "7|||conversions|10|20|+100.0"
+
+
+def test_normalize_goal_id():
+    assert _normalize_goal_id(12.0) == "12"
+    assert _normalize_goal_id(float("nan")) is None
+    assert _normalize_goal_id(" 12 ") == "12"
+    assert _normalize_goal_id("") is None
+
+
+def test_url_payloads_are_lossless_shards_within_budget():
+    significant = {
+        f"https://site.example/page/{i}": {"visits": _change(100, 200 + i), "bounce_rate": _change(30.0, 45.0)}
+        for i in range(60)
+    }
+    analysis = {
+        "significant_urls": significant,
+        "url_aliases": {"https://site.example/page/3": {"url_v1": "https://site.example/old/3"}},
+    }
+    shards = build_url_payloads(analysis, max_tokens=300)
+    assert len(shards) > 1
+    assert all(count_tokens(shard) <= 300 for shard in shards)
+    assert all(shard.startswith("url|metric|v1|v2|change_pct\n") for shard in shards)
+
+    rows = [row for shard in shards for row in shard.splitlines()[1:]]
+    assert len(rows) == 2 * len(significant)
+    assert rows[0].startswith("https://site.example/page/59|")
+    assert "https://site.example/page/3 (v1: https://site.example/old/3)|visits|100|203|+103.0" in rows
@@ -0,0 +1,89 @@
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import mcp_ux_server
+
+
+@pytest.fixture
+def urls(tmp_path, monkeypatch):
+    monkeypatch.setattr(mcp_ux_server, "DATA_DIR", tmp_path)
+    rng = np.random.default_rng(0)
+    n = 1000
+    df = pd.DataFrame({
+        "url": [f"https://site.example/{'bachelor' if i % 3 else 'master'}/{i % 40}" for i in range(n)],
+        "section": np.where(np.arange(n) % 3, "bachelor", "master"),
+        "page_hits": rng.integers(0, 500, n),
+        "bounce_rate": rng.uniform(0, 100, n).round(2),
+        "client": rng.integers(0, 30, n),
+    })
+    # мелкие группы строк: сканер отдает много батчей
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path / "urls.parquet", row_group_size=64)
+    return df
+
+
+def _query(**kwargs):
+    return json.loads(mcp_ux_server._query_parquet("urls.parquet", **kwargs))
+
+
+def test_projection_filters_sort_and_pages(urls):
+    out = _query(columns=["url", "page_hits"], filters=[["bounce_rate", ">", 50], ["url", "contains", "master"]],
+                 sort=[["page_hits", "desc"], ["url"]], limit=5, offset=3)
+    expected = (
+        urls[(urls.bounce_rate > 50) & urls.url.str.contains("master")]
+        .sort_values(["page_hits", "url"], ascending=[False, True], kind="stable")
+    )
+    assert out["columns"] == ["url", "page_hits"]
+    assert out["matched_rows"] == len(expected)
+    assert out["data"]["page_hits"] == expected.page_hits.iloc[3:8].tolist()
+    assert out["data"]["url"] == expected.url.iloc[3:8].tolist()
+
+
+def test_head_without_sort(urls):
+    out = _query(filters=[["section", "in", ["master"]]], limit=4, offset=2)
+    assert out["data"]["url"] == urls[urls.section == "master"].url.iloc[2:6].tolist()
+
+
+@pytest.mark.parametrize("filters", [None, [["page_hits", ">", 250]], [["page_hits", ">", 10_000]]])
+def test_batchwise_aggregates_match_full_table(urls, filters):
+    aggregates = [["page_hits", "sum"], ["bounce_rate", "mean"], ["page_hits", "max"],
+                  ["url", "count"], ["client", "count_distinct"]]
+    out = _query(group_by=["section"], aggregates=aggregates, filters=filters, sort=[["section"]])
+    df = urls if filters is None else urls[urls.page_hits > filters[0][2]]
+    expected = df.groupby("section").agg(
+        page_hits_sum=("page_hits", "sum"), bounce_rate_mean=("bounce_rate", "mean"),
+        page_hits_max=("page_hits", "max"), url_count=("url", "count"), client_count_distinct=("client", "nunique"),
+    ).reset_index()
+    assert out["matched_rows"] == len(expected)
+    for column in expected.columns:
+        assert out["data"][column] == pytest.approx(expected[column].tolist())
+
+
+def test_aggregate_over_whole_file(urls):
+    out = _query(aggregates=[["page_hits", "sum"], ["client", "count_distinct"]])
+    assert out["data"] == {"page_hits_sum": [int(urls.page_hits.sum())], "client_count_distinct": [urls.client.nunique()]}
+
+
+def test_offset_and_limit_bounds(urls):
+    with pytest.raises(ValueError, match="offset"):
+        _query(offset=-1)
+    out = _query(offset=10**9, limit=10**9)
+    assert out["offset"] == mcp_ux_server.QUERY_MAX_OFFSET
+    assert out["rows"] == 0
+    assert _query(limit=10**9)["rows"] == len(urls)
+    with pytest.raises(ValueError, match="operator"):
+        _query(filters=[["url", "~", "x"]])
+    with pytest.raises(ValueError, match="aggregate"):
+        _query(aggregates=[["url", "median"]])
+
+
+def test_arrow_format(urls):
+    out = _query(columns=["url"], limit=3, format="arrow")
+    table = pa.ipc.open_stream(base64.b64decode(out["data"])).read_all()
+    assert table.column("url").to_pylist() == urls.url.iloc[:3].tolist()
+    assert out["matched_rows"] == len(urls)
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+from util.resilience import CircuitBreaker, CircuitOpenError, TokenBucket, backoff_delay
+
+
+def test_token_bucket_limits_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=20, capacity=1)
+        started = time.monotonic()
+        waits = [await bucket.acquire() for _ in range(4)]
+        return waits, time.monotonic() - started
+
+    waits, elapsed = asyncio.run(scenario())
+    # первый токен есть сразу, остальные три — по 1/20 с
+    assert waits[0] == 0
+    assert elapsed >= 0.14
+
+
+def test_breaker_opens_after_threshold_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert breaker.before_call() is True
+    # пока идет пробный запрос, остальные отклоняются
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_breaker_reopens_when_trial_fails():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+@pytest.mark.parametrize("exc", [asyncio.CancelledError, ValueError])
+def test_guard_releases_trial_on_unrecorded_exit(exc):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    with pytest.raises(exc), breaker.guard():
+        raise exc()
+    # отмененный пробный запрос не должен навсегда запереть размыкатель
+    with breaker.guard():
+        pass
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_backoff_delay_is_capped():
+    assert all(0 <= backoff_delay(attempt, base=0.5, cap=2.0) <= 2.0 for attempt in range(20))
@@ -0,0 +1,71 @@
+from datetime import UTC, datetime, timedelta
+
+import polars as pl
+
+from util.run_history import RunHistory, read_metric_rows
+
+
+def _ago(days: float, hour: int = 12) -> str:
+    day = datetime.now(UTC) - timedelta(days=days)
+    return day.replace(hour=hour, minute=0, second=0, microsecond=0).isoformat(timespec="seconds")
+
+
+def test_metric_trend_keeps_numeric_values_of_last_runs(tmp_path):
+    path = tmp_path / "metrics.parquet"
+    pl.DataFrame({"version": ["v1", "v2"], "bounce_rate": [30.0, 25.0], "top_page": ["/a", "/b"]}).write_parquet(path)
+
+    with RunHistory(tmp_path / "history.sqlite") as history:
+        for days in (3, 2, 1):
+            history.record_metrics(read_metric_rows(str(path)), source="etl", run_at=_ago(days))
+        history.record_metrics([{"version": "v2", "bounce_rate": float("nan")}], run_at=_ago(0))
+
+        trend = history.metric_trend("bounce_rate", version="v2", last_runs=3)
+        assert [row["run_at"] for row in trend] == [_ago(2), _ago(1)]
+        assert {row["value"] for row in trend} == {25.0}
+        assert len(history.metric_trend("bounce_rate", last_runs=10)) == 6
+        assert history.metric_trend("top_page") == []
+        assert [run["kind"] for run in history.runs(limit=2)] == ["metrics", "metrics"]
+
+
+def test_goal_metrics_become_separate_rows(tmp_path):
+    with RunHistory(tmp_path / "history.sqlite") as history:
+        history.record_analysis({
+            "metrics": [{"metric": "bounce_rate", "version_a": "30", "version_b": 25, "insight": "ниже"}],
+            "goals": [{"goal_id": 42, "metrics": [
+                {"metric": "conversion", "relative_change": 0.1, "insight": "выше"},
+                {"metric": "reaches", "insight": "больше"},
+            ]}],
+        }, run_at=_ago(1))
+        history.record_analysis({"metrics": [{"metric": "bounce_rate", "insight": "снова ниже"}]}, run_at=_ago(0))
+
+        goal = history.insight_history(goal_id="42")
+        assert [(row["metric"], row["report"]) for row in goal] == [("conversion", "goals"), ("reaches", "goals")]
+        assert goal[0]["relative_change"] == 0.1
+
+        bounce = history.insight_history(metric="bounce_rate")
+        assert [row["insight"] for row in bounce] == ["ниже", "снова ниже"]
+        assert bounce[0]["version_a"] == 30.0
+        assert [row["insight"] for row in history.insight_history(metric="bounce_rate", last_runs=1)] == ["снова ниже"]
+
+
+def test_compact_and_retention(tmp_path):
+    with RunHistory(tmp_path / "history.sqlite") as history:
+        for days in (400, 40):
+            for hour in (9, 15):
+                history.record_metrics([{"version": "v1", "hits": hour}], run_at=_ago(days, hour))
+                history.record_analysis({"metrics": [{"metric": "hits"}]}, run_at=_ago(days, hour))
+        history.record_metrics([{"version": "v1", "hits": 1}], run_at=_ago(1, 9))
+        history.record_metrics([{"version": "v1", "hits": 2}], run_at=_ago(1, 15))
+
+        assert history.compact(keep_all_days=30) == 4
+        assert [row["value"] for row in history.metric_trend("hits")] == [15.0, 15.0, 1.0, 2.0]
+
+        assert history.apply_retention(max_age_days=365) == 2
+        assert history.apply_retention(max_age_days=None, max_runs=2) == 1
+        assert len(history.runs(kind="metrics")) == 2
+        assert len(history.runs(kind="analysis")) == 1
+        # снимки и выводы удаленных запусков уходят вместе с ними
+        orphans = history.conn.execute(
+            "SELECT COUNT(*) FROM metric_snapshots WHERE run_id NOT IN (SELECT run_id FROM runs)"
+        ).fetchone()[0]
+        assert orphans == 0
@@ -0,0 +1,122 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from minimal_agents.agent import Agent
+from minimal_agents.run_config import RunConfig
+from minimal_agents.runner import Runner
+from minimal_agents.tools import function_tool
+
+
+def _call(call_id: str, name: str, arguments) -> dict:
+    raw = arguments if isinstance(arguments, str) else json.dumps(arguments)
+    return {"type": "function_call", "call_id": call_id, "name": name, "arguments": raw}
+
+
+class _Provider:
+    """Отдает заготовленные ответы по очереди и запоминает, с чем его вызывали"""
+
+    def __init__(self, *turns: list[dict], tokens: int = 0):
+        self.turns = list(turns)
+        self.tokens = tokens
+        self.requests = []
+
+    async def respond(self, instructions, input_items, tools, tool_choice, span):
+        self.requests.append({"items": list(input_items), "tool_choice": tool_choice})
+        span.set_usage({"input_tokens": self.tokens, "output_tokens": 0})
+        output = self.turns.pop(0) if self.turns and tool_choice != "none" else []
+        return SimpleNamespace(output=output, output_text="итог")
+
+
+class _Tools:
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+
+    def build(self) -> list:
+        async def url_metrics(url: str) -> dict:
+            """Метрики URL"""
+            self.calls.append(url)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            await asyncio.sleep(0.02)
+            self.active -= 1
+            return {"url": url, "hits": len(url)}
+
+        def broken() -> str:
+            """Всегда падает"""
+            raise RuntimeError("no data")
+
+        def big() -> str:
+            """Большой вывод"""
+            return "x" * 100
+
+        return [function_tool(url_metrics), function_tool(broken), function_tool(big)]
+
+
+def _run(provider, tools, **kwargs):
+    agent = Agent("analyst", "инструкция", "model", tools=tools)
+    return asyncio.run(Runner.run_with_tools(agent, "вход", RunConfig(provider), **kwargs))
+
+
+def _outputs(request: dict) -> dict:
+    return {i["call_id"]: i["output"] for i in request["items"] if i.get("type") == "function_call_output"}
+
+
+def test_calls_run_in_parallel_and_are_memoised():
+    tools = _Tools()
+    provider = _Provider(
+        [_call("1", "url_metrics", {"url": "/a"}), _call("2", "url_metrics", {"url": "/b"}),
+         _call("3", "url_metrics", '{"url": "/a"}')],
+        [_call("4", "url_metrics", {"url": "/a"})],
+    )
+
+    result = _run(provider, tools.build())
+
+    assert result.final_output == "итог"
+    assert result.turns == 3
+    assert sorted(tools.calls) == ["/a", "/b"]
+    assert tools.peak == 2
+    assert [entry["cached"] for entry in result.tool_calls] == [False, False, True, True]
+    assert json.loads(_outputs(provider.requests[1])["3"]) == {"url": "/a", "hits": 2}
+    assert [r["tool_choice"] for r in provider.requests] == ["auto", "auto", "auto"]
+
+
+def test_tool_errors_are_returned_to_the_model():
+    provider = _Provider([
+        _call("1", "missing", {}), _call("2", "url_metrics", "{not json"),
+        _call("3", "broken", {}), _call("4", "big", {}),
+    ])
+
+    result = _run(provider, _Tools().build(), max_tool_output_chars=50)
+
+    outputs = _outputs(provider.requests[1])
+    assert outputs["1"].startswith("Error: unknown tool missing")
+    assert outputs["2"].startswith("Error: arguments are not valid JSON")
+    assert outputs["3"] == "Error: RuntimeError: no data"
+    assert outputs["4"] == "x" * 50 + "\n... truncated 50 chars"
+    assert [entry["status"] for entry in result.tool_calls] == ["error", "error", "error", "ok"]
+
+
+def test_last_turn_and_token_budget_disable_tools():
+    endless = [[_call(str(i), "url_metrics", {"url": f"/{i}"})] for i in range(10)]
+
+    provider = _Provider(*endless)
+    assert _run(provider, _Tools().build(), max_turns=3).turns == 3
+    assert [r["tool_choice"] for r in provider.requests] == ["auto", "auto", "none"]
+
+    provider = _Provider(*endless, tokens=600)
+    assert _run(provider, _Tools().build(), max_turns=8, max_tokens=1000).turns == 3
+    assert provider.requests[-1]["tool_choice"] == "none"
+
+    provider = _Provider(*endless)
+    assert _run(provider, [], max_turns=8).turns == 1
+    assert provider.requests[0]["tool_choice"] == "none"
+
+
+def test_max_turns_must_be_positive():
+    with pytest.raises(ValueError, match="max_turns"):
+        _run(_Provider(), _Tools().build(), max_turns=0)
@@ -0,0 +1,81 @@
+import polars as pl
+import pytest
+
+import sites
+from sites import SiteMetrics
+
+
+def _visits() -> pl.DataFrame:
+    return pl.DataFrame({
+        "ym:s:counterID": [1, 1, 1, 2, None],
+        "ym:s:startURL": ["https://a.ru/", "https://a.ru/", "https://shared.ru/", "https://b.ru/", "https://c.ru/"],
+        "ym:s:endURL": ["https://a.ru/x", "https://a.ru/x", None, "https://b.ru/", "https://c.ru/"],
+        "ym:s:isNewUser": [1, 0, 1, 1, 0],
+        "ym:s:visitDuration": [10, 20, 30, 40, 50],
+        "hits_count": [2, 1, 1, 1, 3],
+        "bot_rule": [None, None, "robot_flag", None, None],
+    })
+
+
+def _hits() -> pl.DataFrame:
+    return pl.DataFrame({
+        "ym:pv:URL": ["https://a.ru/", "https://A.ru:8080/x?q", "https://shared.ru/", "https://b.ru/", "ftp-ish", "https://new.ru/"],
+        "ym:pv:clientID": [1, 2, 3, 4, 5, 6],
+        "bot_rule": [None, None, "robot_flag", None, None, None],
+    })
+
+
+def test_url_host():
+    urls = pl.DataFrame({"url": ["HTTPS://Www.Site.ru:443/path?x", "http://a.ru#top", "/relative", None]})
+    assert urls.select(sites.url_host(pl.col("url")))["url"].to_list() == ["www.site.ru", "a.ru", None, None]
+
+
+def test_site_metrics_by_counter(tmp_path, monkeypatch):
+    monkeypatch.setattr(sites, "SITES_DIR", tmp_path / "sites")
+    metrics = SiteMetrics("v2")
+    visits = _visits()
+    # два куска складываются так же, как один
+    metrics.add_visits(visits.slice(0, 2))
+    metrics.add_visits(visits.slice(2))
+    metrics.add_hits(_hits())
+
+    assert dict(metrics.hosts().iter_rows()) == {"a.ru": "1", "shared.ru": "1", "b.ru": "2", "c.ru": "unknown"}
+    rows = {row["site"]: row for row in metrics.metrics().iter_rows(named=True)}
+
+    a = rows["1"]
+    assert (a["total_visits"], a["total_hits"], a["unique_users"], a["new_users"]) == (3, 3, 3, 2)
+    assert a["bounce_rate"] == pytest.approx(200 / 3)
+    assert a["session_duration_sec"] == pytest.approx(20.0)
+    assert (a["human_total_visits"], a["human_total_hits"], a["human_unique_users"]) == (2, 2, 2)
+    assert a["human_session_duration_sec"] == pytest.approx(15.0)
+    assert a["bot_visit_share"] == pytest.approx(100 / 3)
+    assert (a["top_landing_page"], a["top_exit_page"]) == ("https://a.ru/", "https://a.ru/x")
+    # хиты с хостов без визитов попадают в unknown
+    assert (rows["unknown"]["total_visits"], rows["unknown"]["total_hits"]) == (1, 2)
+    assert metrics.metrics()["total_visits"].sum() == visits.height
+
+    written = sites.write_site_partitions(metrics.metrics(), "full_metrics.parquet")
+    assert sorted(p.parent.name for p in written) == ["1", "2", "unknown"]
+    assert pl.read_parquet(tmp_path / "sites" / "1" / "full_metrics.parquet")["total_visits"].item() == 3
+
+
+def test_top_url_ties_break_by_url():
+    counts = pl.DataFrame({"site": ["1"] * 3, "url": ["/b", "/c", "/a"], "count": [2, 1, 2]})
+    for _ in range(20):
+        assert SiteMetrics._top_url(counts.sample(fraction=1.0, shuffle=True), "top")["top"].item() == "/a"
+
+
+def test_site_metrics_by_domain(monkeypatch):
+    monkeypatch.setattr(sites, "SITE_KEY", "domain")
+    metrics = SiteMetrics("v1")
+    metrics.add_visits(_visits().drop("ym:s:counterID"))
+    metrics.add_hits(_hits())
+
+    totals = dict(metrics.metrics().select("site", "total_hits").iter_rows())
+    assert totals == {"a.ru": 2, "shared.ru": 1, "b.ru": 1, "c.ru": 0, "new.ru": 1, "unknown": 1}
+    assert sites.visit_columns() == ["ym:s:startURL"]
+
+
+def test_empty_site_metrics():
+    assert SiteMetrics("v1").metrics().is_empty()
+    assert sites.site_dir("a/b c").name == "a_b_c"
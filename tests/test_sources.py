@@ -0,0 +1,85 @@
+import polars as pl
+import pytest
+
+import sources
+
+BIG = 2**63 + 7
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(sources, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(sources, "_date_range", (None, None))
+    monkeypatch.setattr(sources, "DEDUP_STATS", {})
+    monkeypatch.setattr(sources, "_duplicates_cache", {})
+    return tmp_path
+
+
+def _visits(ids: list[int], day: str, **extra) -> pl.DataFrame:
+    return pl.DataFrame({
+        "ym:s:visitID": pl.Series(ids, dtype=pl.UInt64),
+        "ym:s:date": [day] * len(ids),
+        "ym:s:clientID": pl.Series(ids, dtype=pl.UInt64),
+        **extra,
+    })
+
+
+def _write(df: pl.DataFrame, path, **kwargs):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.write_parquet(path, **kwargs)
+
+
+def test_files_are_pruned_by_path_date_and_statistics(data_dir):
+    _write(pl.concat([_visits([1], "2022-01-01"), _visits([2], "2022-01-31")]), data_dir / "2022_yandex_metrika_visits.parquet")
+    _write(_visits([3], "2022-02-01"), data_dir / "2022_yandex_metrika_visits_20220201.parquet")
+    _write(_visits([4], "2022-02-02"), data_dir / "visits/version=v1/date=2022-02-02/part-0.parquet")
+    _write(_visits([5], "2024-02-02"), data_dir / "visits/version=v2/date=2024-02-02/part-0.parquet")
+
+    assert len(sources.discover_files("visits", "v1")) == 3
+    sources.set_date_range("2022-02-01", "2022-02-01")
+    assert [p.name for p in sources.source_files("visits", "v1")] == ["2022_yandex_metrika_visits_20220201.parquet"]
+    sources.set_date_range("2022-01-15", None)
+    assert len(sources.source_files("visits", "v1")) == 3
+    # строки вне окна отсекаются и внутри выбранного файла, даже без колонки даты в запросе
+    assert sorted(sources.scan_source("visits", "v1", ["ym:s:visitID"]).collect()["ym:s:visitID"]) == [2, 3, 4]
+    with pytest.raises(FileNotFoundError):
+        sources.source_files("hits", "v1")
+
+
+def test_schema_drift_and_ids_above_int64(data_dir):
+    _write(_visits([1], "2022-01-01", **{"ym:s:isNewUser": [1], "ym:s:watchIDs": ['["10"]']}),
+           data_dir / "2022_yandex_metrika_visits_1.parquet")
+    old = pl.DataFrame({
+        "ym:s:visitID": pl.Series([BIG], dtype=pl.UInt64).reinterpret(signed=True),
+        "ym:s:date": ["2022-01-02"],
+        "ym:s:clientID": pl.Series([BIG], dtype=pl.UInt64).reinterpret(signed=True),
+        "ym:s:watchIDs": [[11, 12]],
+    })
+    _write(old, data_dir / "2022_yandex_metrika_visits_2.parquet")
+
+    columns = ["ym:s:visitID", "ym:s:clientID", "ym:s:isNewUser", "ym:s:watchIDs"]
+    scanned = sources.scan_source("visits", "v1", columns).collect()
+    batches = pl.concat(sources.iter_source_batches("visits", "v1", columns, batch_rows=1))
+
+    assert scanned.schema == {name: sources.SCHEMA[name] for name in columns}
+    assert scanned.rows() == [(1, 1, 1, '["10"]'), (BIG, BIG, None, '["11","12"]')]
+    assert batches.equals(scanned)
+    assert sources.source_columns("visits", "v1") >= set(columns)
+
+
+def test_overlapping_exports_are_deduplicated(data_dir):
+    _write(_visits(list(range(60)), "2022-01-01"), data_dir / "2022_yandex_metrika_visits_a.parquet", row_group_size=16)
+    _write(_visits(list(range(40, 100)) + [BIG, BIG], "2022-01-02"), data_dir / "2022_yandex_metrika_visits_b.parquet",
+           row_group_size=16)
+
+    scanned = sources.scan_source("visits", "v1", ["ym:s:visitID", "ym:s:date"]).collect()
+    batches = pl.concat(sources.iter_source_batches("visits", "v1", ["ym:s:visitID", "ym:s:date"], batch_rows=25))
+
+    assert scanned.height == 101
+    assert scanned["ym:s:visitID"].n_unique() == 101
+    # первое вхождение остается: пересечение 40..59 берется из первого файла
+    assert scanned.filter(pl.col("ym:s:visitID") == 50)["ym:s:date"].item() == "2022-01-01"
+    assert batches.equals(scanned)
+    assert sources.duplicate_count("visits", "v1") == 21
+    assert sources.scan_source("visits", "v1", ["ym:s:visitID"], dedup=False).collect().height == 122
+    assert sources.source_rows("visits", "v1") == 122
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from minimal_agents.agent import Agent
+from minimal_agents.run_config import RunConfig
+from minimal_agents.runner import Runner
+from minimal_agents.tracing import RunTracer, load_spans, summarize_spans
+
+
+class _Provider:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+
+    async def complete(self, instructions, input_text, span):
+        span.queue_ms = 1.0
+        span.set_usage({"input_tokens": 10, "output_tokens": 5, "input_tokens_details": {"cached_tokens": 8}})
+        if self.fail:
+            raise ConnectionError("down")
+        return "ok"
+
+
+def test_runner_records_spans_to_tracer_and_file(tmp_path):
+    path = tmp_path / "calls.jsonl"
+    rc = RunConfig(_Provider(), tracer=RunTracer(str(path)))
+    agent = Agent("analyst", "инструкция", "model")
+
+    result = asyncio.run(Runner.run(agent, "вход", rc))
+
+    assert result.final_output == "ok"
+    (span,) = load_spans(str(path))
+    assert span == rc.tracer.spans[0]
+    assert span["agent_name"] == "analyst"
+    assert span["prompt_bytes"] == len("инструкциявход".encode())
+    assert span["input_tokens"] == 10
+    assert span["cache_hit"] is True
+    assert span["network_ms"] == pytest.approx(max(0.0, span["total_ms"] - 1.0))
+
+
+def test_failed_call_is_recorded_as_error():
+    rc = RunConfig(_Provider(fail=True), tracer=RunTracer())
+    with pytest.raises(ConnectionError):
+        asyncio.run(Runner.run(Agent("a", "i", "m"), "x", rc))
+    assert rc.tracer.spans[0]["status"] == "error"
+    assert rc.tracer.spans[0]["error"] == "ConnectionError: down"
+
+
+def test_summary_percentiles_errors_and_cache_rate():
+    spans = [{"status": "ok", "total_ms": float(ms), "retries": 1, "cache_hit": ms % 2 == 0} for ms in range(1, 21)]
+    spans.append({"status": "error", "total_ms": 1000.0, "retries": 0, "input_tokens": None})
+    summary = summarize_spans(spans)
+    assert summary["calls"] == 21
+    assert summary["errors"] == 1
+    assert summary["retries"] == 20
+    assert summary["cache_hit_rate"] == pytest.approx(10 / 21)
+    assert summary["total_ms"] == {"p50": 11.0, "p95": 20.0, "max": 1000.0, "sum": 1210.0}
+    assert "input_tokens" not in summary
+    assert summarize_spans([])["cache_hit_rate"] == 0.0
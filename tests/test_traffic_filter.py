@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import polars as pl
+import pytest
+
+import sources
+import traffic_filter
+from traffic_filter import TrafficFilter
+
+START = datetime(2024, 3, 1, 10, 0, 0)
+
+
+def _hits(client: int, seconds: list[int]) -> list[dict]:
+    return [
+        {"ym:pv:clientID": client, "ym:pv:dateTime": (START + timedelta(seconds=s)).strftime("%Y-%m-%d %H:%M:%S")}
+        for s in seconds
+    ]
+
+
+def _visits(client: int, count: int, duration: int, watch_ids: str, robot: str | None = None) -> list[dict]:
+    return [
+        {"ym:s:clientID": client, "ym:s:visitDuration": duration, "ym:s:watchIDs": watch_ids, "ym:s:isRobot": robot}
+        for _ in range(count)
+    ]
+
+
+@pytest.fixture
+def traffic(tmp_path, monkeypatch):
+    """1 — признак робота, 2 — всплеск в секунду, 3 — частые хиты, 4 — одни нулевые отказы, 5 — человек"""
+    monkeypatch.setattr(sources, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(sources, "_date_range", (None, None))
+    hits = pl.DataFrame(
+        _hits(1, [0, 600]) + _hits(2, [0, 0, 0, 0, 0]) + _hits(3, list(range(40)))
+        + _hits(4, [i * 3600 for i in range(10)]) + _hits(5, [i * 600 for i in range(12)]),
+        schema={"ym:pv:clientID": pl.UInt64, "ym:pv:dateTime": pl.Utf8},
+    )
+    visits = pl.DataFrame(
+        _visits(1, 2, 30, '["1","2"]', robot="1") + _visits(2, 1, 5, '["1","2"]', robot="0")
+        + _visits(3, 1, 60, '["1","2"]') + _visits(4, 10, 0, '["1"]') + _visits(5, 10, 0, '["1"]') + _visits(5, 2, 40, '["1","2"]'),
+        schema={"ym:s:clientID": pl.UInt64, "ym:s:visitDuration": pl.Int64, "ym:s:watchIDs": pl.Utf8, "ym:s:isRobot": pl.Utf8},
+    )
+    hits.write_parquet(tmp_path / "2024_yandex_metrika_hits.parquet")
+    visits.write_parquet(tmp_path / "2024_yandex_metrika_visits.parquet")
+    return hits, visits
+
+
+def test_rules_are_assigned_in_order(traffic):
+    tf = TrafficFilter.for_version("v2")
+
+    rules = dict(tf.bot_clients.sort("clientID").iter_rows())
+    assert rules == {1: "robot_flag", 2: "hit_burst", 3: "hit_rate", 4: "zero_duration_bounces"}
+    assert {rule: counts["clients"] for rule, counts in tf.counters.items()} == dict.fromkeys(traffic_filter.RULES, 1)
+
+
+
+def test_from_frames_matches_source_scan(traffic):
+    hits, visits = traffic
+    # ETL строит фильтр по уже прочитанным кускам, с лишними колонками; результат тот же, что по файлам
+    wide_visits = visits.with_columns(pl.lit("https://a.ru/").alias("ym:s:startURL"))
+    from_frames = TrafficFilter.from_frames(wide_visits, hits).bot_clients.sort("clientID")
+    assert from_frames.equals(TrafficFilter.for_version("v2").bot_clients.sort("clientID"))
+    assert traffic_filter.robot_columns("visits", "v2") == ["ym:s:isRobot"]
+    assert traffic_filter.robot_columns("hits", "v2") == []
+
+def test_mark_counts_rows_per_rule_and_summary(traffic):
+    hits, visits = traffic
+    tf = TrafficFilter.for_version("v2")
+
+    # куски размечаются по отдельности, счетчики копятся
+    marked = pl.concat([tf.mark(part, "ym:pv:clientID", "hits") for part in hits.iter_slices(20)])
+    tf.mark(visits, "ym:s:clientID", "visits")
+
+    assert marked.height == hits.height
+    assert marked.filter(pl.col("bot_rule").is_null())["ym:pv:clientID"].unique().to_list() == [5]
+    assert tf.counters["hit_rate"] == {"clients": 1, "visits": 1, "hits": 40}
+    assert tf.counters["zero_duration_bounces"] == {"clients": 1, "visits": 10, "hits": 10}
+
+    summary = tf.summary(total_visits=visits.height, total_hits=hits.height)
+    assert summary["bot_robot_flag_visits"] == 2
+    assert summary["bot_hit_burst_hits"] == 5
+    assert summary["bot_clients"] == 4
+    assert summary["bot_visits"] == 14
+    assert summary["bot_hits"] == 57
+    assert summary["bot_hit_share"] == pytest.approx(57 / 69 * 100)
+
+
+def test_disabled_filter_marks_nothing(traffic, monkeypatch):
+    hits, _ = traffic
+    monkeypatch.setattr(traffic_filter, "TRAFFIC_FILTER", False)
+    tf = TrafficFilter.for_version("v2")
+
+    marked = tf.mark(hits, "ym:pv:clientID", "hits")
+    assert marked["bot_rule"].null_count() == hits.height
+    summary = tf.summary(total_visits=0, total_hits=hits.height)
+    assert summary["bot_hits"] == 0
+    assert summary["bot_visit_share"] == 0.0
@@ -0,0 +1,71 @@
+import polars as pl
+
+import url_alignment
+
+
+def _norm(urls: list[str]) -> list[str]:
+    return pl.DataFrame({"url": urls}).select(url_alignment.normalize_url(pl.col("url")))["url"].to_list()
+
+
+def test_normalize_url_drops_noise():
+    assert _norm([
+        "http://WWW.Site.ru:443/catalog//index.html?utm_source=x&page=2#top",
+        "https://site.ru/",
+        "https://site.ru/news/?yclid=1",
+        "/relative/path",
+    ]) == ["https://site.ru/catalog?page=2", "https://site.ru/", "https://site.ru/news", "/relative/path"]
+
+
+def test_fuzzy_match_pairs_similar_urls_one_to_one():
+    v1 = pl.Series(["https://site.ru/services/credit-cards", "https://site.ru/about-company"])
+    v2 = pl.Series(["https://site.ru/services/credit-card", "https://site.ru/services/credit-cards-new", "https://site.ru/zzz"])
+
+    pairs = url_alignment.fuzzy_match(v1, v2)
+
+    assert pairs["url_v1"].to_list() == ["https://site.ru/services/credit-cards"]
+    assert pairs["url_v2"].n_unique() == pairs.height
+    assert (pairs["score"] >= url_alignment.MIN_SIMILARITY).all()
+    assert url_alignment.fuzzy_match(v1, pl.Series([], dtype=pl.Utf8)).is_empty()
+
+
+def test_alignment_match_types_and_keys(tmp_path):
+    redirects = tmp_path / "redirects.csv"
+    pl.DataFrame({"from_url": ["https://site.ru/old-page"], "to_url": ["https://site.ru/brand-new"]}).write_csv(redirects)
+
+    def hits(urls: dict[str, int]) -> pl.DataFrame:
+        return pl.DataFrame({"url": list(urls), "hits": list(urls.values())})
+
+    v1 = hits({
+        "https://site.ru/same": 5,
+        "https://site.ru/catalog/": 7,
+        "https://site.ru/old-page": 3,
+        "https://site.ru/services/credit-cards": 4,
+        "https://site.ru/gone": 1,
+    })
+    v2 = hits({
+        "https://site.ru/same": 6,
+        "https://www.site.ru/catalog?utm_source=mail": 2,
+        "https://site.ru/catalog": 9,
+        "https://site.ru/brand-new": 3,
+        "https://site.ru/services/credit-card": 4,
+        "https://site.ru/fresh": 1,
+    })
+
+    alignment = url_alignment.build_url_alignment(v1, v2, url_alignment.load_redirects(redirects))
+    assert url_alignment.load_redirects(tmp_path / "missing.csv") is None
+    rows = {(r["version"], r["url"]): (r["url_key"], r["match_type"]) for r in alignment.iter_rows(named=True)}
+
+    assert rows["v1", "https://site.ru/same"] == ("https://site.ru/same", "exact")
+    assert rows["v1", "https://site.ru/catalog/"] == ("https://site.ru/catalog", "normalized")
+    assert rows["v2", "https://www.site.ru/catalog?utm_source=mail"] == ("https://site.ru/catalog", "normalized")
+    assert rows["v1", "https://site.ru/old-page"] == ("https://site.ru/brand-new", "redirect")
+    assert rows["v1", "https://site.ru/services/credit-cards"] == ("https://site.ru/services/credit-card", "fuzzy")
+    assert rows["v1", "https://site.ru/gone"][1] == "removed"
+    assert rows["v2", "https://site.ru/fresh"][1] == "added"
+
+    summary = url_alignment.alignment_summary(alignment)
+    assert sum(summary["v1"].values()) == 5
+    assert sum(summary["v2"].values()) == 6
+
+    table = url_alignment.apply_alignment(pl.DataFrame({"url": ["https://site.ru/old-page", "/unknown"]}), alignment, "v1")
+    assert table["url_key"].to_list() == ["https://site.ru/brand-new", "/unknown"]
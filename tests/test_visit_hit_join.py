@@ -0,0 +1,63 @@
+import polars as pl
+import pytest
+
+import sources
+import visit_hit_join
+
+
+@pytest.fixture
+def out_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(visit_hit_join, "OUTPUT_DIR", tmp_path / "metrics")
+    (tmp_path / "metrics").mkdir()
+    return tmp_path / "metrics"
+
+
+def _joined(version: str) -> pl.DataFrame:
+    return visit_hit_join.scan_visit_hits(version).collect().sort(["visit_id", "hit_index"])
+
+
+def test_partition_count_does_not_change_the_result(raw_data, out_dir):
+    hits = pl.read_parquet(raw_data / "2022_yandex_metrika_hits.parquet")
+
+    stats = visit_hit_join.build_visit_hit_map("v1", partitions=1, batch_rows=700)
+    single = _joined("v1")
+    stats_many = visit_hit_join.build_visit_hit_map("v1", partitions=7, batch_rows=700)
+    many = _joined("v1")
+
+    assert single.equals(many)
+    assert stats["matched"] == stats_many["matched"] == hits.height
+    assert stats["missing_hits"] == stats["orphan_hits"] == 0
+    assert single.height == hits.height
+    assert single.group_by("visit_id").agg(pl.col("is_exit").sum())["is_exit"].eq(1).all()
+    assert not list(out_dir.glob("visit_hits_v1_*"))
+
+
+def test_edge_cases_and_ids_above_int64(tmp_path, out_dir, monkeypatch):
+    big = 2**63 + 5
+    visits = pl.DataFrame({
+        "ym:s:visitID": pl.Series([big, 2], dtype=pl.UInt64),
+        "ym:s:watchIDs": [f'["{big + 1}","{big + 2}","{big + 3}"]', '["20","21"]'],
+        "ym:s:date": ["2022-03-01", "2022-03-01"],
+    })
+    hits = pl.DataFrame({
+        "ym:pv:watchID": pl.Series([big + 2, big + 1, big + 3, 20, 99], dtype=pl.UInt64),
+        "ym:pv:URL": ["/b", "/a", "/c", "/x", "/orphan"],
+        "ym:pv:dateTime": ["2022-03-01 10:00:30", "2022-03-01 10:00:00", "2022-03-01 10:02:00",
+                           "2022-03-01 11:00:00", "2022-03-01 12:00:00"],
+    })
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    visits.write_parquet(raw / "2022_yandex_metrika_visits.parquet")
+    hits.write_parquet(raw / "2022_yandex_metrika_hits.parquet")
+    monkeypatch.setattr(sources, "DATA_DIR", raw)
+    monkeypatch.setattr(sources, "_date_range", (None, None))
+
+    stats = visit_hit_join.build_visit_hit_map("v1", partitions=2)
+
+    assert (stats["matched"], stats["missing_hits"], stats["orphan_hits"]) == (4, 1, 1)
+    result = _joined("v1")
+    assert result.filter(pl.col("visit_id") == big).select("url", "time_on_page_sec", "is_exit").rows() == [
+        ("/a", 30, False), ("/b", 90, False), ("/c", None, True),
+    ]
+    assert result.filter(pl.col("visit_id") == 2)["url"].to_list() == ["/x", None]
+    assert visit_hit_join.true_exit_pages("v1")["url"].to_list() == ["/c"]
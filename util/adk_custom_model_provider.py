@@ -1,12 +1,188 @@
+import asyncio
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from util.resilience import CircuitBreaker, TokenBucket, backoff_delay
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# ошибки запроса к API; httpx — обрыв соединения посреди потока, который клиент не оборачивает
+API_ERRORS = (openai.OpenAIError, httpx.HTTPError)
+
+
+def make_client(
+    base_url: str,
+    api_key: str,
+    project: str | None = None,
+    max_connections: int = 32,
+    max_keepalive_connections: int = 16,
+    timeout: float = 120.0,
+) -> AsyncOpenAI:
+    """
+    AsyncOpenAI с настроенным пулом соединений. Встроенные ретраи клиента выключены:
+    повторы, backoff и rate limit делает CustomModelProvider
+    """
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=30.0,
+        ),
+        timeout=httpx.Timeout(timeout, connect=10.0),
+    )
+    return AsyncOpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        project=project,
+        http_client=http_client,
+        max_retries=0,
+    )
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def _is_server_failure(exc: Exception) -> bool:
+    """
+    Ошибка, говорящая о недоступности провайдера: обрыв соединения, таймаут или 5xx.
+    Только такие считаются размыкателем — 4xx (плохой запрос, 429) провайдер вернул сам, он жив
+    """
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code >= 500
+    return False
+
+
+def _retry_after(exc: Exception) -> float | None:
+    """Значение заголовка Retry-After в секундах, если сервер его прислал"""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
 class CustomModelProvider:
-    def __init__(self, model, client):
+    def __init__(
+        self,
+        model,
+        client,
+        max_retries: int = 5,
+        rate_limiter: TokenBucket | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 30.0,
+    ):
         self.model = model
         self.client = client
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    async def _throttle(self, span=None, attempt: int = 0):
+        if span is not None:
+            span.retries = attempt
+        if self.rate_limiter is not None:
+            waited = await self.rate_limiter.acquire()
+            if span is not None:
+                span.queue_ms += waited * 1000
+
+    def _retry_delay(self, exc: Exception, attempt: int) -> float:
+        """Решает, повторять ли запрос: если да — возвращает паузу перед повтором, если нет — пробрасывает ошибку"""
+        if _is_server_failure(exc):
+            self.circuit_breaker.record_failure()
+        if not _is_retryable(exc) or attempt >= self.max_retries:
+            raise exc
 
-    async def complete(self, instructions: str, input_text: str) -> str:
-        resp = await self.client.responses.create(
-            model=self.model,
-            instructions=instructions,
-            input=input_text
-        )
+        delay = _retry_after(exc)
+        if delay is None:
+            delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+        print(f"Warning: LLM request failed ({type(exc).__name__}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    async def _create(self, span=None, **kwargs):
+        """
+        responses.create с rate limit, размыкателем и повторами. Пауза перед повтором — вне
+        circuit_breaker.guard(), чтобы пробный запрос полуоткрытого размыкателя не держался на время сна
+        """
+        attempt = 0
+        while True:
+            with self.circuit_breaker.guard():
+                await self._throttle(span, attempt)
+                try:
+                    resp = await self.client.responses.create(model=self.model, **kwargs)
+                except API_ERRORS as exc:
+                    delay = self._retry_delay(exc, attempt)
+                else:
+                    self.circuit_breaker.record_success()
+                    if span is not None:
+                        span.set_usage(getattr(resp, "usage", None))
+                    return resp
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def complete(self, instructions: str, input_text: str, span=None) -> str:
+        resp = await self._create(span, instructions=instructions, input=input_text)
         return resp.output_text
+
+    async def respond(self, instructions: str, input_items: list, tools: list[dict] | None = None,
+                      tool_choice: str | None = None, span=None):
+        """
+        Один ход диалога с инструментами: input_items — история (сообщения, function_call и
+        function_call_output), tools — схемы функций. Возвращает ответ целиком: вызовы
+        инструментов лежат в resp.output, текст — в resp.output_text
+        """
+        kwargs = {"tools": tools} if tools else {}
+        if tools and tool_choice is not None:
+            kwargs["tool_choice"] = tool_choice
+        return await self._create(span, instructions=instructions, input=input_items, **kwargs)
+
+    async def stream(self, instructions: str, input_text: str, span=None):
+        """
+        Потоковый вариант complete: отдает куски текста ответа по мере генерации.
+
+        Повторы, как у complete, есть только до первого куска текста. Если поток оборвался после
+        него, ошибка пробрасывается без повтора: вызывающий уже получил часть ответа, и повтор
+        задвоил бы текст. Перезапускать запрос целиком (и отбрасывать полученное) — решение вызывающего
+        """
+        attempt = 0
+        while True:
+            started = False
+            with self.circuit_breaker.guard():
+                await self._throttle(span, attempt)
+                try:
+                    stream = await self.client.responses.create(
+                        model=self.model,
+                        instructions=instructions,
+                        input=input_text,
+                        stream=True
+                    )
+                    async for event in stream:
+                        if event.type == "response.output_text.delta":
+                            started = True
+                            yield event.delta
+                        elif event.type == "response.completed" and span is not None:
+                            span.set_usage(getattr(event.response, "usage", None))
+                except API_ERRORS as exc:
+                    if started:
+                        if _is_server_failure(exc):
+                            self.circuit_breaker.record_failure()
+                        raise
+                    delay = self._retry_delay(exc, attempt)
+                else:
+                    self.circuit_breaker.record_success()
+                    return
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,279 @@
+import json
+import math
+import re
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+INDEX_DIR = Path("data/index/ux")
+
+EMBEDDING_DIM = 256
+
+# с меньшим числом векторов IVF не нужен: полный перебор и так быстрее миллисекунды
+MIN_VECTORS_FOR_IVF = 4096
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    Векторизация текста без обучения и без сети: слова и символьные n-граммы слов
+    раскладываются hashing trick'ом (crc32 — стабилен между запусками, в отличие от hash())
+    в dim корзин со знаком, частоты сглаживаются log1p, вектор нормируется по L2.
+    Косинусная близость таких векторов — близость по общим словам и их кускам,
+    поэтому "показатель отказов вырос" и "рост отказов" оказываются рядом, а /bachelor/ и /bachelors/ — почти совпадают
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, char_ngrams: tuple[int, ...] = (3, 4)):
+        self.dim = dim
+        self.char_ngrams = char_ngrams
+
+    def tokens(self, text: str) -> list[str]:
+        words = _WORD_RE.findall(str(text).lower())
+        tokens = [f"w:{word}" for word in words]
+        for word in words:
+            padded = f"<{word}>"
+            for n in self.char_ngrams:
+                tokens.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+        return tokens
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Матрица (len(texts), dim) float32, строки единичной длины (у пустого текста — нулевая)"""
+        rows, cols, signs = [], [], []
+        for row, text in enumerate(texts):
+            for token in self.tokens(text):
+                h = zlib.crc32(token.encode("utf8"))
+                rows.append(row)
+                cols.append(h % self.dim)
+                signs.append(1.0 if h & 0x80000000 else -1.0)
+
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(matrix, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)), np.asarray(signs, dtype=np.float32))
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    def config(self) -> dict:
+        return {"kind": "hashing", "dim": self.dim, "char_ngrams": list(self.char_ngrams)}
+
+    @classmethod
+    def from_config(cls, config: dict) -> "HashingEmbedder":
+        return cls(dim=config["dim"], char_ngrams=tuple(config["char_ngrams"]))
+
+
+def _spherical_kmeans(vectors: np.ndarray, n_lists: int, iterations: int, seed: int, chunk: int = 16384) -> np.ndarray:
+    """Центроиды k-means по косинусу; пустой кластер получает случайный вектор выборки"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = assign_lists(vectors, centroids, chunk)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=n_lists)
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.divide(sums, norms, out=np.zeros_like(sums), where=norms > 0)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 16384) -> np.ndarray:
+    """Номер ближайшего центроида для каждого вектора; считается кусками, чтобы не держать n x n_lists"""
+    return np.concatenate([
+        np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), chunk)
+    ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+class VectorIndex:
+    """
+    Приближенный поиск ближайших соседей по косинусу (IVF): векторы разбиты на n_lists
+    кластеров k-means и лежат на диске подряд по кластерам. Запрос сравнивается с центроидами,
+    и полный перебор идет только внутри n_probe ближайших кластеров — при 100k векторах
+    это пара тысяч скалярных произведений.
+
+    На диске — каталог с centroids.npy, vectors.npy, offsets.npy, kinds.npy, meta.jsonl и index.json;
+    векторы читаются через mmap, поэтому загрузка индекса почти бесплатна.
+    meta — словари с обязательными kind (url, goal, insight, ...) и text
+    """
+
+    def __init__(self, embedder: HashingEmbedder, centroids: np.ndarray, vectors: np.ndarray,
+                 offsets: np.ndarray, kinds: np.ndarray, kind_names: list[str], meta: list[dict]):
+        self.embedder = embedder
+        self.centroids = centroids
+        self.vectors = vectors
+        self.offsets = offsets
+        self.kinds = kinds
+        self.kind_names = kind_names
+        self.meta = meta
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    @classmethod
+    def build(cls, meta: list[dict], embedder: HashingEmbedder | None = None, n_lists: int | None = None,
+              iterations: int = 8, seed: int = 0) -> "VectorIndex":
+        embedder = embedder or HashingEmbedder()
+        vectors = embedder.embed([m["text"] for m in meta])
+        if n_lists is None:
+            n_lists = 1 if len(vectors) < MIN_VECTORS_FOR_IVF else int(math.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        if n_lists == 1:
+            centroids = np.zeros((1, embedder.dim), dtype=np.float32)
+            assign = np.zeros(len(vectors), dtype=np.int64)
+        else:
+            centroids = _spherical_kmeans(vectors, n_lists, iterations, seed)
+            assign = assign_lists(vectors, centroids)
+
+        order = np.argsort(assign, kind="stable")
+        offsets = np.searchsorted(assign[order], np.arange(n_lists + 1)).astype(np.int64)
+
+        kind_names = sorted({m["kind"] for m in meta})
+        kind_codes = {name: code for code, name in enumerate(kind_names)}
+        kinds = np.array([kind_codes[meta[i]["kind"]] for i in order], dtype=np.int16)
+
+        return cls(embedder, centroids, vectors[order], offsets, kinds, kind_names, [meta[i] for i in order])
+
+    def save(self, index_dir: Path = INDEX_DIR) -> Path:
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / "centroids.npy", self.centroids)
+        np.save(index_dir / "vectors.npy", self.vectors)
+        np.save(index_dir / "offsets.npy", self.offsets)
+        np.save(index_dir / "kinds.npy", self.kinds)
+        with open(index_dir / "meta.jsonl", "w", encoding="utf8") as f:
+            f.writelines(json.dumps(m, ensure_ascii=False) + "\n" for m in self.meta)
+        (index_dir / "index.json").write_text(json.dumps({
+            "embedder": self.embedder.config(),
+            "vectors": len(self.meta),
+            "n_lists": len(self.centroids),
+            "kinds": self.kind_names,
+        }, ensure_ascii=False, indent=2), encoding="utf8")
+        return index_dir
+
+    @classmethod
+    def load(cls, index_dir: Path = INDEX_DIR, mmap: bool = True) -> "VectorIndex":
+        index_dir = Path(index_dir)
+        info = json.loads((index_dir / "index.json").read_text(encoding="utf8"))
+        mode = "r" if mmap else None
+        with open(index_dir / "meta.jsonl", encoding="utf8") as f:
+            meta = [json.loads(line) for line in f]
+        return cls(
+            HashingEmbedder.from_config(info["embedder"]),
+            np.load(index_dir / "centroids.npy"),
+            np.load(index_dir / "vectors.npy", mmap_mode=mode),
+            np.load(index_dir / "offsets.npy"),
+            np.load(index_dir / "kinds.npy"),
+            info["kinds"],
+            meta,
+        )
+
+    def search_vector(self, query: np.ndarray, k: int = 10, n_probe: int = 8,
+                      kind: str | None = None, min_score: float | None = None) -> list[tuple[float, dict]]:
+        """k ближайших к query (единичный вектор) из n_probe ближайших кластеров: [(косинус, meta), ...]"""
+        if not len(self.meta):
+            return []
+        if kind is not None and kind not in self.kind_names:
+            return []
+        kind_code = self.kind_names.index(kind) if kind is not None else None
+
+        lists = np.argsort(-(self.centroids @ query))[:n_probe]
+        scores, positions = [], []
+        for lst in lists:
+            start, end = int(self.offsets[lst]), int(self.offsets[lst + 1])
+            if start == end:
+                continue
+            s = np.asarray(self.vectors[start:end]) @ query
+            pos = np.arange(start, end)
+            if kind_code is not None:
+                mask = self.kinds[start:end] == kind_code
+                s, pos = s[mask], pos[mask]
+            scores.append(s)
+            positions.append(pos)
+        if not scores:
+            return []
+
+        scores = np.concatenate(scores)
+        positions = np.concatenate(positions)
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            (float(scores[i]), self.meta[positions[i]])
+            for i in top
+            if min_score is None or scores[i] >= min_score
+        ]
+
+    def search(self, text: str, k: int = 10, n_probe: int = 8, kind: str | None = None,
+               min_score: float | None = None) -> list[tuple[float, dict]]:
+        return self.search_vector(self.embedder.embed([text])[0], k, n_probe, kind, min_score)
+
+
+def insight_text(item: dict) -> str:
+    """Текст элемента анализа LLM для векторизации: о чем он (метрика, url, цель) и что в нем сказано"""
+    parts = [item.get(field) for field in ("metric", "url", "goal_id", "goal_name", "insight", "solution")]
+    for metric in item.get("metrics") or []:
+        if isinstance(metric, dict):
+            parts.extend(metric.get(field) for field in ("metric", "insight", "solution"))
+    return " ".join(str(p) for p in parts if p)
+
+
+def cluster_items(items: list[dict], embedder: HashingEmbedder | None = None, threshold: float = 0.8) -> list[int]:
+    """
+    Номера кластеров почти одинаковых выводов: элемент присоединяется к первому
+    (в порядке отчета — самому важному) элементу, с которым косинус не меньше threshold.
+    Отчеты — сотни элементов, поэтому полная матрица близостей дешевле индекса
+    """
+    if not items:
+        return []
+    vectors = (embedder or HashingEmbedder()).embed([insight_text(item) for item in items])
+    similar = (vectors @ vectors.T) >= threshold
+
+    clusters = [-1] * len(items)
+    for i in range(len(items)):
+        if clusters[i] != -1:
+            continue
+        # элемент без текста (нулевой вектор) не похож даже на себя — он свой собственный кластер
+        clusters[i] = i
+        for j in np.flatnonzero(similar[i]):
+            if clusters[j] == -1:
+                clusters[j] = i
+    return clusters
+
+
+def annotate_clusters(items: list[dict], embedder: HashingEmbedder | None = None, threshold: float = 0.8) -> int:
+    """
+    Помечает повторяющиеся выводы: у всех элементов кластера кроме первого появляется
+    duplicate_of — индекс первого элемента в отчете. Возвращает число помеченных
+    """
+    duplicates = 0
+    for i, cluster in enumerate(cluster_items(items, embedder, threshold)):
+        if cluster != i:
+            items[i]["duplicate_of"] = cluster
+            duplicates += 1
+    return duplicates
+
+
+def attach_prior_insights(items: list[dict], index: VectorIndex, min_score: float = 0.75) -> int:
+    """
+    Добавляет к элементам анализа prior_insight — самый похожий вывод прошлых запусков из индекса
+    (kind = insight), если косинус не меньше min_score. Возвращает число найденных
+    """
+    if not items or not len(index):
+        return 0
+    found = 0
+    vectors = index.embedder.embed([insight_text(item) for item in items])
+    for item, vector in zip(items, vectors):
+        hits = index.search_vector(vector, k=1, kind="insight", min_score=min_score)
+        if hits:
+            score, meta = hits[0]
+            item["prior_insight"] = {
+                "insight": meta.get("insight"),
+                "solution": meta.get("solution"),
+                "run_at": meta.get("run_at"),
+                "similarity": round(score, 3),
+            }
+            found += 1
+    return found
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+# относительное изменение v1/v2, ниже которого прошлый вывод по метрике считается актуальным
+DEFAULT_TOLERANCE = 0.01
+
+
+def prompt_fingerprint(*parts: str) -> str:
+    """
+    Отпечаток всего, что влияет на ответ модели помимо данных (модель, шаблон промпта, инструкции).
+    Если он изменился, прошлые выводы не переиспользуются
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode("utf8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def load_previous_report(path: str) -> dict | None:
+    """Прошлый отчет анализа, если он есть и читается"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf8") as f:
+            report = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Warning: Could not read previous report {path}: {e}")
+        return None
+    return report if isinstance(report, dict) else None
+
+
+def _value_close(current, previous, tolerance: float) -> bool:
+    try:
+        current, previous = float(current), float(previous)
+    except (TypeError, ValueError):
+        return current == previous
+    return abs(current - previous) <= tolerance * max(abs(current), abs(previous))
+
+
+def values_close(current: dict, previous: dict, tolerance: float = DEFAULT_TOLERANCE) -> bool:
+    """
+    Совпадают ли входные данные элемента с точностью tolerance: сравниваются v1_value и v2_value
+    метрики ({"v1_value", "v2_value", ...}) или каждой метрики цели/URL ({метрика: {...}})
+    """
+    if not isinstance(current, dict) or not isinstance(previous, dict):
+        return False
+    if "v1_value" in current:
+        return all(_value_close(current.get(f), previous.get(f), tolerance) for f in ("v1_value", "v2_value"))
+    return current.keys() == previous.keys() and all(
+        values_close(current[k], previous[k], tolerance) for k in current
+    )
+
+
+class IncrementalPlan:
+    """
+    Что отправить модели, а что взять из прошлого отчета.
+    changed — элементы входных данных, которые надо проанализировать заново;
+    reused — элементы analysis прошлого отчета для неизменившихся ключей;
+    snapshot — входные данные, на которых написаны выводы итогового отчета: для переиспользованных
+    ключей это прошлые значения, поэтому медленный дрейф копится и в какой-то момент превысит допуск
+    """
+
+    def __init__(self, fingerprint: str, reason: str | None = None):
+        self.fingerprint = fingerprint
+        self.reason = reason
+        self.changed: dict = {}
+        self.reused: list[dict] = []
+        self.snapshot: dict = {}
+        self.removed: list[str] = []
+
+    @property
+    def full(self) -> bool:
+        return self.reason is not None
+
+    def summary(self) -> dict:
+        data = {
+            "mode": "full" if self.full else "incremental",
+            "reanalyzed": len(self.changed),
+            "reused_keys": len(self.snapshot) - len(self.changed),
+            "reused_items": len(self.reused),
+            "removed": len(self.removed),
+        }
+        if self.reason:
+            data["reason"] = self.reason
+        return data
+
+    def finalize(self, report: dict) -> dict:
+        """Дописывает в итоговый отчет снимок входных данных и отпечаток — для следующего запуска"""
+        report["input_snapshot"] = self.snapshot
+        report["prompt_fingerprint"] = self.fingerprint
+        report["incremental"] = self.summary()
+        return report
+
+
+def plan_incremental(
+    current: dict[str, dict],
+    previous_report: dict | None,
+    item_key,
+    fingerprint: str,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> IncrementalPlan:
+    """
+    Сравнивает текущие входные данные ({ключ: данные метрики / цели / URL}) со снимком прошлого отчета.
+    item_key(item) -> ключ элемента analysis (например, item["metric"]).
+    Ключ переиспользуется, если данные в пределах tolerance и по нему в прошлом отчете есть выводы;
+    без прошлого отчета, снимка или при другом fingerprint — полный анализ
+    """
+    plan = IncrementalPlan(fingerprint)
+    if previous_report is None:
+        plan.reason = "no previous report"
+    elif "input_snapshot" not in previous_report:
+        plan.reason = "previous report has no input snapshot"
+    elif previous_report.get("prompt_fingerprint") != fingerprint:
+        plan.reason = "model or prompt changed"
+
+    if plan.full:
+        plan.changed = dict(current)
+        plan.snapshot = dict(current)
+        return plan
+
+    previous_snapshot = previous_report["input_snapshot"]
+    previous_items: dict[str, list[dict]] = {}
+    for item in previous_report.get("analysis", []):
+        key = item_key(item)
+        if key is not None:
+            previous_items.setdefault(str(key), []).append(item)
+
+    for key, data in current.items():
+        key = str(key)
+        previous = previous_snapshot.get(key)
+        if previous is not None and key in previous_items and values_close(data, previous, tolerance):
+            plan.reused.extend(previous_items[key])
+            plan.snapshot[key] = previous
+        else:
+            plan.changed[key] = data
+            plan.snapshot[key] = data
+
+    plan.removed = sorted(set(previous_snapshot) - set(map(str, current)))
+    return plan
@@ -0,0 +1,93 @@
+import json
+
+
+class AnalysisStreamParser:
+    """
+    Инкрементальный парсер ответа LLM вида {"analysis": [ {...}, {...} ]}.
+    Текст подается кусками через feed(), каждый элемент массива отдается сразу,
+    как только закрылась его фигурная скобка — не дожидаясь конца ответа.
+    Текст вокруг JSON (например, ```json) игнорируется
+    """
+
+    def __init__(self, array_key: str = "analysis"):
+        self.array_key = array_key
+        self.items = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_chars = []
+        self._last_key = None
+        self._array_depth = None
+        self._array_closed = False
+        self._item_chars = None
+
+    def feed(self, chunk: str) -> list[dict]:
+        """Обрабатывает очередной кусок текста, возвращает элементы, завершившиеся в нем"""
+        completed = []
+
+        for ch in chunk:
+            if self._item_chars is not None:
+                self._item_chars.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = "".join(self._key_chars)
+                elif self._depth == 1:
+                    self._key_chars.append(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._key_chars = []
+            elif ch in "{[":
+                if (
+                    ch == "{"
+                    and self._array_depth is not None
+                    and not self._array_closed
+                    and self._depth == self._array_depth
+                ):
+                    self._item_chars = [ch]
+                self._depth += 1
+                if ch == "[" and self._depth == 2 and self._last_key == self.array_key and self._array_depth is None:
+                    self._array_depth = 2
+            elif ch in "}]":
+                self._depth -= 1
+                if self._item_chars is not None and self._depth == self._array_depth:
+                    item = self._close_item()
+                    if item is not None:
+                        completed.append(item)
+                elif ch == "]" and self._array_depth is not None and self._depth == self._array_depth - 1:
+                    self._array_closed = True
+
+        return completed
+
+    def _close_item(self):
+        text = "".join(self._item_chars)
+        self._item_chars = None
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        self.items.append(item)
+        return item
+
+    @property
+    def complete(self) -> bool:
+        """Массив analysis закрыт — ответ не был обрезан посреди списка"""
+        return self._array_closed
+
+
+def recover_analysis_items(text: str, array_key: str = "analysis") -> list[dict]:
+    """
+    Достает все полностью сгенерированные элементы массива из ответа, который не парсится
+    целиком (обрезан по лимиту токенов, мусор после JSON и т.п.)
+    """
+    parser = AnalysisStreamParser(array_key)
+    parser.feed(text)
+    return parser.items
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from util.adk_custom_model_provider import API_ERRORS
+from util.json_stream import recover_analysis_items
+from util.resilience import CircuitOpenError
+
+
+def _as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _item_score(item: dict) -> float:
+    """
+    Вес элемента анализа для ранжирования: модуль relative_change.
+    Для целей (вложенный список metrics) — максимум по метрикам цели
+    """
+    if isinstance(item.get("metrics"), list) and item["metrics"]:
+        return max(abs(_as_float(m.get("relative_change"))) for m in item["metrics"])
+    return abs(_as_float(item.get("relative_change")))
+
+
+def merge_analysis(partials: list[list[dict]], key_fields: tuple[str, ...]) -> list[dict]:
+    """
+    Склеивает частичные массивы analysis в один отчет.
+    Дубликаты по key_fields (например, ("url", "metric")) отбрасываются — остается первый,
+    итог отсортирован по убыванию модуля изменения
+    """
+    merged = {}
+    for partial in partials:
+        for item in partial:
+            key = tuple(str(item.get(field)) for field in key_fields)
+            merged.setdefault(key, item)
+
+    return sorted(merged.values(), key=lambda item: (-_item_score(item), *(str(item.get(f)) for f in key_fields)))
+
+
+async def map_reduce_analysis(
+    payloads: list[str],
+    run_batch,
+    key_fields: tuple[str, ...],
+    max_concurrency: int = 4,
+) -> dict:
+    """
+    Map: каждый payload отправляется в run_batch (async, возвращает ответ LLM строкой),
+    одновременно не больше max_concurrency запросов (частоту запросов ограничивает
+    общий rate limiter провайдера).
+    Reduce: массивы analysis из ответов склеиваются через merge_analysis.
+    Из обрезанного ответа берутся все успевшие сгенерироваться элементы (батч попадает в truncated_batches),
+    батч с ошибкой запроса или без единого валидного элемента не роняет весь отчет, а попадает в failed_batches
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    truncated = []
+
+    async def _map(i: int, payload: str) -> list[dict] | None:
+        async with semaphore:
+            print(f"  Batch {i + 1}/{len(payloads)}...")
+            try:
+                output = await run_batch(payload)
+            except (*API_ERRORS, CircuitOpenError, TimeoutError) as e:
+                print(f"Error: LLM request failed for batch {i + 1}: {e}")
+                return None
+        try:
+            return json.loads(output).get("analysis", [])
+        except (json.JSONDecodeError, AttributeError):
+            recovered = recover_analysis_items(output)
+            if recovered:
+                print(f"Warning: Truncated response from LLM for batch {i + 1}, recovered {len(recovered)} items")
+                truncated.append(i)
+                return recovered
+            print(f"Error: Invalid response from LLM for batch {i + 1}")
+            return None
+
+    results = await asyncio.gather(*(_map(i, payload) for i, payload in enumerate(payloads)))
+
+    partials = [r for r in results if r is not None]
+    return {
+        "analysis": merge_analysis(partials, key_fields),
+        "batches_total": len(payloads),
+        "failed_batches": [i for i, r in enumerate(results) if r is None],
+        "truncated_batches": sorted(truncated),
+    }
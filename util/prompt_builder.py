@@ -0,0 +1,243 @@
+import math
+import re
+
+DEFAULT_TOKEN_BUDGET = 2000
+
+try:
+    import tiktoken
+
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _ENCODING = None
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_CYRILLIC_RE = re.compile(r"[а-яё]", re.IGNORECASE)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Оценка количества токенов в тексте.
+    Если установлен tiktoken — точный подсчет, иначе консервативная эвристика:
+    латиница ~4 символа на токен, кириллица ~2 символа на токен
+    """
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+
+    tokens = 0
+    for piece in _TOKEN_RE.findall(text):
+        chars_per_token = 2 if _CYRILLIC_RE.search(piece) else 4
+        tokens += max(1, math.ceil(len(piece) / chars_per_token))
+    return tokens
+
+
+def _fmt(value) -> str:
+    """Короткая запись числа: целые без дробной части, остальные — до 3 знаков"""
+    if value is None:
+        return ""
+    value = float(value)
+    if math.isnan(value):
+        return "nan"
+    if value.is_integer():
+        return str(int(value))
+    return f"{value:.3f}".rstrip("0").rstrip(".")
+
+
+def _fmt_change(value) -> str:
+    return f"{float(value):+.1f}"
+
+
+def _clean_cell(value) -> str:
+    """Убирает из текста разделители таблицы и переносы строк"""
+    if value is None:
+        return ""
+    return " ".join(str(value).replace("|", "/").split())
+
+
+def _fit_rows(header: str, blocks: list[list[str]], max_tokens: int, omitted_label: str) -> str:
+    """
+    Детерминированно добавляет блоки строк в порядке следования, пока укладываемся в бюджет.
+    Блок (например, цель со всеми ее метриками) добавляется целиком или не добавляется совсем.
+    Если что-то не поместилось — в конце добавляется строка с количеством опущенных блоков
+    """
+    lines = [header]
+    used = count_tokens(header)
+
+    for i, block in enumerate(blocks):
+        block_text = "\n".join(block)
+        block_tokens = count_tokens(block_text) + 1
+        remaining = len(blocks) - i - 1
+        trailer_tokens = count_tokens(f"... {omitted_label}: {remaining}") + 1 if remaining else 0
+
+        if used + block_tokens + trailer_tokens > max_tokens:
+            trailer = f"... {omitted_label}: {len(blocks) - i}"
+            if used + count_tokens(trailer) + 1 <= max_tokens:
+                lines.append(trailer)
+            break
+
+        lines.extend(block)
+        used += block_tokens
+
+    return "\n".join(lines)
+
+
+def build_metrics_payload(analysis: dict, max_tokens: int = DEFAULT_TOKEN_BUDGET) -> str:
+    """
+    Компактное представление результата _analyze_full_metrics_data для промпта.
+    Только значимые изменения, таблица через "|", строки отсортированы по модулю изменения
+    """
+    significant = analysis.get("significant_changes_20pct", {})
+    ordered = sorted(
+        significant.items(),
+        key=lambda kv: (-abs(kv[1]["change_percent"]), kv[0])
+    )
+
+    header = "metric|v1|v2|change_pct"
+    blocks = [
+        [f"{_clean_cell(metric)}|{_fmt(data['v1_value'])}|{_fmt(data['v2_value'])}|{_fmt_change(data['change_percent'])}"]
+        for metric, data in ordered
+    ]
+
+    return _fit_rows(header, blocks, max_tokens, "метрик опущено")
+
+
+def _normalize_goal_id(value):
+    """goal_id может прийти как int, float или строка — приводим к строке без .0"""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return str(int(value))
+    value = str(value).strip()
+    return value or None
+
+
+def _goal_blocks(goals_analysis: dict, goal_descriptions: dict | None) -> tuple[str, list[list[str]]]:
+    """
+    Строки таблицы по целям: только цели со значимыми изменениями (обе метрики цели)
+    и описания только этих целей. Цели отсортированы по максимальному модулю изменения
+    """
+    goal_descriptions = goal_descriptions or {}
+    comparison = goals_analysis.get("goals_comparison", {})
+    significant = goals_analysis.get("significant_goals", {})
+
+    ordered = sorted(
+        significant,
+        key=lambda goal_id: (
+            -max(abs(m["change_percent"]) for m in significant[goal_id].values()),
+            goal_id,
+        )
+    )
+
+    header = "goal_id|name|description|metric|v1|v2|change_pct"
+    blocks = []
+    for goal_id in ordered:
+        desc = goal_descriptions.get(_normalize_goal_id(goal_id), {})
+        name = _clean_cell(desc.get("name"))
+        description = _clean_cell(desc.get("description"))
+
+        block = []
+        for metric, data in sorted(comparison.get(goal_id, significant[goal_id]).items()):
+            block.append(
+                f"{goal_id}|{name}|{description}|{metric}|"
+                f"{_fmt(data['v1_value'])}|{_fmt(data['v2_value'])}|{_fmt_change(data['change_percent'])}"
+            )
+            # название и описание повторять в каждой строке цели незачем
+            name = description = ""
+        blocks.append(block)
+
+    return header, blocks
+
+
+def _url_blocks(url_analysis: dict) -> tuple[str, list[list[str]]]:
+    """
+    Строки таблицы по URL из результата _analyze_url_metrics_data.
+    Только значимые метрики. URL отсортированы по anomaly_score детектора аномалий,
+    если он есть, иначе по максимальному модулю изменения.
+    У страниц, сменивших адрес (url_aliases), рядом с новым URL указан старый
+    """
+    significant = url_analysis.get("significant_urls", {})
+    aliases = url_analysis.get("url_aliases", {})
+
+    def _weight(metric_data: dict) -> float:
+        return metric_data.get("anomaly_score", abs(metric_data["change_percent"]))
+
+    ordered = sorted(
+        significant,
+        key=lambda url: (-max(_weight(m) for m in significant[url].values()), url)
+    )
+
+    header = "url|metric|v1|v2|change_pct"
+    blocks = []
+    for url in ordered:
+        cell = _clean_cell(url)
+        if url in aliases:
+            cell = f"{cell} (v1: {_clean_cell(aliases[url]['url_v1'])})"
+        blocks.append([
+            f"{cell}|{metric}|"
+            f"{_fmt(data['v1_value'])}|{_fmt(data['v2_value'])}|{_fmt_change(data['change_percent'])}"
+            for metric, data in sorted(significant[url].items())
+        ])
+
+    return header, blocks
+
+
+def _shard_rows(header: str, blocks: list[list[str]], max_tokens: int) -> list[str]:
+    """
+    Раскладывает блоки строк по нескольким таблицам, каждая со своим заголовком и в пределах бюджета.
+    Порядок блоков сохраняется. Блок, который не влезает даже в пустую таблицу, обрезается через _fit_rows
+    """
+    header_tokens = count_tokens(header)
+    shards = []
+    current = []
+    used = header_tokens
+
+    for block in blocks:
+        block_tokens = count_tokens("\n".join(block)) + 1
+        if current and used + block_tokens > max_tokens:
+            shards.append("\n".join([header, *current]))
+            current = []
+            used = header_tokens
+        if header_tokens + block_tokens > max_tokens:
+            shards.append(_fit_rows(header, [[line] for line in block], max_tokens, "строк опущено"))
+            continue
+        current.extend(block)
+        used += block_tokens
+
+    if current:
+        shards.append("\n".join([header, *current]))
+    return shards
+
+
+def build_goals_payload(
+    goals_analysis: dict,
+    goal_descriptions: dict | None = None,
+    max_tokens: int = DEFAULT_TOKEN_BUDGET,
+) -> str:
+    """
+    Компактное представление результата _analyze_goals_data для промпта.
+    Все, что не влезло в бюджет, отбрасывается
+    """
+    header, blocks = _goal_blocks(goals_analysis, goal_descriptions)
+    return _fit_rows(header, blocks, max_tokens, "целей опущено")
+
+
+def build_goals_payloads(
+    goals_analysis: dict,
+    goal_descriptions: dict | None = None,
+    max_tokens: int = DEFAULT_TOKEN_BUDGET,
+) -> list[str]:
+    """
+    То же, что build_goals_payload, но без потерь: цели раскладываются по нескольким
+    промптам, каждый в пределах бюджета. Для map-reduce анализа
+    """
+    header, blocks = _goal_blocks(goals_analysis, goal_descriptions)
+    return _shard_rows(header, blocks, max_tokens)
+
+
+def build_url_payloads(url_analysis: dict, max_tokens: int = DEFAULT_TOKEN_BUDGET) -> list[str]:
+    """
+    Значимые изменения по URL, разложенные по промптам в пределах бюджета. Для map-reduce анализа
+    """
+    header, blocks = _url_blocks(url_analysis)
+    return _shard_rows(header, blocks, max_tokens)
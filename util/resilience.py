@@ -0,0 +1,103 @@
+import asyncio
+import random
+import time
+from contextlib import contextmanager
+
+
+class CircuitOpenError(RuntimeError):
+    """Запрос не отправлен: после серии ошибок провайдер временно считается недоступным"""
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket: не больше rate запросов в секунду в среднем,
+    всплеск до capacity. Один экземпляр делится между всеми конкурентными задачами
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        """Ждет, пока в ведре наберется tokens токенов, и забирает их. Возвращает время ожидания"""
+        waited = 0.0
+        # ожидающие встают в очередь на lock, поэтому токены раздаются по порядку прихода
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+
+                delay = (tokens - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+class CircuitBreaker:
+    """
+    Размыкается после failure_threshold ошибок подряд и reset_timeout секунд отклоняет запросы сразу.
+    Потом пропускает один пробный запрос: успех — замыкается, ошибка — снова размыкается
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self) -> bool:
+        """Пропускает вызов или бросает CircuitOpenError. True — вызов стал пробным в полуоткрытом состоянии"""
+        state = self.state
+        if state == "open" or (state == "half-open" and self._trial_in_flight):
+            raise CircuitOpenError(
+                f"Circuit is open after {self._failures} consecutive failures"
+            )
+        if state == "half-open":
+            self._trial_in_flight = True
+            return True
+        return False
+
+    @contextmanager
+    def guard(self):
+        """
+        before_call на время блока. Пробный запрос освобождается в любом случае: если блок отменен
+        или упал с ошибкой, которую не учли record_success/record_failure, размыкатель не залипает
+        """
+        trial = self.before_call()
+        try:
+            yield
+        finally:
+            if trial:
+                self._trial_in_flight = False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Экспоненциальная задержка с full jitter: случайное значение от 0 до min(cap, base * 2^attempt)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
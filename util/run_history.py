@@ -0,0 +1,302 @@
+import argparse
+import json
+import math
+import sqlite3
+import time
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from typing import Self
+
+HISTORY_DB = Path("data/history/run_history.sqlite")
+
+# запуски моложе этого хранятся целиком, старше — по одному на день (compact)
+KEEP_ALL_DAYS = 30
+RETENTION_DAYS = 365
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_at TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT,
+    meta TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_kind_time ON runs (kind, run_at);
+
+CREATE TABLE IF NOT EXISTS metric_snapshots (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    version TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS metric_snapshots_metric ON metric_snapshots (metric, version, run_id);
+CREATE INDEX IF NOT EXISTS metric_snapshots_run ON metric_snapshots (run_id);
+
+CREATE TABLE IF NOT EXISTS analysis_items (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    report TEXT NOT NULL,
+    metric TEXT,
+    goal_id TEXT,
+    url TEXT,
+    version_a REAL,
+    version_b REAL,
+    relative_change REAL,
+    insight TEXT,
+    solution TEXT,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analysis_items_metric ON analysis_items (metric, run_id);
+CREATE INDEX IF NOT EXISTS analysis_items_goal ON analysis_items (goal_id, run_id);
+CREATE INDEX IF NOT EXISTS analysis_items_url ON analysis_items (url, run_id);
+CREATE INDEX IF NOT EXISTS analysis_items_run ON analysis_items (run_id);
+"""
+
+
+def _now() -> str:
+    return datetime.now(UTC).isoformat(timespec="seconds")
+
+
+def _as_float(value) -> float | None:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+class RunHistory:
+    """
+    История запусков в SQLite: снимки full_metrics после ETL и элементы анализа LLM каждого запуска.
+    Записи только добавляются (WAL: дашборд читает, пока агент пишет); тренды по метрике, цели
+    или URL идут по индексам (metric|goal_id|url, run_id) и берут только последние N запусков.
+    Снимок после ETL из корня репозитория: python -m util.run_history record-metrics data/full_metrics.parquet
+    """
+
+    def __init__(self, path: Path | str = HISTORY_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _add_run(self, kind: str, source: str | None, meta: dict | None, run_at: str | None) -> int:
+        cur = self.conn.execute(
+            "INSERT INTO runs (run_at, kind, source, meta) VALUES (?, ?, ?, ?)",
+            (run_at or _now(), kind, source, json.dumps(meta, ensure_ascii=False) if meta else None),
+        )
+        return cur.lastrowid
+
+    def record_metrics(self, rows: list[dict], source: str | None = None, run_at: str | None = None,
+                       meta: dict | None = None) -> int:
+        """
+        Снимок метрик: rows — строки full_metrics ({"version": "v1", "bounce_rate": ..., ...}).
+        Сохраняются числовые колонки. Возвращает run_id
+        """
+        with self.conn:
+            run_id = self._add_run("metrics", source, meta, run_at)
+            self.conn.executemany(
+                "INSERT INTO metric_snapshots (run_id, metric, version, value) VALUES (?, ?, ?, ?)",
+                [
+                    (run_id, metric, str(row.get("version", i)), _as_float(value))
+                    for i, row in enumerate(rows)
+                    for metric, value in row.items()
+                    if metric != "version" and _as_float(value) is not None
+                ],
+            )
+        return run_id
+
+    def record_analysis(self, reports: dict[str, list[dict]], source: str | None = None,
+                        run_at: str | None = None, meta: dict | None = None) -> int:
+        """
+        Элементы анализа LLM одного запуска: reports — {"metrics": [...], "goals": [...], "urls": [...]}.
+        У целей метрики вложены в metrics — каждая становится отдельной строкой с goal_id
+        """
+        rows = []
+        for report, items in reports.items():
+            for item in items:
+                nested = item.get("metrics") if isinstance(item.get("metrics"), list) else [item]
+                for entry in nested:
+                    rows.append((
+                        report,
+                        entry.get("metric"),
+                        str(item["goal_id"]) if item.get("goal_id") is not None else None,
+                        item.get("url"),
+                        _as_float(entry.get("version_a")),
+                        _as_float(entry.get("version_b")),
+                        _as_float(entry.get("relative_change")),
+                        entry.get("insight"),
+                        entry.get("solution"),
+                        json.dumps(item, ensure_ascii=False),
+                    ))
+
+        with self.conn:
+            run_id = self._add_run("analysis", source, meta, run_at)
+            self.conn.executemany(
+                "INSERT INTO analysis_items (run_id, report, metric, goal_id, url, version_a, version_b, "
+                "relative_change, insight, solution, item) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, *row) for row in rows],
+            )
+        return run_id
+
+    def _last_runs(self, kind: str, last_runs: int) -> str:
+        """Подзапрос run_id последних last_runs запусков вида kind"""
+        return (
+            f"SELECT run_id FROM runs WHERE kind = '{kind}' "
+            f"ORDER BY run_at DESC, run_id DESC LIMIT {int(last_runs)}"
+        )
+
+    def metric_trend(self, metric: str, version: str | None = None, last_runs: int = 30) -> list[dict]:
+        """Значения метрики по последним last_runs снимкам: [{"run_at", "version", "value"}, ...] по времени"""
+        params = [metric]
+        version_filter = ""
+        if version is not None:
+            version_filter = "AND s.version = ?"
+            params.append(version)
+        rows = self.conn.execute(
+            f"""
+            SELECT r.run_at, s.version, s.value
+            FROM metric_snapshots s JOIN runs r USING (run_id)
+            WHERE s.metric = ? {version_filter} AND s.run_id IN ({self._last_runs("metrics", last_runs)})
+            ORDER BY r.run_at, r.run_id, s.version
+            """,
+            params,
+        )
+        return [dict(row) for row in rows]
+
+    def insight_history(self, metric: str | None = None, goal_id: str | None = None, url: str | None = None,
+                        report: str | None = None, last_runs: int = 30) -> list[dict]:
+        """
+        Выводы LLM по метрике / цели / URL за последние last_runs запусков анализа, по времени:
+        [{"run_at", "report", "metric", "goal_id", "url", "version_a", "version_b", "relative_change", "insight", "solution"}]
+        """
+        conditions, params = [], []
+        for column, value in (("metric", metric), ("goal_id", goal_id), ("url", url), ("report", report)):
+            if value is not None:
+                conditions.append(f"a.{column} = ?")
+                params.append(str(value))
+        where = " AND ".join([*conditions, f"a.run_id IN ({self._last_runs('analysis', last_runs)})"])
+        rows = self.conn.execute(
+            f"""
+            SELECT r.run_at, a.report, a.metric, a.goal_id, a.url, a.version_a, a.version_b,
+                   a.relative_change, a.insight, a.solution
+            FROM analysis_items a JOIN runs r USING (run_id)
+            WHERE {where}
+            ORDER BY r.run_at, r.run_id
+            """,
+            params,
+        )
+        return [dict(row) for row in rows]
+
+    def runs(self, kind: str | None = None, limit: int = 50) -> list[dict]:
+        """Последние запуски, новые первыми"""
+        kind_filter = "WHERE kind = ?" if kind else ""
+        rows = self.conn.execute(
+            f"SELECT run_id, run_at, kind, source, meta FROM runs {kind_filter} ORDER BY run_at DESC, run_id DESC LIMIT ?",
+            [kind, limit] if kind else [limit],
+        )
+        return [dict(row) for row in rows]
+
+    def compact(self, keep_all_days: int = KEEP_ALL_DAYS) -> int:
+        """
+        Прореживание: у запусков старше keep_all_days остается последний запуск каждого вида за день,
+        тренды на длинном горизонте сохраняются с дневной детализацией. Возвращает число удаленных запусков
+        """
+        cutoff = (datetime.now(UTC) - timedelta(days=keep_all_days)).isoformat(timespec="seconds")
+        with self.conn:
+            cur = self.conn.execute(
+                """
+                DELETE FROM runs WHERE run_at < ? AND run_id NOT IN (
+                    SELECT run_id FROM (
+                        SELECT run_id, ROW_NUMBER() OVER (
+                            PARTITION BY kind, substr(run_at, 1, 10) ORDER BY run_at DESC, run_id DESC
+                        ) AS rn
+                        FROM runs WHERE run_at < ?
+                    ) WHERE rn = 1
+                )
+                """,
+                (cutoff, cutoff),
+            )
+        return cur.rowcount
+
+    def apply_retention(self, max_age_days: int | None = RETENTION_DAYS, max_runs: int | None = None) -> int:
+        """Удаляет запуски старше max_age_days и сверх max_runs последних каждого вида; затем VACUUM"""
+        deleted = 0
+        with self.conn:
+            if max_age_days is not None:
+                cutoff = (datetime.now(UTC) - timedelta(days=max_age_days)).isoformat(timespec="seconds")
+                deleted += self.conn.execute("DELETE FROM runs WHERE run_at < ?", (cutoff,)).rowcount
+            if max_runs is not None:
+                deleted += self.conn.execute(
+                    """
+                    DELETE FROM runs WHERE run_id IN (
+                        SELECT run_id FROM (
+                            SELECT run_id, ROW_NUMBER() OVER (PARTITION BY kind ORDER BY run_at DESC, run_id DESC) AS rn
+                            FROM runs
+                        ) WHERE rn > ?
+                    )
+                    """,
+                    (max_runs,),
+                ).rowcount
+        if deleted:
+            self.conn.execute("VACUUM")
+        self.conn.execute("ANALYZE")
+        return deleted
+
+
+def read_metric_rows(metrics_file: str) -> list[dict]:
+    """Строки full_metrics.parquet как словари (через pyarrow, без pandas)"""
+    import pyarrow.parquet as pq
+
+    return pq.read_table(metrics_file).to_pylist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="История запусков ETL и анализа")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    record = sub.add_parser("record-metrics", help="записать снимок full_metrics.parquet")
+    record.add_argument("metrics_file")
+
+    trend = sub.add_parser("trend", help="тренд метрики по последним запускам")
+    trend.add_argument("metric")
+    trend.add_argument("--version", default=None)
+    trend.add_argument("--last-runs", type=int, default=30)
+
+    maintain = sub.add_parser("maintain", help="прореживание и удаление старых запусков")
+    maintain.add_argument("--keep-all-days", type=int, default=KEEP_ALL_DAYS)
+    maintain.add_argument("--max-age-days", type=int, default=RETENTION_DAYS)
+    maintain.add_argument("--max-runs", type=int, default=None)
+
+    parser.add_argument("--db", type=Path, default=HISTORY_DB)
+    args = parser.parse_args()
+
+    with RunHistory(args.db) as history:
+        if args.command == "record-metrics":
+            run_id = history.record_metrics(read_metric_rows(args.metrics_file), source=args.metrics_file)
+            print(f"Metrics snapshot saved to {args.db} (run {run_id})")
+        elif args.command == "trend":
+            t0 = time.perf_counter()
+            rows = history.metric_trend(args.metric, args.version, args.last_runs)
+            for row in rows:
+                print(f"{row['run_at']}  {row['version']}  {row['value']}")
+            print(f"{len(rows)} rows in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        else:
+            compacted = history.compact(args.keep_all_days)
+            deleted = history.apply_retention(args.max_age_days, args.max_runs)
+            print(f"Compacted {compacted} runs, deleted {deleted} runs by retention")
+
+
+if __name__ == "__main__":
+    main()
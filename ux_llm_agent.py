@@ -1,15 +1,53 @@
-import os
-import json
 import asyncio
+import json
+import os
+import time
+from datetime import UTC, datetime
+
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
 
+from mcp_ux_server import (
+    GOAL_ANOMALIES_FILE,
+    _analyze_full_metrics_data,
+    _analyze_goals_data,
+    _analyze_url_metrics_data,
+    _load_anomalies,
+    _load_full_metrics_analysis,
+    _load_goal_catalog_json,
+    _load_goal_descriptions,
+    _load_goals_analysis,
+    _load_parquet_summary_direct,
+    _load_run_history,
+    _load_url_alignment,
+    _load_url_metrics_analysis,
+    _read_parquet_df,
+    _search_ux_index,
+    _slice_metrics_cube,
+)
 from minimal_agents.agent import Agent
-from minimal_agents.runner import Runner
 from minimal_agents.run_config import RunConfig
-from util.adk_custom_model_provider import CustomModelProvider
-
-from mcp_ux_server import _load_full_metrics_analysis, _load_parquet_summary_direct, _load_goals_analysis, _read_excel_file
+from minimal_agents.runner import Runner
+from minimal_agents.tools import FunctionTool
+from minimal_agents.tracing import RunTracer
+from util.adk_custom_model_provider import CustomModelProvider, make_client
+from util.embeddings import (
+    VectorIndex,
+    annotate_clusters,
+    attach_prior_insights,
+    insight_text,
+)
+from util.incremental import load_previous_report, plan_incremental, prompt_fingerprint
+from util.json_stream import recover_analysis_items
+from util.map_reduce import map_reduce_analysis, merge_analysis
+from util.prompt_builder import (
+    _normalize_goal_id,
+    build_goals_payloads,
+    build_metrics_payload,
+    build_url_payloads,
+    count_tokens,
+)
+from util.resilience import TokenBucket
+from util.run_history import HISTORY_DB, RunHistory, read_metric_rows
 
 load_dotenv()
 folder_id = os.environ["folder_id"]
@@ -17,16 +55,56 @@ api_key = os.environ["api_key"]
 
 model = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
 
-client = AsyncOpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "2000"))
+MAP_REDUCE_CONCURRENCY = int(os.environ.get("MAP_REDUCE_CONCURRENCY", "4"))
+LLM_RPS = float(os.environ.get("LLM_RPS", "1"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "5"))
+LLM_TRACE_FILE = os.environ.get("LLM_TRACE_FILE", "ux_llm_calls.jsonl")
+UX_INDEX_DIR = os.environ.get("UX_INDEX_DIR", "data/index/ux")
+
+# INCREMENTAL_ANALYSIS=0 — всегда полный анализ; иначе модели уходят только изменившиеся метрики/цели/URL
+INCREMENTAL_ANALYSIS = os.environ.get("INCREMENTAL_ANALYSIS", "1") != "0"
+INCREMENTAL_TOLERANCE = float(os.environ.get("INCREMENTAL_TOLERANCE", "0.01"))
+
+# AGENT_MODE=tools — данные не вставляются в промпт, модель запрашивает нужные срезы через инструменты
+AGENT_MODE = os.environ.get("AGENT_MODE", "prompt")
+AGENT_MAX_TURNS = int(os.environ.get("AGENT_MAX_TURNS", "6"))
+AGENT_MAX_TOKENS = int(os.environ.get("AGENT_MAX_TOKENS", "60000"))
+
+METRICS_FILE = "data/full_metrics.parquet"
+GOALS_FILE = "data/goal_stats_common_v1_v2.parquet"
+GOALS_DESCRIPTIONS_FILE = "data/Цели ЯМетрика.xlsx"
+URL_METRICS_FILES = {
+    "v1": "data/metrics/url_metrics_v1.parquet",
+    "v2": "data/metrics/url_metrics_v2.parquet",
+}
+# таблицы, которые инструмент load_parquet_as_summary отдает модели целиком
+AGENT_DATASETS = {
+    "full_metrics": METRICS_FILE,
+    "goal_stats": GOALS_FILE,
+    "url_metrics_v1": URL_METRICS_FILES["v1"],
+    "url_metrics_v2": URL_METRICS_FILES["v2"],
+}
+
+METRICS_REPORT_FILE = "ux_metrics_analysis.json"
+GOALS_REPORT_FILE = "ux_goals_analysis.json"
+URLS_REPORT_FILE = "ux_urls_analysis.json"
+INSIGHT_HISTORY_LIMIT = int(os.environ.get("INSIGHT_HISTORY_LIMIT", "50000"))
+# RUN_HISTORY=0 — не записывать запуск в историю (util/run_history.py)
+RUN_HISTORY = os.environ.get("RUN_HISTORY", "1") != "0"
+RUN_HISTORY_DB = os.environ.get("RUN_HISTORY_DB", str(HISTORY_DB))
+
+client = make_client(
+    base_url=os.environ.get("LLM_BASE_URL", "https://rest-assistant.api.cloud.yandex.net/v1"),
     api_key=api_key,
-    project=folder_id
+    project=folder_id,
+    max_connections=MAP_REDUCE_CONCURRENCY * 2,
 )
 
 PROMPT_TEMPLATE_METRICS = """
 Ты — опытный UX аналитик. Ты получаешь данные сравнения двух версий продукта (V1 и V2).
 
-ДАННЫЕ ДЛЯ АНАЛИЗА:
+ДАННЫЕ ДЛЯ АНАЛИЗА (только метрики с изменением >20%, таблица через "|", change_pct — изменение V2 относительно V1 в процентах):
 {metrics_data}
 
 ТВОЯ ЗАДАЧА:
@@ -64,18 +142,14 @@ PROMPT_TEMPLATE_METRICS = """
 PROMPT_TEMPLATE_GOALS = """
 Ты — опытный UX аналитик. Ты получаешь данные по достижению целей на сайте для двух версий (V1 и V2).
 
-ДАННЫЕ ПО ЦЕЛЯМ:
+ДАННЫЕ ПО ЦЕЛЯМ С ОПИСАНИЯМИ (только цели с изменением >20%, таблица через "|", change_pct — изменение V2 относительно V1 в процентах):
 {goals_data}
 
-ОПИСАНИЯ ЦЕЛЕЙ:
-{goals_descriptions}
-
 ТВОЯ ЗАДАЧА:
-1. Сопоставить goal_id из данных с номерами целей из описаний
-2. Проанализировать изменения во времени достижения (avg_duration_sec) и количестве шагов (avg_steps) для каждой цели
-3. Выделить цели, где произошли значительные изменения (>20%)
-4. Проанализировать проблемы в пользовательском пути
-5. Предложить конкретные решения для улучшения конверсии
+1. Проанализировать изменения во времени достижения (avg_duration_sec) и количестве шагов (avg_steps) для каждой цели
+2. Выделить цели, где произошли значительные изменения (>20%)
+3. Проанализировать проблемы в пользовательском пути
+4. Предложить конкретные решения для улучшения конверсии
 
 ФОРМАТ ОТВЕТА ОБЯЗАТЕЛЕН:
 {{
@@ -109,13 +183,140 @@ PROMPT_TEMPLATE_GOALS = """
 }}
 
 ВАЖНО:
-- Сопоставляй goal_id из данных с колонкой "Номер цели" из Excel
-- Используй "Название цели" и "Описание" из Excel для названия и описания цели
+- Используй колонки name и description для названия и описания цели
 - Анализируй обе метрики (avg_steps и avg_duration_sec) для каждой цели
 - Фокусируйся на целях с изменениями >20%
 - Предлагай конкретные UX решения на основе типа цели
 """
 
+PROMPT_TEMPLATE_URLS = """
+Ты — опытный UX аналитик. Ты получаешь изменения метрик отдельных страниц сайта между двумя версиями (V1 и V2).
+
+ДАННЫЕ ПО СТРАНИЦАМ (только значимые изменения, отобранные детектором аномалий или порогом 20%, таблица через "|", change_pct — изменение V2 относительно V1 в процентах):
+{urls_data}
+
+Метрики: page_hits — просмотры страницы, page_visits — визиты с входом на страницу,
+bounce_rate — доля отказов среди входов на страницу (%), avg_pages_per_visit — просмотры на один вход,
+median_time_on_page_sec — медианное время на странице до следующего просмотра в том же визите (сек).
+
+ТВОЯ ЗАДАЧА:
+1. Для каждой страницы проанализировать изменения ее метрик
+2. Сформулировать проблему пользовательского опыта на этой странице
+3. Предложить конкретное решение для UI/UX дизайнера
+
+ФОРМАТ ОТВЕТА ОБЯЗАТЕЛЕН:
+{{
+  "analysis": [
+    {{
+      "url": "адрес_страницы",
+      "metric": "название_метрики",
+      "unit": "единица_измерения",
+      "version_a": число,
+      "version_b": число,
+      "relative_change": число,
+      "insight": "подробное описание проблемы",
+      "solution": "конкретное предложение для дизайнера"
+    }}
+  ]
+}}
+
+ВАЖНО:
+- url копируй из данных без изменений
+- version_a и version_b должны быть ЧИСЛАМИ (без единиц измерения)
+- Будь конкретен в решениях! Не пиши общие фразы.
+"""
+
+PROMPT_TEMPLATE_METRICS_TOOLS = """
+Ты — опытный UX аналитик. Сравни две версии продукта (V1 и V2) по общим метрикам.
+
+Данные в промпт не вложены — получи их инструментами, запрашивая только то, что нужно:
+- load_full_metrics_analysis() — сравнение всех метрик версий
+- slice_metrics_cube — срезы по устройствам, источникам трафика, новым пользователям, датам
+- load_url_metrics_analysis / search_ux_index — если нужно понять, на каких страницах изменение
+- load_run_history — как метрика менялась в прошлых запусках и что о ней уже писали
+Независимые запросы делай одним ходом — они выполняются параллельно.
+
+Проанализируй метрики: {metrics}
+
+ФОРМАТ ОТВЕТА ОБЯЗАТЕЛЕН:
+{{
+  "analysis": [
+    {{
+      "metric": "название_метрики",
+      "unit": "единица_измерения",
+      "version_a": число,
+      "version_b": число,
+      "relative_change": число,
+      "insight": "подробное описание проблемы",
+      "solution": "конкретное предложение для дизайнера"
+    }}
+  ]
+}}
+"""
+
+# Инструменты модели — обертки над функциями MCP без параметров-путей: файлы, индекс и история
+# фиксированы запуском, модель выбирает только срез данных и не может прочитать произвольный файл
+def _tool_full_metrics_analysis() -> str:
+    """Сравнение всех общих метрик версий V1 и V2"""
+    return _load_full_metrics_analysis(METRICS_FILE)
+
+
+def _tool_goals_analysis() -> str:
+    """Сравнение конверсий целей версий V1 и V2"""
+    return _load_goals_analysis(GOALS_FILE)
+
+
+def _tool_url_metrics_analysis() -> str:
+    """Сравнение метрик по URL версий V1 и V2 с аномалиями и соответствием URL"""
+    return _load_url_metrics_analysis(URL_METRICS_FILES["v1"], URL_METRICS_FILES["v2"])
+
+
+def _tool_parquet_summary(dataset: str) -> str:
+    """Таблица данных запуска целиком (JSON records): full_metrics, goal_stats, url_metrics_v1 или url_metrics_v2"""
+    if dataset not in AGENT_DATASETS:
+        raise ValueError(f"Unknown dataset: {dataset}. Available: {sorted(AGENT_DATASETS)}")
+    return _load_parquet_summary_direct(AGENT_DATASETS[dataset])
+
+
+def _tool_goal_catalog() -> str:
+    """Каталог целей: {"<goal_id>": {"name": ..., "description": ...}}"""
+    return _load_goal_catalog_json(GOALS_DESCRIPTIONS_FILE)
+
+
+def _tool_slice_metrics_cube(by: list[str] | None = None, filters: dict | None = None, limit: int = 100) -> str:
+    """
+    Срез куба метрик: суммы мер по версиям и измерениям by (date, is_new_user, landing_url,
+    traffic_source, device) при условиях filters ({"device": "mobile", "is_new_user": [0, 1]}) и доли из сумм
+    """
+    return _slice_metrics_cube(by=by, filters=filters, limit=limit)
+
+
+def _tool_search_ux_index(query: str, kind: str | None = None, k: int = 10) -> str:
+    """Ближайшие к query URL, цели и выводы прошлых запусков; kind — url, goal или insight"""
+    return _search_ux_index(query, kind=kind, k=k, index_dir=UX_INDEX_DIR)
+
+
+def _tool_run_history(metric: str | None = None, goal_id: str | None = None, url: str | None = None,
+                      last_runs: int = 10) -> str:
+    """Тренд метрики по прошлым запускам и выводы прошлых анализов по метрике, цели или URL"""
+    return _load_run_history(metric=metric, goal_id=goal_id, url=url, last_runs=last_runs, db_path=RUN_HISTORY_DB)
+
+
+UX_TOOLS = [
+    FunctionTool(_tool_full_metrics_analysis, name="load_full_metrics_analysis"),
+    FunctionTool(_tool_goals_analysis, name="load_goals_analysis"),
+    FunctionTool(_tool_url_metrics_analysis, name="load_url_metrics_analysis"),
+    FunctionTool(_tool_parquet_summary, name="load_parquet_as_summary", parameters={
+        "type": "object",
+        "properties": {"dataset": {"type": "string", "enum": list(AGENT_DATASETS)}},
+        "required": ["dataset"],
+    }),
+    FunctionTool(_tool_goal_catalog, name="load_goal_catalog"),
+    FunctionTool(_tool_slice_metrics_cube, name="slice_metrics_cube"),
+    FunctionTool(_tool_search_ux_index, name="search_ux_index"),
+    FunctionTool(_tool_run_history, name="load_run_history"),
+]
+
 agent = Agent(
     name="UX_Metrics_Analyzer",
     instructions="""Ты — эксперт по UX аналитике. Строго следуй правилам:
@@ -128,41 +329,275 @@ agent = Agent(
     model=model
 )
 
-rc = RunConfig(model_provider=CustomModelProvider(model, client))
+tool_agent = Agent(
+    name="UX_Metrics_Tool_Analyzer",
+    instructions=agent.instructions + "\n7. Данные получай через инструменты, не выдумывай значения",
+    model=model,
+    tools=UX_TOOLS,
+)
+
+rc = RunConfig(model_provider=CustomModelProvider(
+    model, client,
+    max_retries=LLM_MAX_RETRIES,
+    rate_limiter=TokenBucket(rate=LLM_RPS, capacity=MAP_REDUCE_CONCURRENCY),
+), tracer=RunTracer(LLM_TRACE_FILE))
+
+
+def partial_report_writer(path: str):
+    """
+    Callback для Runner.run_streamed: каждый готовый элемент analysis сразу дописывается
+    строкой в JSONL-файл, который дашборд показывает, пока анализ еще идет
+    """
+    open(path, "w", encoding="utf8").close()
+    started = time.monotonic()
+    written = 0
+
+    def on_item(item: dict):
+        nonlocal written
+        with open(path, "a", encoding="utf8") as f:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        written += 1
+        if written == 1:
+            print(f"First insight after {time.monotonic() - started:.1f}s")
+
+    return on_item
+
+
+def load_ux_index() -> VectorIndex | None:
+    """Индекс URL, целей и выводов прошлых запусков (см. update_ux_index), если он уже есть"""
+    try:
+        return VectorIndex.load(UX_INDEX_DIR)
+    except FileNotFoundError:
+        return None
+
+
+def postprocess_items(items: list[dict], prior_index: VectorIndex | None):
+    """
+    Помечает почти одинаковые выводы внутри отчета (duplicate_of) и прикладывает
+    похожие выводы прошлых запусков (prior_insight)
+    """
+    for item in items:
+        item.pop("duplicate_of", None)
+    duplicates = annotate_clusters(items)
+    # у переиспользованных выводов самый похожий прошлый вывод — они сами
+    fresh = [item for item in items if not item.get("reused")]
+    prior = attach_prior_insights(fresh, prior_index) if prior_index is not None else 0
+    print(f"  {duplicates} near-duplicate insights, {prior} matched to previous runs")
+
+
+def record_run_history(metrics_file: str, reports: dict[str, list[dict]]):
+    """
+    Дописывает запуск в историю: снимок full_metrics и все элементы отчетов,
+    затем прореживает и чистит старые запуски
+    """
+    with RunHistory(RUN_HISTORY_DB) as history:
+        run_at = datetime.now(UTC).isoformat(timespec="seconds")
+        history.record_metrics(read_metric_rows(metrics_file), source=metrics_file, run_at=run_at)
+        history.record_analysis(reports, source="ux_llm_agent", run_at=run_at, meta={"model": model, "mode": AGENT_MODE})
+        compacted = history.compact()
+        deleted = history.apply_retention()
+    items = sum(len(v) for v in reports.values())
+    print(f"Run saved to {RUN_HISTORY_DB} ({items} items; {compacted} runs compacted, {deleted} expired)")
+
+
+def update_ux_index(
+    reports: dict[str, list[dict]],
+    prior_index: VectorIndex | None,
+    url_files: list[str],
+    goals_descriptions_file: str,
+):
+    """
+    Пересобирает индекс: URL из url_metrics, цели из каталога и выводы — новые из reports
+    ({"metrics": [...], ...}) плюс история из прошлого индекса, не больше INSIGHT_HISTORY_LIMIT последних
+    """
+    urls = set()
+    for path in url_files:
+        if os.path.exists(path):
+            urls.update(_read_parquet_df(path)["url"].dropna().astype(str))
+    docs = [{"kind": "url", "key": url, "text": url} for url in sorted(urls)]
+
+    try:
+        for goal_id, goal in _load_goal_descriptions(goals_descriptions_file).items():
+            docs.append({"kind": "goal", "key": goal_id, "text": f"{goal['name']} {goal['description']}"})
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: Could not index goals descriptions: {e}")
+
+    run_at = datetime.now(UTC).isoformat()
+    insights = [m for m in prior_index.meta if m["kind"] == "insight"] if prior_index is not None else []
+    for report, items in reports.items():
+        for item in items:
+            if "duplicate_of" in item:
+                continue
+            insights.append({
+                "kind": "insight",
+                "report": report,
+                "key": item.get("url") or item.get("goal_id") or item.get("metric"),
+                "text": insight_text(item),
+                "insight": item.get("insight"),
+                "solution": item.get("solution"),
+                "run_at": run_at,
+            })
+    insights.sort(key=lambda m: m.get("run_at") or "", reverse=True)
+    latest = {}
+    for m in insights:
+        latest.setdefault((m.get("report"), m.get("key"), m["text"]), m)
+    docs.extend(list(latest.values())[:INSIGHT_HISTORY_LIMIT])
+
+    if docs:
+        VectorIndex.build(docs).save(UX_INDEX_DIR)
+        print(f"UX index saved to {UX_INDEX_DIR}: {len(docs)} vectors")
+
+
+def agent_fingerprint(runner_agent: Agent, template: str) -> str:
+    """
+    Отпечаток агента, который будет отвечать: модель, шаблон, инструкции, имена и схемы инструментов.
+    У агента без инструментов он прежний, так что выводы режима prompt остаются действительными
+    """
+    parts = [runner_agent.model, template, runner_agent.instructions]
+    if runner_agent.tools:
+        parts.append(json.dumps([tool.schema() for tool in runner_agent.tools], ensure_ascii=False, sort_keys=True))
+    return prompt_fingerprint(*parts)
+
+
+def plan_analysis(current: dict, report_file: str, template: str, item_key, runner_agent: Agent = agent):
+    """
+    Какие элементы отправить модели заново, а какие выводы взять из прошлого отчета report_file.
+    runner_agent — агент, который будет анализировать (в режиме tools — tool_agent).
+    Переиспользованные выводы помечаются reused
+    """
+    plan = plan_incremental(
+        current,
+        load_previous_report(report_file) if INCREMENTAL_ANALYSIS else None,
+        item_key=item_key,
+        fingerprint=agent_fingerprint(runner_agent, template),
+        tolerance=INCREMENTAL_TOLERANCE,
+    )
+    for item in plan.reused:
+        item["reused"] = True
+    print(f"Incremental plan: {plan.summary()}")
+    return plan
+
 
 async def run_metrics_analysis(metrics_file: str):
     print(f"Loading data from {metrics_file}...")
     
-    json_data = _load_full_metrics_analysis(metrics_file)
-    
-    data = json.loads(json_data)
-    
-    prompt = PROMPT_TEMPLATE_METRICS.format(
-        metrics_data=json_data
+    analysis = _analyze_full_metrics_data(_read_parquet_df(metrics_file), anomalies=_load_anomalies())
+    plan = plan_analysis(
+        analysis.get("significant_changes_20pct", {}), METRICS_REPORT_FILE,
+        PROMPT_TEMPLATE_METRICS_TOOLS if AGENT_MODE == "tools" else PROMPT_TEMPLATE_METRICS,
+        item_key=lambda item: item.get("metric"),
+        runner_agent=tool_agent if AGENT_MODE == "tools" else agent,
     )
 
-    print("Running LLM analysis...")
-    result = await Runner.run(agent, input=prompt, run_config=rc)
-    return result.final_output
+    report = {"analysis": []}
+    if plan.changed and AGENT_MODE == "tools":
+        prompt = PROMPT_TEMPLATE_METRICS_TOOLS.format(metrics=", ".join(plan.changed))
+        print("Running LLM analysis with tools...")
+        result = await Runner.run_with_tools(
+            tool_agent, input=prompt, run_config=rc, max_turns=AGENT_MAX_TURNS, max_tokens=AGENT_MAX_TOKENS
+        )
+        cached = sum(call["cached"] for call in result.tool_calls)
+        print(f"  {result.turns} turns, {len(result.tool_calls)} tool calls ({cached} from cache)")
+    elif plan.changed:
+        metrics_data = build_metrics_payload(
+            {**analysis, "significant_changes_20pct": plan.changed}, max_tokens=PROMPT_TOKEN_BUDGET
+        )
+        print(f"Prompt payload: {count_tokens(metrics_data)} tokens")
+
+        prompt = PROMPT_TEMPLATE_METRICS.format(
+            metrics_data=metrics_data
+        )
+
+        print("Running LLM analysis...")
+        result = await Runner.run_streamed(
+            agent, input=prompt, run_config=rc,
+            on_item=partial_report_writer("ux_metrics_analysis.partial.jsonl")
+        )
+
+    if plan.changed:
+        try:
+            report["analysis"] = json.loads(result.final_output).get("analysis", [])
+        except (json.JSONDecodeError, AttributeError):
+            report["analysis"] = recover_analysis_items(result.final_output)
+            if report["analysis"]:
+                report["truncated"] = True
+                print(f"Warning: Truncated response from LLM for metrics analysis, recovered {len(report['analysis'])} items")
+            else:
+                report["failed"] = True
+                print("Error: Invalid response from LLM for metrics analysis")
+
+    report["analysis"] = merge_analysis([report["analysis"], plan.reused], key_fields=("metric",))
+    return json.dumps(plan.finalize(report), ensure_ascii=False)
 
 async def run_goals_analysis(goals_file: str, goals_descriptions_file: str):
     print(f"Loading goals data from {goals_file}...")
-    goals_json_data = _load_goals_analysis(goals_file)
+    goals_analysis = _analyze_goals_data(
+        _read_parquet_df(goals_file), anomalies=_load_anomalies(GOAL_ANOMALIES_FILE)
+    )
 
     try:
-        goals_descriptions = _read_excel_file(goals_descriptions_file)
-    except Exception as e:
-        goals_descriptions = "Описания целей недоступны"
+        goals_descriptions = _load_goal_descriptions(goals_descriptions_file)
+    except (OSError, ValueError, KeyError) as e:
+        goals_descriptions = {}
         print(f"Warning: Could not load goals descriptions: {e}")
-    
-    prompt = PROMPT_TEMPLATE_GOALS.format(
-        goals_data=goals_json_data,
-        goals_descriptions=goals_descriptions
+
+    plan = plan_analysis(
+        goals_analysis.get("significant_goals", {}), GOALS_REPORT_FILE, PROMPT_TEMPLATE_GOALS,
+        item_key=lambda item: _normalize_goal_id(item.get("goal_id")),
     )
 
+    payloads = build_goals_payloads(
+        {**goals_analysis, "significant_goals": plan.changed}, goals_descriptions, max_tokens=PROMPT_TOKEN_BUDGET
+    )
+    print(f"Prompt payload: {sum(count_tokens(p) for p in payloads)} tokens in {len(payloads)} batches")
+
+    on_item = partial_report_writer("ux_goals_analysis.partial.jsonl")
+
+    async def run_batch(goals_data: str) -> str:
+        prompt = PROMPT_TEMPLATE_GOALS.format(goals_data=goals_data)
+        result = await Runner.run_streamed(agent, input=prompt, run_config=rc, on_item=on_item)
+        return result.final_output
+
     print("Running LLM goals analysis...")
-    result = await Runner.run(agent, input=prompt, run_config=rc)
-    return result.final_output
+    report = await map_reduce_analysis(
+        payloads, run_batch, key_fields=("goal_id",),
+        max_concurrency=MAP_REDUCE_CONCURRENCY
+    )
+    report["analysis"] = merge_analysis([report["analysis"], plan.reused], key_fields=("goal_id",))
+    return json.dumps(plan.finalize(report), ensure_ascii=False)
+
+async def run_url_analysis(url_metrics_v1_file: str, url_metrics_v2_file: str):
+    print(f"Loading URL metrics from {url_metrics_v1_file} and {url_metrics_v2_file}...")
+    url_analysis = _analyze_url_metrics_data(
+        _read_parquet_df(url_metrics_v1_file),
+        _read_parquet_df(url_metrics_v2_file),
+        anomalies=_load_anomalies(),
+        alignment=_load_url_alignment(),
+    )
+
+    plan = plan_analysis(
+        url_analysis["significant_urls"], URLS_REPORT_FILE, PROMPT_TEMPLATE_URLS,
+        item_key=lambda item: item.get("url"),
+    )
+
+    payloads = build_url_payloads({**url_analysis, "significant_urls": plan.changed}, max_tokens=PROMPT_TOKEN_BUDGET)
+    print(f"{url_analysis['significant_urls_count']} of {url_analysis['total_urls']} URLs changed "
+          f"({url_analysis['significance']}), {len(payloads)} batches")
+
+    on_item = partial_report_writer("ux_urls_analysis.partial.jsonl")
+
+    async def run_batch(urls_data: str) -> str:
+        prompt = PROMPT_TEMPLATE_URLS.format(urls_data=urls_data)
+        result = await Runner.run_streamed(agent, input=prompt, run_config=rc, on_item=on_item)
+        return result.final_output
+
+    print("Running LLM URL analysis...")
+    report = await map_reduce_analysis(
+        payloads, run_batch, key_fields=("url", "metric"),
+        max_concurrency=MAP_REDUCE_CONCURRENCY
+    )
+    report["analysis"] = merge_analysis([report["analysis"], plan.reused], key_fields=("url", "metric"))
+    return json.dumps(plan.finalize(report), ensure_ascii=False)
 
 async def run_analysis_simple(file_a: str, file_b: str):
     json_a = _load_parquet_summary_direct(file_a)
@@ -176,40 +611,66 @@ async def run_analysis_simple(file_a: str, file_b: str):
     result = await Runner.run(agent, input=prompt, run_config=rc)
     return result.final_output
 
-if __name__ == "__main__":
-    metrics_file = "data/full_metrics.parquet"
+def _write_report(path: str, report: dict):
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+async def main():
+    metrics_file = METRICS_FILE
     
     print("UX metrics analysis started")
-    
-    out_metrics = asyncio.run(run_metrics_analysis(metrics_file))
 
-    try:
-        parsed_metrics = json.loads(out_metrics)
-        with open("ux_metrics_analysis.json", "w", encoding="utf8") as f:
-            json.dump(parsed_metrics, f, ensure_ascii=False, indent=2)
-        
-        analysis_metrics = parsed_metrics.get("analysis", [])
-        total_metrics = len(analysis_metrics)
-                    
-    except json.JSONDecodeError:
-        print("Error: Invalid response from LLM for metrics analysis")
+    prior_index = load_ux_index()
+    reports = {}
+
+    out_metrics = await run_metrics_analysis(metrics_file)
 
-    goals_file = "data/goal_stats_common_v1_v2.parquet"
-    goals_descriptions_file = "data/Цели ЯМетрика.xlsx"
+    parsed_metrics = json.loads(out_metrics)
+    postprocess_items(parsed_metrics["analysis"], prior_index)
+    reports["metrics"] = parsed_metrics["analysis"]
+    await asyncio.to_thread(_write_report, METRICS_REPORT_FILE, parsed_metrics)
+
+    goals_file = GOALS_FILE
+    goals_descriptions_file = GOALS_DESCRIPTIONS_FILE
     
     print("\nUX goals analysis started")
     
-    out_goals = asyncio.run(run_goals_analysis(goals_file, goals_descriptions_file))
+    out_goals = await run_goals_analysis(goals_file, goals_descriptions_file)
 
     try:
         parsed_goals = json.loads(out_goals)
-        with open("ux_goals_analysis.json", "w", encoding="utf8") as f:
-            json.dump(parsed_goals, f, ensure_ascii=False, indent=2)
-        
-        analysis_goals = parsed_goals.get("analysis", [])
-        total_goals = len(analysis_goals)
-        
+        postprocess_items(parsed_goals.get("analysis", []), prior_index)
+        reports["goals"] = parsed_goals.get("analysis", [])
+        await asyncio.to_thread(_write_report, GOALS_REPORT_FILE, parsed_goals)
+
         print("Goals report saved to ux_goals_analysis.json")
                     
     except json.JSONDecodeError:
-        print("Error: Invalid response from LLM for goals analysis")
\ No newline at end of file
+        print("Error: Invalid response from LLM for goals analysis")
+
+    url_metrics_v1_file = URL_METRICS_FILES["v1"]
+    url_metrics_v2_file = URL_METRICS_FILES["v2"]
+
+    if os.path.exists(url_metrics_v1_file) and os.path.exists(url_metrics_v2_file):
+        print("\nUX URL analysis started")
+
+        out_urls = await run_url_analysis(url_metrics_v1_file, url_metrics_v2_file)
+        parsed_urls = json.loads(out_urls)
+        postprocess_items(parsed_urls["analysis"], prior_index)
+        reports["urls"] = parsed_urls["analysis"]
+        await asyncio.to_thread(_write_report, URLS_REPORT_FILE, parsed_urls)
+
+        print(f"URL report saved to ux_urls_analysis.json "
+              f"({len(parsed_urls['analysis'])} items, {len(parsed_urls['failed_batches'])} failed batches)")
+
+    update_ux_index(reports, prior_index, [url_metrics_v1_file, url_metrics_v2_file], goals_descriptions_file)
+    if RUN_HISTORY:
+        record_run_history(metrics_file, reports)
+
+    print(f"\nLLM calls summary (spans in {LLM_TRACE_FILE}):")
+    print(json.dumps(rc.tracer.summary(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())